@@ -4,93 +4,756 @@ Gestisce Excel come database con 18 tabelle (fogli)
 """
 
 import pandas as pd
+import numpy as np
+import streamlit as st
 import threading
 import contextlib
-from datetime import datetime
+from datetime import datetime, date
 import json
+import pickle
+import hashlib
+import zipfile
+import zlib
 import time
 import re
 import os
+import logging
+import warnings
 import shutil
 from pathlib import Path
 from datetime import datetime
 
 
 # --- Concorrenza / sicurezza scritture (Excel come DB) ---
-_PERSGEST_WRITE_LOCK = threading.RLock()
+# Lock lettori/scrittore per file dati:
+# - nello stesso processo (tutte le sessioni Streamlit): condition variable, attese bloccanti con
+#   timeout, precedenza agli scrittori in attesa, rientrante per il thread che scrive
+# - tra processi/postazioni: lock sul file <db>.lock (flock su Linux/macOS, LockFileEx su Windows)
+#   in modalita' condivisa o esclusiva, fuori dalla condition variable. Se il file e' occupato
+#   l'attesa e' quella bloccante del sistema operativo, in un thread di appoggio su un handle
+#   proprio (le chiamate bloccanti non hanno timeout): alla scadenza il thread viene abbandonato e,
+#   se poi ottiene il lock, lo rilascia subito. Senza chiamata bloccante (msvcrt.locking) si
+#   riprova con backoff esponenziale (5ms -> 200ms)
+# - uno scrittore in attesa del file tiene <db>.lock-pending: i lettori (anche quelli di questo
+#   processo che si aggiungono a un lock condiviso gia' preso) non entrano finche' non ha scritto
+# Per ogni punto di chiamata (site=) si registrano attesa, durata di possesso e contesa (lock_metrics()).
 
-@contextlib.contextmanager
-def _persgest_write_lock(db_path: Path, timeout: int = 120, poll: float = 0.1):
-    """Lock globale + lock su file (filesystem locale) per serializzare le scritture.
+def _win_lock_file_ex(fh, flags: int) -> bool:
+    """LockFileEx sul primo byte di fh (ImportError/AttributeError se ctypes/kernel32 mancano)."""
+    import ctypes
+    from ctypes import wintypes
+    import msvcrt
 
-    Implementazione senza dipendenze esterne:
-    - Windows: msvcrt.locking
-    - Linux/macOS: fcntl.flock
+    class _OVERLAPPED(ctypes.Structure):
+        _fields_ = [("Internal", ctypes.c_void_p), ("InternalHigh", ctypes.c_void_p),
+                    ("Offset", wintypes.DWORD), ("OffsetHigh", wintypes.DWORD), ("hEvent", wintypes.HANDLE)]
+
+    ov = _OVERLAPPED()
+    h = msvcrt.get_osfhandle(fh.fileno())
+    return bool(ctypes.windll.kernel32.LockFileEx(wintypes.HANDLE(h), flags, 0, 1, 0, ctypes.byref(ov)))
+
+
+def _file_lock_try(fh, exclusive: bool) -> bool:
+    """Prova a prendere il lock su file senza attendere (True se preso)."""
+    if os.name == "nt":
+        try:
+            return _win_lock_file_ex(fh, 0x1 | (0x2 if exclusive else 0))  # FAIL_IMMEDIATELY | EXCLUSIVE
+        except (ImportError, AttributeError):
+            import msvcrt
+            try:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                return False
+    import fcntl
+    try:
+        fcntl.flock(fh, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def _file_lock_blocking(fh, exclusive: bool):
+    """Prende il lock su file attendendo nel sistema operativo (nessun timeout).
+
+    NotImplementedError se manca una chiamata bloccante (msvcrt.locking riprova da solo a intervalli
+    di 1s per 10s: meglio il polling di _PathLock._poll).
+    """
+    if os.name == "nt":
+        try:
+            ok = _win_lock_file_ex(fh, 0x2 if exclusive else 0)  # senza FAIL_IMMEDIATELY: attende
+        except (ImportError, AttributeError):
+            raise NotImplementedError("LockFileEx non disponibile")
+        if not ok:
+            raise OSError(f"LockFileEx non riuscito: {fh.name}")
+        return
+    import fcntl
+    fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def _file_lock_wait(path: Path, exclusive: bool, deadline: float):
+    """Attende il lock su un nuovo handle di path fino a deadline; ritorna l'handle che lo tiene.
+
+    L'attesa bloccante gira in un thread di appoggio. Se il tempo scade il thread viene abbandonato
+    (TimeoutError): quando ottiene il lock lo rilascia subito e chiude il suo handle, senza toccare
+    gli handle di chi riprova.
     """
-    with _PERSGEST_WRITE_LOCK:
-        lock_file = db_path.with_suffix(db_path.suffix + ".lock")
-        lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fh = open(path, "a+b")
+    done = threading.Event()
+    guard = threading.Lock()
+    state = {"abandoned": False, "error": None}
 
-        f = open(lock_file, "a+b")
-        start = time.time()
-        locked = False
+    def _run():
         try:
-            while True:
+            _file_lock_blocking(fh, exclusive)
+        except BaseException as exc:
+            state["error"] = exc
+        with guard:
+            done.set()
+            abandoned = state["abandoned"]
+        if abandoned:
+            if state["error"] is None:
+                _file_unlock(fh)
+            fh.close()
+
+    threading.Thread(target=_run, name="persgest-filelock", daemon=True).start()
+    done.wait(max(0.0, deadline - time.time()))
+    with guard:
+        if not done.is_set():
+            state["abandoned"] = True
+    if state["abandoned"]:
+        raise TimeoutError(f"Timeout lock file: {path}")
+    if state["error"] is not None:
+        fh.close()
+        raise state["error"]
+    return fh
+
+
+def _file_unlock(fh):
+    try:
+        if os.name == "nt":
+            try:
+                import ctypes
+                from ctypes import wintypes
+                import msvcrt
+
+                class _OVERLAPPED(ctypes.Structure):
+                    _fields_ = [("Internal", ctypes.c_void_p), ("InternalHigh", ctypes.c_void_p),
+                                ("Offset", wintypes.DWORD), ("OffsetHigh", wintypes.DWORD), ("hEvent", wintypes.HANDLE)]
+
+                ov = _OVERLAPPED()
+                h = msvcrt.get_osfhandle(fh.fileno())
+                ctypes.windll.kernel32.UnlockFileEx(wintypes.HANDLE(h), 0, 1, 0, ctypes.byref(ov))
+            except (ImportError, AttributeError):
+                import msvcrt
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    except Exception:
+        pass
+
+
+class _PathLock:
+    """Lock lettori/scrittore (processo + file) per un singolo file dati."""
+
+    def __init__(self, lock_file: Path):
+        self.lock_file = lock_file
+        self.pending_file = lock_file.with_name(lock_file.name + "-pending")
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {}          # thread id -> profondita'
+        self.writer = None         # thread id
+        self.writer_depth = 0
+        self.waiting_writers = 0
+        self._fh = None
+        self._pending_fh = None
+        self._held_fh = None       # handle che tiene il lock su file (_fh o quello di _file_lock_wait)
+        self._file_mode = None     # None | 'sh' | 'ex'
+        self._file_busy = False    # un thread sta prendendo il lock su file (fuori dalla condition)
+        self._drain = False        # scrittore di un altro processo in attesa: niente nuovi lettori
+
+    def _wait(self, deadline: float):
+        if not self.cond.wait(max(0.0, deadline - time.time())):
+            raise TimeoutError(f"Timeout lock: {self.lock_file}")
+
+    def _open_files(self):
+        if self._fh is None:
+            self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = open(self.lock_file, "a+b")
+            self._pending_fh = open(self.pending_file, "a+b")
+
+    def _poll(self, fh, exclusive: bool, deadline: float) -> bool:
+        """Riprova il lock su file con backoff fino a deadline. Ritorna True se c'e' stata contesa."""
+        contended = False
+        delay = 0.005
+        while not _file_lock_try(fh, exclusive):
+            contended = True
+            if time.time() >= deadline:
+                raise TimeoutError(f"Timeout lock file: {self.lock_file}")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        return contended
+
+    def _take(self, path: Path, fh, exclusive: bool, deadline: float):
+        """Lock su file: subito su fh se libero, altrimenti attesa bloccante (polling se non disponibile).
+
+        Ritorna (handle che tiene il lock, contesa).
+        """
+        if _file_lock_try(fh, exclusive):
+            return fh, False
+        try:
+            return _file_lock_wait(path, exclusive, deadline), True
+        except NotImplementedError:
+            self._poll(fh, exclusive, deadline)
+            return fh, True
+
+    def _lock_file(self, exclusive: bool, deadline: float) -> bool:
+        """Prende il lock su file (senza la condition, con _file_busy impostato). True se contesa.
+
+        Come il lock PENDING di SQLite: si passa prima dal file -pending (esclusivo per chi scrive,
+        condiviso per chi legge) e lo si rilascia appena preso il lock principale. Uno scrittore in
+        attesa tiene il -pending, quindi nessun nuovo lettore di altri processi lo scavalca.
+        """
+        pending, contended = self._take(self.pending_file, self._pending_fh, exclusive, deadline)
+        try:
+            self._held_fh, main_contended = self._take(self.lock_file, self._fh, exclusive, deadline)
+        finally:
+            _file_unlock(pending)
+            if pending is not self._pending_fh:
+                pending.close()
+        self._file_mode = 'ex' if exclusive else 'sh'
+        return contended or main_contended
+
+    def _writer_pending_elsewhere(self) -> bool:
+        """True se uno scrittore di un altro processo tiene il -pending (chiamare con cond acquisita)."""
+        if not _file_lock_try(self._pending_fh, False):
+            return True
+        _file_unlock(self._pending_fh)
+        return False
+
+    def _unlock_file(self):
+        held, self._held_fh = self._held_fh, None
+        if held is not None and self._file_mode is not None:
+            _file_unlock(held)
+            if held is not self._fh:
+                held.close()
+        self._file_mode = None
+
+    def acquire(self, exclusive: bool, timeout: float) -> tuple[bool, bool]:
+        """Ritorna (contended, reentrant)."""
+        tid = threading.get_ident()
+        deadline = time.time() + timeout
+        with self.cond:
+            # rientro: chi scrive puo' rileggere/riscrivere; chi legge puo' rileggere
+            if self.writer == tid:
+                self.writer_depth += 1
+                return False, True
+            if not exclusive and tid in self.readers:
+                self.readers[tid] += 1
+                return False, True
+            if exclusive and tid in self.readers:
+                raise RuntimeError("Upgrade lock lettura -> scrittura non supportato")
+
+            contended = False
+            if exclusive:
+                self.waiting_writers += 1
                 try:
-                    if os.name == "nt":
-                        import msvcrt
-                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
-                    else:
-                        import fcntl
-                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    locked = True
-                    break
-                except OSError:
-                    if (time.time() - start) >= timeout:
-                        raise TimeoutError(f"Timeout lock file: {lock_file}")
-                    time.sleep(poll)
+                    while self.writer is not None or self.readers or self._file_busy:
+                        contended = True
+                        self._wait(deadline)
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = tid
+                self.writer_depth = 1
+            else:
+                while True:
+                    while (self.writer is not None or self.waiting_writers or self._file_busy
+                           or (self._drain and self.readers)):
+                        contended = True
+                        self._wait(deadline)
+                    if not self.readers:
+                        break
+                    # lock condiviso su file gia' preso per i lettori attivi: ci si aggiunge, a meno che
+                    # uno scrittore di un altro processo stia aspettando che il file si liberi
+                    if not self._writer_pending_elsewhere():
+                        self.readers[tid] = 1
+                        return contended, False
+                    self._drain = True
+            self._open_files()
+            self._file_busy = True
+
+        # attesa del lock su file fuori dalla condition: gli altri thread restano in cond.wait
+        # (con i loro timeout) invece di bloccarsi su acquire/release
+        try:
+            contended = self._lock_file(exclusive, deadline) or contended
+        except BaseException:
+            with self.cond:
+                self._file_busy = False
+                if exclusive:
+                    self.writer = None
+                    self.writer_depth = 0
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self._file_busy = False
+            if not exclusive:
+                self.readers[tid] = 1
+            self.cond.notify_all()
+        return contended, False
 
+    def release(self, exclusive: bool):
+        tid = threading.get_ident()
+        with self.cond:
+            if self.writer == tid:
+                self.writer_depth -= 1
+                if self.writer_depth == 0:
+                    self.writer = None
+                    self._unlock_file()
+                    self.cond.notify_all()
+                return
+            depth = self.readers.get(tid, 0) - 1
+            if depth > 0:
+                self.readers[tid] = depth
+                return
+            self.readers.pop(tid, None)
+            if not self.readers:
+                self._unlock_file()
+                self._drain = False
+                self.cond.notify_all()
+
+
+class _LockManager:
+    """Registro dei lock per file dati + metriche per punto di chiamata."""
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._stats = {}
+
+    def lock_for(self, db_path: Path) -> _PathLock:
+        lock_file = Path(db_path).with_suffix(Path(db_path).suffix + ".lock")
+        key = str(lock_file)
+        with self._guard:
+            lk = self._locks.get(key)
+            if lk is None:
+                lk = self._locks[key] = _PathLock(lock_file)
+            return lk
+
+    def record(self, site: str, mode: str, wait_s: float, hold_s: float, contended: bool, timeout: bool = False):
+        with self._guard:
+            st_ = self._stats.setdefault((site, mode), {
+                "count": 0, "contended": 0, "timeouts": 0,
+                "wait_total_s": 0.0, "wait_max_s": 0.0, "hold_total_s": 0.0, "hold_max_s": 0.0,
+            })
+            if timeout:
+                st_["timeouts"] += 1
+                st_["wait_max_s"] = max(st_["wait_max_s"], wait_s)
+                return
+            st_["count"] += 1
+            st_["contended"] += int(bool(contended))
+            st_["wait_total_s"] += wait_s
+            st_["wait_max_s"] = max(st_["wait_max_s"], wait_s)
+            st_["hold_total_s"] += hold_s
+            st_["hold_max_s"] = max(st_["hold_max_s"], hold_s)
+
+    def metrics(self) -> list[dict]:
+        with self._guard:
+            out = []
+            for (site, mode), v in sorted(self._stats.items()):
+                n = max(1, v["count"])
+                out.append({
+                    "site": site, "mode": mode, **v,
+                    "wait_avg_s": v["wait_total_s"] / n,
+                    "hold_avg_s": v["hold_total_s"] / n,
+                })
+            return out
+
+    @contextlib.contextmanager
+    def hold(self, db_path: Path, exclusive: bool, timeout: float, site: str):
+        mode = "ex" if exclusive else "sh"
+        lk = self.lock_for(db_path)
+        t0 = time.perf_counter()
+        try:
+            contended, reentrant = lk.acquire(exclusive, timeout)
+        except TimeoutError:
+            self.record(site, mode, time.perf_counter() - t0, 0.0, True, timeout=True)
+            raise
+        t1 = time.perf_counter()
+        try:
             yield
         finally:
-            if locked:
-                try:
-                    if os.name == "nt":
-                        import msvcrt
-                        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
-                    else:
-                        import fcntl
-                        fcntl.flock(f, fcntl.LOCK_UN)
-                except Exception:
-                    pass
+            lk.release(exclusive)
+            if not reentrant:
+                self.record(site, mode, t1 - t0, time.perf_counter() - t1, contended)
+
+
+_LOCKS = _LockManager()
+
+
+def lock_metrics() -> list[dict]:
+    """Metriche lock per punto di chiamata/modalita' (attesa, possesso, contesa, timeout)."""
+    return _LOCKS.metrics()
+
+
+@contextlib.contextmanager
+def _persgest_write_lock(db_path: Path, timeout: int = 120, *, site: str):
+    """Lock esclusivo (processo + file) per serializzare le scritture.
+
+    Implementazione senza dipendenze esterne:
+    - Windows: LockFileEx (msvcrt.locking se ctypes non disponibile)
+    - Linux/macOS: fcntl.flock
+    """
+    with _LOCKS.hold(db_path, True, timeout, site):
+        yield
+
+
+@contextlib.contextmanager
+def _persgest_read_lock(db_path: Path, timeout: int = 120, *, site: str):
+    """Lock condiviso: piu' lettori insieme, nessuna scrittura durante letture multi-tabella."""
+    with _LOCKS.hold(db_path, False, timeout, site):
+        yield
+
+
+# --- Backup deduplicati (content-addressed) ---
+# Ogni backup e' un piccolo manifest JSON (backups/manifests/<stem>_<timestamp>.json) con l'elenco
+# delle parti del file e il loro hash sha256; il contenuto di ogni parte e' salvato una sola volta
+# (compresso) in backups/objects/<hh>/<sha256>. Parti:
+#   - xlsx   : i membri dello zip (un foglio = xl/worksheets/sheetN.xml, piu' workbook/stili/stringhe)
+#   - sqlite : una parte per tabella (schema + righe + indici)
+# Un foglio che non cambia tra due salvataggi non occupa altro spazio; ogni versione si ricostruisce
+# per intero con _restore_backup.
+# Piu' processi possono condividere la cartella: un oggetto viene scritto (o ritoccato, se c'e' gia')
+# prima che esista il manifest che lo usa, quindi la pulizia elimina solo gli oggetti non referenziati
+# e non toccati da almeno BACKUP_OBJECT_GRACE_S secondi; dopo aver scritto il manifest il backup
+# riscrive comunque gli oggetti che fossero spariti nel frattempo.
+# Le copie integrali (file non scomponibile, backup di versioni precedenti dell'app) seguono la
+# stessa retention sugli ultimi BACKUP_KEEP_LAST.
+BACKUP_KEEP_LAST = 200
+BACKUP_OBJECT_GRACE_S = 3600
+
+
+def _backup_dirs(db_path: Path) -> tuple[Path, Path]:
+    backups_dir = db_path.parent / "backups"
+    return backups_dir / "objects", backups_dir / "manifests"
+
+
+def _sqlite_backup_parts(db_path: Path) -> list[tuple[str, bytes]]:
+    import sqlite3
+    conn = sqlite3.connect(str(db_path), timeout=120)
+    try:
+        parts = []
+        tables = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+        for name, sql in tables:
+            q = '"' + name.replace('"', '""') + '"'
+            rows = conn.execute(f"SELECT * FROM {q} ORDER BY rowid").fetchall()
+            indexes = [r[0] for r in conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL ORDER BY name", (name,)
+            )]
+            parts.append((name, pickle.dumps({"sql": sql, "rows": rows, "indexes": indexes}, protocol=4)))
+        return parts
+    finally:
+        conn.close()
+
+
+def _backup_parts(db_path: Path) -> list[tuple[str, bytes]]:
+    """Scompone il file dati nelle parti da salvare (ordine preservato)."""
+    if db_path.suffix.lower() == ".sqlite":
+        return _sqlite_backup_parts(db_path)
+    with zipfile.ZipFile(db_path) as zf:
+        return [(zi.filename, zf.read(zi)) for zi in zf.infolist()]
+
+
+def _backup_store_object(objects_dir: Path, data: bytes) -> str:
+    h = hashlib.sha256(data).hexdigest()
+    p = objects_dir / h[:2] / h
+    try:
+        # gia' presente: aggiorna mtime, cosi' la pulizia di un altro processo non lo considera vecchio
+        os.utime(p)
+        return h
+    except OSError:
+        pass
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(f"{h}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(zlib.compress(data, 6))
+    os.replace(str(tmp), str(p))
+    return h
+
+
+def _backup_excel(db_path: Path, keep_last: int = BACKUP_KEEP_LAST, source_path: Path | None = None,
+                  created: datetime | None = None):
+    """Backup best-effort del DB prima di una scrittura; retention sugli ultimi N backup.
+
+    source_path: copia/snapshot da cui leggere il contenuto (default: db_path stesso)
+    created: istante del backup (default: adesso)
+
+    Returns:
+        Path del manifest creato (None se non c'era nulla da salvare o in caso di errore)
+    """
+    try:
+        source_path = Path(source_path) if source_path is not None else db_path
+        if not source_path.exists():
+            return None
+        objects_dir, manifests_dir = _backup_dirs(db_path)
+        manifests_dir.mkdir(parents=True, exist_ok=True)
+        ts = created or datetime.now()
+
+        try:
+            parts = _backup_parts(source_path)
+        except Exception:
+            # file non scomponibile (es. xlsx corrotto): copia integrale come in passato
+            shutil.copy2(source_path, db_path.parent / "backups" / f"{db_path.stem}_{ts.strftime('%Y%m%d_%H%M%S')}{db_path.suffix}")
+            _prune_backups(db_path, keep_last)
+            return None
+
+        entries = []
+        for name, data in parts:
+            entries.append({"name": name, "sha256": _backup_store_object(objects_dir, data), "size": len(data)})
+
+        manifest = {
+            "created": ts.isoformat(timespec="seconds"),
+            "source": db_path.name,
+            "format": "sqlite" if db_path.suffix.lower() == ".sqlite" else "xlsx",
+            "parts": entries,
+        }
+        mp = manifests_dir / f"{db_path.stem}_{ts.strftime('%Y%m%d_%H%M%S_%f')}.json"
+        tmp = mp.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+        os.replace(str(tmp), str(mp))
+        # oggetti eliminati da una pulizia concorrente prima che il manifest esistesse
+        for (name, data), e in zip(parts, entries):
+            if not (objects_dir / e["sha256"][:2] / e["sha256"]).exists():
+                _backup_store_object(objects_dir, data)
+
+        _prune_backups(db_path, keep_last)
+        return mp
+    except Exception:
+        return None
+
+
+def _list_backup_manifests(db_path: Path) -> list[Path]:
+    """Manifest del DB, dal piu' recente (il nome contiene il timestamp: niente stat/sort per mtime)."""
+    _objects_dir, manifests_dir = _backup_dirs(db_path)
+    if not manifests_dir.exists():
+        return []
+    return sorted(manifests_dir.glob(f"{db_path.stem}_*.json"), key=lambda p: p.name, reverse=True)
+
+
+def _prune_backups(db_path: Path, keep_last: int):
+    """Retention: elimina i manifest e le copie integrali oltre keep_last e gli oggetti non piu'
+    referenziati (e non toccati da BACKUP_OBJECT_GRACE_S secondi: possono servire a un backup
+    in corso in un altro processo).
+
+    Per non rileggere tutti i manifest ad ogni salvataggio, la pulizia parte solo quando si
+    supera keep_last di almeno il 10%.
+    """
+    copies = sorted((p for p in (db_path.parent / "backups").glob(f"{db_path.stem}_*{db_path.suffix}") if p.is_file()),
+                    key=lambda p: p.name, reverse=True)
+    for old in copies[keep_last:]:
+        try:
+            old.unlink()
+        except Exception:
+            pass
+
+    manifests = _list_backup_manifests(db_path)
+    if len(manifests) <= keep_last + max(1, keep_last // 10):
+        return
+    for old in manifests[keep_last:]:
+        try:
+            old.unlink()
+        except Exception:
+            pass
+
+    objects_dir, manifests_dir = _backup_dirs(db_path)
+    referenced = set()
+    for mp in manifests_dir.glob("*.json"):
+        try:
+            for e in json.loads(mp.read_text(encoding="utf-8")).get("parts", []):
+                referenced.add(e.get("sha256"))
+        except Exception:
+            # manifest illeggibile: meglio non cancellare nulla
+            return
+    cutoff = time.time() - BACKUP_OBJECT_GRACE_S
+    for obj in objects_dir.glob("*/*"):
+        # .tmp piu' vecchi della soglia: scritture interrotte
+        if obj.name not in referenced:
             try:
-                f.close()
+                if obj.stat().st_mtime < cutoff:
+                    obj.unlink()
             except Exception:
                 pass
 
-def _backup_excel(db_path: Path, keep_last: int = 200):
-    """Backup best-effort del DB prima di una scrittura; retention sugli ultimi N backup."""
+
+def _restore_backup(manifest_path: Path, dest_path: Path) -> Path:
+    """Ricostruisce il file completo (xlsx o sqlite) descritto da un manifest."""
+    manifest_path = Path(manifest_path)
+    dest_path = Path(dest_path)
+    objects_dir = manifest_path.parent.parent / "objects"
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+
+    def _load(h):
+        data = zlib.decompress((objects_dir / h[:2] / h).read_bytes())
+        if hashlib.sha256(data).hexdigest() != h:
+            raise RuntimeError(f"Backup danneggiato: oggetto {h}")
+        return data
+
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _tmp_path_for(dest_path)
     try:
-        if not db_path.exists():
+        if manifest.get("format") == "sqlite":
+            import sqlite3
+            if tmp.exists():
+                tmp.unlink()
+            conn = sqlite3.connect(str(tmp))
+            try:
+                with conn:
+                    for e in manifest.get("parts", []):
+                        part = pickle.loads(_load(e["sha256"]))
+                        conn.execute(part["sql"])
+                        if part["rows"]:
+                            ph = ", ".join("?" for _ in part["rows"][0])
+                            q = '"' + e["name"].replace('"', '""') + '"'
+                            conn.executemany(f"INSERT INTO {q} VALUES ({ph})", part["rows"])
+                        for sql in part.get("indexes", []):
+                            conn.execute(sql)
+            finally:
+                conn.close()
+        else:
+            with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                for e in manifest.get("parts", []):
+                    zf.writestr(e["name"], _load(e["sha256"]))
+        _atomic_replace(tmp, dest_path)
+    finally:
+        try:
+            if tmp.exists():
+                tmp.unlink()
+        except Exception:
+            pass
+    return dest_path
+
+
+# --- Backup in background ---
+# Sotto write lock si fa solo uno snapshot della versione corrente in backups/pending/
+# (hard link: istantaneo, il file originale viene poi sostituito da os.replace; se il filesystem
+# non supporta i link, o per SQLite che scrive sul posto, copia). La scomposizione/deduplica
+# (_backup_excel) la fa un thread di background. Snapshot rimasti in pending (es. app chiusa)
+# vengono ripresi al successivo avvio del worker.
+_BACKUP_PENDING_DIRNAME = "pending"
+
+
+class _BackupWorker:
+    """Coda backup per processo, con metriche (durate, profondita' coda, errori)."""
+
+    def __init__(self):
+        import queue
+        from collections import deque
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._durations = deque(maxlen=200)
+        self._snapshot_durations = deque(maxlen=200)
+        self.processed = 0
+        self.failed = 0
+        self.max_queue = 0
+        self.last_error = ""
+        self._recovered = set()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="persgest-backup", daemon=True)
+                self._thread.start()
+
+    def record_snapshot(self, seconds: float):
+        with self._stats_lock:
+            self._snapshot_durations.append(seconds)
+
+    def submit(self, db_path: Path, snapshot: Path, created: datetime, keep_last: int = BACKUP_KEEP_LAST):
+        self._queue.put((Path(db_path), Path(snapshot), created, keep_last))
+        with self._stats_lock:
+            self.max_queue = max(self.max_queue, self._queue.qsize())
+        self._ensure_started()
+
+    def recover_pending(self, db_path: Path):
+        """Rimette in coda gli snapshot non ancora elaborati (una volta per file dati)."""
+        key = str(db_path)
+        if key in self._recovered:
             return
-        backups_dir = db_path.parent / "backups"
-        backups_dir.mkdir(parents=True, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = backups_dir / f"{db_path.stem}_{ts}{db_path.suffix}"
-        shutil.copy2(db_path, backup_path)
+        self._recovered.add(key)
+        pending_dir = db_path.parent / "backups" / _BACKUP_PENDING_DIRNAME
+        if not pending_dir.exists():
+            return
+        for snap in sorted(pending_dir.glob(f"{db_path.stem}_*{db_path.suffix}")):
+            try:
+                created = datetime.strptime(snap.stem[len(db_path.stem) + 1:], "%Y%m%d_%H%M%S_%f")
+            except Exception:
+                created = datetime.fromtimestamp(snap.stat().st_mtime)
+            self.submit(db_path, snap, created)
 
-        # retention
-        try:
-            backups = sorted([p for p in backups_dir.glob(f"{db_path.stem}_*{db_path.suffix}") if p.is_file()],
-                             key=lambda p: p.stat().st_mtime, reverse=True)
-            for old in backups[keep_last:]:
+    def _run(self):
+        while True:
+            db_path, snap, created, keep_last = self._queue.get()
+            t0 = time.perf_counter()
+            try:
+                _backup_excel(db_path, keep_last=keep_last, source_path=snap, created=created)
                 try:
-                    old.unlink()
-                except Exception:
+                    snap.unlink()
+                except FileNotFoundError:
                     pass
-        except Exception:
-            pass
-    except Exception:
-        pass
+                with self._stats_lock:
+                    self.processed += 1
+                    self._durations.append(time.perf_counter() - t0)
+            except Exception as e:
+                with self._stats_lock:
+                    self.failed += 1
+                    self.last_error = str(e)
+            finally:
+                self._queue.task_done()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Attende lo svuotamento della coda (True se vuota entro timeout)."""
+        end = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            d = list(self._durations)
+            sd = list(self._snapshot_durations)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue,
+                "processed": self.processed,
+                "failed": self.failed,
+                "last_error": self.last_error,
+                "backup_avg_s": (sum(d) / len(d)) if d else 0.0,
+                "backup_max_s": max(d) if d else 0.0,
+                "backup_last_s": d[-1] if d else 0.0,
+                "snapshot_avg_s": (sum(sd) / len(sd)) if sd else 0.0,
+                "snapshot_max_s": max(sd) if sd else 0.0,
+            }
+
+
+_BACKUP_WORKER = _BackupWorker()
+
+
+def backup_metrics() -> dict:
+    """Metriche dei backup in background (durate, coda, errori) per questo processo."""
+    return _BACKUP_WORKER.metrics()
+
+
+def _tmp_path_for(path: Path) -> Path:
+    """File temporaneo accanto a path, con la stessa estensione (openpyxl valida l'estensione)."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.tmp{path.suffix}")
+
 
 def _atomic_replace(tmp_path: Path, final_path: Path):
     """Sostituisce final_path con tmp_path in modo atomico (locale)."""
@@ -100,18 +763,75 @@ def _atomic_replace(tmp_path: Path, final_path: Path):
 def _meta_path_for(db_path: Path) -> Path:
     return db_path.with_name("db_meta.json")
 
-def _bump_db_version(db_path: Path):
-    """Incrementa un contatore versione DB (utile per cache/invalidation)."""
+def current_session_id() -> str:
+    """Id sessione Streamlit corrente ('' fuori da una sessione, es. thread di background)."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return ctx.session_id if ctx else ""
+    except Exception:
+        return ""
+
+
+def _read_db_meta(db_path: Path) -> dict:
+    """Legge db_meta.json ({} se assente/illeggibile)."""
     try:
         mp = _meta_path_for(db_path)
-        meta = {}
         if mp.exists():
-            try:
-                meta = json.loads(mp.read_text(encoding="utf-8"))
-            except Exception:
-                meta = {}
+            meta = json.loads(mp.read_text(encoding="utf-8"))
+            return meta if isinstance(meta, dict) else {}
+    except Exception:
+        pass
+    return {}
+
+
+def _bump_db_version(db_path: Path, tables=(), storage_path: Path | None = None, sig_before: tuple | None = None):
+    """Incrementa i contatori versione DB (utile per cache/invalidation).
+
+    - db_version: contatore globale (qualsiasi scrittura)
+    - table_versions: contatore per tabella, solo per le tabelle scritte
+    - table_last_write / table_last_writer: ora e sessione dell'ultima scrittura per tabella
+    - storage_sig: firma (mtime/size) del file dati dopo la scrittura; se prima della scrittura
+      il file non corrispondeva piu' alla firma registrata (modifica esterna, es. Excel aperto a mano)
+      si incrementa epoch, che invalida le cache di tutte le tabelle.
+    - table_sigs: firma del file dopo l'ultima scrittura di ogni tabella; base_sig: firma del file
+      da cui vengono le tabelle non ancora scritte (alla creazione di db_meta.json o a un cambio di
+      epoch). Entrano nella chiave delle cache su disco: se db_meta.json viene perso o ripristinato
+      i contatori possono tornare a valori gia' usati, le firme no.
+    """
+    try:
+        mp = _meta_path_for(db_path)
+        meta = _read_db_meta(db_path)
+        now = datetime.now().isoformat(timespec="seconds")
         meta["db_version"] = int(meta.get("db_version", 0)) + 1
-        meta["last_write_ts"] = datetime.now().isoformat(timespec="seconds")
+        meta["last_write_ts"] = now
+
+        tv, tw, tb = ({} if not isinstance(meta.get(k), dict) else meta[k]
+                      for k in ("table_versions", "table_last_write", "table_last_writer"))
+        writer = current_session_id()
+        for t in tables:
+            tv[t] = int(tv.get(t, 0)) + 1
+            tw[t] = now
+            tb[t] = writer
+        meta["table_versions"] = tv
+        meta["table_last_write"] = tw
+        meta["table_last_writer"] = tb
+
+        if storage_path is not None:
+            prev = meta.get("storage_sig")
+            if prev is not None and sig_before is not None and list(sig_before) != list(prev):
+                meta["epoch"] = int(meta.get("epoch", 0)) + 1
+                meta.pop("base_sig", None)
+                meta.pop("table_sigs", None)
+            if not meta.get("base_sig"):
+                meta["base_sig"] = list(sig_before) if sig_before is not None else prev
+            sig = list(_source_signature(storage_path))
+            meta["storage_sig"] = sig
+            ts = meta.get("table_sigs") if isinstance(meta.get("table_sigs"), dict) else {}
+            for t in tables:
+                ts[t] = sig
+            meta["table_sigs"] = ts
+
         tmp = mp.with_suffix(".tmp")
         tmp.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
         os.replace(str(tmp), str(mp))
@@ -119,71 +839,805 @@ def _bump_db_version(db_path: Path):
         pass
 
 
+def _table_version_key(db_path: Path, storage_path: Path, table: str, meta: dict | None = None) -> tuple:
+    """Chiave di versione di una tabella: (epoch, versione tabella, firma file se modificato da fuori,
+    firma del file all'ultima scrittura della tabella).
 
-def _excel_engine_for_name(name: str | None) -> str | None:
-    """Best-effort engine selection for pandas Excel readers.
+    Finche' il file dati corrisponde alla firma registrata dall'ultima scrittura dell'app,
+    la chiave cambia solo quando cambia quella tabella.
+    """
+    if meta is None:
+        meta = _read_db_meta(db_path)
+    sig = _source_signature(storage_path)
+    rec = meta.get("storage_sig")
+    ext = None if (rec is not None and list(rec) == list(sig)) else tuple(sig)
+    tv = meta.get("table_versions") if isinstance(meta.get("table_versions"), dict) else {}
+    ts = meta.get("table_sigs") if isinstance(meta.get("table_sigs"), dict) else {}
+    wsig = ts.get(table) or meta.get("base_sig") or sig
+    return (int(meta.get("epoch", 0)), int(tv.get(table, 0)), ext, tuple(wsig))
 
-    Pandas may fail to infer the engine when the input is a file-like object
-    (e.g. Streamlit UploadedFile) or when the file has a non-standard extension.
+
+# --- Cache su disco per tabella (sidecar) ---
+# Un file pickle per foglio in persgest_cache/, accanto al DB: <tabella>.v<epoch>_<versione>_<firma>.pkl
+# (firma: hash breve della firma del file dati all'ultima scrittura della tabella, vedi _bump_db_version).
+# Contiene il DataFrame gia' normalizzato (dtype inclusi) + la chiave di versione completa
+# (vedi _table_version_key), cosi' una modifica fatta a mano in Excel invalida comunque la cache.
+_SIDECAR_DIRNAME = "persgest_cache"
+
+
+def _sidecar_dir_for(db_path: Path) -> Path:
+    return db_path.parent / _SIDECAR_DIRNAME
+
+
+def _source_signature(path: Path) -> tuple:
+    try:
+        stt = Path(path).stat()
+        return (stt.st_mtime_ns, stt.st_size)
+    except Exception:
+        return (0, 0)
+
+
+def _sidecar_version_tag(key: tuple) -> str:
+    """Parte del nome file dei sidecar: versione + firma del file dati (vedi _table_version_key).
+
+    Nell'hash entrano anche i tipi di SCHEMA_COLUMN_TYPES: una cache scritta con tipi diversi
+    (es. minuti float32 delle versioni precedenti) non viene riusata.
     """
-    if not name:
-        return None
-    suffix = Path(str(name)).suffix.lower()
-    if suffix in {'.xlsx', '.xlsm', '.xltx', '.xltm'}:
-        return 'openpyxl'
-    # .xls requires xlrd (often not installed). Prefer converting to .xlsx.
-    if suffix == '.xls':
-        return 'xlrd'
-    if suffix == '.xlsb':
-        return 'pyxlsb'
-    if suffix == '.ods':
-        return 'odf'
-    return None
+    wsig = hashlib.sha1(repr((tuple(key[3:]), sorted(SCHEMA_COLUMN_TYPES.items()))).encode("utf-8")).hexdigest()[:10]
+    return f"v{int(key[0])}_{int(key[1])}_{wsig}"
 
 
-def _excel_engine_for_obj(obj) -> str | None:
-    """Try to determine the engine from a path or Streamlit UploadedFile."""
+def _sidecar_path(db_path: Path, table: str, key: tuple) -> Path:
+    return _sidecar_dir_for(db_path) / f"{table}.{_sidecar_version_tag(key)}.pkl"
+
+
+def _sidecar_load(db_path: Path, table: str, key: tuple):
+    """Ritorna il DataFrame in cache per (tabella, chiave versione) oppure None."""
     try:
-        if isinstance(obj, (str, Path)):
-            return _excel_engine_for_name(str(obj))
-        name = getattr(obj, 'name', None)
-        return _excel_engine_for_name(name)
+        p = _sidecar_path(db_path, table, key)
+        if not p.exists():
+            return None
+        with open(p, "rb") as f:
+            payload = pickle.load(f)
+        if tuple(payload.get("key", ())) != tuple(key):
+            return None
+        df = payload.get("df")
+        return df if isinstance(df, pd.DataFrame) else None
     except Exception:
         return None
-import streamlit as st
 
-# ============================
-# Import robusto (anche senza intestazioni)
-# ============================
 
-def _safe_str(x) -> str:
-    if pd.isna(x):
-        return ""
+def _sidecar_store(db_path: Path, table: str, key: tuple, df: pd.DataFrame):
+    """Salva best-effort la cache della tabella e rimuove quelle di versioni precedenti."""
     try:
-        return str(x).strip()
+        d = _sidecar_dir_for(db_path)
+        d.mkdir(parents=True, exist_ok=True)
+        p = _sidecar_path(db_path, table, key)
+        tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump({"key": tuple(key), "df": df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp), str(p))
+
+        for old in d.glob(f"{table}.v*.pkl"):
+            if old != p:
+                try:
+                    old.unlink()
+                except Exception:
+                    pass
     except Exception:
-        return ""
+        pass
 
-def _series_date_score(s: pd.Series) -> float:
-    """Ritorna una score [0..1] di quanto la serie sembri una data."""
-    if s is None or len(s) == 0:
-        return 0.0
-    dt = pd.to_datetime(s, errors='coerce', dayfirst=True)
-    ok = dt.notna().mean()
-    if ok == 0:
-        return 0.0
-    # penalizza date fuori range
-    years = dt.dropna().dt.year
-    if len(years) == 0:
-        return 0.0
-    in_range = ((years >= 2000) & (years <= 2100)).mean()
-    return float(ok * in_range)
 
-def _series_numeric_score(s: pd.Series) -> float:
-    if s is None or len(s) == 0:
-        return 0.0
-    num = pd.to_numeric(s, errors='coerce')
-    ok = num.notna().mean()
+
+# --- Partizioni mensili (cache su disco) ---
+# Le tabelle di PARTITIONED_TABLES (Attivita) hanno, accanto alla cache completa, una cartella
+# persgest_cache/<tabella>.parts.v<epoch>_<versione>_<firma>/ con un pickle per mese (YYYY-MM.pkl, righe
+# senza data in nodate.pkl) e un manifest.json con righe, data min/max e hash di ogni mese.
+# get_all con filtro date legge solo i mesi che si sovrappongono all'intervallo; alla nuova versione
+# i mesi con lo stesso contenuto (stesso hash) vengono ricollegati, non riscritti.
+# Il foglio Excel / la tabella SQLite restano unici (formato di import/export).
+PARTITIONED_TABLES = {'Attivita': 'data'}
+_PARTITION_NODATE = "nodate"
+
+
+def _partition_dir(db_path: Path, table: str, key: tuple) -> Path:
+    return _sidecar_dir_for(db_path) / f"{table}.parts.{_sidecar_version_tag(key)}"
+
+
+def _partition_key(key: tuple) -> list:
+    """Chiave versione come salvata nel manifest (JSON: le tuple diventano liste)."""
+    return json.loads(json.dumps(list(key), default=str))
+
+
+def _partition_manifest(pdir: Path) -> dict | None:
+    try:
+        with open(pdir / "manifest.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _partition_hash(seg: pd.DataFrame) -> str:
+    h = hashlib.sha1(pd.util.hash_pandas_object(seg, index=True).to_numpy().tobytes())
+    h.update(repr([(str(c), str(t)) for c, t in seg.dtypes.items()]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _partition_store(db_path: Path, table: str, key: tuple, df: pd.DataFrame):
+    """Scrive (best effort) le partizioni mensili della versione; riusa i mesi invariati delle precedenti."""
+    date_col = PARTITIONED_TABLES.get(table)
+    if date_col is None or df is None or date_col not in df.columns:
+        return
+    try:
+        pdir = _partition_dir(db_path, table, key)
+        man = _partition_manifest(pdir)
+        if man is not None and man.get("key") == _partition_key(key):
+            return
+
+        # mesi gia' scritti dalle versioni precedenti: hash -> file
+        old_dirs = [p for p in _sidecar_dir_for(db_path).glob(f"{table}.parts.v*") if p != pdir and p.is_dir()]
+        reuse = {}
+        for od in old_dirs:
+            om = _partition_manifest(od) or {}
+            for part in om.get("parts", []):
+                reuse.setdefault(part.get("hash"), od / part.get("file", ""))
+
+        tmp_dir = pdir.with_name(f"{pdir.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        d = df[date_col]
+        if not pd.api.types.is_datetime64_any_dtype(d):
+            d = pd.to_datetime(d, errors='coerce', dayfirst=True)
+        month = d.dt.strftime('%Y-%m').where(d.notna(), _PARTITION_NODATE)
+
+        parts = []
+        for name, idx in month.groupby(month, sort=True).groups.items():
+            seg = df.loc[idx]
+            digest = _partition_hash(seg)
+            fname = f"{name}.pkl"
+            target = tmp_dir / fname
+            src = reuse.get(digest)
+            linked = False
+            if src is not None and src.exists():
+                try:
+                    os.link(src, target)
+                    linked = True
+                except OSError:
+                    pass
+            if not linked:
+                with open(target, "wb") as f:
+                    pickle.dump(seg, f, protocol=pickle.HIGHEST_PROTOCOL)
+            dm = d.loc[idx]
+            parts.append({
+                "name": name,
+                "file": fname,
+                "rows": int(len(seg)),
+                "min": None if dm.isna().all() else dm.min().isoformat(),
+                "max": None if dm.isna().all() else dm.max().isoformat(),
+                "hash": digest,
+                "reused": linked,
+            })
+
+        manifest = {"key": _partition_key(key), "table": table, "columns": [str(c) for c in df.columns],
+                    "rows": int(len(df)), "parts": parts}
+        with open(tmp_dir / "manifest.json", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, default=str)
+
+        shutil.rmtree(pdir, ignore_errors=True)
+        os.replace(str(tmp_dir), str(pdir))
+        for od in old_dirs:
+            if not od.name.endswith(".tmp"):
+                shutil.rmtree(od, ignore_errors=True)
+    except Exception:
+        pass
+
+
+def _partition_load(db_path: Path, table: str, key: tuple, date_from=None, date_to=None):
+    """Legge solo le partizioni che si sovrappongono a [date_from, date_to]; None se mancano."""
+    try:
+        pdir = _partition_dir(db_path, table, key)
+        man = _partition_manifest(pdir)
+        if man is None or man.get("key") != _partition_key(key):
+            return None
+        lo = pd.Timestamp(date_from) if date_from is not None else None
+        hi = pd.Timestamp(date_to) + pd.Timedelta(days=1) if date_to is not None else None
+        segs = []
+        for part in man.get("parts", []):
+            if part.get("min") is None:
+                continue  # righe senza data: mai dentro un intervallo
+            if hi is not None and pd.Timestamp(part["min"]) >= hi:
+                continue
+            if lo is not None and pd.Timestamp(part["max"]) < lo:
+                continue
+            with open(pdir / part["file"], "rb") as f:
+                segs.append(pickle.load(f))
+        if not segs:
+            return pd.DataFrame(columns=man.get("columns", []))
+        df = pd.concat(segs).sort_index() if len(segs) > 1 else segs[0]
+        # categorie diverse tra i mesi: concat le porta a object, ritipizza
+        return _apply_schema(table, df)
+    except Exception:
+        return None
+
+
+# --- Tabelle in memoria condivise (una copia per processo) ---
+# Tutte le sessioni Streamlit del processo leggono le stesse istanze DataFrame (tabelle complete,
+# colonne derivate, letture filtrate), indicizzate per token di versione. Ogni lettura riceve
+# shared_view della voce: un DataFrame nuovo sugli stessi array, senza copiare le colonne.
+# - Gli array della voce sono in sola lettura (readonly_frame): una scrittura sul posto
+#   (df.loc[m, c] = v, fillna(inplace=True)) con pandas 2.x solleva "assignment destination is
+#   read-only" invece di modificare la tabella condivisa; con pandas 3 (copy-on-write) copia la
+#   colonna e procede.
+# - Dove pandas non sa confrontare (s == 'X') un array object in sola lettura (pandas < 2.2, vedi
+#   _READONLY_OBJECT_OK) le colonne testo della voce restano scrivibili e condivise (memoria per
+#   sessione costante): readonly_frame lo segnala nel log.
+# - Riassegnare una colonna (df[c] = ...), filtrare, unire ecc. lavora su array nuovi come sempre;
+#   chi modifica il frame sul posto se ne fa prima una copia (df.copy()).
+# Le opzioni globali di pandas non vengono toccate. Oltre il budget (PERSGEST_TABLE_STORE_MB) si
+# scartano le voci usate meno di recente; una nuova versione di una tabella rimpiazza le vecchie.
+TABLE_STORE_ENV_VAR = "PERSGEST_TABLE_STORE_MB"
+TABLE_STORE_DEFAULT_MB = 1024
+
+
+def _readonly_object_compare_ok() -> bool:
+    """True se questa versione di pandas confronta con uno scalare un array object in sola lettura."""
+    try:
+        arr = np.array(['a', None], dtype=object)
+        arr.flags.writeable = False
+        return bool((pd.Series(arr, copy=False) == 'a').iloc[0])
+    except Exception:
+        # pandas 2.1: "buffer source array is read-only"
+        return False
+
+
+_READONLY_OBJECT_OK = _readonly_object_compare_ok()
+
+
+# pandas 3: copy-on-write sempre attivo, una scrittura sul posto copia la colonna prima di modificarla
+_COPY_ON_WRITE = int(pd.__version__.split(".")[0]) >= 3
+_READONLY_WARNED = set()
+
+
+def _readonly_array(s: pd.Series):
+    """Array di s (stessi dati) in sola lettura, preso con gli accessori pubblici; None se pandas
+    non permette di proteggerlo (array object con _READONLY_OBJECT_OK falso, altri tipi estesi)."""
+    dtype = s.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        # Categorical.codes e' gia' una vista in sola lettura dei codici
+        return pd.Categorical.from_codes(s.array.codes, dtype=dtype, validate=False)
+    if isinstance(dtype, pd.ArrowDtype) or (isinstance(dtype, pd.StringDtype)
+                                            and str(dtype.storage).startswith("pyarrow")):
+        return s.array  # buffer arrow immutabili
+    if isinstance(dtype, np.dtype) and (dtype != object or _READONLY_OBJECT_OK):
+        arr = s.to_numpy(copy=False)
+        arr.flags.writeable = False
+        return arr
+    return None
+
+
+def readonly_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """DataFrame sugli stessi dati di df con gli array in sola lettura (voci condivise tra sessioni).
+
+    Le colonne che pandas non permette di proteggere restano scrivibili (e condivise): senza
+    copy-on-write viene registrato un warning, una volta per tipo di colonna.
+    """
+    arrays, open_cols = {}, []
+    for i in range(df.shape[1]):
+        s = df.iloc[:, i]
+        arr = _readonly_array(s)
+        if arr is None:
+            arr = s.array
+            open_cols.append((df.columns[i], str(s.dtype)))
+        if isinstance(arr, np.ndarray):
+            # dtype esplicito: pandas 3 dedurrebbe str da un array object di testi
+            arr = pd.Series(arr, index=df.index, dtype=s.dtype, copy=False)
+        arrays[i] = arr
+    new_types = {t for _, t in open_cols} - _READONLY_WARNED
+    if new_types and not _COPY_ON_WRITE:
+        _READONLY_WARNED.update(new_types)
+        _log.warning("Tabelle condivise: colonne %s scrivibili con pandas %s (una scrittura sul posto "
+                     "modifica la voce di tutte le sessioni)", [c for c, _ in open_cols], pd.__version__)
+    out = pd.DataFrame(arrays, index=df.index, copy=False)
+    out.columns = df.columns
+    out.attrs = dict(df.attrs)
+    return out
+
+
+def shared_view(df: pd.DataFrame) -> pd.DataFrame:
+    """DataFrame del chiamante sugli stessi array di df condiviso (readonly_frame), senza copie."""
+    return df.copy(deep=False)
+
+
+class _TableStore:
+    """DataFrame in sola lettura condivisi tra le sessioni, con budget memoria e metriche."""
+
+    def __init__(self, max_bytes: int):
+        from collections import OrderedDict
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (df, nbytes)
+        self._loading = {}           # key -> lock (un solo caricamento per chiave)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_s = 0.0
+
+    @staticmethod
+    def _family(key: tuple) -> tuple:
+        # (file dati, tabella): voci della stessa tabella con token diverso sono superate
+        return key[1:3]
+
+    def _get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return shared_view(item[0])
+
+    def peek(self, key):
+        """Voce in memoria (shared_view) o None, senza caricare."""
+        with self._lock:
+            return self._get(key)
+
+    def previous(self, key):
+        """(token, shared_view) della stessa voce in memoria con un altro token, o None.
+
+        Al caricamento di una nuova versione la precedente e' ancora qui (put la scarta dopo).
+        """
+        with self._lock:
+            for k, (df, _) in reversed(self._items.items()):
+                if k[:3] == key[:3] and k[3:] != key[3:]:
+                    return k[3], shared_view(df)
+        return None
+
+    def put(self, key, df: pd.DataFrame) -> pd.DataFrame:
+        """Registra df (in sola lettura, vedi readonly_frame) e ritorna il frame registrato."""
+        try:
+            nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        except Exception:
+            nbytes = 0
+        with self._lock:
+            fam = self._family(key)
+            for k in [k for k in self._items if k != key and self._family(k) == fam and k[3] != key[3]]:
+                self._bytes -= self._items.pop(k)[1]
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            df = readonly_frame(df)
+            self._items[key] = (df, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, (_, nb) = self._items.popitem(last=False)
+                self._bytes -= nb
+                self.evictions += 1
+        return df
+
+    def fetch(self, key, loader):
+        """Ritorna la voce (shared_view); se manca la carica una volta sola anche con sessioni concorrenti."""
+        with self._lock:
+            df = self._get(key)
+            if df is not None:
+                return df
+            klock = self._loading.setdefault(key, threading.Lock())
+        with klock:
+            with self._lock:
+                df = self._get(key)  # caricata da un'altra sessione mentre si aspettava
+            if df is not None:
+                return df
+            t0 = time.perf_counter()
+            try:
+                df = loader()
+            finally:
+                with self._lock:
+                    self.misses += 1
+                    self.load_s += time.perf_counter() - t0
+                    self._loading.pop(key, None)
+            return shared_view(self.put(key, df))
+
+    def clear(self, db_path=None):
+        with self._lock:
+            for k in [k for k in self._items if db_path is None or k[1] == str(db_path)]:
+                self._bytes -= self._items.pop(k)[1]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_s": self.load_s,
+                "items": [
+                    {"kind": k[0], "table": k[2], "rows": len(df), "bytes": nb}
+                    for k, (df, nb) in self._items.items()
+                ],
+            }
+
+
+def _table_store_budget() -> int:
+    try:
+        mb = int(os.environ.get(TABLE_STORE_ENV_VAR, TABLE_STORE_DEFAULT_MB))
+    except ValueError:
+        mb = TABLE_STORE_DEFAULT_MB
+    return max(1, mb) * 1024 * 1024
+
+
+_TABLE_STORE = _TableStore(_table_store_budget())
+
+
+def table_store_metrics() -> dict:
+    """Memoria delle tabelle condivise in questo processo (voci, byte, hit/miss, scarti)."""
+    return _TABLE_STORE.metrics()
+
+
+# --- Journal operazioni di riga (append-only) ---
+# add_record/update_record/delete_record non riscrivono piu' il workbook: accodano una riga JSON
+# a persgest_master.journal.jsonl (fsync). Le letture applicano il journal sopra la tabella base
+# (cache su disco inclusa); la compattazione riporta tutto nel DB quando il journal cresce.
+# Un'operazione viene accodata solo se si applica alla tabella corrente (riga esistente, valori
+# accettati), altrimenti il metodo record solleva come prima. Se una voce non si applica piu' in
+# lettura (journal scritto da un'altra versione, file modificato a mano) viene saltata, registrata
+# nel log e mostrata da journal_info(); la compattazione la sposta in
+# persgest_master.journal.rejected.jsonl invece di perderla.
+# Quando una tabella viene riscritta per intero (save_table, compattazione) le sue voci vengono
+# prima marcate con la generazione del file dati (folded_on, vedi storage.generation()): se il file
+# e' poi cambiato le voci sono gia' nella tabella e non vengono riapplicate, anche se il processo
+# si interrompe prima di togliere le voci dal journal (add/update/delete non sono idempotenti).
+JOURNAL_COMPACT_ENTRIES = 500
+JOURNAL_COMPACT_BYTES = 2 * 1024 * 1024
+JOURNAL_COMPACT_AGE_S = 15 * 60
+
+_JOURNAL_READ_CACHE: dict = {}
+
+
+_log = logging.getLogger(__name__)
+# voci del journal che non si applicano in lettura: (tabella, ts, op, indice) -> errore
+_JOURNAL_APPLY_ERRORS: dict = {}
+
+
+def _journal_path_for(db_path: Path) -> Path:
+    return db_path.with_name(f"{db_path.stem}.journal.jsonl")
+
+
+def _journal_rejected_path_for(db_path: Path) -> Path:
+    return db_path.with_name(f"{db_path.stem}.journal.rejected.jsonl")
+
+
+def _journal_encode(v):
+    """Valore cella -> JSON (date marcate per poterle ricostruire)."""
+    if v is None:
+        return None
+    if isinstance(v, (pd.Timestamp, datetime, date)):
+        if pd.isna(v):
+            return None
+        return {"__dt__": pd.Timestamp(v).isoformat()}
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(v, "item"):
+        try:
+            v = v.item()
+        except Exception:
+            pass
+    if isinstance(v, (str, int, float, bool)):
+        return v
+    return str(v)
+
+
+def _journal_decode(v):
+    if isinstance(v, dict) and "__dt__" in v:
+        return pd.Timestamp(v["__dt__"])
+    return v
+
+
+def _journal_read(db_path: Path) -> list[dict]:
+    """Tutte le operazioni del journal, in ordine (righe incomplete/corrotte ignorate)."""
+    jp = _journal_path_for(db_path)
+    sig = _source_signature(jp)
+    if sig == (0, 0):
+        return []
+    cached = _JOURNAL_READ_CACHE.get(str(jp))
+    if cached and cached[0] == sig:
+        return cached[1]
+    entries = []
+    try:
+        with open(jp, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    e = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(e, dict) and e.get("table") and e.get("op"):
+                    entries.append(e)
+    except Exception:
+        return []
+    _JOURNAL_READ_CACHE[str(jp)] = (sig, entries)
+    return entries
+
+
+def _journal_append(db_path: Path, entries: list[dict]):
+    """Accoda operazioni al journal in modo durevole, un solo fsync (chiamare sotto write lock)."""
+    jp = _journal_path_for(db_path)
+    lines = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+    with open(jp, "a", encoding="utf-8") as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _journal_rewrite(db_path: Path, entries: list[dict]):
+    """Riscrive il journal (vuoto = rimosso) in modo atomico (chiamare sotto write lock)."""
+    jp = _journal_path_for(db_path)
+    if not entries:
+        try:
+            jp.unlink()
+        except FileNotFoundError:
+            pass
+        _JOURNAL_READ_CACHE.pop(str(jp), None)
+        return
+    tmp = jp.with_name(jp.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for e in entries:
+            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp), str(jp))
+
+
+def _journal_apply_one(df: pd.DataFrame, e: dict) -> pd.DataFrame:
+    """Applica una voce del journal a df (colonne object); solleva se non applicabile."""
+    op = e.get("op")
+    index = e.get("index")
+    rec = {k: _journal_decode(v) for k, v in (e.get("record") or {}).items()}
+    if op == "add":
+        return pd.concat([df, pd.DataFrame([rec])], ignore_index=True)
+    if op not in ("update", "delete"):
+        raise ValueError(f"Operazione journal sconosciuta: {op}")
+    if index is None or index not in df.index:
+        raise KeyError(f"Riga {index} non presente in {e.get('table')}")
+    if op == "update":
+        for key, value in rec.items():
+            df.at[index, key] = value
+        return df
+    return df.drop(index).reset_index(drop=True)
+
+
+def _journal_concat(df: pd.DataFrame, records: list[dict]) -> pd.DataFrame:
+    """df con in fondo le righe records (add consecutive: un solo concat).
+
+    Colonne categoria: se i valori nuovi sono gia' tra le categorie la colonna resta categoria
+    (niente ritipizzazione dell'intera colonna), altrimenti passa a object.
+    """
+    new = pd.DataFrame(records)
+    for c in new.columns.intersection(df.columns):
+        dtype = df[c].dtype
+        if isinstance(dtype, pd.CategoricalDtype) and new[c].dropna().isin(dtype.categories).all():
+            new[c] = new[c].astype(dtype)
+    return pd.concat([df, new], ignore_index=True)
+
+
+def _journal_apply(df: pd.DataFrame, entries: list[dict], table: str | None = None,
+                   strict: bool = False, failed: list | None = None) -> pd.DataFrame:
+    """Riapplica in ordine le operazioni add/update/delete (stessa semantica dei metodi record).
+
+    Le add consecutive entrano con un solo concat, le delete consecutive con un solo take; alla
+    fine si ritipizzano (date, TABLE_SCHEMAS con table indicata) solo le colonne il cui tipo e'
+    cambiato. Con strict una voce non applicabile solleva; altrimenti viene saltata, registrata
+    (log, _JOURNAL_APPLY_ERRORS) e aggiunta a failed come (voce, errore).
+    """
+    if not entries:
+        # cache su disco scritte prima dei tipi dichiarati: ritipizza (no-op se gia' tipizzata)
+        return _apply_schema(table, df) if table else df
+    dtypes = df.dtypes.to_dict()
+    df = df.copy()
+    adds = []     # record delle add in attesa
+    alive = None  # posizioni rimaste dopo le delete in attesa
+    deleted = False
+
+    def _flush(df):
+        nonlocal adds, alive
+        if alive is not None:
+            df = df.take(alive).reset_index(drop=True)
+            alive = None
+        if adds:
+            df = _journal_concat(df, adds)
+            adds = []
+        return df
+
+    for e in entries:
+        op = e.get("op")
+        index = e.get("index")
+        try:
+            if op == "add":
+                if alive is not None:
+                    df = _flush(df)
+                adds.append({k: _journal_decode(v) for k, v in (e.get("record") or {}).items()})
+                continue
+            if op not in ("update", "delete"):
+                raise ValueError(f"Operazione journal sconosciuta: {op}")
+            if op == "update" or adds:
+                df = _flush(df)
+            n = len(alive) if alive is not None else len(df)
+            if index is None or index not in pd.RangeIndex(n):
+                raise KeyError(f"Riga {index} non presente in {e.get('table')}")
+            if op == "delete":
+                alive = np.delete(alive if alive is not None else np.arange(n), index)
+                deleted = True
+                continue
+            for key, value in e.get("record", {}).items():
+                # le categorie non accettano valori nuovi: la colonna passa a object
+                if key in df.columns and isinstance(df[key].dtype, pd.CategoricalDtype):
+                    df[key] = df[key].astype(object)
+                df.at[index, key] = _journal_decode(value)
+        except Exception as exc:
+            if strict:
+                raise
+            err = f"{type(exc).__name__}: {exc}"
+            key = (e.get("table"), e.get("ts"), e.get("op"), e.get("index"))
+            if _JOURNAL_APPLY_ERRORS.get(key) != err:
+                _log.warning("Journal: operazione %s su %s (riga %s) non applicabile: %s",
+                             e.get("op"), e.get("table"), e.get("index"), err)
+            _JOURNAL_APPLY_ERRORS[key] = err
+            if failed is not None:
+                failed.append((e, err))
+    df = _flush(df)
+    changed = [c for c in df.columns if c not in dtypes or df[c].dtype != dtypes[c]]
+    if deleted:
+        # categorie senza piu' righe tolte, come rileggendo la tabella ('' resta, vedi _schema_cast)
+        for c in df.columns:
+            if c not in changed and isinstance(df[c].dtype, pd.CategoricalDtype):
+                col = df[c].cat.remove_unused_categories()
+                if '' in dtypes[c].categories and '' not in col.cat.categories:
+                    col = col.cat.add_categories([''])
+                df[c] = col
+    df = _coerce_date_columns(df, changed)
+    return _apply_schema(table, df, changed) if table else df
+
+
+def _journal_reject(db_path: Path, failed: list):
+    """Sposta nel file .journal.rejected.jsonl le voci non applicabili (chiamare sotto write lock)."""
+    if not failed:
+        return
+    jp = _journal_rejected_path_for(db_path)
+    with open(jp, "a", encoding="utf-8") as f:
+        for e, err in failed:
+            f.write(json.dumps({**e, "error": err, "rejected_ts": time.time()}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _coerce_date_columns(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """Converte le colonne data standard (data, data_inizio, data_fine) in datetime.
+
+    columns: solo tra queste colonne (default tutte).
+    """
+    date_cols = ['data', 'data_inizio', 'data_fine']
+    for col in date_cols:
+        if col in df.columns and (columns is None or col in columns):
+            df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
+    return df
+
+
+def _excel_engine_for_name(name: str | None) -> str | None:
+    """Best-effort engine selection for pandas Excel readers.
+
+    Pandas may fail to infer the engine when the input is a file-like object
+    (e.g. Streamlit UploadedFile) or when the file has a non-standard extension.
+    """
+    if not name:
+        return None
+    suffix = Path(str(name)).suffix.lower()
+    if suffix in {'.xlsx', '.xlsm', '.xltx', '.xltm'}:
+        return 'openpyxl'
+    # .xls requires xlrd (often not installed). Prefer converting to .xlsx.
+    if suffix == '.xls':
+        return 'xlrd'
+    if suffix == '.xlsb':
+        return 'pyxlsb'
+    if suffix == '.ods':
+        return 'odf'
+    return None
+
+
+def _excel_engine_for_obj(obj) -> str | None:
+    """Try to determine the engine from a path or Streamlit UploadedFile."""
+    try:
+        if isinstance(obj, (str, Path)):
+            return _excel_engine_for_name(str(obj))
+        name = getattr(obj, 'name', None)
+        return _excel_engine_for_name(name)
+    except Exception:
+        return None
+
+# ============================
+# Import robusto (anche senza intestazioni)
+# ============================
+
+def _safe_str(x) -> str:
+    if pd.isna(x):
+        return ""
+    try:
+        return str(x).strip()
+    except Exception:
+        return ""
+
+# formati data dei testi (export GT, CSV): giorno prima, poi ISO
+_TEXT_DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y',
+                      '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y/%m/%d')
+
+
+def _text_dates(s: pd.Series) -> pd.Series:
+    """Colonna -> datetime: date vere cosi' come sono, testi con uno dei _TEXT_DATE_FORMATS.
+
+    Tutto il resto (numeri, testi in altri formati) e' NaT. Con formato esplicito pandas non
+    ripiega su dateutil elemento per elemento (lento, e un UserWarning "Could not infer format"
+    per ogni colonna di testo non data).
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    vals = s.astype(object)
+    is_day = vals.map(lambda v: isinstance(v, (datetime, date)) and not pd.isna(v)).to_numpy(dtype=bool)
+    is_txt = vals.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    out = np.full(len(vals), np.datetime64('NaT'), dtype='datetime64[ns]')
+    if is_day.any():
+        out[is_day] = pd.to_datetime(vals[is_day].tolist()).to_numpy(dtype='datetime64[ns]')
+    todo = np.flatnonzero(is_txt)
+    txt = pd.Series(vals.to_numpy()[todo], dtype=object).str.strip()
+    for fmt in _TEXT_DATE_FORMATS:
+        if not len(todo):
+            break
+        got = pd.to_datetime(txt, format=fmt, errors='coerce').to_numpy(dtype='datetime64[ns]')
+        ok = ~np.isnat(got)
+        out[todo[ok]] = got[ok]
+        todo, txt = todo[~ok], txt[~ok]
+    return pd.Series(out, index=s.index, name=s.name)
+
+
+def _loose_dates(s: pd.Series) -> pd.Series:
+    """_text_dates, poi i testi rimasti in altri formati (Excel: '1 mar 2024') con dayfirst elemento per elemento."""
+    dt = _text_dates(s)
+    vals = s.astype(object).to_numpy()
+    rest = np.flatnonzero(dt.isna().to_numpy() & np.array([isinstance(v, str) for v in vals], dtype=bool))
+    if not len(rest):
+        return dt
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        got = pd.to_datetime(pd.Series(vals[rest], dtype=object), errors='coerce', dayfirst=True, format='mixed')
+    out = dt.to_numpy(dtype='datetime64[ns]', copy=True)
+    out[rest] = got.to_numpy(dtype='datetime64[ns]')
+    return pd.Series(out, index=s.index, name=s.name)
+
+
+def _series_date_score(s: pd.Series) -> float:
+    """Ritorna una score [0..1] di quanto la serie sembri una data."""
+    if s is None or len(s) == 0:
+        return 0.0
+    dt = _loose_dates(s)
+    ok = dt.notna().mean()
+    if ok == 0:
+        return 0.0
+    # penalizza date fuori range
+    years = dt.dropna().dt.year
+    if len(years) == 0:
+        return 0.0
+    in_range = ((years >= 2000) & (years <= 2100)).mean()
+    return float(ok * in_range)
+
+def _series_numeric_score(s: pd.Series) -> float:
+    if s is None or len(s) == 0:
+        return 0.0
+    num = pd.to_numeric(s, errors='coerce')
+    ok = num.notna().mean()
     return float(ok)
 
 def _series_name_score(s: pd.Series) -> float:
@@ -240,7 +1694,7 @@ def _looks_like_header_row(df: pd.DataFrame) -> bool:
     keys = ["data", "matric", "turn", "ore", "min", "valore", "nome", "cognome"]
     return any(k in joined for k in keys)
 
-def _normalize_attivita_headerless(df: pd.DataFrame) -> pd.DataFrame:
+def _normalize_attivita_headerless(df: pd.DataFrame, mapping: dict | None = None) -> pd.DataFrame:
     """Normalizza un DataFrame **Attivita** senza intestazioni (header=None).
 
     Formato atteso (posizionale, come export GT):
@@ -256,13 +1710,55 @@ def _normalize_attivita_headerless(df: pd.DataFrame) -> pd.DataFrame:
     Output colonne: nome, matricola, uo, turno, att, pox, data, minuti, valore
       - minuti: intero (minuti)
       - valore: ore float (2 decimali)
+
+    mapping: ruolo -> colonna (da _attivita_headerless_mapping); nell'import a blocchi si
+    calcola sul primo blocco e si riusa per gli altri, cosi' le colonne restano le stesse.
     """
     if df is None or df.empty:
         return pd.DataFrame(columns=["nome", "matricola", "turno", "data", "valore"])
 
     # rimuovi colonne completamente vuote
     df = df.dropna(axis=1, how='all').copy()
+    if mapping is None:
+        mapping = _attivita_headerless_mapping(df)
+    nome_col, matricola_col, uo_col = mapping.get("nome"), mapping.get("matricola"), mapping.get("uo")
+    turno_col, att_col, pox_col = mapping.get("turno"), mapping.get("att"), mapping.get("pox")
+    date_col, minuti_col = mapping.get("data"), mapping.get("minuti")
+
+    out = pd.DataFrame({
+        "nome": df[nome_col] if nome_col in df.columns else "",
+        "matricola": df[matricola_col] if matricola_col in df.columns else "",
+        "uo": df[uo_col] if (uo_col in df.columns) else "",
+        "turno": df[turno_col] if turno_col in df.columns else "",
+        "att": df[att_col] if (att_col in df.columns) else "",
+        "pox": df[pox_col] if (pox_col in df.columns) else "",
+        "data": df[date_col] if date_col in df.columns else pd.NaT,
+        "minuti": df[minuti_col] if minuti_col in df.columns else 0,
+    })
+
+    # pulizia
+    out["matricola"] = out["matricola"].apply(_safe_str)
+    out["nome"] = out["nome"].apply(_safe_str)
+    out["turno"] = out["turno"].apply(_safe_str)
+    out["uo"] = out["uo"].apply(_safe_str)
+    out["att"] = out["att"].apply(_safe_str)
+    out["pox"] = out["pox"].apply(_safe_str)
+    out["data"] = _loose_dates(out["data"])
+
+    # minuti -> ore
+    m = pd.to_numeric(out["minuti"], errors='coerce')
+    m = m.fillna(0.0)
+    out["minuti"] = m.astype(float)
+    out["valore"] = (out["minuti"] / 60.0).round(2)
+
+    # rimuovi righe completamente vuote
+    out = out[(out["matricola"] != "") | (out["nome"] != "") | (out["turno"] != "") | (out["valore"] != 0) | (out["data"].notna())]
 
+    return out
+
+
+def _attivita_headerless_mapping(df: pd.DataFrame) -> dict:
+    """Riconosce le colonne di un foglio Attivita senza intestazioni (colonne gia' senza vuote)."""
     # Mapping posizionale (preferito): foglio "attivita" headerless
     fallback = {}
     if df.shape[1] >= 7:
@@ -321,220 +1817,2470 @@ def _normalize_attivita_headerless(df: pd.DataFrame) -> pd.DataFrame:
     if turno_col is None or turno_scores.get(turno_col, 0) < 0.25:
         turno_col = fallback.get("turno")
 
-    # campi aggiuntivi (UO, ATT, POX) se presenti
-    uo_col = fallback.get("uo")
-    att_col = fallback.get("att")
-    pox_col = fallback.get("pox")
+    # campi aggiuntivi (UO, ATT, POX) se presenti
+    return {
+        "nome": nome_col,
+        "matricola": matricola_col,
+        "uo": fallback.get("uo"),
+        "turno": turno_col,
+        "att": fallback.get("att"),
+        "pox": fallback.get("pox"),
+        "data": date_col,
+        "minuti": minuti_col,
+    }
+
+def _make_unique_columns(cols, casefold: bool = False) -> list[str]:
+    """Rende univoci i nomi colonna preservando l'ordine (es. valore, valore_1, ...).
+
+    Con casefold=True due nomi che differiscono solo per maiuscole contano come uguali
+    (SQLite non distingue UO da uo).
+    """
+    seen = {}
+    out = []
+    for c in cols:
+        base = str(c).strip()
+        key = base.lower() if casefold else base
+        if key not in seen:
+            seen[key] = 0
+            out.append(base)
+        else:
+            seen[key] += 1
+            out.append(f"{base}_{seen[key]}")
+    return out
+
+
+def _storage_column_names(data: dict) -> dict:
+    """Nomi colonna come li salva ogni motore: senza spazi ai bordi e univoci senza distinguere
+    maiuscole (SQLite non distingue UO da uo), cosi' Excel e SQLite rileggono gli stessi nomi.
+
+    Le colonne rinominate finiscono nel log (warning).
+    """
+    out = {}
+    for table, df in data.items():
+        cols = _make_unique_columns(df.columns, casefold=True)
+        if cols != list(df.columns):
+            renamed = {str(a): b for a, b in zip(df.columns, cols) if str(a) != b}
+            if renamed:
+                _log.warning("Tabella %s: colonne rinominate nel salvataggio %s", table, renamed)
+            df = df.set_axis(cols, axis=1)
+        out[table] = df
+    return out
+
+
+def _normalize_columns_generic(df: pd.DataFrame) -> pd.DataFrame:
+    """Normalizza colonne comuni: case/strip e alias minimi."""
+    if df is None:
+        return pd.DataFrame()
+    df = df.copy()
+
+    # prima di qualsiasi rename, rendi univoci (Excel puo' avere header duplicati)
+    df.columns = _make_unique_columns(df.columns)
+    rename = {}
+    for c in df.columns:
+        cl = str(c).strip().lower()
+        if cl in {"data", "date", "giorno"}:
+            rename[c] = "data"
+        elif "matric" in cl or cl in {"badge", "id"}:
+            rename[c] = "matricola"
+        elif "turn" in cl or cl in {"shift"}:
+            rename[c] = "turno"
+        # IMPORTANTE: non collassare 'minuti' dentro 'valore' (crea duplicati)
+        elif cl in {"minuti", "minutes"}:
+            rename[c] = "minuti"
+        elif cl in {"ore", "hours"}:
+            rename[c] = "ore"
+        elif cl in {"valore", "value"}:
+            rename[c] = "valore"
+        elif cl in {"nome", "nominativo"}:
+            rename[c] = "nome"
+    if rename:
+        df = df.rename(columns=rename)
+
+    # post-rename: garantisci ancora univocita'
+    if df.columns.duplicated().any():
+        df.columns = _make_unique_columns(df.columns)
+    return df
+
+
+# ============================
+# Template intestazioni tabelle (vuote)
+# ============================
+
+TEMPLATE_HEADERS = {
+    # Attivita: colonne canoniche dopo la normalizzazione (import GT / headerless)
+    'Attivita': ['nome', 'matricola', 'uo', 'turno', 'att', 'pox', 'data', 'minuti', 'valore'],
+    'AbilitazioniTipo': ['abilitazione', 'Tipologia', 'note', 'periodicita1', 'periodicita2'],
+    'AltreAbilitazioniPers': ['Matricola', 'categ_professionale', 'Abilitazione', 'note', 'dataSuCert', 'rinnovo', 'zone', 'nr_documento'],
+    'CatProfTipo': ['CAT', 'note'],
+    'ColoriTurni': ['Pattern', 'BkR', 'BkG', 'BkB', 'FkR', 'FkG', 'FkB', 'Bold', 'Priority'],
+    'Ferie_AP': ['matricola', 'cognome_e_nome', 'gg_ferie_AP', 'hr_ferie_AP', 'gg_RFS_AP', 'hr_RFS_AP', 'anno'],
+    'Ferie_spettanti': ['Da anni', 'A anni', 'Giorni_Spett', 'RFS_Spett'],
+    'IdoneitaMedichePers': ['Matricola', 'categ_professionale', 'idoneita', 'note', 'dataSuCert', 'rinnovo'],
+    'Personale': ['CAT', 'matricola', 'Nome', 'UO', 'regime_orario', 'no_spec', 'note_scheda_pers', 'In_Forza', 'Data_di_Nascita', 'Luogo_di_Nascita', 'Cittadinanza', 'Via_e_numero_civico', 'Città', 'Provincia', 'CAP', 'Cod_Fiscale', 'note', 'Indirizzo_posta_elettronica', 'Telefono_uff', 'Telefono_ab', 'Tel_Cellulare', 'Fax', 'Data_prima_Assunzione', 'Licenza', 'Data_Rilascio_Licenza', 'Allegato', 'ENG_lvl', 'Documenti'],
+    'Personale_PartTime': ['cognome_e_nome', 'matricola', 'categ_professionale', '%_part_time', 'ID_part_time', 'dal', 'al'],
+    'Ripo': ['MATRICOLA', 'COGNOME', 'NOME', 'SETTORE', 'DATA', 'IMPIANTO', 'INIZIO TURNO', 'FINE TURNO', 'ORAE', 'ORAU', 'PAUSA', 'SPEZZONE', 'SIGLA_ATTIVITA', 'StartDT', 'EndDT', 'WorkDate', 'Seq', 'MinutiPOX'],
+    'SpecUO-CompTipo': ['SpecUO/Comp', 'Tipologia', 'note', '1_R', '2_R', 'R_C', 'Su_impianto'],
+    'SpecUOPers': ['Matricola', 'categ_professionale', 'SpecUO/Comp', 'note', 'dataSuLic', '1_rinnovo', 'doc_1r', '2_rinnovo', 'doc_2r', 'R_comp', 'doc_R_comp', 'note1R', 'note2R', 'notecomp'],
+    'Specializzazioni_tipo': ['SPECIALIZZAZIONE', 'POX'],
+    'Straordinario': ['CAT', 'Nome', 'matricola', 'UO', 'turno', 'att', 'data', 'valore', 'STP', 'contattato_il', 'note'],
+    'TargetOp': ['Days', 'TargetOpTot'],
+    'Turni_tipo': ['Turno', 'OraInizio', 'OraFine', 'Minuti', 'SplitNotte', 'MinutiGiornoCorrente', 'MinutiGiornoPrecedente', 'IsOperativo', 'Categoria'],
+    'idoneitaMedicheTipo': ['Idoneita', 'Tipologia', 'note', 'periodicita1', 'periodicita2', 'Is_Attiva'],
+    'tbl_UO': ['UO'],
+    'Festivi': ['GiornoFestivo', 'Descrizione', 'Localita'],
+    # Tabella editabile: elenco codici che rappresentano assenze (es. FER, MAL, 104, ...)
+    'Turni_Assenze': ['Turno'],
+}
+
+# Default elenco assenze (editabile dall'utente nella tabella Turni_Assenze)
+# Nota: nei dati GT ricorrono spesso FER (ferie) e RPD/RPN (riposi). Se non esclusi,
+# i festivi verrebbero conteggiati anche quando la persona non ...
+DEFAULT_TURNI_ASSENZE = [
+    'FER','RPD','RPN',
+    '104','ASS','CONP','DONS','MAL','MAT','PDEC','VMSP','ROS','NASF','INF','MALF',
+    'MIX','PRLS','SCIO','RCI','ALL','PELE','PEXT','PSIN','ESAU'
+]
+
+
+# ============================
+# Schemi tabelle (tipi colonna)
+# ============================
+
+# Tipo per nome colonna (confronto case-insensitive). I codici ripetuti su migliaia di righe
+# diventano categorie, la data datetime64. 'minuti' e 'valore' restano float64: le pagine
+# sommano i minuti su mesi e persone (in float32 i totali perderebbero precisione) e 'valore'
+# contiene ore con 2 decimali (7.2, 7.35...) che in float32 comparirebbero come 7.1999998.
+SCHEMA_COLUMN_TYPES = {
+    'matricola': 'category',
+    'uo': 'category',
+    'turno': 'category',
+    'att': 'category',
+    'pox': 'category',
+    'data': 'datetime',
+    'minuti': 'float64',
+    'valore': 'float64',
+}
+
+# Tabelle tipizzate al caricamento (quelle con molte righe); le anagrafiche restano object.
+# get_all/get_many consegnano le categorie cosi' come sono in memoria (nessuna conversione per
+# lettura). Le pagine passano i codici da text_column prima di confronti e raggruppamenti; chi
+# assegna codici nuovi cella per cella (Editor Dati) chiede typed=False: con una categoria
+# df.loc[m, c] = nuovo codice solleverebbe.
+TABLE_SCHEMAS = {
+    t: {c: SCHEMA_COLUMN_TYPES[c.lower()] for c in TEMPLATE_HEADERS[t] if c.lower() in SCHEMA_COLUMN_TYPES}
+    for t in ('Attivita', 'Straordinario')
+}
+
+
+def _schema_cast(s: pd.Series, kind: str) -> pd.Series:
+    """Converte una colonna nel tipo dichiarato; se la conversione perderebbe dati la lascia com'e'."""
+    if kind == 'category':
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            # i valori originali restano invariati (matricola numerica resta numero nel file)
+            s = s.astype('category')
+        # '' sempre tra le categorie: le pagine fanno fillna('') sulle colonne testo
+        if '' not in s.cat.categories:
+            s = s.cat.add_categories([''])
+        return s
+    if kind == 'datetime':
+        if pd.api.types.is_datetime64_any_dtype(s):
+            return s
+        return pd.to_datetime(s, errors='coerce', dayfirst=True)
+    # numerico
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        num = s
+    else:
+        num = pd.to_numeric(s, errors='coerce')
+        blank = s.isna() | s.astype(str).str.strip().eq('')
+        if (num.isna() & ~blank).any():
+            # testo non numerico (es. '8.00h' in Straordinario.valore): lo interpreta la pagina
+            return s
+    return num.astype(kind)
+
+
+def _apply_schema(table: str, df: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """Applica a una tabella i tipi di TABLE_SCHEMAS (best effort, colonna per colonna).
+
+    columns: solo queste colonne (default tutte).
+    """
+    schema = TABLE_SCHEMAS.get(table)
+    if not schema or df is None or len(df.columns) == 0:
+        return df
+    by_lower = {str(c).lower(): c for c in (df.columns if columns is None else columns)}
+    for name, kind in schema.items():
+        col = by_lower.get(name.lower())
+        if col is None:
+            continue
+        try:
+            df[col] = _schema_cast(df[col], kind)
+        except Exception:
+            pass
+    return df
+
+
+def _schema_release(df: pd.DataFrame) -> pd.DataFrame:
+    """Categorie -> object (get_all(typed=False), modifiche cella per cella con valori nuovi).
+
+    Le altre colonne restano quelle di df (copia shallow).
+    """
+    cats = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if cats:
+        df = df.copy(deep=False)
+        for c in cats:
+            df[c] = df[c].astype(object)
+    return df
+
+
+# --- Colonne derivate (canoniche) ---
+# Crosstab, Verifica Match, WE liberi, Festivi e Report Straordinari derivano tutte le stesse
+# informazioni da Attivita: le calcoliamo una volta per versione tabella (get_all(..., derived=True)).
+# Le regole dei minuti sono quelle delle singole pagine (non si uniformano: cambierebbero i totali).
+#   _day       data senza orario (datetime64, mezzanotte)
+#   _turno_up  turno trim/maiuscolo, '' per vuoti (nan/None)
+#   _att_up    att trim/maiuscolo, '' per vuoti
+#   _mins      minuti come nel Calendario Crosstab / WE liberi: colonna minuti (vuoti = 0); senza
+#              minuti, valore in ore (x60) se per quella persona e quel giorno il massimo e' <= 24
+#   _mins_gt   minuti come in extract_gt_overtime (Report Straordinari): prima colonna tra
+#              valore/minuti/mins/minute; riga per riga un intero tra 1 e 24 vale come ore (x60)
+# Verifica Match e Festivi mantengono le loro regole (sulle colonne originali).
+DERIVED_COLUMNS = {
+    'Attivita': ['_day', '_turno_up', '_att_up', '_mins', '_mins_gt'],
+}
+
+
+def _numeric_clean(s: pd.Series) -> pd.Series:
+    """Serie -> float (accetta anche testi tipo '8.00h' o '8,00'); NaN dove non convertibile."""
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+        return s.astype(float)
+    txt = (s.astype(object).where(s.notna(), '').astype(str).str.strip().str.lower()
+           .str.replace('ore', '', regex=False).str.replace('h', '', regex=False)
+           .str.replace(',', '.', regex=False).str.strip())
+    return pd.to_numeric(txt, errors='coerce')
+
+
+def _derive_code_upper(s: pd.Series) -> pd.Series:
+    """Codice turno/att normalizzato (trim, maiuscolo, '' per vuoti) come categoria."""
+    def _norm(x: pd.Series) -> pd.Series:
+        out = x.astype(object).where(x.notna(), '').astype(str).str.strip().str.upper()
+        return out.replace({'NAN': '', 'NONE': ''})
+
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # normalizza solo le categorie (poche) e rimappa i codici (-1 = NaN -> '')
+        cats = _norm(pd.Series(s.cat.categories, dtype=object)).to_numpy(dtype=object)
+        vals = np.append(cats, '')[s.cat.codes.to_numpy()]
+        out = pd.Series(vals, index=s.index, dtype=object)
+    else:
+        out = _norm(s)
+    return out.astype('category')
+
+
+def _derive_columns(table: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Ritorna le colonne derivate di DERIVED_COLUMNS (stesso indice di df); vuoto se non previste."""
+    if table not in DERIVED_COLUMNS or df is None:
+        return pd.DataFrame(index=getattr(df, 'index', None))
+    n = len(df)
+    out = pd.DataFrame(index=df.index)
+
+    if 'data' in df.columns:
+        out['_day'] = pd.to_datetime(df['data'], errors='coerce', dayfirst=True).dt.normalize()
+    else:
+        out['_day'] = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+
+    for col, name in (('turno', '_turno_up'), ('att', '_att_up')):
+        if col in df.columns:
+            out[name] = _derive_code_upper(df[col])
+        else:
+            out[name] = pd.Series([''] * n, index=df.index, dtype='category')
+
+    if 'minuti' in df.columns:
+        mins = pd.to_numeric(df['minuti'], errors='coerce').fillna(0.0)
+    elif 'valore' in df.columns:
+        v = pd.to_numeric(df['valore'], errors='coerce').fillna(0.0)
+        mat = df['matricola'].astype(str).str.strip() if 'matricola' in df.columns else pd.Series('', index=df.index)
+        day_max = v.groupby([mat, out['_day']], dropna=False, sort=False).transform('max')
+        mins = v.where(day_max > 24.0, v * 60.0)
+    else:
+        mins = pd.Series(0.0, index=df.index)
+    out['_mins'] = mins.astype('float64')
+
+    val_col = next((c for c in ('valore', 'minuti', 'mins', 'minute') if c in df.columns), None)
+    if val_col is not None:
+        g = _numeric_clean(df[val_col]).fillna(0.0)
+        # regola conservativa: un intero tra 1 e 24 e' in ore
+        g = g.where(~((g > 0) & (g <= 24) & ((g % 1) == 0)), g * 60.0)
+    else:
+        g = pd.Series(0.0, index=df.index)
+    # float64 come 'valore' e 'minuti' (ore con decimali non convertite: in float32 i totali cambierebbero)
+    out['_mins_gt'] = g.astype('float64')
+    return out
+
+
+# --- Filtri get_all (proiezione / intervallo date / matricole) ---
+
+def _filter_args(columns=None, date_from=None, date_to=None, matricole=None) -> tuple:
+    """Normalizza i filtri di get_all in valori hashable (chiave di cache)."""
+    cols = tuple(columns) if columns is not None else None
+    d0 = pd.Timestamp(date_from).normalize() if date_from is not None else None
+    d1 = pd.Timestamp(date_to).normalize() if date_to is not None else None
+    mats = tuple(sorted({str(m).strip() for m in matricole})) if matricole is not None else None
+    return cols, d0, d1, mats
+
+
+def _text_isin(s: pd.Series, keys) -> pd.Series:
+    """s.astype(str).str.strip().isin(keys); sulle categorie confronta solo i valori distinti."""
+    keys = set(keys)
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        hit = pd.Index(s.cat.categories).astype(str).str.strip().isin(keys)
+        codes = s.cat.codes.to_numpy()
+        return pd.Series(np.append(hit, False)[codes], index=s.index)
+    return s.astype(str).str.strip().isin(keys)
+
+
+def _filter_frame(df: pd.DataFrame, columns=None, date_from=None, date_to=None, matricole=None) -> pd.DataFrame:
+    """Applica i filtri di get_all a un DataFrame gia' letto (l'indice originale resta invariato).
+
+    Le date sono inclusive per giorno (date_to comprende tutto il giorno); un filtro su una colonna
+    assente viene ignorato.
+    """
+    if df is None or len(df.columns) == 0:
+        return df
+    mask = None
+    if (date_from is not None or date_to is not None) and 'data' in df.columns:
+        d = df['data']
+        if not pd.api.types.is_datetime64_any_dtype(d):
+            d = pd.to_datetime(d, errors='coerce', dayfirst=True)
+        m = d.notna()
+        if date_from is not None:
+            m &= d >= pd.Timestamp(date_from)
+        if date_to is not None:
+            m &= d < pd.Timestamp(date_to) + pd.Timedelta(days=1)
+        mask = m
+    if matricole is not None and 'matricola' in df.columns:
+        m = _text_isin(df['matricola'], matricole)
+        mask = m if mask is None else (mask & m)
+    if mask is not None:
+        df = df[mask.to_numpy()]
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+# --- Indice per persona (matricola -> righe) ---
+# Selezionare una persona (o le persone di una UO) non deve scandire tutta la tabella: per ogni
+# versione si costruisce una volta l'ordinamento stabile per (matricola, giorno), cosi' le righe di
+# una matricola, e di una matricola in un intervallo di giorni, sono un tratto contiguo trovato per
+# bisezione. L'indice vive nello store condiviso (voce "personidx") accanto alla tabella.
+PERSON_INDEXED_TABLES = {'Attivita'}
+
+
+def _person_index_build(df: pd.DataFrame) -> pd.DataFrame:
+    """Righe di df ordinate per (matricola, giorno).
+
+    Colonne: _mat (matricola come testo ripulito, categoria ordinata: codici crescenti),
+    _day (giorno in ns, int64; NaT = minimo, quindi in testa), _pos (posizione in df).
+    """
+    n = len(df)
+    if 'matricola' in df.columns:
+        s = df['matricola']
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            cats = pd.Index(s.cat.categories).astype(str).str.strip()
+            keys = np.append(cats.to_numpy(dtype=object), 'nan')[s.cat.codes.to_numpy()]
+        else:
+            keys = s.astype(str).str.strip().to_numpy(dtype=object)
+    else:
+        keys = np.full(n, '', dtype=object)
+    codes, uniques = pd.factorize(keys, sort=True)
+    if 'data' in df.columns:
+        day = pd.to_datetime(df['data'], errors='coerce', dayfirst=True).dt.normalize()
+        day_i8 = day.to_numpy(dtype='datetime64[ns]').view('int64')
+    else:
+        day_i8 = np.full(n, np.iinfo('int64').min, dtype='int64')
+    order = np.lexsort((day_i8, codes))
+    return pd.DataFrame({
+        '_mat': pd.Categorical.from_codes(codes[order], categories=pd.Index(uniques, dtype=object)),
+        '_day': day_i8[order],
+        '_pos': order.astype('int64'),
+    })
+
+
+def _person_index_positions(idx: pd.DataFrame, matricole, date_from=None, date_to=None) -> np.ndarray:
+    """Posizioni (crescenti) delle righe delle matricole richieste, con date inclusive per giorno.
+
+    Costo: una bisezione per matricola (e per i limiti di data) + le righe restituite.
+    """
+    mat = idx['_mat']
+    codes = mat.cat.codes.to_numpy()
+    days = idx['_day'].to_numpy()
+    pos = idx['_pos'].to_numpy()
+    wanted = mat.cat.categories.get_indexer(pd.Index([str(m).strip() for m in matricole], dtype=object))
+    dated = date_from is not None or date_to is not None
+    lo_day = pd.Timestamp(date_from).normalize().value if date_from is not None else np.iinfo('int64').min + 1
+    hi_day = pd.Timestamp(date_to).normalize().value if date_to is not None else np.iinfo('int64').max
+    parts = []
+    for c in np.unique(wanted[wanted >= 0]):
+        a = int(np.searchsorted(codes, c, side='left'))
+        b = int(np.searchsorted(codes, c, side='right'))
+        if dated:
+            seg = days[a:b]
+            a, b = a + int(np.searchsorted(seg, lo_day, side='left')), a + int(np.searchsorted(seg, hi_day, side='right'))
+        if b > a:
+            parts.append(pos[a:b])
+    if not parts:
+        return np.empty(0, dtype='int64')
+    return np.sort(np.concatenate(parts))
+
+
+# --- Codifica a dizionario (id interi per matricola / UO / categoria / codici) ---
+# Le pagine confrontano matricole e codici turno come testo ripulito (strip/upper) ripetendo la
+# normalizzazione a ogni uso. Qui ogni dominio ha un dizionario testo -> id int32 condiviso dal
+# processo: gli id sono stabili tra tabelle e versioni finche' si usa lo stesso dizionario, quindi
+# join, isin e groupby possono lavorare sugli array interi. La codifica di una tabella si calcola una
+# volta per versione (get_encoded) e normalizza solo i valori distinti.
+# Il dizionario non cresce senza limite: oltre VOCABULARY_MAX_VALUES valori vocabulary() ne apre uno
+# nuovo (generazione successiva). Chi confronta id di piu' codifiche prende il dizionario una volta
+# con vocabulary() e lo usa per tutte; le codifiche di get_encoded sono legate alla generazione
+# (decode_ids rifiuta gli id di una generazione sostituita).
+#   matricola  testo ripulito (come astype(str).str.strip(); NaN -> 'nan')
+#   uo / cat   testo ripulito, vuoti -> ''
+#   code       turno/att/pox: trim, maiuscolo, '' per vuoti (come _turno_up/_att_up)
+ENCODED_COLUMNS = {
+    'matricola': 'matricola',
+    'uo': 'uo',
+    'cat': 'cat',
+    'catproftipo': 'cat',
+    'turno': 'code',
+    'att': 'code',
+    'pox': 'code',
+    '_turno_up': 'code',
+    '_att_up': 'code',
+}
+
+
+def _encode_normalize(domain: str, values: pd.Series) -> pd.Series:
+    if domain == 'code':
+        out = values.astype(object).where(values.notna(), '').astype(str).str.strip().str.upper()
+        return out.replace({'NAN': '', 'NONE': ''})
+    fill = 'nan' if domain == 'matricola' else ''
+    return values.astype(object).where(values.notna(), fill).astype(str).str.strip()
+
+
+VOCABULARY_MAX_VALUES = 500_000
+
+
+class _Vocabulary:
+    """Dizionario testo -> id (int32) di un dominio; gli id non cambiano per la vita dell'oggetto."""
+
+    def __init__(self, domain: str, generation: int = 0):
+        self.domain = domain
+        self.generation = generation
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._values = []
+
+    def ids_for(self, uniques, add: bool = True) -> np.ndarray:
+        """id dei valori (gia' normalizzati); se add=False i valori sconosciuti valgono -1."""
+        with self._lock:
+            out = np.empty(len(uniques), dtype='int32')
+            for i, v in enumerate(uniques):
+                k = self._ids.get(v)
+                if k is None:
+                    if not add:
+                        out[i] = -1
+                        continue
+                    k = len(self._values)
+                    self._ids[v] = k
+                    self._values.append(v)
+                out[i] = k
+            return out
+
+    def encode(self, s: pd.Series) -> np.ndarray:
+        """Serie -> array int32 di id (normalizza e registra i soli valori distinti)."""
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            cats = _encode_normalize(self.domain, pd.Series(s.cat.categories, dtype=object))
+            na = _encode_normalize(self.domain, pd.Series([np.nan], dtype=object)).iloc[0]
+            ids = self.ids_for(list(cats) + [na])
+            return ids[s.cat.codes.to_numpy()]
+        codes, uniques = pd.factorize(_encode_normalize(self.domain, s), use_na_sentinel=False)
+        return self.ids_for(list(uniques))[codes]
+
+    def keys(self, values) -> np.ndarray:
+        """Chiavi gia' normalizzate -> id (-1 per valori mai visti), cercando i soli valori distinti."""
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object).astype(str), use_na_sentinel=False)
+        return self.ids_for(list(uniques), add=False)[codes]
+
+    def values(self, ids) -> np.ndarray:
+        with self._lock:
+            vals = np.array(self._values + [''], dtype=object)
+        ids = np.asarray(ids)
+        return vals[np.where(ids < 0, len(vals) - 1, ids)]
+
+    def __len__(self):
+        return len(self._values)
+
+
+_VOCABULARIES = {d: _Vocabulary(d) for d in sorted(set(ENCODED_COLUMNS.values()))}
+_VOCABULARIES_LOCK = threading.Lock()
+
+
+def vocabulary(domain: str) -> _Vocabulary:
+    """Dizionario corrente del dominio; se ha superato VOCABULARY_MAX_VALUES ne apre uno nuovo.
+
+    Il vecchio resta valido per chi lo sta usando e viene liberato quando nessuno lo referenzia.
+    """
+    with _VOCABULARIES_LOCK:
+        voc = _VOCABULARIES[domain]
+        if len(voc) >= VOCABULARY_MAX_VALUES:
+            voc = _VOCABULARIES[domain] = _Vocabulary(domain, voc.generation + 1)
+        return voc
+
+
+def _vocabulary_generations() -> tuple:
+    with _VOCABULARIES_LOCK:
+        return tuple(v.generation for _, v in sorted(_VOCABULARIES.items()))
+
+
+def _current_vocabulary(domain: str) -> _Vocabulary:
+    """Dizionario corrente senza aprirne uno nuovo (letture: chiavi e decodifica)."""
+    with _VOCABULARIES_LOCK:
+        return _VOCABULARIES[domain]
+
+
+def encode_column(domain: str, s: pd.Series) -> np.ndarray:
+    """Serie -> array int32 di id del dizionario corrente del dominio."""
+    return vocabulary(domain).encode(s)
+
+
+def encode_keys(domain: str, values) -> np.ndarray:
+    """Chiavi gia' normalizzate (es. matricole di un filtro) -> id; -1 per valori mai visti."""
+    return _current_vocabulary(domain).keys(values)
+
+
+def decode_ids(domain: str, ids) -> np.ndarray:
+    """id -> testo normalizzato del dominio ('' per -1).
+
+    Le colonne di get_encoded portano in attrs la generazione dei dizionari: se nel frattempo il
+    dizionario e' stato sostituito (vedi vocabulary) gli id non sono piu' decodificabili -> ValueError.
+    """
+    voc = _current_vocabulary(domain)
+    gen = (getattr(ids, 'attrs', None) or {}).get('vocabulary_generations', {}).get(domain)
+    if gen is not None and gen != voc.generation:
+        raise ValueError(f"Codifica '{domain}' di una generazione precedente ({gen}): ricalcolare con get_encoded")
+    return voc.values(ids)
+
+
+def text_column(s: pd.Series, upper: bool = False, fill: str | None = None) -> pd.Series:
+    """Come s.astype(str).str.strip() (fill: prima fillna(fill); upper: poi .str.upper()).
+
+    strip/upper calcolati sui soli valori distinti: sulle colonne con pochi valori ripetuti
+    (matricola, codici) evita il lavoro riga per riga. Stesso indice e nome di s, dtype object.
+    """
+    if fill is not None:
+        s = s.fillna(fill) if not isinstance(s.dtype, pd.CategoricalDtype) else s.astype(object).fillna(fill)
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # categorie gia' distinte
+        codes, uniques = s.cat.codes.to_numpy(), s.cat.categories.astype(str)
+    else:
+        # niente factorize sui valori grezzi: 1, 1.0 e True finirebbero nella stessa chiave
+        codes, uniques = pd.factorize(s.astype(str))
+    vals = pd.Index(np.asarray(uniques, dtype=object), dtype=object).str.strip()
+    if upper:
+        vals = vals.str.upper()
+    # codice -1 (vuoti) -> ultimo valore: come li rende astype(str) in questa versione di pandas ('nan' o NaN)
+    na = pd.Series([np.nan], dtype=object).astype(str).str.strip()
+    na = (na.str.upper() if upper else na).iloc[0]
+    vals = np.append(np.asarray(vals, dtype=object), np.array([na], dtype=object))
+    return pd.Series(vals[codes], index=s.index, name=s.name, dtype=object)
+
+
+def _encode_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Colonne <col>_id (int32) per le colonne di df previste da ENCODED_COLUMNS (stesso indice)."""
+    out = pd.DataFrame(index=df.index)
+    vocs = {}
+    for c in df.columns:
+        domain = ENCODED_COLUMNS.get(str(c).strip().lower())
+        if domain is not None:
+            if domain not in vocs:
+                vocs[domain] = vocabulary(domain)
+            out[f"{str(c).strip().lower()}_id"] = vocs[domain].encode(df[c])
+    out.attrs['vocabulary_generations'] = {d: v.generation for d, v in vocs.items()}
+    return out
+
+
+def _attivita_move_extra_turno_to_att(df: pd.DataFrame, primary_turni: set[str] | None = None) -> pd.DataFrame:
+    """Normalizza la tabella Attivita quando le *attività secondarie* sono state inserite come righe extra nel campo TURNO.
+
+    Scenario tipico (export/import):
+      - stessa matricola + stesso giorno -> più righe
+      - una riga con turno primario (es. M78/P38/N11...) + minuti ~480
+      - altre righe con codici attività (es. ESAU/ISTR/UCS...) e minuti diversi, ma messe in colonna TURNO
+
+    Obiettivo:
+      - per ogni (matricola, giorno) tenere 1 sola riga con TURNO valorizzato (primario)
+      - convertire le altre righe in secondarie usando la colonna ATT (TURNO vuoto)
+      - preservare minuti/valore per il calcolo ore delle secondarie
+
+    Primario: tra i codici presenti in Turni_tipo quello con piu' minuti, altrimenti la riga con
+    piu' minuti (a parita' la prima). Un solo passaggio vettoriale sui gruppi: stesso risultato,
+    riga per riga, della versione originale un gruppo alla volta (tests/bench/bench_attivita_regroup.py).
+    """
+    if df is None or len(df) == 0:
+        return df
+
+    out = df.copy()
+
+    # colonne minime
+    for c in ["matricola", "turno", "att"]:
+        if c not in out.columns:
+            out[c] = ""
+    if "data" not in out.columns:
+        return out
+
+    # data -> giorno (senza orario)
+    out["data"] = pd.to_datetime(out["data"], errors="coerce", dayfirst=True)
+    out["_day"] = out["data"].dt.normalize()
+
+    # minuti coerenti
+    if "minuti" in out.columns:
+        out["minuti"] = pd.to_numeric(out["minuti"], errors="coerce").fillna(0.0).astype(float)
+    else:
+        # fallback: se esiste valore in ore
+        if "valore" in out.columns:
+            out["valore"] = pd.to_numeric(out["valore"], errors="coerce").fillna(0.0).astype(float)
+            out["minuti"] = (out["valore"] * 60.0).round(0)
+        else:
+            out["minuti"] = 0.0
+
+    out["turno"] = out["turno"].fillna("").astype(str).str.strip()
+    out["att"] = out["att"].fillna("").astype(str).str.strip()
+
+    primary_turni = {str(x).strip().upper() for x in (primary_turni or set()) if str(x).strip()}
+
+    n = len(out)
+    pos = np.arange(n)
+    # numero gruppo nello stesso ordine dell'iterazione su groupby(sort=True, dropna=False)
+    gid = out.groupby(["matricola", "_day"], dropna=False, sort=True).ngroup().to_numpy()
+
+    # candidati: i codici di Turni_tipo se il gruppo ne ha, altrimenti tutte le righe
+    if primary_turni:
+        is_code = out["turno"].str.upper().isin(primary_turni).to_numpy()
+    else:
+        is_code = np.zeros(n, dtype=bool)
+    group_has_code = np.bincount(gid, weights=is_code) > 0
+    eligible = is_code | ~group_has_code[gid]
+
+    # primario = primo per (gruppo, candidato, minuti decrescenti, posizione) come idxmax
+    minuti = out["minuti"].to_numpy(dtype=float)
+    rank = np.lexsort((pos, -minuti, ~eligible, gid))
+    is_primary = np.zeros(n, dtype=bool)
+    first = np.ones(n, dtype=bool)
+    first[1:] = gid[rank][1:] != gid[rank][:-1]
+    is_primary[rank[first]] = True
+
+    # secondarie: codice in ATT (se vuota prende il TURNO), TURNO vuoto
+    sec = ~is_primary
+    att = out["att"].to_numpy(dtype=object)
+    turno = out["turno"].to_numpy(dtype=object)
+    out["att"] = np.where(sec & (att == ""), turno, att)
+    out["turno"] = np.where(sec, "", turno)
+
+    # per gruppo: primario, poi le secondarie nell'ordine originale
+    out2 = out.take(np.lexsort((pos, sec, gid))).reset_index(drop=True)
+
+    # pulizia helper
+    out2 = out2.drop(columns=["_day"], errors="ignore")
+
+    # ricalcola valore (ore) da minuti, se presente
+    out2["minuti"] = pd.to_numeric(out2.get("minuti", 0), errors="coerce").fillna(0.0).astype(float)
+    out2["valore"] = (out2["minuti"] / 60.0).round(2)
+
+    # dedup finale
+    out2 = out2.drop_duplicates()
+
+    return out2
+
+
+# --- Import a blocchi (file caricati) ---
+# Un export GT annuale (~500k righe) letto con excel_file.parse tiene in memoria insieme le celle
+# openpyxl, la lista di righe e il DataFrame dell'intero foglio, poi le sue copie (spostamento turni,
+# drop_duplicates, append/upsert, scrittura). L'import lavora invece un blocco di IMPORT_CHUNK_ROWS
+# righe alla volta, in tre passaggi appoggiati a file SQLite temporanei (vedi _StagedRows):
+#   1. lettura: openpyxl in sola lettura (ws.iter_rows), ogni blocco convertito con i tipi che
+#      darebbe read_excel, normalizzato e scritto nello staging (anche nei processi del pool)
+#   2. preparazione: per Attivita le righe si rileggono ordinate per (matricola, giorno) a blocchi
+#      che non spezzano mai un giorno, cosi' lo spostamento dei turni extra lavora blocco per
+#      blocco; i doppioni si tolgono con le impronte di riga (vedi _row_fingerprints)
+#   3. modalita': replace usa le righe preparate cosi' come sono, append/upsert confrontano ogni
+#      blocco con l'indice delle impronte della tabella e mettono nello staging solo righe
+#      cambiate e righe nuove
+# Al commit i motori dati scrivono la tabella rileggendo lo staging a blocchi (_ImportResult); con
+# SQLite un import in aggiunta/upsert aggiorna solo le righe cambiate e inserisce quelle nuove. In
+# memoria restano un blocco e le impronte (8 byte per riga); append/upsert usano la tabella
+# attuale gia' condivisa da get_all, senza copiarla. Limiti: i formati senza lettura a blocchi
+# (xls/ods) si leggono interi e il salvataggio Excel completo con openpyxl (file non gestiti a
+# livello zip) carica il workbook.
+IMPORT_CHUNK_ROWS = 50_000
+
+
+def excel_sheet_names(uploaded_file) -> list[str]:
+    """Nomi dei fogli senza caricare le celle (openpyxl in sola lettura per xlsx/xlsm).
+
+    Per CSV/TSV c'e' un solo foglio con il nome del file senza estensione.
+    """
+    if _is_delimited(uploaded_file):
+        return [_delimited_sheet_name(uploaded_file)]
+    try:
+        uploaded_file.seek(0)
+    except Exception:
+        pass
+    eng = _excel_engine_for_obj(uploaded_file)
+    if eng in (None, 'openpyxl'):
+        try:
+            from openpyxl import load_workbook
+            wb = load_workbook(uploaded_file, read_only=True, data_only=True, keep_links=False)
+            try:
+                return list(wb.sheetnames)
+            finally:
+                wb.close()
+        except Exception:
+            try:
+                uploaded_file.seek(0)
+            except Exception:
+                pass
+    with pd.ExcelFile(uploaded_file, engine=eng) as xf:
+        return list(xf.sheet_names)
+
+
+def _excel_cell(v):
+    # come il lettore openpyxl di pandas: float interi -> int
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def _excel_header_names(row: list) -> list:
+    """Nomi colonna dalla riga di intestazione come read_excel: vuoti -> 'Unnamed: i', doppi -> 'x.1'."""
+    names, seen = [], {}
+    for i, v in enumerate(row):
+        name = f"Unnamed: {i}" if v is None or (isinstance(v, str) and not v.strip()) else v
+        k = seen.get(name, 0)
+        seen[name] = k + 1
+        names.append(f"{name}.{k}" if k else name)
+    return names
+
+
+def _excel_chunk_frame(rows: list, names: list) -> pd.DataFrame:
+    """Righe di un blocco (valori openpyxl) -> DataFrame con i tipi che darebbe read_excel.
+
+    Celle vuote -> NaN, date -> datetime64; colonne di soli numeri, anche scritti come testo
+    ('1001', '0101') -> numeri; il resto resta testo/misto.
+    """
+    df = pd.DataFrame(rows, columns=range(len(names))).infer_objects()
+    for i in range(len(names)):
+        s = df[i]
+        if (pd.api.types.is_numeric_dtype(s) or pd.api.types.is_datetime64_any_dtype(s)
+                or pd.api.types.is_bool_dtype(s)):
+            continue
+        vals = s.dropna()
+        if not len(vals) or pd.api.types.infer_dtype(vals, skipna=True) == 'boolean':
+            continue
+        num = pd.to_numeric(vals, errors='coerce')
+        if num.notna().all():
+            df[i] = pd.to_numeric(s, errors='coerce')
+    df.columns = names
+    return df
+
+
+def _excel_sheet_chunks(wb, sheet_name: str, header=0, chunk_rows: int = IMPORT_CHUNK_ROWS):
+    """Legge un foglio (workbook openpyxl read-only) a blocchi: genera (DataFrame, righe lette, righe totali).
+
+    Le intestazioni (header=0) vengono dalla prima riga; i blocchi successivi usano gli stessi nomi.
+    La larghezza e' quella del primo blocco; le righe vuote in coda al foglio vengono scartate.
+    """
+    ws = wb[sheet_name]
+    total = int(ws.max_row or 0)
+    names = None
+    buf, empty_run, done = [], [], 0
+
+    def _frame(rows):
+        nonlocal names
+        if names is None:
+            width = max((len(r) for r in rows), default=0)
+            if header == 0:
+                names = _excel_header_names(rows[0] + [None] * (width - len(rows[0])))
+                rows = rows[1:]
+            else:
+                names = list(range(width))
+        width = len(names)
+        return _excel_chunk_frame([r[:width] + [None] * (width - len(r)) for r in rows], names)
+
+    for raw in ws.iter_rows(values_only=True):
+        row = [_excel_cell(v) for v in raw]
+        while row and (row[-1] is None or row[-1] == ""):
+            row.pop()
+        done += 1
+        if not row:
+            empty_run.append(row)
+            continue
+        if empty_run:
+            buf.extend(empty_run)
+            empty_run = []
+        buf.append(row)
+        if len(buf) >= chunk_rows + (1 if names is None and header == 0 else 0):
+            yield _frame(buf), done, total
+            buf = []
+    if buf or names is None:
+        yield (_frame(buf) if buf else pd.DataFrame()), done, total
+
+
+# --- Staging dell'import (SQLite temporaneo) ---
+# Ogni tabella di staging e' un file SQLite proprio nella cartella temporanea dell'import (i processi
+# del pool scrivono ciascuno il suo). Una riga e' la tupla dei suoi valori python serializzata con
+# pickle (numeri, testi e date restano quello che sono) accanto alle colonne di servizio per
+# ordinamento e posizione; riletto, ogni blocco prende i tipi che pandas deduce dai valori.
+
+def _stage_rows(folder, keys=()) -> "_StagedRows":
+    """Nuova tabella di staging (file SQLite proprio) nella cartella temporanea dell'import."""
+    import tempfile
+    fd, path = tempfile.mkstemp(prefix="stage_", suffix=".sqlite", dir=folder)
+    os.close(fd)
+    return _StagedRows(path, keys)
+
+
+class _StagedRows:
+    """Righe scritte a blocchi in una tabella SQLite temporanea e rilette a blocchi.
+
+    keys: colonne di servizio salvate accanto alla riga (chiavi di ordinamento, posizioni).
+    L'oggetto non tiene connessioni aperte: passa tra i processi del pool.
+    """
+
+    def __init__(self, path, keys=()):
+        self.path = str(path)
+        self.keys = tuple(keys)
+        self.columns = []
+        self.rows = 0
+        self._created = False
+
+    def __len__(self):
+        return self.rows
+
+    @staticmethod
+    def _q(name: str) -> str:
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _connect(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        # file temporaneo: niente journal ne' fsync
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    def append(self, df: pd.DataFrame, **keys):
+        """Aggiunge un blocco; keys: una sequenza di valori per ogni colonna di servizio."""
+        import pickle
+        self.columns += [c for c in df.columns if c not in self.columns]
+        conn = self._connect()
+        try:
+            with conn:
+                if not self._created:
+                    decl = ["r BLOB"] + [self._q(k) for k in self.keys]
+                    conn.execute(f"CREATE TABLE s ({', '.join(decl)})")
+                    self._created = True
+                if not len(df):
+                    return
+                # righe allineate alle colonne viste finora (quelle aggiunte dopo mancano in coda)
+                vals = df.reindex(columns=self.columns).astype(object)
+                blobs = [pickle.dumps(r, pickle.HIGHEST_PROTOCOL) for r in vals.itertuples(index=False, name=None)]
+                key_vals = [np.asarray(keys[k], dtype=object).tolist() for k in self.keys]
+                names = ["r"] + [self._q(k) for k in self.keys]
+                conn.executemany(f"INSERT INTO s ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                                 zip(blobs, *key_vals))
+                self.rows += len(df)
+        finally:
+            conn.close()
+
+    def chunks(self, size: int, by=(), keys: bool = False):
+        """Righe a blocchi di size righe.
+
+        Indice del blocco = posizione di scrittura della riga (0, 1, ...).
+        by: colonne di servizio per l'ordinamento (vuoti in fondo, a parita' l'ordine di
+        scrittura); un blocco non spezza mai le righe con le stesse chiavi by (puo' superare size).
+        keys: aggiunge al blocco le colonne di servizio.
+        """
+        if not self._created:
+            return
+        extra = list(self.keys) if keys else []
+        sel = ["rowid - 1", "r"] + [self._q(k) for k in extra] + [self._q(k) for k in by]
+        order = "".join(f"{self._q(k)} IS NULL, {self._q(k)}, " for k in by) + "rowid"
+        nb = len(by)
+        conn = self._connect()
+        try:
+            cur = conn.execute(f"SELECT {', '.join(sel)} FROM s ORDER BY {order}")
+            pending = []
+            while True:
+                block = cur.fetchmany(size)
+                rows = pending + block
+                if not rows:
+                    break
+                pending = []
+                if nb and len(block) == size:
+                    # le ultime righe potrebbero continuare nel blocco successivo: restano in attesa
+                    last = rows[-1][-nb:]
+                    cut = len(rows)
+                    while cut and rows[cut - 1][-nb:] == last:
+                        cut -= 1
+                    if not cut:
+                        pending = rows
+                        continue
+                    rows, pending = rows[:cut], rows[cut:]
+                yield self._frame(rows, extra)
+                if len(block) < size:
+                    break
+        finally:
+            conn.close()
+
+    def _frame(self, rows, extra) -> pd.DataFrame:
+        import pickle
+        n = len(self.columns)
+        recs = []
+        for r in rows:
+            rec = pickle.loads(r[1])
+            recs.append(rec + (np.nan,) * (n - len(rec)) if len(rec) < n else rec)
+        df = pd.DataFrame(recs, columns=range(n))
+        df.index = pd.Index([r[0] for r in rows], dtype='int64')
+        df.columns = self.columns
+        for j, k in enumerate(extra):
+            df[k] = [r[2 + j] for r in rows]
+        return df
+
+    def frame(self, by=(), keys: bool = False) -> pd.DataFrame:
+        """Tutte le righe in un solo DataFrame (solo dove serve davvero la tabella intera)."""
+        parts = list(self.chunks(max(self.rows, 1), by=by, keys=keys))
+        if parts:
+            return pd.concat(parts) if len(parts) > 1 else parts[0]
+        return pd.DataFrame(columns=self.columns + (list(self.keys) if keys else []))
+
+
+def _set_rows(part: pd.DataFrame, rel: np.ndarray, rows: pd.DataFrame):
+    """Valori di rows nelle righe rel (posizioni) di part, colonna per colonna.
+
+    Tipi diversi (es. testo su numero): la colonna passa a object e pandas ne deduce il tipo.
+    """
+    for c in rows.columns:
+        if c not in part.columns:
+            part[c] = pd.Series(np.nan, index=part.index, dtype=object)
+        col = part[c]
+        if col.dtype == rows[c].dtype:
+            arr = col.to_numpy(copy=True)
+            arr[rel] = rows[c].to_numpy()
+            part[c] = arr
+        else:
+            arr = col.to_numpy(dtype=object, copy=True)
+            arr[rel] = rows[c].to_numpy(dtype=object)
+            part[c] = pd.Series(arr, index=part.index).infer_objects()
+
+
+class _ImportResult:
+    """Tabella risultante da un import, letta a blocchi dal motore dati al commit.
+
+    Le righe della tabella attuale head (quelle presenti in patches sostituite, alla stessa
+    posizione) seguite dalle righe nuove di tail. save_table la mette in transazione cosi'
+    com'e'; dentro la transazione get_all la materializza (copy()).
+
+    stored: head e' la tabella come sta nel file dati (letta fuori transazione, senza journal):
+    il motore puo' scrivere solo righe cambiate e nuove (vedi SQLiteStorage._write_rows).
+    """
+
+    def __init__(self, tail: _StagedRows, head: pd.DataFrame | None = None,
+                 patches: _StagedRows | None = None, tail_by=(), chunk_rows: int = IMPORT_CHUNK_ROWS,
+                 stored: bool = False):
+        self.tail = tail
+        self.stored = stored and head is not None
+        self.chunk_rows = chunk_rows
+        self.head = head
+        self.patches = patches
+        self.tail_by = tuple(tail_by)
+        cols = list(head.columns) if head is not None else []
+        for src in (patches, tail):
+            if src is not None:
+                cols += [c for c in src.columns if c not in cols]
+        self._source = cols
+        self.columns = list(cols)
+
+    def __len__(self):
+        return (len(self.head) if self.head is not None else 0) + len(self.tail)
+
+    def set_axis(self, labels, axis=1):
+        """Stessi dati con altri nomi colonna (vedi _storage_column_names)."""
+        import copy
+        out = copy.copy(self)
+        out.columns = list(labels)
+        return out
+
+    def _named(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = df.reindex(columns=self._source)
+        df.columns = self.columns
+        return df
+
+    def head_chunks(self, size: int | None = None):
+        """Blocchi della tabella attuale con le righe cambiate al loro posto (indice = posizione)."""
+        size = size or self.chunk_rows
+        patches = self.patches.chunks(size, by=('_pos',), keys=True) if self.patches is not None else iter(())
+        buf = None
+        for start in range(0, len(self.head), size):
+            end = min(start + size, len(self.head))
+            part = _schema_release(self.head.iloc[start:end]).copy()
+            # righe cambiate in questo tratto (patches ordinate per posizione)
+            while buf is None or not len(buf) or buf['_pos'].iloc[-1] < end:
+                nxt = next(patches, None)
+                if nxt is None:
+                    break
+                buf = nxt if buf is None or not len(buf) else pd.concat([buf, nxt])
+            if buf is not None and len(buf):
+                here = buf['_pos'].to_numpy(dtype='int64') < end
+                rows, buf = buf[here], buf[~here]
+                if len(rows):
+                    _set_rows(part, rows['_pos'].to_numpy(dtype='int64') - start, rows.drop(columns='_pos'))
+            yield part
+
+    def chunks(self, size: int | None = None):
+        """Blocchi di righe nell'ordine finale (almeno uno, anche vuoto, con tutte le colonne)."""
+        size = size or self.chunk_rows
+        sent = False
+        if self.head is not None:
+            for part in self.head_chunks(size):
+                sent = True
+                yield self._named(part.reset_index(drop=True))
+        for part in self.tail_chunks(size):
+            sent = True
+            yield part
+        if not sent:
+            yield self._named(pd.DataFrame(columns=self._source))
+
+    def tail_chunks(self, size: int | None = None):
+        """Blocchi delle righe nuove (in fondo alla tabella)."""
+        for part in self.tail.chunks(size or self.chunk_rows, by=self.tail_by):
+            yield self._named(part)
+
+    def patch_chunks(self, size: int | None = None):
+        """Blocchi (righe cambiate, loro posizioni in head), per posizione; a parita' vale l'ultima."""
+        if self.patches is None:
+            return
+        for part in self.patches.chunks(size or self.chunk_rows, by=('_pos',), keys=True):
+            pos = part.pop('_pos').to_numpy(dtype='int64')
+            yield self._named(part), pos
+
+    def copy(self) -> pd.DataFrame:
+        """Tabella completa in memoria (letture dentro la transazione dell'import)."""
+        parts = list(self.chunks(max(len(self), 1)))
+        return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+
+    def row_ops(self, table: str, limit: int) -> list[dict] | None:
+        """Operazioni di journal equivalenti (vedi _row_ops); None se sono piu' di limit."""
+        n_patch = len(self.patches) if self.patches is not None else 0
+        if self.head is None or n_patch + len(self.tail) > limit:
+            return None
+        changed = self.patches.frame(keys=True) if n_patch else pd.DataFrame(columns=['_pos'])
+        changed = changed.drop_duplicates('_pos', keep='last').sort_values('_pos')
+        pos = changed.pop('_pos').to_numpy(dtype='int64')
+        before = self.head.iloc[pos]
+        after = pd.concat([changed.set_axis(before.index), self.tail.frame(by=self.tail_by)], ignore_index=False)
+        return _row_ops(table, before, after.reindex(columns=self._source), limit)
+
+
+def _frame_chunks(df, rows: int = IMPORT_CHUNK_ROWS):
+    """Righe di una tabella da scrivere a blocchi: quelli di un _ImportResult, altrimenti fette di
+    rows righe del DataFrame (almeno una, anche vuota, con tutte le colonne)."""
+    if isinstance(df, _ImportResult):
+        yield from df.chunks()
+        return
+    for start in range(0, max(len(df), 1), rows):
+        yield df.iloc[start:start + rows]
+
+
+# --- File delimitati (CSV/TSV) ---
+# L'export GT in CSV si legge con il parser C di pandas (10-50x piu' veloce di openpyxl), tutte le
+# colonne come testo (dtype object esplicito: nessuna inferenza diversa tra un blocco e l'altro);
+# poi ogni blocco viene tipizzato come farebbe read_excel su un foglio: colonne tutte numeriche ->
+# numeri (virgola decimale se il separatore e' ';'), codici con zeri iniziali lasciati testo, colonne
+# data standard -> datetime. Il file e' un "foglio" unico con il nome del file senza estensione, cosi'
+# mapping, riconoscimento intestazioni, Festivi e spostamento turni extra restano quelli di Excel.
+DELIMITED_SUFFIXES = {'.csv', '.tsv', '.txt'}
+DELIMITED_SAMPLE_BYTES = 1 << 16
+_DELIMITED_SEPARATORS = ';,\t|'
+
+
+def _is_delimited(obj) -> bool:
+    name = str(obj) if isinstance(obj, (str, Path)) else getattr(obj, 'name', None)
+    return bool(name) and Path(str(name)).suffix.lower() in DELIMITED_SUFFIXES
+
+
+def _delimited_sheet_name(obj) -> str:
+    """Nome del "foglio" di un file delimitato (nome file senza estensione)."""
+    name = str(obj) if isinstance(obj, (str, Path)) else (getattr(obj, 'name', None) or 'CSV')
+    return Path(str(name)).stem or 'CSV'
+
+
+def _delimited_encoding(sample: bytes) -> str:
+    """utf-8 (con o senza BOM) se l'inizio del file e' utf-8 valido, altrimenti cp1252 (export Windows).
+
+    sample: i primi byte del file (un carattere spezzato in fondo non conta).
+    """
+    import codecs
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp1252'
+
+
+def _delimited_separator(sample: str, suffix: str) -> str:
+    if suffix == '.tsv':
+        return '\t'
+    import csv
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=_DELIMITED_SEPARATORS).delimiter
+    except csv.Error:
+        # riga singola o campi irregolari: il separatore piu' frequente nella prima riga
+        first = sample.splitlines()[0] if sample else ''
+        return max(_DELIMITED_SEPARATORS, key=first.count) if first else ','
+
+
+def _csv_typed(df: pd.DataFrame, decimal: str = '.', dates: bool = False) -> pd.DataFrame:
+    """Tipi di un blocco letto come testo, come li darebbe read_excel sulle stesse celle."""
+    date_cols = {'data', 'data_inizio', 'data_fine'}
+    for c in df.columns:
+        s = df[c]
+        txt = s.dropna()
+        if not len(txt):
+            continue
+        txt = txt.astype(str).str.strip()
+        if dates and str(c).strip().lower() in date_cols:
+            dt = _text_dates(txt)
+            if dt.notna().all():
+                df[c] = dt.reindex(s.index)
+            continue
+        if txt.str.match(r'^[+-]?0\d').any():
+            continue  # codici tipo 0101 / 001234: restano testo
+        num = pd.to_numeric(txt.str.replace(',', '.', regex=False) if decimal == ',' else txt, errors='coerce')
+        if num.notna().all():
+            df[c] = num.reindex(s.index)
+    return df
+
+
+class _DelimitedFile:
+    """File CSV/TSV visto come un file Excel con un solo foglio (stessa interfaccia di pd.ExcelFile).
+
+    Codifica e separatore vengono dai primi DELIMITED_SAMPLE_BYTES byte; le righe si leggono dal
+    file (percorso o file caricato) a ogni parse/chunks, senza tenerlo in memoria.
+    """
+
+    def __init__(self, src):
+        self._src = src
+        name = str(src) if isinstance(src, (str, Path)) else (getattr(src, 'name', None) or '')
+        self.sheet_names = [_delimited_sheet_name(src)]
+        if isinstance(src, (str, Path)):
+            with open(src, 'rb') as fh:
+                sample = fh.read(DELIMITED_SAMPLE_BYTES)
+        else:
+            self._rewind()
+            sample = src.read(DELIMITED_SAMPLE_BYTES)
+            self._rewind()
+        if isinstance(sample, str):  # file aperto in modo testo: gia' decodificato
+            sample = sample.encode('utf-8')
+        self.encoding = _delimited_encoding(sample)
+        self.sep = _delimited_separator(sample.decode(self.encoding, errors='replace'), Path(name).suffix.lower())
+        self.decimal = ',' if self.sep == ';' else '.'
+        # righe totali per l'avanzamento: esatte se il campione e' tutto il file, altrimenti stimate
+        lines = sample.count(b'\n')
+        if len(sample) < DELIMITED_SAMPLE_BYTES:
+            self._total = lines + (0 if sample.endswith(b'\n') or not sample else 1)
+        else:
+            self._total = int(_import_source_size(src) * lines / len(sample))
+
+    def _rewind(self):
+        try:
+            self._src.seek(0)
+        except Exception:
+            pass
+
+    def _reader(self, header, nrows=None, chunksize=None):
+        if not isinstance(self._src, (str, Path)):
+            self._rewind()
+        return pd.read_csv(self._src, sep=self.sep, header=header, dtype=object,
+                           keep_default_na=False, na_values=[''], skip_blank_lines=True, engine='c',
+                           encoding=self.encoding, encoding_errors='replace', nrows=nrows,
+                           chunksize=chunksize)
+
+    def parse(self, sheet_name=None, header=0, nrows=None) -> pd.DataFrame:
+        try:
+            df = self._reader(header, nrows=nrows)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+        return _csv_typed(df, self.decimal, dates=header == 0)
+
+    def chunks(self, sheet_name=None, header=0, chunk_rows: int = IMPORT_CHUNK_ROWS):
+        """Come _excel_sheet_chunks: genera (DataFrame, righe lette, righe totali stimate).
+
+        Un blocco si consegna quando il successivo e' letto: l'ultimo porta il totale esatto.
+        """
+        done = 1 if header == 0 else 0
+        try:
+            reader = self._reader(header, chunksize=chunk_rows)
+        except pd.errors.EmptyDataError:
+            yield pd.DataFrame(), 0, 0
+            return
+        with reader:
+            last = None
+            for chunk in reader:
+                if last is not None:
+                    yield last, done, max(self._total, done + 1)
+                done += len(chunk)
+                last = _csv_typed(chunk, self.decimal, dates=header == 0)
+            if last is not None:
+                yield last, done, done
+
+    def close(self):
+        """Niente da chiudere: ogni lettura apre (e chiude) il file per conto suo."""
+        self._src = None
+
+
+def _open_import_source(src, engine):
+    """(workbook openpyxl read-only, None) per xlsx/xlsm, altrimenti (None, pd.ExcelFile o _DelimitedFile)."""
+    if _is_delimited(src):
+        return None, _DelimitedFile(src)
+    if engine in (None, 'openpyxl'):
+        try:
+            from openpyxl import load_workbook
+            return load_workbook(src, read_only=True, data_only=True, keep_links=False), None
+        except Exception:
+            try:
+                src.seek(0)
+            except Exception:
+                pass
+    return None, (pd.ExcelFile(src, engine=engine) if engine else pd.ExcelFile(src))
+
+
+def _import_read_chunks(wb, excel_file, sheet_name, header=0, normalize=None,
+                        chunk_rows: int = IMPORT_CHUNK_ROWS, progress=None):
+    """Blocchi del foglio; normalize viene applicata a ogni blocco appena letto.
+
+    I formati senza lettura a blocchi (xls/ods) danno un solo blocco con l'intero foglio.
+    """
+    if wb is None and not isinstance(excel_file, _DelimitedFile):
+        df = excel_file.parse(sheet_name, header=header)
+        if progress is not None:
+            progress(sheet_name, len(df), len(df))
+        yield normalize(df) if normalize is not None else df
+        return
+    if wb is None:
+        chunks = excel_file.chunks(sheet_name, header, chunk_rows)
+    else:
+        chunks = _excel_sheet_chunks(wb, sheet_name, header, chunk_rows)
+    for chunk, done, total in chunks:
+        yield normalize(chunk) if normalize is not None else chunk
+        if progress is not None:
+            progress(sheet_name, done, total)
+
+
+def _import_preview_sheet(wb, excel_file, sheet_name, nrows: int = 2) -> pd.DataFrame:
+    if wb is None:
+        return excel_file.parse(sheet_name, header=None, nrows=nrows)
+    gen = _excel_sheet_chunks(wb, sheet_name, None, nrows)
+    try:
+        return next(gen)[0]
+    finally:
+        gen.close()
+
+
+def _normalize_festivi(df_raw: pd.DataFrame) -> pd.DataFrame:
+    """Foglio Festivi -> colonne data (gg/mm, anno perpetuo) e nome.
+
+    La prima colonna può essere numerica tipo 0101 (ggmm) o una data vera.
+    """
+    # colonne attese: data (ggmm o date), nome/descrizione (opzionale)
+    cols = {c.lower(): c for c in df_raw.columns}
+    c_data = cols.get("data") or cols.get("giorno") or cols.get("ggmm") or list(df_raw.columns)[0]
+    c_nome = cols.get("nome") or cols.get("festivo") or cols.get("descrizione") or (list(df_raw.columns)[1] if len(df_raw.columns) > 1 else None)
+
+    def _to_ddmm(v):
+        if v is None or (isinstance(v, float) and pd.isna(v)):
+            return None
+        s = str(v).strip()
+        if not s:
+            return None
+        # Se Excel ha interpretato come data vera
+        try:
+            dt = pd.to_datetime(v, errors="coerce")
+            if pd.notna(dt):
+                return dt.strftime("%d/%m")
+        except Exception:
+            pass
+        s = re.sub(r"[^0-9]", "", s)
+        if len(s) == 3:  # es 101 -> 0101
+            s = "0" + s
+        if len(s) >= 4:
+            gg = s[:2]
+            mm = s[2:4]
+            return f"{gg}/{mm}"
+        return None
+
+    out = pd.DataFrame()
+    out["ddmm"] = df_raw[c_data].apply(_to_ddmm)
+    out["nome"] = (df_raw[c_nome] if c_nome else "").astype(str).str.strip()
+    out = out[out["ddmm"].notna()].copy()
+    # compatibilità: tabella Festivi usa colonna 'data' come dd/mm
+    out.rename(columns={"ddmm": "data"}, inplace=True)
+    return out
+
+
+def _import_sheet_chunks(wb, excel_file, sheet_name, dest_table, chunk_rows: int = IMPORT_CHUNK_ROWS,
+                         progress=None):
+    """Blocchi del foglio normalizzati per dest_table (lo spostamento dei turni extra e' in _import_prepare)."""
+    def _read(header=0, normalize=None):
+        return _import_read_chunks(wb, excel_file, sheet_name, header, normalize, chunk_rows, progress)
+
+    # --- FESTIVI ---
+    if dest_table == 'Festivi':
+        return _read(0, lambda chunk: _normalize_festivi(_normalize_columns_generic(chunk)))
+
+    # --- ATTIVITA (GT_IMPORT) ---
+    if dest_table == 'Attivita':
+        # Il file "Attivita" può avere header "strano" o mancante: rileviamo se la prima riga è header.
+        preview = _import_preview_sheet(wb, excel_file, sheet_name)
+        if _looks_like_header_row(preview):
+            return _read(0, _normalize_columns_generic)
+        # colonne riconosciute sul primo blocco, poi le stesse per tutti
+        roles = {}
+
+        def _norm_headerless(chunk):
+            if 'map' not in roles:
+                roles['map'] = _attivita_headerless_mapping(chunk.dropna(axis=1, how='all'))
+            return _normalize_attivita_headerless(chunk, roles['map'])
+
+        return _read(None, _norm_headerless)
+
+    return _read(0, _normalize_columns_generic)
+
+
+# chiavi dei gruppi (matricola, giorno) di Attivita nello staging (vedi _attivita_group_keys)
+_ATTIVITA_GROUP_KEYS = ('_kn', '_kt', '_kd')
+
+
+def _attivita_group_keys(df: pd.DataFrame) -> dict:
+    """Chiavi (matricola, giorno) di ogni riga Attivita per l'ordinamento nello staging.
+
+    _kn: matricola numerica (None per testo e vuoti); _kt: matricola normalizzata (None se vuota);
+    _kd: giorno ISO (None senza data valida). Ordinando per _kn, _kt, _kd (vuoti in fondo) i gruppi
+    escono nell'ordine di groupby(sort=True) sulla matricola originale (numeri, poi testi, poi vuoti),
+    come in _attivita_move_extra_turno_to_att sull'intero foglio.
+    """
+    n = len(df)
+    if 'matricola' in df.columns:
+        m = df['matricola']
+        kn = []
+        for v in m.astype(object).tolist():
+            if isinstance(v, (bool, np.bool_)) or not isinstance(v, (int, float, np.integer, np.floating)):
+                kn.append(None)
+            elif isinstance(v, (float, np.floating)):
+                kn.append(None if np.isnan(v) else float(v))
+            else:
+                kn.append(int(v))
+        kt = np.where(m.isna().to_numpy(), None, _fp_text(m)).tolist()
+    else:
+        kn, kt = [None] * n, [''] * n
+    if 'data' in df.columns:
+        day = pd.to_datetime(df['data'], errors='coerce', dayfirst=True)
+        kd = day.dt.strftime('%Y-%m-%d').where(day.notna(), None).tolist()
+    else:
+        kd = [None] * n
+    return {'_kn': kn, '_kt': kt, '_kd': kd}
+
+
+def _attivita_day_keys(df: pd.DataFrame) -> np.ndarray:
+    """Impronta (matricola normalizzata, giorno) per riga: i giorni toccati da un import in aggiunta."""
+    day = pd.to_datetime(df['data'], errors='coerce', dayfirst=True).dt.normalize()
+    return _row_fingerprints(pd.DataFrame({'matricola': _fp_text(df['matricola']), 'data': day}))
+
+
+def _import_stage_sheet(wb, excel_file, sheet_name, dest_table, folder,
+                        chunk_rows: int = IMPORT_CHUNK_ROWS, progress=None) -> _StagedRows:
+    """Primo passaggio: foglio letto, normalizzato e scritto nello staging un blocco alla volta."""
+    keys = _ATTIVITA_GROUP_KEYS if dest_table == 'Attivita' else ()
+    raw = _stage_rows(folder, keys)
+    for chunk in _import_sheet_chunks(wb, excel_file, sheet_name, dest_table, chunk_rows, progress):
+        raw.append(chunk, **(_attivita_group_keys(chunk) if keys else {}))
+    return raw
+
+
+def _import_prepare(table: str, raw: _StagedRows, folder, chunk_rows: int = IMPORT_CHUNK_ROWS,
+                    primary: set | None = None, keys=None):
+    """Secondo passaggio: righe del foglio pronte per la modalita' di import, a blocchi.
+
+    Attivita: i blocchi si rileggono ordinati per (matricola, giorno) senza spezzare un giorno e lo
+    spostamento dei turni extra lavora blocco per blocco, con lo stesso risultato che sull'intero
+    foglio. Doppioni (stessa impronta, anche in blocchi diversi): resta la prima riga.
+
+    Returns:
+        (righe preparate, impronte uniche delle righe, impronte delle chiavi naturali per riga
+         preparata o None senza keys)
+    """
+    by = _ATTIVITA_GROUP_KEYS if table == 'Attivita' and 'data' in raw.columns else ()
+    out = _stage_rows(folder, _ATTIVITA_GROUP_KEYS if table == 'Attivita' else ())
+    seen = np.empty(0, dtype='uint64')
+    key_fps = []
+    for chunk in raw.chunks(chunk_rows, by=by):
+        if table == 'Attivita':
+            try:
+                chunk = _attivita_move_extra_turno_to_att(chunk, primary_turni=primary)
+            except Exception:
+                # best effort: non bloccare l'import se qualcosa non torna
+                pass
+        fp = _row_fingerprints(chunk)
+        keep = ~pd.Series(fp).duplicated().to_numpy() & ~_fp_seen(fp, seen)
+        chunk, fp = chunk[keep], fp[keep]
+        seen = _fp_add(seen, fp)
+        if keys and set(keys).issubset(chunk.columns):
+            key_fps.append(_row_fingerprints(chunk[list(keys)]))
+        out.append(chunk, **(_attivita_group_keys(chunk) if table == 'Attivita' else {}))
+    if not out.columns:
+        out.append(raw.frame())  # foglio senza righe: restano le colonne
+    key_fps = np.concatenate(key_fps) if keys and key_fps else (np.empty(0, dtype='uint64') if keys else None)
+    return out, seen, key_fps
+
+
+# --- Lettura dei fogli in parallelo ---
+# Un pacchetto mensile (Attivita, Straordinario, Personale, tabelle di decodifica) ha piu' fogli
+# mappati e il parsing openpyxl + normalizzazione e' CPU-bound: nei thread il GIL lo serializza.
+# Con almeno due fogli e un file non piccolo ogni foglio viene letto in un processo del pool (avvio
+# 'spawn': il processo Streamlit ha gia' i suoi thread, fork non e' sicuro) da una copia temporanea
+# del file e scrive le righe nel suo file di staging; il processo principale riceve solo i
+# riferimenti allo staging e applica modalita' e scrittura in un solo commit. Il pool si crea per
+# il singolo import e si chiude alla fine (nessun processo resta attivo tra un import e l'altro).
+# Se non parte (ambiente senza processi figli) si legge nel thread corrente.
+IMPORT_PARALLEL_MIN_BYTES = 1 << 20
+IMPORT_PARALLEL_MAX_WORKERS = 8
+
+
+def _import_sheet_task(path: str, engine, sheet_name, dest_table, folder, chunk_rows: int) -> _StagedRows:
+    """Lettura di un foglio nel processo del pool (apre il file per conto suo, scrive il suo staging)."""
+    wb, excel_file = _open_import_source(path, engine)
+    try:
+        return _import_stage_sheet(wb, excel_file, sheet_name, dest_table, folder, chunk_rows)
+    finally:
+        (wb or excel_file).close()
+
+
+def _import_cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def _import_pool_workers(tasks) -> int:
+    """Processi per un import: uno per foglio, al massimo IMPORT_PARALLEL_MAX_WORKERS e le CPU."""
+    return max(1, min(len(tasks), IMPORT_PARALLEL_MAX_WORKERS, _import_cpu_count()))
+
+
+def _import_source_size(obj) -> int:
+    if isinstance(obj, (str, Path)):
+        return _source_signature(Path(obj))[1]
+    size = getattr(obj, 'size', None)
+    if isinstance(size, int):
+        return size
+    try:
+        return obj.getbuffer().nbytes
+    except Exception:
+        return 0
+
+
+def _import_use_pool(parallel, tasks, uploaded_file) -> bool:
+    if parallel is not None:
+        return bool(parallel) and len(tasks) > 1
+    return (_import_pool_workers(tasks) > 1
+            and _import_source_size(uploaded_file) >= IMPORT_PARALLEL_MIN_BYTES)
+
+
+def _import_sheets_parallel(uploaded_file, engine, tasks, folder, chunk_rows: int = IMPORT_CHUNK_ROWS,
+                            progress=None):
+    """{foglio: _StagedRows} letti in un pool di processi; None se il pool non e' utilizzabile.
+
+    Il pool vive solo per questa chiamata: alla fine i processi terminano e la memoria torna al
+    sistema. Gli errori di lettura di un foglio vengono rilanciati come nella lettura sequenziale.
+    """
+    import multiprocessing
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    suffix = Path(str(getattr(uploaded_file, 'name', '') or uploaded_file)).suffix or '.xlsx'
+    if isinstance(uploaded_file, (str, Path)):
+        path, tmp = str(uploaded_file), None
+    else:
+        try:
+            uploaded_file.seek(0)
+        except Exception:
+            pass
+        with tempfile.NamedTemporaryFile(prefix="persgest_import_", suffix=suffix, delete=False) as fh:
+            shutil.copyfileobj(uploaded_file, fh)
+        path = tmp = fh.name
+
+    futs = {}
+    ex = None
+    try:
+        try:
+            ex = ProcessPoolExecutor(max_workers=_import_pool_workers(tasks),
+                                     mp_context=multiprocessing.get_context("spawn"))
+            for sheet_name, dest_table in tasks:
+                futs[ex.submit(_import_sheet_task, path, engine, sheet_name, dest_table, folder,
+                               chunk_rows)] = sheet_name
+        except (BrokenProcessPool, OSError, RuntimeError):
+            return None
+        out = {}
+        for fut in as_completed(futs):
+            sheet_name = futs[fut]
+            try:
+                rows = fut.result()
+            except BrokenProcessPool:
+                return None
+            out[sheet_name] = rows
+            if progress is not None:
+                progress(sheet_name, len(rows), len(rows))
+        return out
+    finally:
+        if ex is not None:
+            # attende i processi (anche dopo un errore: niente figli rimasti con il file aperto)
+            ex.shutdown(wait=True, cancel_futures=True)
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+# --- Impronte di riga (import in aggiunta senza duplicati) ---
+# In modalita' 'append' una riga importata e' nuova solo se non esiste gia' identica in tabella.
+# Il controllo riguarda le righe in arrivo: doppioni gia' presenti in tabella non vengono tolti
+# (vedi _append_new_rows).
+# Invece di concatenare tutta la storia e rifare drop_duplicates, ogni versione di tabella ha un
+# indice di impronte (hash 64 bit dei valori normalizzati di tutte le colonne, ordinato) salvato in
+# persgest_cache/<tabella>.fp.v<epoch>_<versione>.pkl: l'import calcola le impronte delle sole righe
+# in arrivo. I valori sono normalizzati come dopo un salvataggio/rilettura (testo senza spazi,
+# 1001 == 1001.0 == '1001', float a 6 decimali, date come datetime), cosi' la stessa riga ha la
+# stessa impronta prima e dopo il passaggio dal file.
+
+def _fp_value(v) -> str:
+    if v is None:
+        return ''
+    if isinstance(v, str):
+        return v.strip()
+    if isinstance(v, (bool, np.bool_)):
+        return str(bool(v))
+    if isinstance(v, (int, np.integer)):
+        return str(int(v))
+    if isinstance(v, (float, np.floating)):
+        if np.isnan(v):
+            return ''
+        r = round(float(v), 6)
+        return str(int(r)) if r.is_integer() else repr(r)
+    try:
+        if pd.isna(v):
+            return ''
+    except (TypeError, ValueError):
+        pass
+    if isinstance(v, (datetime, date)):
+        return pd.Timestamp(v).strftime('%Y-%m-%d %H:%M:%S')
+    return str(v).strip()
+
+
+def _fp_text(s: pd.Series) -> np.ndarray:
+    """Testo normalizzato della colonna (calcolato sui soli valori distinti)."""
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    return np.array([_fp_value(u) for u in uniques] + [''], dtype=object)[codes]
+
+
+def _row_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    """Impronta uint64 per riga: somma degli hash (nome colonna, valore) dei valori non vuoti.
+
+    Una colonna assente e una colonna vuota danno la stessa impronta (il file riletto puo' avere
+    colonne in piu' o in un altro ordine).
+    """
+    n = len(df)
+    out = np.zeros(n, dtype='uint64')
+    if not n:
+        return out
+    base = _coerce_date_columns(df.copy(deep=False))
+    for c in base.columns:
+        txt = _fp_text(base[c])
+        key = hashlib.md5(str(c).strip().encode('utf-8')).hexdigest()[:16]
+        h = pd.util.hash_array(txt, hash_key=key, categorize=True)
+        h[txt == ''] = 0
+        out += h
+    return out
+
+
+def _fp_seen(fp: np.ndarray, seen: np.ndarray) -> np.ndarray:
+    """Maschera delle impronte fp gia' in seen (ordinato): memoria del solo fp, non di seen."""
+    if not len(seen):
+        return np.zeros(len(fp), dtype=bool)
+    at = np.searchsorted(seen, fp).clip(max=len(seen) - 1)
+    return seen[at] == fp
+
+
+def _fp_add(seen: np.ndarray, fp: np.ndarray) -> np.ndarray:
+    """seen (ordinato, unico) unito alle impronte nuove fp: una sola copia di seen, ordinata sul posto."""
+    fp = np.unique(fp)
+    fp = fp[~_fp_seen(fp, seen)]
+    if not len(fp):
+        return seen
+    out = np.concatenate((seen, fp))
+    out.sort(kind='stable')
+    return out
+
+
+# Chiavi naturali per l'import in modalita' upsert: una riga in arrivo con la stessa chiave di una
+# riga esistente la aggiorna (colonne del file), altrimenti viene inserita. Modificabile per tabella;
+# import_excel(natural_keys=...) sovrascrive le voci per il singolo import. Se le righe toccate sono
+# poche (meno di JOURNAL_COMPACT_ENTRIES operazioni) l'import scrive solo quelle, come update/add nel
+# journal, invece di riscrivere la tabella; la compattazione le riporta poi nel file dati.
+IMPORT_NATURAL_KEYS = {
+    'Attivita': ['matricola', 'data', 'turno', 'att'],
+    'Straordinario': ['matricola', 'data'],
+}
+
+
+def _row_ops(table: str, before: pd.DataFrame, after: pd.DataFrame, limit: int) -> list[dict] | None:
+    """Operazioni di journal (update sul posto, add in fondo) che portano before ad after.
+
+    after deve essere before con alcune righe cambiate sul posto e le righe nuove in fondo, come
+    i risultati di _append_new_rows/_upsert_rows. Valori confrontati normalizzati come nelle
+    impronte (1001 -> '1001' non e' una modifica); negli update solo le colonne cambiate.
+    None se servono piu' di limit operazioni (meglio riscrivere la tabella).
+    """
+    n = len(before)
+    if len(after) < n:
+        return None
+    head = after.iloc[:n]
+    changed = np.flatnonzero(_row_fingerprints(before) != _row_fingerprints(head))
+    if len(changed) + len(after) - n > limit:
+        return None
+    ts, by = time.time(), current_session_id()
+    ops = []
+    if len(changed):
+        b, a = before.iloc[changed], head.iloc[changed]
+        diff = {c: _fp_text(a[c]) != (_fp_text(b[c]) if c in b.columns else '') for c in after.columns}
+        for k, pos in enumerate(changed):
+            rec = {str(c): _journal_encode(a[c].iat[k]) for c in after.columns if diff[c][k]}
+            ops.append({"ts": ts, "by": by, "table": table, "op": "update",
+                        "index": int(before.index[pos]), "record": rec})
+    for row in after.iloc[n:].to_dict("records"):
+        ops.append({"ts": ts, "by": by, "table": table, "op": "add", "index": None,
+                    "record": {str(c): _journal_encode(v) for c, v in row.items()}})
+    return ops
+
+
+# ============================
+# Sostituzione fogli a livello zip (xlsx)
+# ============================
+#
+# Un xlsx e' uno zip: ogni foglio e' un membro xl/worksheets/sheetN.xml. Per riscrivere una tabella
+# basta generare quel solo membro dal DataFrame (stringhe inline, nessun tocco a sharedStrings.xml)
+# e copiare tutti gli altri membri cosi' come sono (byte compressi inclusi, senza ricomprimere).
+# Se il file ha strutture che il percorso veloce non gestisce (foglio nuovo, relazioni del foglio,
+# calcChain, zip64) si torna al salvataggio completo con openpyxl.
+
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+_XML_ILLEGAL_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_XLSX_DATE_FORMAT = "yyyy-mm-dd h:mm:ss"  # stesso formato usato da openpyxl per i datetime
+_EXCEL_EPOCH = pd.Timestamp("1899-12-30")
+
+
+class _ZipFastPathUnsupported(Exception):
+    """Il workbook richiede il salvataggio completo (openpyxl)."""
+
+
+def _xlsx_col_letter(idx: int) -> str:
+    out = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        out = chr(65 + rem) + out
+    return out
+
+
+def _xml_text(v: str) -> str:
+    v = _XML_ILLEGAL_RE.sub("", v)
+    return v.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _xlsx_cell(ref: str, v, date_style: int | None) -> str:
+    """Cella SpreadsheetML per un valore Python ('' per celle vuote)."""
+    if v is None:
+        return ""
+    if isinstance(v, (bool, np.bool_)):
+        return f'<c r="{ref}" t="b"><v>{int(v)}</v></c>'
+    if isinstance(v, (int, np.integer)):
+        return f'<c r="{ref}"><v>{int(v)}</v></c>'
+    if isinstance(v, (float, np.floating)):
+        if not np.isfinite(v):
+            return ""
+        return f'<c r="{ref}"><v>{repr(float(v))}</v></c>'
+    if isinstance(v, (pd.Timestamp, datetime, date)) and not isinstance(v, pd.Timedelta):
+        if pd.isna(v):
+            return ""
+        ts = pd.Timestamp(v)
+        if ts.tzinfo is not None:
+            ts = ts.tz_localize(None)
+        serial = (ts - _EXCEL_EPOCH) / pd.Timedelta(days=1)
+        return f'<c r="{ref}" s="{date_style}"><v>{repr(float(serial))}</v></c>'
+    try:
+        if pd.isna(v):
+            return ""
+    except (TypeError, ValueError):
+        pass
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{_xml_text(str(v))}</t></is></c>'
+
+
+def _xlsx_sheet_xml(df: pd.DataFrame, date_style: int | None):
+    """Genera (a blocchi) l'XML del foglio: riga 1 intestazioni, poi i dati (come dataframe_to_rows)."""
+    ncols = len(df.columns)
+    letters = [_xlsx_col_letter(i) for i in range(ncols)]
+    nrows = len(df) + 1
+    dim = f"A1:{letters[-1]}{nrows}" if ncols else "A1"
+    yield (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           f'<worksheet xmlns="{_NS_MAIN}"><dimension ref="{dim}"/><sheetData>')
+    if ncols:
+        yield '<row r="1">' + "".join(_xlsx_cell(f"{letters[j]}1", str(c), None) for j, c in enumerate(df.columns)) + "</row>"
+        r = 1
+        for part in _frame_chunks(df):
+            cols = []
+            for j in range(ncols):
+                s = part.iloc[:, j]
+                if pd.api.types.is_datetime64_any_dtype(s):
+                    cols.append([None if pd.isna(x) else x for x in s.tolist()])
+                else:
+                    cols.append(s.tolist())
+            buf = []
+            for i in range(len(part)):
+                r += 1
+                cells = "".join(_xlsx_cell(f"{letters[j]}{r}", cols[j][i], date_style) for j in range(ncols))
+                buf.append(f'<row r="{r}">{cells}</row>')
+                if len(buf) >= 2000:
+                    yield "".join(buf)
+                    buf = []
+            if buf:
+                yield "".join(buf)
+    yield "</sheetData></worksheet>"
+
+
+def _xlsx_needs_date_style(df: pd.DataFrame) -> bool:
+    if isinstance(df, _ImportResult):
+        # le righe dell'import si leggono solo in scrittura: lo stile data si aggiunge comunque
+        return True
+    for j in range(len(df.columns)):
+        s = df.iloc[:, j]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            if s.notna().any():
+                return True
+        elif s.dtype == object:
+            if any(isinstance(x, (pd.Timestamp, datetime, date)) for x in s.tolist()):
+                return True
+    return False
+
+
+def _xlsx_ensure_date_style(styles_xml: str) -> tuple[str, int]:
+    """Ritorna (styles.xml, indice cellXfs) con uno stile data 'yyyy-mm-dd h:mm:ss' (aggiunto se manca)."""
+    fmt_id = None
+    for m in re.finditer(r'<numFmt\s+numFmtId="(\d+)"\s+formatCode="([^"]*)"\s*/>', styles_xml):
+        if m.group(2) == _XLSX_DATE_FORMAT:
+            fmt_id = int(m.group(1))
+            break
+    if fmt_id is None:
+        ids = [int(x) for x in re.findall(r'<numFmt\s+numFmtId="(\d+)"', styles_xml)]
+        fmt_id = max([163] + ids) + 1
+        new_fmt = f'<numFmt numFmtId="{fmt_id}" formatCode="{_XLSX_DATE_FORMAT}"/>'
+        m = re.search(r'<numFmts\s+count="(\d+)"\s*(/?)>', styles_xml)
+        if m and m.group(2):
+            # <numFmts count="0" /> (openpyxl senza formati personalizzati)
+            styles_xml = styles_xml[:m.start()] + f'<numFmts count="1">{new_fmt}</numFmts>' + styles_xml[m.end():]
+        elif m:
+            styles_xml = (styles_xml[:m.start()] + f'<numFmts count="{int(m.group(1)) + 1}">' + new_fmt
+                          + styles_xml[m.end():])
+        else:
+            m = re.search(r"<styleSheet\b[^>]*>", styles_xml)
+            if not m:
+                raise _ZipFastPathUnsupported("styles.xml")
+            styles_xml = styles_xml[:m.end()] + f'<numFmts count="1">{new_fmt}</numFmts>' + styles_xml[m.end():]
+
+    m = re.search(r'<cellXfs\s+count="(\d+)"\s*>(.*?)</cellXfs>', styles_xml, flags=re.S)
+    if not m:
+        raise _ZipFastPathUnsupported("cellXfs")
+    xfs = re.findall(r"<xf\b[^>]*?(?:/>|>.*?</xf>)", m.group(2), flags=re.S)
+    for i, xf in enumerate(xfs):
+        if f'numFmtId="{fmt_id}"' in xf:
+            return styles_xml, i
+    new_xf = f'<xf numFmtId="{fmt_id}" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    body = m.group(2) + new_xf
+    styles_xml = (styles_xml[:m.start()] + f'<cellXfs count="{len(xfs) + 1}">' + body + "</cellXfs>"
+                  + styles_xml[m.end():])
+    return styles_xml, len(xfs)
+
+
+def _xlsx_sheet_members(zf: zipfile.ZipFile) -> dict:
+    """Nome foglio -> membro zip (xl/worksheets/sheetN.xml)."""
+    import xml.etree.ElementTree as ET
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {r.get("Id"): r.get("Target") for r in rels.findall(f"{{{_NS_PKG_REL}}}Relationship")}
+    out = {}
+    for sh in wb.iter(f"{{{_NS_MAIN}}}sheet"):
+        t = targets.get(sh.get(f"{{{_NS_REL}}}id"))
+        if not t:
+            continue
+        out[sh.get("name")] = t.lstrip("/") if t.startswith("/") else f"xl/{t}"
+    return out
+
+
+def _zip_dos_datetime(dt: datetime) -> tuple[int, int]:
+    return ((dt.hour << 11) | (dt.minute << 5) | (dt.second // 2),
+            ((max(dt.year, 1980) - 1980) << 9) | (dt.month << 5) | dt.day)
+
+
+def _xlsx_replace_sheets(src: Path, dst: Path, data: dict):
+    """Scrive in dst una copia di src con i fogli indicati rigenerati dai DataFrame.
+
+    I membri non toccati vengono copiati con i byte compressi originali.
+
+    Returns:
+        Membri zip riscritti
+    """
+    import struct
+    with zipfile.ZipFile(src) as zf:
+        infos = zf.infolist()
+        names = {zi.filename for zi in infos}
+        if len(infos) >= 0xFFFF or any(zi.file_size >= 0xFFFFFFFF or zi.compress_size >= 0xFFFFFFFF
+                                       or zi.header_offset >= 0xFFFFFFFF for zi in infos):
+            raise _ZipFastPathUnsupported("zip64")
+        if "xl/calcChain.xml" in names:
+            raise _ZipFastPathUnsupported("calcChain")
+        members = _xlsx_sheet_members(zf)
+
+        replaced = {}
+        for table in data:
+            member = members.get(table)
+            if member is None or member not in names:
+                raise _ZipFastPathUnsupported(f"foglio {table} assente")
+            rels = member.rsplit("/", 1)
+            if f"{rels[0]}/_rels/{rels[1]}.rels" in names:
+                raise _ZipFastPathUnsupported(f"foglio {table} con relazioni")
+            replaced[member] = table
+
+        new_parts = {}
+        if any(_xlsx_needs_date_style(df) for df in data.values()):
+            styles, date_style = _xlsx_ensure_date_style(zf.read("xl/styles.xml").decode("utf-8"))
+            new_parts["xl/styles.xml"] = styles.encode("utf-8")
+        else:
+            date_style = None
+
+    def _deflate(fout, chunks):
+        # compresso direttamente nel file: in memoria solo il blocco corrente
+        comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc, size, csize = 0, 0, 0
+        for ch in chunks:
+            b = ch.encode("utf-8") if isinstance(ch, str) else ch
+            crc = zlib.crc32(b, crc)
+            size += len(b)
+            out = comp.compress(b)
+            csize += len(out)
+            fout.write(out)
+        out = comp.flush()
+        fout.write(out)
+        return csize + len(out), crc & 0xFFFFFFFF, size
+
+    def _copy(fin, fout, n):
+        while n > 0:
+            b = fin.read(min(n, 1 << 16))
+            if not b:
+                raise _ZipFastPathUnsupported("membro zip troncato")
+            fout.write(b)
+            n -= len(b)
+
+    date_time = _zip_dos_datetime(datetime.now())
+    central = []
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for zi in infos:
+            fin.seek(zi.header_offset)
+            hdr = fin.read(30)
+            if hdr[:4] != b"PK\x03\x04":
+                raise _ZipFastPathUnsupported("header zip")
+            name_len, extra_len = struct.unpack("<HH", hdr[26:30])
+            name_b = fin.read(name_len)
+            fin.seek(extra_len, 1)
+            flags = zi.flag_bits & ~0x08  # niente data descriptor: dimensioni note
+
+            offset = fout.tell()
+            if zi.filename in replaced or zi.filename in new_parts:
+                method, dtime, ddate = zipfile.ZIP_DEFLATED, date_time[0], date_time[1]
+                # header provvisorio: crc e dimensioni si scrivono a compressione finita
+                fout.write(b"\0" * 30 + name_b)
+                if zi.filename in replaced:
+                    csize, crc, usize = _deflate(fout, _xlsx_sheet_xml(data[replaced[zi.filename]], date_style))
+                else:
+                    csize, crc, usize = _deflate(fout, [new_parts[zi.filename]])
+                end = fout.tell()
+                if usize >= 0xFFFFFFFF or end >= 0xFFFFFFFF:
+                    raise _ZipFastPathUnsupported("zip64")
+                fout.seek(offset)
+                fout.write(struct.pack("<IHHHHHIIIHH", 0x04034B50, 20, flags, method, dtime, ddate,
+                                       crc, csize, usize, len(name_b), 0))
+                fout.seek(end)
+            else:
+                crc, csize, usize, method = zi.CRC, zi.compress_size, zi.file_size, zi.compress_type
+                dtime, ddate = _zip_dos_datetime(datetime(*zi.date_time))
+                fout.write(struct.pack("<IHHHHHIIIHH", 0x04034B50, 20, flags, method, dtime, ddate,
+                                       crc, csize, usize, len(name_b), 0))
+                fout.write(name_b)
+                _copy(fin, fout, csize)
+            central.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, zi.create_version if zi.create_version else 20,
+                                       20, flags, method, dtime, ddate, crc, csize, usize,
+                                       len(name_b), 0, 0, 0, zi.internal_attr, zi.external_attr, offset) + name_b)
+
+        cd_offset = fout.tell()
+        for c in central:
+            fout.write(c)
+        cd_size = fout.tell() - cd_offset
+        fout.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, len(central), len(central), cd_size, cd_offset, 0))
+        fout.flush()
+        os.fsync(fout.fileno())
+
+    return list(replaced) + list(new_parts)
+
+
+# ============================
+# Storage backend (Excel / SQLite)
+# ============================
+#
+# PersGestDatabase espone sempre la stessa API (get_all/save_table/add_record/...).
+# Il "motore" fisico che conserva le tabelle e' intercambiabile:
+#   - excel  : un foglio per tabella in persgest_master.xlsx (default storico)
+#   - sqlite : una tabella SQLite per tabella in persgest_master.sqlite (stessa cartella)
+# L'Excel resta comunque il formato di import/export (import_excel / export_excel).
+
+STORAGE_ENV_VAR = "PERSGEST_STORAGE"
+DEFAULT_STORAGE_BACKEND = "excel"
+
+# Colonne indicizzate nel backend SQLite (confronto case-insensitive sul nome colonna)
+_SQLITE_INDEX_COLUMNS = ("matricola", "data", "turno")
+
+
+class ExcelStorage:
+    """Backend storico: ogni tabella e' un foglio del file Excel master."""
+
+    name = "excel"
+
+    def __init__(self, excel_path: Path):
+        self.excel_path = Path(excel_path)
+        self.path = self.excel_path
+        self._engine = _excel_engine_for_obj(self.excel_path) or 'openpyxl'
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def table_names(self) -> set[str]:
+        try:
+            xl = pd.ExcelFile(self.path, engine=self._engine)
+            return set(xl.sheet_names)
+        except Exception:
+            return set()
+
+    def read_table(self, table: str, header=0) -> pd.DataFrame:
+        return pd.read_excel(self.path, sheet_name=table, header=header, engine=self._engine)
+
+    def read_filtered(self, table: str, columns=None, date_from=None, date_to=None, matricole=None):
+        """Nessun filtro nel backend: openpyxl legge comunque l'intero foglio (filtra get_all in memoria)."""
+        return None
+
+    def generation(self) -> list:
+        """Identita' della versione pubblicata del file: ogni scrittura lo sostituisce (os.replace),
+        quindi cambiano inode e firma."""
+        try:
+            stt = self.path.stat()
+            return [stt.st_ino, stt.st_mtime_ns, stt.st_size]
+        except OSError:
+            return [0, 0, 0]
+
+    def snapshot(self, dest: Path):
+        """Congela la versione corrente: hard link (il salvataggio sostituisce il file con os.replace,
+        quindi il link continua a puntare alla versione precedente); copia se i link non sono supportati."""
+        try:
+            os.link(self.path, dest)
+        except OSError:
+            shutil.copy2(self.path, dest)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Apre il workbook una sola volta (openpyxl read-only) per piu' letture di fogli."""
+        xl = pd.ExcelFile(self.path, engine=self._engine)
+        try:
+            yield lambda table, header=0: xl.parse(sheet_name=table, header=header)
+        finally:
+            try:
+                xl.close()
+            except Exception:
+                pass
+
+    def _write_tables_zip(self, data: dict) -> bool:
+        """Sostituzione a livello zip (True se riuscita, False = usare openpyxl)."""
+        if not self.path.exists() or self.path.suffix.lower() not in {'.xlsx', '.xlsm'}:
+            return False
+        tmp_path = _tmp_path_for(self.path)
+        try:
+            written = _xlsx_replace_sheets(self.path, tmp_path, data)
+            # validazione minima: directory zip leggibile e membri riscritti integri (CRC);
+            # gli altri membri sono copie byte per byte dell'originale
+            with zipfile.ZipFile(tmp_path) as zf:
+                for name in written:
+                    with zf.open(name) as f:
+                        while f.read(1 << 16):
+                            pass
+            _atomic_replace(tmp_path, self.path)
+            return True
+        except Exception:
+            # qualsiasi imprevisto: salvataggio completo con openpyxl (che valida a sua volta)
+            return False
+        finally:
+            try:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            except Exception:
+                pass
+
+    def create(self, all_data: dict, order: list[str]):
+        """Crea (o rigenera) il file con tutti i fogli indicati."""
+        tmp_path = _tmp_path_for(self.path)
+        try:
+            with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+                for name in sorted(all_data, key=lambda n: order.index(n) if n in order else len(order)):
+                    all_data[name].to_excel(writer, sheet_name=name, index=False)
+            _atomic_replace(tmp_path, self.path)
+        finally:
+            try:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            except Exception:
+                pass
+
+    def write_tables(self, data: dict, order: list[str]):
+        """Sostituisce i fogli indicati preservando tutti gli altri (salvataggio atomico)."""
+        # Percorso veloce: riscrive solo i membri zip dei fogli indicati
+        if self._write_tables_zip(data):
+            return
+
+        # Import locali per evitare dipendenze in fase di import modulo
+        from openpyxl import load_workbook, Workbook
+        from openpyxl.utils.dataframe import dataframe_to_rows
+
+        # Carica o crea workbook
+        if os.path.exists(self.path):
+            wb = load_workbook(self.path)
+        else:
+            wb = Workbook()
+            # rimuovi sheet di default
+            try:
+                if wb.active and wb.active.title == 'Sheet':
+                    wb.remove(wb.active)
+            except Exception:
+                pass
+
+        # Assicura che TUTTE le tabelle esistano come fogli (senza sovrascriverle)
+        for tbl in order:
+            if tbl not in wb.sheetnames:
+                wb.create_sheet(tbl)
+
+        for table, df in data.items():
+            # Rimuovi e ricrea il foglio target alla posizione coerente con TABLES
+            try:
+                idx = order.index(table)
+            except Exception:
+                idx = 0
+
+            if table in wb.sheetnames:
+                ws_old = wb[table]
+                wb.remove(ws_old)
+
+            ws = wb.create_sheet(table, index=min(idx, len(wb.sheetnames)))
+
+            # Scrivi header + righe (caratteri di controllo tolti come nel percorso zip:
+            # openpyxl li rifiuterebbe e il salvataggio fallirebbe solo in questo ramo)
+            for k, part in enumerate(_frame_chunks(df)):
+                for row in dataframe_to_rows(part, index=False, header=k == 0):
+                    ws.append([_XML_ILLEGAL_RE.sub("", v) if isinstance(v, str) else v for v in row])
+
+        # Salvataggio atomico: tmp -> replace
+        tmp_path = _tmp_path_for(self.path)
+        try:
+            wb.save(tmp_path)
+            # validazione minima: il file deve riaprirsi
+            try:
+                _ = load_workbook(tmp_path, read_only=True)
+            except Exception as e:
+                raise RuntimeError(f"File Excel temporaneo non valido: {e}") from e
+
+            _atomic_replace(tmp_path, self.path)
+        finally:
+            try:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            except Exception:
+                pass
+
+
+class SQLiteStorage:
+    """Backend SQLite: ogni tabella PersGest e' una tabella nel file persgest_master.sqlite.
 
-    out = pd.DataFrame({
-        "nome": df[nome_col] if nome_col in df.columns else "",
-        "matricola": df[matricola_col] if matricola_col in df.columns else "",
-        "uo": df[uo_col] if (uo_col in df.columns) else "",
-        "turno": df[turno_col] if turno_col in df.columns else "",
-        "att": df[att_col] if (att_col in df.columns) else "",
-        "pox": df[pox_col] if (pox_col in df.columns) else "",
-        "data": df[date_col] if date_col in df.columns else pd.NaT,
-        "minuti": df[minuti_col] if minuti_col in df.columns else 0,
-    })
+    - ordine righe preservato (rowid) e ordine/nomi colonna salvati in _persgest_tables
+    - colonne data salvate come testo ISO e riconvertite in lettura
+    - indici su matricola/data/turno (se presenti) per le letture filtrate
+    - journal_mode di default (niente WAL): il file puo' stare anche su cartella condivisa
+    """
 
-    # pulizia
-    out["matricola"] = out["matricola"].apply(_safe_str)
-    out["nome"] = out["nome"].apply(_safe_str)
-    out["turno"] = out["turno"].apply(_safe_str)
-    out["uo"] = out["uo"].apply(_safe_str)
-    out["att"] = out["att"].apply(_safe_str)
-    out["pox"] = out["pox"].apply(_safe_str)
-    out["data"] = pd.to_datetime(out["data"], errors='coerce', dayfirst=True)
+    name = "sqlite"
+    _META_TABLE = "_persgest_tables"
 
-    # minuti -> ore
-    m = pd.to_numeric(out["minuti"], errors='coerce')
-    m = m.fillna(0.0)
-    out["minuti"] = m.astype(float)
-    out["valore"] = (out["minuti"] / 60.0).round(2)
+    def __init__(self, excel_path: Path):
+        self.excel_path = Path(excel_path)
+        self.path = self.excel_path.with_suffix(".sqlite")
 
-    # rimuovi righe completamente vuote
-    out = out[(out["matricola"] != "") | (out["nome"] != "") | (out["turno"] != "") | (out["valore"] != 0) | (out["data"].notna())]
+    @staticmethod
+    def _q(name: str) -> str:
+        return '"' + str(name).replace('"', '""') + '"'
 
-    return out
+    def _connect(self):
+        import sqlite3
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=120)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self._META_TABLE} (name TEXT PRIMARY KEY, columns TEXT NOT NULL)")
+        return conn
 
-def _normalize_columns_generic(df: pd.DataFrame) -> pd.DataFrame:
-    """Normalizza colonne comuni: case/strip e alias minimi."""
-    if df is None:
-        return pd.DataFrame()
-    df = df.copy()
+    def exists(self) -> bool:
+        return self.path.exists() and self.path.stat().st_size > 0
 
-    def _make_unique_columns(cols):
-        """Rende univoci i nomi colonna preservando l'ordine."""
-        seen = {}
-        out = []
-        for c in cols:
-            base = str(c).strip()
-            if base not in seen:
-                seen[base] = 0
-                out.append(base)
+    def table_names(self) -> set[str]:
+        if not self.path.exists():
+            return set()
+        conn = self._connect()
+        try:
+            return {r[0] for r in conn.execute(f"SELECT name FROM {self._META_TABLE}")}
+        finally:
+            conn.close()
+
+    def generation(self) -> int:
+        """Contatore delle scritture (PRAGMA user_version), aggiornato nella stessa transazione."""
+        if not self.exists():
+            return 0
+        conn = self._connect()
+        try:
+            return int(conn.execute("PRAGMA user_version").fetchone()[0])
+        finally:
+            conn.close()
+
+    def read_table(self, table: str, header=0) -> pd.DataFrame:
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT columns FROM {self._META_TABLE} WHERE name = ?", (table,)).fetchone()
+            if row is None:
+                raise ValueError(f"Worksheet named '{table}' not found")
+            cols = json.loads(row[0])
+            if cols:
+                types = {r[1]: (r[2] or '').upper() for r in conn.execute(f"PRAGMA table_info({self._q(table)})")}
+                df = pd.read_sql_query(f"SELECT * FROM {self._q(table)} ORDER BY rowid", conn)
+                df.columns = cols
+                for c, t in types.items():
+                    if t == 'TIMESTAMP' and c in df.columns:
+                        df[c] = pd.to_datetime(df[c], errors='coerce', format='ISO8601')
             else:
-                seen[base] += 1
-                out.append(f"{base}_{seen[base]}")
-        return out
+                df = pd.DataFrame()
+        finally:
+            conn.close()
 
-    # prima di qualsiasi rename, rendi univoci (Excel puo' avere header duplicati)
-    df.columns = _make_unique_columns(df.columns)
-    rename = {}
-    for c in df.columns:
-        cl = str(c).strip().lower()
-        if cl in {"data", "date", "giorno"}:
-            rename[c] = "data"
-        elif "matric" in cl or cl in {"badge", "id"}:
-            rename[c] = "matricola"
-        elif "turn" in cl or cl in {"shift"}:
-            rename[c] = "turno"
-        # IMPORTANTE: non collassare 'minuti' dentro 'valore' (crea duplicati)
-        elif cl in {"minuti", "minutes"}:
-            rename[c] = "minuti"
-        elif cl in {"ore", "hours"}:
-            rename[c] = "ore"
-        elif cl in {"valore", "value"}:
-            rename[c] = "valore"
-        elif cl in {"nome", "nominativo"}:
-            rename[c] = "nome"
-    if rename:
-        df = df.rename(columns=rename)
+        if header is None:
+            # Emula read_excel(header=None): l'intestazione diventa la prima riga dati
+            head = pd.DataFrame([list(df.columns)])
+            body = pd.DataFrame(df.to_numpy(dtype=object))
+            return pd.concat([head, body], ignore_index=True) if len(df.columns) else pd.DataFrame()
+        return df
 
-    # post-rename: garantisci ancora univocita'
-    if df.columns.duplicated().any():
-        df.columns = _make_unique_columns(df.columns)
-    return df
+    def read_filtered(self, table: str, columns=None, date_from=None, date_to=None, matricole=None):
+        """Lettura con filtri/proiezione in SQL (indici su data e matricola).
 
+        Filtri e nomi colonna sono quelli normalizzati (data, matricola, ...). L'indice del risultato
+        e' la posizione della riga nella tabella completa (rowid - 1), come per il filtro in memoria.
+        Ritorna None se la query non e' applicabile (colonne mancanti, data non TIMESTAMP, intestazioni
+        da consolidare): il chiamante ricade sulla lettura completa.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT columns FROM {self._META_TABLE} WHERE name = ?", (table,)).fetchone()
+            if row is None:
+                return None
+            cols = json.loads(row[0])
+            if not cols:
+                return None
+            types = {r[1]: (r[2] or '').upper() for r in conn.execute(f"PRAGMA table_info({self._q(table)})")}
+            norm = list(_normalize_columns_generic(pd.DataFrame(columns=cols)).columns)
+            by_norm = dict(zip(norm, cols))
+            if sum(1 for n in norm if str(n).startswith('valore')) > 1:
+                return None  # valore_1/valore_2: la consolidazione richiede tutte le righe
 
-# ============================
-# Template intestazioni tabelle (vuote)
-# ============================
+            where, params = [], []
+            if date_from is not None or date_to is not None:
+                c = by_norm.get('data')
+                if c is None or types.get(c) != 'TIMESTAMP':
+                    return None
+                if date_from is not None:
+                    where.append(f"{self._q(c)} >= ?")
+                    params.append(pd.Timestamp(date_from).strftime('%Y-%m-%d %H:%M:%S'))
+                if date_to is not None:
+                    where.append(f"{self._q(c)} < ?")
+                    params.append((pd.Timestamp(date_to) + pd.Timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
+            if matricole is not None:
+                c = by_norm.get('matricola')
+                if c is None:
+                    return None
+                # la matricola puo' essere salvata come numero o testo: cerca entrambe le forme
+                # (il confronto esatto sul testo lo rifa' get_all)
+                keys = set()
+                for m in matricole:
+                    keys.add(str(m))
+                    try:
+                        f = float(m)
+                        keys.add(f)
+                        if f.is_integer():
+                            keys.add(int(f))
+                    except (TypeError, ValueError):
+                        pass
+                if not keys:
+                    where.append("0")
+                elif len(keys) <= 900:  # limite parametri SQLite
+                    where.append(f"{self._q(c)} IN ({', '.join('?' for _ in keys)})")
+                    params.extend(keys)
 
-TEMPLATE_HEADERS = {
-    'AbilitazioniTipo': ['abilitazione', 'Tipologia', 'note', 'periodicita1', 'periodicita2'],
-    'AltreAbilitazioniPers': ['Matricola', 'categ_professionale', 'Abilitazione', 'note', 'dataSuCert', 'rinnovo', 'zone', 'nr_documento'],
-    'CatProfTipo': ['CAT', 'note'],
-    'ColoriTurni': ['Pattern', 'BkR', 'BkG', 'BkB', 'FkR', 'FkG', 'FkB', 'Bold', 'Priority'],
-    'Ferie_AP': ['matricola', 'cognome_e_nome', 'gg_ferie_AP', 'hr_ferie_AP', 'gg_RFS_AP', 'hr_RFS_AP', 'anno'],
-    'Ferie_spettanti': ['Da anni', 'A anni', 'Giorni_Spett', 'RFS_Spett'],
-    'IdoneitaMedichePers': ['Matricola', 'categ_professionale', 'idoneita', 'note', 'dataSuCert', 'rinnovo'],
-    'Personale': ['CAT', 'matricola', 'Nome', 'UO', 'regime_orario', 'no_spec', 'note_scheda_pers', 'In_Forza', 'Data_di_Nascita', 'Luogo_di_Nascita', 'Cittadinanza', 'Via_e_numero_civico', 'Città', 'Provincia', 'CAP', 'Cod_Fiscale', 'note', 'Indirizzo_posta_elettronica', 'Telefono_uff', 'Telefono_ab', 'Tel_Cellulare', 'Fax', 'Data_prima_Assunzione', 'Licenza', 'Data_Rilascio_Licenza', 'Allegato', 'ENG_lvl', 'Documenti'],
-    'Personale_PartTime': ['cognome_e_nome', 'matricola', 'categ_professionale', '%_part_time', 'ID_part_time', 'dal', 'al'],
-    'Ripo': ['MATRICOLA', 'COGNOME', 'NOME', 'SETTORE', 'DATA', 'IMPIANTO', 'INIZIO TURNO', 'FINE TURNO', 'ORAE', 'ORAU', 'PAUSA', 'SPEZZONE', 'SIGLA_ATTIVITA', 'StartDT', 'EndDT', 'WorkDate', 'Seq', 'MinutiPOX'],
-    'SpecUO-CompTipo': ['SpecUO/Comp', 'Tipologia', 'note', '1_R', '2_R', 'R_C', 'Su_impianto'],
-    'SpecUOPers': ['Matricola', 'categ_professionale', 'SpecUO/Comp', 'note', 'dataSuLic', '1_rinnovo', 'doc_1r', '2_rinnovo', 'doc_2r', 'R_comp', 'doc_R_comp', 'note1R', 'note2R', 'notecomp'],
-    'Specializzazioni_tipo': ['SPECIALIZZAZIONE', 'POX'],
-    'Straordinario': ['CAT', 'Nome', 'matricola', 'UO', 'turno', 'att', 'data', 'valore', 'STP', 'contattato_il', 'note'],
-    'TargetOp': ['Days', 'TargetOpTot'],
-    'Turni_tipo': ['Turno', 'OraInizio', 'OraFine', 'Minuti', 'SplitNotte', 'MinutiGiornoCorrente', 'MinutiGiornoPrecedente', 'IsOperativo', 'Categoria'],
-    'idoneitaMedicheTipo': ['Idoneita', 'Tipologia', 'note', 'periodicita1', 'periodicita2', 'Is_Attiva'],
-    'tbl_UO': ['UO'],
-    'Festivi': ['GiornoFestivo', 'Descrizione', 'Localita'],
-    # Tabella editabile: elenco codici che rappresentano assenze (es. FER, MAL, 104, ...)
-    'Turni_Assenze': ['Turno'],
-}
+            sel = cols
+            if columns is not None:
+                wanted = set(columns) | {'data', 'matricola', 'turno'}
+                sel = [c for c, n in zip(cols, norm) if n in wanted]
+                if not sel:
+                    return None
+            sql = (f"SELECT rowid - 1 AS __pos__, {', '.join(self._q(c) for c in sel)} FROM {self._q(table)}"
+                   + (f" WHERE {' AND '.join(where)}" if where else "") + " ORDER BY rowid")
+            df = pd.read_sql_query(sql, conn, params=params)
+        finally:
+            conn.close()
 
-# Default elenco assenze (editabile dall'utente nella tabella Turni_Assenze)
-# Nota: nei dati GT ricorrono spesso FER (ferie) e RPD/RPN (riposi). Se non esclusi,
-# i festivi verrebbero conteggiati anche quando la persona non ...
-DEFAULT_TURNI_ASSENZE = [
-    'FER','RPD','RPN',
-    '104','ASS','CONP','DONS','MAL','MAT','PDEC','VMSP','ROS','NASF','INF','MALF',
-    'MIX','PRLS','SCIO','RCI','ALL','PELE','PEXT','PSIN','ESAU'
-]
+        df = df.set_index('__pos__')
+        df.index.name = None
+        df.columns = sel
+        for c in sel:
+            if types.get(c) == 'TIMESTAMP':
+                df[c] = pd.to_datetime(df[c], errors='coerce', format='ISO8601')
+        return df
 
+    def snapshot(self, dest: Path):
+        """Copia coerente del database (API backup di SQLite: il file viene modificato sul posto)."""
+        import sqlite3
+        src = sqlite3.connect(str(self.path), timeout=120)
+        try:
+            dst = sqlite3.connect(str(dest))
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
 
-def _attivita_move_extra_turno_to_att(df: pd.DataFrame, primary_turni: set[str] | None = None) -> pd.DataFrame:
-    """Normalizza la tabella Attivita quando le *attività secondarie* sono state inserite come righe extra nel campo TURNO.
+    @contextlib.contextmanager
+    def reader(self):
+        """Letture multiple: ogni tabella SQLite si legge gia' in modo indipendente."""
+        yield self.read_table
 
-    Scenario tipico (export/import):
-      - stessa matricola + stesso giorno -> più righe
-      - una riga con turno primario (es. M78/P38/N11...) + minuti ~480
-      - altre righe con codici attività (es. ESAU/ISTR/UCS...) e minuti diversi, ma messe in colonna TURNO
+    @staticmethod
+    def _is_null(v) -> bool:
+        return v is None or (not isinstance(v, (str, bytes)) and pd.isna(v))
 
-    Obiettivo:
-      - per ogni (matricola, giorno) tenere 1 sola riga con TURNO valorizzato (primario)
-      - convertire le altre righe in secondarie usando la colonna ATT (TURNO vuoto)
-      - preservare minuti/valore per il calcolo ore delle secondarie
-    """
-    if df is None or len(df) == 0:
-        return df
+    @classmethod
+    def _column_type(cls, s: pd.Series) -> str:
+        """Tipo dichiarato SQLite per una colonna intera."""
+        from datetime import date as _date
+        if pd.api.types.is_datetime64_any_dtype(s):
+            return 'TIMESTAMP'
+        if pd.api.types.is_bool_dtype(s) or pd.api.types.is_integer_dtype(s):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(s):
+            return 'REAL'
+        # object/misto: nessuna affinita' (i valori restano del tipo originale), tranne solo date
+        non_null = [v for v in s.tolist() if not cls._is_null(v)]
+        if non_null and all(isinstance(v, (datetime, _date)) for v in non_null):
+            return 'TIMESTAMP'
+        return ''
 
-    out = df.copy()
+    @classmethod
+    def _column_values(cls, s: pd.Series) -> list:
+        """Valori python di una colonna (o di una sua fetta) da inserire."""
+        from datetime import date as _date
+        if pd.api.types.is_datetime64_any_dtype(s):
+            vals = s.dt.strftime('%Y-%m-%d %H:%M:%S')
+            return vals.where(s.notna(), None).tolist()
+        if pd.api.types.is_bool_dtype(s) or pd.api.types.is_integer_dtype(s):
+            return [None if pd.isna(v) else int(v) for v in s.tolist()]
+        if pd.api.types.is_float_dtype(s):
+            return [None if pd.isna(v) else float(v) for v in s.tolist()]
 
-    # colonne minime
-    for c in ["matricola", "turno", "att"]:
-        if c not in out.columns:
-            out[c] = ""
-    if "data" not in out.columns:
+        out = []
+        for v in s.tolist():
+            if cls._is_null(v):
+                out.append(None)
+            elif isinstance(v, (str, int, float, bytes)):
+                out.append(v)
+            elif hasattr(v, 'item'):
+                out.append(v.item())
+            elif isinstance(v, (datetime, _date)):
+                out.append(pd.Timestamp(v).strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                out.append(str(v))
         return out
 
-    # data -> giorno (senza orario)
-    out["data"] = pd.to_datetime(out["data"], errors="coerce", dayfirst=True)
-    out["_day"] = out["data"].dt.normalize()
-
-    # minuti coerenti
-    if "minuti" in out.columns:
-        out["minuti"] = pd.to_numeric(out["minuti"], errors="coerce").fillna(0.0).astype(float)
-    else:
-        # fallback: se esiste valore in ore
-        if "valore" in out.columns:
-            out["valore"] = pd.to_numeric(out["valore"], errors="coerce").fillna(0.0).astype(float)
-            out["minuti"] = (out["valore"] * 60.0).round(0)
-        else:
-            out["minuti"] = 0.0
+    @classmethod
+    def _result_types(cls, result: "_ImportResult") -> list[str]:
+        """Tipi dichiarati delle colonne di un import, da un passaggio sui suoi blocchi.
 
-    out["turno"] = out["turno"].fillna("").astype(str).str.strip()
-    out["att"] = out["att"].fillna("").astype(str).str.strip()
+        Blocchi con la colonna vuota non contano; INTEGER con REAL -> REAL, altri tipi diversi ->
+        nessuna affinita' (come _column_type sulla colonna intera mista).
+        """
+        seen, first = None, None
+        for part in result.chunks():
+            kinds = [cls._column_type(part.iloc[:, i]) for i in range(len(part.columns))]
+            if first is None:
+                first, seen = kinds, [set() for _ in kinds]
+            for i, k in enumerate(kinds):
+                if part.iloc[:, i].notna().any():
+                    seen[i].add(k)
+        out = []
+        for k0, kinds in zip(first or [], seen or []):
+            if not kinds:
+                out.append(k0)
+            elif len(kinds) == 1:
+                out.append(kinds.pop())
+            else:
+                out.append('REAL' if kinds == {'INTEGER', 'REAL'} else '')
+        return out
 
-    primary_turni = {str(x).strip().upper() for x in (primary_turni or set()) if str(x).strip()}
+    def _write_rows(self, conn, table: str, result: "_ImportResult", cols: list, types: list) -> bool:
+        """Import in aggiunta/upsert: solo le righe cambiate (UPDATE per rowid) e quelle nuove (INSERT).
 
-    def pick_primary(g: pd.DataFrame) -> int:
-        # preferisci codici che appartengono a Turni_tipo, altrimenti max minuti
-        t = g["turno"].fillna("").astype(str).str.strip().str.upper()
-        is_primary_code = t.isin(primary_turni) if primary_turni else pd.Series([False]*len(g), index=g.index)
-        if is_primary_code.any():
-            gg = g[is_primary_code]
-            # tra i primari scegli quello con più minuti
-            return int(gg["minuti"].idxmax())
-        # fallback: il record con più minuti
-        return int(g["minuti"].idxmax())
-
-    new_rows = []
-    for (mat, day), g in out.groupby(["matricola", "_day"], dropna=False):
-        if len(g) == 1:
-            new_rows.append(g)
-            continue
+        Vale se la tabella nel file e' ancora head (stesse colonne, stessi tipi, stesse righe: rowid =
+        posizione + 1, le tabelle si riscrivono sempre per intero); False se va riscritta.
+        """
+        row = conn.execute(f"SELECT columns FROM {self._META_TABLE} WHERE name = ?", (table,)).fetchone()
+        if row is None or not cols or json.loads(row[0]) != cols:
+            return False
+        decl = [(r[2] or '').upper() for r in conn.execute(f"PRAGMA table_info({self._q(table)})")]
+        if decl != types:
+            return False
+        if conn.execute(f"SELECT COUNT(*) FROM {self._q(table)}").fetchone()[0] != len(result.head):
+            return False
+        sets = ", ".join(f"{self._q(c)} = ?" for c in cols)
+        for part, pos in result.patch_chunks():
+            columns = [self._column_values(part.iloc[:, i]) for i in range(len(cols))]
+            conn.executemany(f"UPDATE {self._q(table)} SET {sets} WHERE rowid = ?",
+                             zip(*columns, (pos + 1).tolist()))
+        ph = ", ".join("?" for _ in cols)
+        for part in result.tail_chunks():
+            columns = [self._column_values(part.iloc[:, i]) for i in range(len(cols))]
+            conn.executemany(f"INSERT INTO {self._q(table)} VALUES ({ph})", zip(*columns))
+        return True
 
-        idx_primary = pick_primary(g)
-        primary_row = g.loc[[idx_primary]].copy()
+    def _write(self, conn, table: str, df: pd.DataFrame):
+        cols = _make_unique_columns(df.columns, casefold=True)
+        if isinstance(df, _ImportResult):
+            # risultato di un import: tipi da un primo passaggio sui blocchi
+            types = self._result_types(df)
+            if df.stored and self._write_rows(conn, table, df, cols, types):
+                return
+        else:
+            types = [self._column_type(df.iloc[:, i]) for i in range(len(cols))]
+        conn.execute(f"DROP TABLE IF EXISTS {self._q(table)}")
+        if cols:
+            ph = ", ".join("?" for _ in cols)
+            # tipi dalla colonna intera, valori convertiti e inseriti a blocchi (vedi _frame_chunks)
+            decl = [f"{self._q(c)} {t}".rstrip() for c, t in zip(cols, types)]
+            conn.execute(f"CREATE TABLE {self._q(table)} ({', '.join(decl)})")
+            for part in _frame_chunks(df):
+                if len(part):
+                    columns = [self._column_values(part.iloc[:, i]) for i in range(len(cols))]
+                    conn.executemany(f"INSERT INTO {self._q(table)} VALUES ({ph})", zip(*columns))
 
-        # le altre righe diventano secondarie
-        others = g.drop(index=idx_primary).copy()
-        # se att è vuoto, usa turno come codice attività
-        others["att"] = others["att"].where(others["att"].astype(str).str.strip().ne(""), others["turno"])
-        # turno vuoto sulle secondarie per evitare "più turni primari"
-        others["turno"] = ""
+            # indici su matricola/data/turno (+ composto matricola,data)
+            low = {c.strip().lower(): c for c in cols}
+            idx_cols = [low[k] for k in _SQLITE_INDEX_COLUMNS if k in low]
+            for c in idx_cols:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {self._q(f'ix_{table}_{c}')} ON {self._q(table)} ({self._q(c)})")
+            if 'matricola' in low and 'data' in low:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self._q(f'ix_{table}_matricola_data')} "
+                    f"ON {self._q(table)} ({self._q(low['matricola'])}, {self._q(low['data'])})"
+                )
+        conn.execute(f"INSERT OR REPLACE INTO {self._META_TABLE} (name, columns) VALUES (?, ?)", (table, json.dumps(cols, ensure_ascii=False)))
 
-        # se la riga primaria aveva anche un'attività in colonna att, la lasciamo; se invece l'attività era in turno (caso raro)
-        primary_row["att"] = primary_row["att"].astype(str).str.strip()
+    def write_tables(self, data: dict, order: list[str]):
+        """Sostituisce le tabelle indicate in un'unica transazione (tutto o niente)."""
+        conn = self._connect()
+        try:
+            with conn:
+                # BEGIN esplicito: sqlite3 non apre da solo la transazione prima di DROP/CREATE,
+                # senza un errore a meta' lascerebbe la tabella gia' eliminata
+                conn.execute("BEGIN")
+                for table, df in data.items():
+                    self._write(conn, table, df if df is not None else pd.DataFrame())
+                self._bump_generation(conn)
+        finally:
+            conn.close()
 
-        new_rows.append(primary_row)
-        new_rows.append(others)
+    def create(self, all_data: dict, order: list[str]):
+        """Crea (o rigenera) il database con tutte le tabelle indicate."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                for (name,) in conn.execute(f"SELECT name FROM {self._META_TABLE}").fetchall():
+                    if name not in all_data:
+                        conn.execute(f"DROP TABLE IF EXISTS {self._q(name)}")
+                        conn.execute(f"DELETE FROM {self._META_TABLE} WHERE name = ?", (name,))
+                for table, df in all_data.items():
+                    self._write(conn, table, df)
+                self._bump_generation(conn)
+        finally:
+            conn.close()
 
-    out2 = pd.concat(new_rows, ignore_index=True)
+    @staticmethod
+    def _bump_generation(conn):
+        gen = int(conn.execute("PRAGMA user_version").fetchone()[0])
+        conn.execute(f"PRAGMA user_version = {gen + 1}")
 
-    # pulizia helper
-    out2 = out2.drop(columns=["_day"], errors="ignore")
 
-    # ricalcola valore (ore) da minuti, se presente
-    out2["minuti"] = pd.to_numeric(out2.get("minuti", 0), errors="coerce").fillna(0.0).astype(float)
-    out2["valore"] = (out2["minuti"] / 60.0).round(2)
+STORAGE_BACKENDS = {
+    ExcelStorage.name: ExcelStorage,
+    SQLiteStorage.name: SQLiteStorage,
+}
 
-    # dedup finale
-    out2 = out2.drop_duplicates()
 
-    return out2
+def _storage_for(backend: str | None, excel_path: Path):
+    """Istanzia il backend richiesto (argomento > variabile ambiente > default excel)."""
+    name = (backend or os.environ.get(STORAGE_ENV_VAR) or DEFAULT_STORAGE_BACKEND).strip().lower()
+    cls = STORAGE_BACKENDS.get(name)
+    if cls is None:
+        raise ValueError(f"Backend storage sconosciuto: {name} (disponibili: {', '.join(STORAGE_BACKENDS)})")
+    return cls(excel_path)
 
 
 class PersGestDatabase:
@@ -577,7 +4323,7 @@ class PersGestDatabase:
         'Festivi',
         'Turni_Assenze',
     ]
-    
+
     def _default_db_path(self) -> Path:
         """Percorso database persistente (non dentro la cartella del progetto)."""
         # Windows: LOCALAPPDATA\PersGestStreamlit\persgest_master.xlsx
@@ -586,13 +4332,16 @@ class PersGestDatabase:
         p.parent.mkdir(parents=True, exist_ok=True)
         return p
 
-    def __init__(self, excel_path='data/persgest_master.xlsx'):
+    def __init__(self, excel_path='data/persgest_master.xlsx', backend: str | None = None):
         """Inizializza database Excel.
 
         - Se viene passato un path esplicito (es. cartella condivisa), viene usato quello.
         - Se viene passato il path di default del progetto (data/persgest_master.xlsx),
           il database viene salvato in un percorso persistente (AppData / home) per non perdere i dati
           durante gli aggiornamenti.
+        - backend: 'excel' (default) o 'sqlite'; se None usa la variabile ambiente PERSGEST_STORAGE.
+          Con 'sqlite' il file persgest_master.sqlite viene creato accanto all'xlsx e, al primo avvio,
+          popolato con il contenuto dell'xlsx esistente.
         """
         passed = Path(excel_path) if excel_path else Path('data/persgest_master.xlsx')
 
@@ -615,19 +4364,38 @@ class PersGestDatabase:
 
         # Engine Excel (preferisci openpyxl per xlsx/xlsm)
         self._excel_engine = _excel_engine_for_obj(self.excel_path) or 'openpyxl'
-        
-        # Cache per performance
-        if 'db_cache' not in st.session_state:
-            st.session_state.db_cache = {}
-        
+
+        # Motore di persistenza (Excel o SQLite)
+        self.storage = _storage_for(backend, self.excel_path)
+
+        # Backup rimasti in sospeso da una sessione precedente
+        try:
+            _BACKUP_WORKER.recover_pending(self.storage.path)
+        except Exception:
+            pass
+
+        # Stato db.transaction() per thread (l'istanza e' condivisa tra le sessioni)
+        self._tx_local = threading.local()
+
+        # Watcher modifiche (vedi start_watcher)
+        self._watcher = None
+        self._watch_stop = threading.Event()
+        self._watch_state = {}
+        self._changes = []
+        self._change_seq = 0
+        self._changes_lock = threading.Lock()
+
         # Inizializza file se non esiste
-        if not self.excel_path.exists():
-            self._create_empty_database()
+        if not self.storage.exists():
+            if self.storage.name != ExcelStorage.name and self.excel_path.exists():
+                self._migrate_from_excel()
+            else:
+                self._create_empty_database()
 
         # Se il file esiste ma e' vuoto/corrotto (tipico dopo copie/parziali download),
         # pandas non riesce a determinare il formato. In quel caso lo rigeneriamo.
         try:
-            if self.excel_path.exists() and self.excel_path.stat().st_size < 4096:
+            if self.storage.name == ExcelStorage.name and self.excel_path.exists() and self.excel_path.stat().st_size < 4096:
                 # Backup best-effort
                 try:
                     bak = self.excel_path.with_suffix(self.excel_path.suffix + ".bak")
@@ -640,461 +4408,1240 @@ class PersGestDatabase:
 
         # Aggiunge eventuali nuove tabelle (fogli) senza richiedere re-import
         self._ensure_tables_exist()
-    
-def _create_empty_database(self):
-    """Crea file Excel vuoto con tutti i fogli previsti (vuoti)."""
-    with _persgest_write_lock(self.excel_path):
-        _backup_excel(self.excel_path)
 
-        tmp_path = self.excel_path.with_suffix(self.excel_path.suffix + ".tmp")
+    @property
+    def storage_path(self) -> Path:
+        """File fisico che contiene i dati (xlsx o sqlite, in base al backend)."""
+        return self.storage.path
+
+    def _queue_backup(self):
+        """Snapshot della versione corrente + backup in background (chiamare sotto write lock)."""
         try:
-            with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
-                for table in self.TABLES:
-                    # Foglio vuoto
-                    cols = TEMPLATE_HEADERS.get(table, [])
-                    if table == 'Turni_Assenze' and cols:
-                        # Default iniziale (modificabile dall'utente)
-                        df = pd.DataFrame({cols[0]: DEFAULT_TURNI_ASSENZE})
-                    else:
-                        df = pd.DataFrame(columns=cols)
-                    df.to_excel(writer, sheet_name=table, index=False)
-
-            _atomic_replace(tmp_path, self.excel_path)
-            _bump_db_version(self.excel_path)
-        finally:
+            if not self.storage.exists():
+                return
+            t0 = time.perf_counter()
+            created = datetime.now()
+            pending_dir = self.storage_path.parent / "backups" / _BACKUP_PENDING_DIRNAME
+            pending_dir.mkdir(parents=True, exist_ok=True)
+            snap = pending_dir / f"{self.storage_path.stem}_{created.strftime('%Y%m%d_%H%M%S_%f')}{self.storage_path.suffix}"
+            self.storage.snapshot(snap)
+            _BACKUP_WORKER.record_snapshot(time.perf_counter() - t0)
+            _BACKUP_WORKER.submit(self.storage_path, snap, created)
+        except Exception:
+            pass
+
+    def _create_empty_database(self):
+        """Crea il database vuoto con tutte le tabelle previste (vuote)."""
+        with _persgest_write_lock(self.excel_path, site="_create_empty_database"):
+            self._queue_backup()
+            sig_before = _source_signature(self.storage_path)
+
+            all_data = {}
+            for table in self.TABLES:
+                # Foglio vuoto
+                cols = TEMPLATE_HEADERS.get(table, [])
+                if table == 'Turni_Assenze' and cols:
+                    # Default iniziale (modificabile dall'utente)
+                    all_data[table] = pd.DataFrame({cols[0]: DEFAULT_TURNI_ASSENZE})
+                else:
+                    all_data[table] = pd.DataFrame(columns=cols)
+
+            self.storage.create(all_data, self.TABLES)
+            _journal_rewrite(self.excel_path, [])
+            _bump_db_version(self.excel_path, self.TABLES, self.storage_path, sig_before)
+
+    def _migrate_from_excel(self):
+        """Primo avvio con backend non-Excel: copia tutti i fogli dell'xlsx esistente."""
+        with _persgest_write_lock(self.excel_path, site="_migrate_from_excel"):
+            eng = _excel_engine_for_obj(self.excel_path) or self._excel_engine
             try:
-                if tmp_path.exists():
-                    tmp_path.unlink()
+                all_data = pd.read_excel(self.excel_path, sheet_name=None, engine=eng)
             except Exception:
-                pass
+                all_data = {}
+            if not all_data:
+                all_data = {t: pd.DataFrame(columns=TEMPLATE_HEADERS.get(t, [])) for t in self.TABLES}
+            sig_before = _source_signature(self.storage_path)
+            self.storage.create(_storage_column_names(all_data), self.TABLES)
+            _bump_db_version(self.excel_path, self.TABLES, self.storage_path, sig_before)
+
     def _ensure_tables_exist(self):
-        """Assicura che tutte le tabelle (fogli) esistano nel file Excel.
+        """Assicura che tutte le tabelle (fogli) esistano nel database.
+
+        - Se mancano fogli, li crea vuoti (0 righe) con intestazioni note (se disponibili).
+        - Non sovrascrive i fogli gia' presenti.
+        """
+        existing = self.storage.table_names()
+
+        missing = [t for t in self.TABLES if t not in existing]
+        if not missing:
+            return
+
+        to_write = {}
+
+        # Se la tabella Turni_Assenze esiste già ma risulta vuota (tipico quando si aggiorna un DB
+        # già esistente con una nuova feature), pre-carica l'elenco di default delle assenze.
+        # Non sovrascriviamo mai dati esistenti: inseriamo solo se non c'è alcun valore utile.
+        if 'Turni_Assenze' in existing:
+            try:
+                df_ta = self.storage.read_table('Turni_Assenze')
+            except Exception:
+                df_ta = pd.DataFrame()
+            if df_ta is None or df_ta.empty:
+                to_write['Turni_Assenze'] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
+            else:
+                col = 'Turno' if 'Turno' in df_ta.columns else (df_ta.columns[0] if len(df_ta.columns) else None)
+                if col is not None:
+                    vals = df_ta[col].astype(str).str.strip()
+                    vals = vals[vals.ne('') & vals.ne('nan')]
+                    if len(vals) == 0:
+                        to_write['Turni_Assenze'] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
+
+        # aggiungi fogli mancanti vuoti
+        for t in missing:
+            cols = TEMPLATE_HEADERS.get(t, [])
+            if t == 'Turni_Assenze' and cols:
+                to_write[t] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
+            else:
+                to_write[t] = pd.DataFrame(columns=cols)
+
+        with _persgest_write_lock(self.excel_path, site="_ensure_tables_exist"):
+            self._journal_settle()
+            self._queue_backup()
+            sig_before = _source_signature(self.storage_path)
+            self.storage.write_tables(to_write, self.TABLES)
+            _bump_db_version(self.excel_path, to_write.keys(), self.storage_path, sig_before)
+
+    def get_all(self, table, derived=False, columns=None, date_from=None, date_to=None, matricole=None,
+                typed=True):
+        """Leggi tutti i record da una tabella
+
+        Args:
+            table: Nome tabella/foglio
+            derived: Aggiunge le colonne derivate canoniche (DERIVED_COLUMNS, es. _day/_mins)
+            columns: Solo queste colonne (None = tutte)
+            date_from: Solo righe con data >= questo giorno
+            date_to: Solo righe con data <= questo giorno (giorno intero)
+            matricole: Solo queste matricole (confronto sul testo, come nelle pagine)
+            typed: Colonne codice come category (TABLE_SCHEMAS, default); False = testo object,
+                per chi assegna codici nuovi cella per cella
+
+        Con i filtri l'indice resta quello della tabella completa (valido per update_record/delete_record).
+
+        Returns:
+            DataFrame con i dati: vista sugli array condivisi tra le sessioni (vedi shared_view). Chi lo
+            modifica sul posto (df.loc[m, c] = v) lavora su df.copy()
+        """
+        args = _filter_args(columns, date_from, date_to, matricole)
+        filtered = any(a is not None for a in args)
+
+        tx = self._current_tx()
+        if tx is not None and table in tx:
+            df = tx[table].copy()
+            if derived and table in DERIVED_COLUMNS:
+                df = df.join(_derive_columns(table, df))
+                if args[0] is not None:
+                    args = (args[0] + tuple(DERIVED_COLUMNS[table]),) + args[1:]
+            df = _filter_frame(df, *args) if filtered else df
+            return df if typed else _schema_release(df)
+        if table not in self.TABLES:
+            raise ValueError(f"Tabella {table} non esiste")
+        token = self.table_token(table)
+        if filtered:
+            df = self._get_filtered_cached(table, token, *args)
+        else:
+            df = self._get_all_cached(table, token)
+        if derived and table in DERIVED_COLUMNS and len(df.columns):
+            # stesso indice della tabella completa: derivate della versione allineate per indice.
+            # Assegnate colonna per colonna sulla vista (join ricopierebbe anche la tabella)
+            der = self._get_derived_cached(table, token)
+            for c in der.columns:
+                df[c] = der[c]
+        # typed=False: categorie -> object, array nuovi privati del chiamante
+        return df if typed else _schema_release(df)
+
+    def _get_filtered_cached(self, table, token, columns, date_from, date_to, matricole):
+        """get_all filtrato, condiviso tra le sessioni (vedi _TableStore)."""
+        key = ("filtered", str(self.excel_path), table, token, (columns, date_from, date_to, matricole))
+        return _TABLE_STORE.fetch(key, lambda: self._load_filtered(table, token, columns, date_from, date_to, matricole))
+
+    def _load_filtered(self, table, token, columns, date_from, date_to, matricole):
+        """Lettura filtrata: partizioni mensili o SQL nel backend quando possibile,
+        altrimenti filtro sulla tabella in memoria."""
+        if matricole is not None and table in PERSON_INDEXED_TABLES:
+            # tabella completa gia' in memoria: righe delle persone dall'indice, senza scandire
+            full = _TABLE_STORE.peek(("all", str(self.excel_path), table, token))
+            if full is not None:
+                return self._person_rows(table, token, full, columns, date_from, date_to, matricole)
+        df = None
+        # le operazioni in journal usano gli indici della tabella completa: scorciatoie solo senza journal
+        direct = not self._journal_entries(table)
+        by_month = direct and table in PARTITIONED_TABLES and (date_from is not None or date_to is not None)
+        if by_month:
+            df = _partition_load(self.excel_path, table, token[1], date_from, date_to)
+        if df is None and direct:
+            try:
+                with _persgest_read_lock(self.excel_path, site="_load_filtered"):
+                    raw = self.storage.read_filtered(table, columns, date_from, date_to, matricole)
+                if raw is not None:
+                    def _read(t, header=0):
+                        if header != 0:
+                            raise ValueError("rilettura senza intestazioni non disponibile su lettura filtrata")
+                        return raw
+                    df = self._load_table(table, read=_read)
+            except Exception:
+                df = None
+        if df is None and by_month:
+            # prima lettura della versione (backend senza filtri): tabella completa, poi le partizioni
+            df = self._get_all_cached(table, token)
+            _partition_store(self.excel_path, table, token[1], df)
+        if df is None:
+            df = self._get_all_cached(table, token)
+            if matricole is not None and table in PERSON_INDEXED_TABLES and len(df.columns):
+                return self._person_rows(table, token, df, columns, date_from, date_to, matricole)
+        return _filter_frame(df, columns, date_from, date_to, matricole)
+
+    def get_encoded(self, table, derived=False) -> pd.DataFrame:
+        """Id interi (int32) di matricola/uo/cat/codici della tabella, stesso indice di get_all.
+
+        Colonne <col>_id secondo ENCODED_COLUMNS (con derived=True anche _turno_up_id/_att_up_id);
+        i testi si recuperano con decode_ids. Calcolati una volta per versione tabella e per
+        generazione dei dizionari (vedi vocabulary).
+        """
+        tx = self._current_tx()
+        if tx is not None and table in tx:
+            return _encode_frame(self.get_all(table, derived=derived))
+        if table not in self.TABLES:
+            raise ValueError(f"Tabella {table} non esiste")
+        token = self.table_token(table)
+        key = ("encoded", str(self.excel_path), table, token, bool(derived), _vocabulary_generations())
+        return _TABLE_STORE.fetch(key, lambda: _encode_frame(self.get_all(table, derived=derived)))
+
+    def _get_person_index(self, table, token, full=None):
+        """Indice (matricola, giorno) -> righe della versione, condiviso tra le sessioni."""
+        def _build():
+            base = full if full is not None else self._get_all_cached(table, token)
+            return _person_index_build(base)
+        return _TABLE_STORE.fetch(("personidx", str(self.excel_path), table, token), _build)
+
+    def _person_rows(self, table, token, full, columns, date_from, date_to, matricole):
+        """Righe delle matricole (e del periodo) prese dalla tabella completa tramite l'indice per persona."""
+        idx = self._get_person_index(table, token, full)
+        if 'data' not in full.columns:
+            date_from = date_to = None  # come _filter_frame: filtro su colonna assente ignorato
+        df = full.take(_person_index_positions(idx, matricole, date_from, date_to))
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return df
+
+    def _get_all_cached(self, table, token):
+        """Tabella completa per versione (token), condivisa tra le sessioni del processo."""
+        try:
+            return _TABLE_STORE.fetch(("all", str(self.excel_path), table, token), lambda: self._load_current(table, token))
+        except Exception as e:
+            st.error(f"Errore lettura {table}: {e}")
+            return pd.DataFrame()
+
+    def _load_current(self, table, token):
+        """Tabella base (cache su disco o backend) + operazioni di riga non ancora compattate.
+
+        Se in memoria c'e' la versione precedente con la stessa tabella base e parte delle stesse
+        voci di journal, si applicano solo le voci nuove.
+        """
+        prev = _TABLE_STORE.previous(("all", str(self.excel_path), table, token))
+        if prev is not None and prev[0][1] == token[1]:
+            entries = self._journal_entries(table)
+            n, ts = prev[0][2]
+            if n <= len(entries) and (n == 0 or entries[n - 1].get("ts") == ts):
+                return _journal_apply(prev[1], entries[n:], table)
+        # Cache su disco (sidecar) valida per questa versione della tabella: evita il parse openpyxl
+        key = token[1]
+        df = _sidecar_load(self.excel_path, table, key)
+        if df is None:
+            df = self._load_table(table)
+            _sidecar_store(self.excel_path, table, key, df)
+        return _journal_apply(df, self._journal_entries(table), table)
+
+    def _get_derived_cached(self, table, token):
+        """Colonne derivate per versione tabella: in memoria (condivise) + cache su disco accanto alla tabella."""
+        return _TABLE_STORE.fetch(("derived", str(self.excel_path), table, token), lambda: self._load_derived(table, token))
 
-        - Se mancano fogli, li crea vuoti (0 righe) con intestazioni note (se disponibili).
-        - Non sovrascrive i fogli gia' presenti.
+    def _load_derived(self, table, token):
+        entries = self._journal_entries(table)
+        key = token[1]
+        if not entries:
+            der = _sidecar_load(self.excel_path, f"{table}.derived", key)
+            if der is not None and list(der.columns) == DERIVED_COLUMNS[table]:
+                return der
+        der = _derive_columns(table, self._get_all_cached(table, token))
+        if not entries:
+            # con operazioni in journal la base cambia senza cambiare versione: niente file
+            _sidecar_store(self.excel_path, f"{table}.derived", key, der)
+        return der
+
+    def _load_table(self, table, read=None) -> pd.DataFrame:
+        """Legge e normalizza una tabella dal backend (senza cache).
+
+        read: funzione (tabella, header) -> DataFrame; default storage.read_table
+        (get_many passa il reader che tiene aperto il workbook).
         """
-        try:
-            xl = pd.ExcelFile(self.excel_path, engine=_excel_engine_for_obj(self.excel_path) or self._excel_engine)
-            existing = set(xl.sheet_names)
-        except Exception:
-            existing = set()
+        read = read or self.storage.read_table
+        df = read(table)
+        # Excel puo' contenere intestazioni duplicate: rendi univoci subito
+        if df is not None and not df.empty and getattr(df.columns, 'duplicated', None) is not None:
+            if df.columns.duplicated().any():
+                df.columns = _make_unique_columns(df.columns)
+        df = _normalize_columns_generic(df)
 
-        missing = [t for t in self.TABLES if t not in existing]
-        if not missing:
-            return
+        # Fix speciale: Attivita spesso importata senza intestazioni (headerless)
+        if table == 'Attivita':
+            needed = {'data', 'matricola', 'turno'}
+            if not needed.issubset(set(df.columns)):
+                # prova a rileggere come header=None e normalizzare
+                try:
+                    df0 = read(table, header=None)
+                    df = _normalize_attivita_headerless(df0)
+                except Exception:
+                    pass
+            # garantisci colonne base
+            for col in TEMPLATE_HEADERS['Attivita']:
+                if col not in df.columns:
+                    df[col] = '' if col not in {'minuti','valore','data'} else (0 if col in {'minuti','valore'} else pd.NaT)
 
-        all_data = {}
-        # carica fogli esistenti
-        for s in sorted(existing):
-            try:
-                all_data[s] = pd.read_excel(self.excel_path, sheet_name=s, engine=_excel_engine_for_obj(self.excel_path) or self._excel_engine)
-            except Exception:
-                all_data[s] = pd.DataFrame()
+            # Se esistono ancora colonne duplicate tipo valore_1, valore_2 (import vecchi), consolida.
+            val_cols = [c for c in df.columns if str(c).startswith('valore')]
+            if len(val_cols) > 1:
+                scores = {}
+                for c in val_cols:
+                    s = pd.to_numeric(df[c], errors='coerce').fillna(0.0).abs()
+                    scores[c] = float((s > 0).mean())
+                keep = max(scores, key=scores.get)
+                df['valore'] = pd.to_numeric(df[keep], errors='coerce').fillna(0.0)
+                drop_cols = [c for c in val_cols if c != keep and c != 'valore']
+                if drop_cols:
+                    df = df.drop(columns=drop_cols)
 
-        # Se la tabella Turni_Assenze esiste già ma risulta vuota (tipico quando si aggiorna un DB
-        # già esistente con una nuova feature), pre-carica l'elenco di default delle assenze.
-        # Non sovrascriviamo mai dati esistenti: inseriamo solo se non c'è alcun valore utile.
-        if 'Turni_Assenze' in all_data:
-            df_ta = all_data.get('Turni_Assenze', pd.DataFrame())
-            if df_ta is None or df_ta.empty:
-                all_data['Turni_Assenze'] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
-            else:
-                col = 'Turno' if 'Turno' in df_ta.columns else (df_ta.columns[0] if len(df_ta.columns) else None)
-                if col is not None:
-                    vals = df_ta[col].astype(str).str.strip()
-                    vals = vals[vals.ne('') & vals.ne('nan')]
-                    if len(vals) == 0:
-                        all_data['Turni_Assenze'] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
+        # Converti date e applica i tipi dichiarati (categorie/datetime/float)
+        return _apply_schema(table, _coerce_date_columns(df))
 
-        # aggiungi fogli mancanti vuoti
-        for t in missing:
-            cols = TEMPLATE_HEADERS.get(t, [])
-            if t == 'Turni_Assenze' and cols:
-                all_data[t] = pd.DataFrame({'Turno': DEFAULT_TURNI_ASSENZE})
-            else:
-                all_data[t] = pd.DataFrame(columns=cols)
+    def table_token(self, table, meta=None, journal=None) -> tuple:
+        """Token di versione di una tabella, da usare come chiave di cache (st.cache_data).
 
-        
-with _persgest_write_lock(self.excel_path):
-    _backup_excel(self.excel_path)
-    tmp_path = self.excel_path.with_suffix(self.excel_path.suffix + ".tmp")
-    try:
-        with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
-            for name, df in all_data.items():
-                df.to_excel(writer, sheet_name=name, index=False)
+        Cambia solo quando quella tabella viene scritta (save_table, import, compattazione,
+        operazioni di riga in journal) o quando il file dati viene modificato da fuori.
+        meta/journal: gia' letti dal chiamante (letture di piu' tabelle).
+        """
+        entries = self._journal_entries(table, journal)
+        jtok = (len(entries), entries[-1].get("ts") if entries else None)
+        return (str(self.excel_path), _table_version_key(self.excel_path, self.storage_path, table, meta), jtok)
 
-        _atomic_replace(tmp_path, self.excel_path)
-        _bump_db_version(self.excel_path)
-    finally:
-        try:
-            if tmp_path.exists():
-                tmp_path.unlink()
-        except Exception:
-            pass
-        # reset cache
-        try:
-            self.get_all.clear()
-        except Exception:
-            pass
-        st.cache_data.clear()
+    def tables_token(self, tables) -> tuple:
+        """Token combinato per funzioni cache-ate che dipendono da piu' tabelle."""
+        meta = _read_db_meta(self.excel_path)
+        journal = _journal_read(self.excel_path)
+        out = []
+        for t in tables:
+            entries = self._journal_entries(t, journal)
+            jtok = (len(entries), entries[-1].get("ts") if entries else None)
+            out.append((t, _table_version_key(self.excel_path, self.storage_path, t, meta), jtok))
+        return (str(self.excel_path), tuple(out))
+
+    def get_many(self, tables=None, typed=True) -> dict:
+        """Legge piu' tabelle aprendo il workbook una sola volta.
+
+        Le tabelle gia' presenti nella cache su disco (versione corrente) non vengono rilette;
+        le altre vengono lette in un unico passaggio e salvate in cache (get_all le trovera' pronte).
 
-    @st.cache_data(ttl=5)
-    def get_all(_self, table):
-        """Leggi tutti i record da una tabella
-        
         Args:
-            table: Nome tabella/foglio
-            
+            tables: Lista tabelle (None = tutte)
+            typed: Come in get_all (default colonne codice come category)
+
         Returns:
-            DataFrame con i dati
+            Dict {tabella: DataFrame}
         """
-        if table not in _self.TABLES:
-            raise ValueError(f"Tabella {table} non esiste")
-        
-        try:
-            eng = _excel_engine_for_obj(_self.excel_path) or getattr(_self, '_excel_engine', None)
-            df = pd.read_excel(_self.excel_path, sheet_name=table, engine=eng)
-            # Excel puo' contenere intestazioni duplicate: rendi univoci subito
-            if df is not None and not df.empty and getattr(df.columns, 'duplicated', None) is not None:
-                if df.columns.duplicated().any():
-                    seen = {}
-                    new_cols = []
-                    for c in df.columns:
-                        base = str(c).strip()
-                        if base not in seen:
-                            seen[base] = 0
-                            new_cols.append(base)
-                        else:
-                            seen[base] += 1
-                            new_cols.append(f"{base}_{seen[base]}")
-                    df.columns = new_cols
-            df = _normalize_columns_generic(df)
-
-            # Fix speciale: Attivita spesso importata senza intestazioni (headerless)
-            if table == 'Attivita':
-                needed = {'data', 'matricola', 'turno'}
-                if not needed.issubset(set(df.columns)):
-                    # prova a rileggere come header=None e normalizzare
-                    try:
-                        df0 = pd.read_excel(_self.excel_path, sheet_name=table, header=None, engine=eng)
-                        df = _normalize_attivita_headerless(df0)
-                    except Exception:
-                        pass
-                # garantisci colonne base
-                for col in ['nome','matricola','uo','turno','att','pox','data','minuti','valore']:
-                    if col not in df.columns:
-                        df[col] = '' if col not in {'minuti','valore','data'} else (0 if col in {'minuti','valore'} else pd.NaT)
-
-                # Se esistono ancora colonne duplicate tipo valore_1, valore_2 (import vecchi), consolida.
-                val_cols = [c for c in df.columns if str(c).startswith('valore')]
-                if len(val_cols) > 1:
-                    scores = {}
-                    for c in val_cols:
-                        s = pd.to_numeric(df[c], errors='coerce').fillna(0.0).abs()
-                        scores[c] = float((s > 0).mean())
-                    keep = max(scores, key=scores.get)
-                    df['valore'] = pd.to_numeric(df[keep], errors='coerce').fillna(0.0)
-                    drop_cols = [c for c in val_cols if c != keep and c != 'valore']
-                    if drop_cols:
-                        df = df.drop(columns=drop_cols)
-
-            # Converti date
-            date_cols = ['data', 'data_inizio', 'data_fine']
-            for col in date_cols:
-                if col in df.columns:
-                    df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
-
-            return df
-        except Exception as e:
-            st.error(f"Errore lettura {table}: {e}")
-            return pd.DataFrame()
-    
-def save_table(self, table, df):
-    """Salva DataFrame su foglio Excel SENZA rischiare di svuotare le altre tabelle.
+        if tables is None:
+            tables = self.TABLES
+        for t in tables:
+            if t not in self.TABLES:
+                raise ValueError(f"Tabella {t} non esiste")
 
-    Strategia: aggiorna solo il foglio richiesto via openpyxl, preservando gli altri fogli.
+        meta = _read_db_meta(self.excel_path)
+        journal = _journal_read(self.excel_path)
+        tokens = {t: self.table_token(t, meta, journal) for t in tables}
+        keys = {t: tokens[t][1] for t in tables}
 
-    **Safety per uso multi-utente (≈10 utenti)**:
-    - serializza le scritture con lock (globale + su file)
-    - crea backup automatico prima della scrittura
-    - salva su file temporaneo e sostituisce in modo atomico (os.replace)
-    """
-    if table not in self.TABLES:
-        raise ValueError(f"Tabella {table} non esiste")
+        out = {}
+        loaded = {}
+        missing = []
+        for t in tables:
+            # gia' in memoria (condivisa tra le sessioni)?
+            df = _TABLE_STORE.peek(("all", str(self.excel_path), t, tokens[t]))
+            if df is not None:
+                out[t] = df
+                continue
+            df = _sidecar_load(self.excel_path, t, keys[t])
+            if df is None:
+                missing.append(t)
+            else:
+                loaded[t] = df
 
-    # Import locali per evitare dipendenze in fase di import modulo
-    from openpyxl import load_workbook, Workbook
-    from openpyxl.utils.dataframe import dataframe_to_rows
+        if missing:
+            try:
+                # lock condiviso: tutte le tabelle lette dalla stessa versione del file
+                with _persgest_read_lock(self.excel_path, site="get_many"), self.storage.reader() as read:
+                    for t in missing:
+                        try:
+                            df = self._load_table(t, read)
+                            _sidecar_store(self.excel_path, t, keys[t], df)
+                            loaded[t] = df
+                        except Exception as e:
+                            st.error(f"Errore lettura {t}: {e}")
+                            out[t] = pd.DataFrame()
+            except Exception as e:
+                st.error(f"Errore lettura database: {e}")
+                for t in missing:
+                    if t not in loaded:
+                        out.setdefault(t, pd.DataFrame())
 
-    # Normalizza dataframe
-    if df is None:
-        df = pd.DataFrame()
-    try:
-        df = df.copy()
-    except Exception:
-        pass
+        for t, df in loaded.items():
+            df = _journal_apply(df, self._journal_entries(t, journal), t)
+            out[t] = shared_view(_TABLE_STORE.put(("all", str(self.excel_path), t, tokens[t]), df))
+        out = {t: out[t] for t in tables}
 
-    # Lock su scrittura: impedisce sovrascritture concorrenti
-    with _persgest_write_lock(self.excel_path):
-        # Backup best-effort (non altera logiche / strutture)
-        _backup_excel(self.excel_path)
+        tx = self._current_tx()
+        if tx:
+            out.update({t: tx[t].copy() for t in tables if t in tx})
+        if not typed:
+            out = {t: _schema_release(df) for t, df in out.items()}
+        return out
 
-        # Carica o crea workbook
-        if os.path.exists(self.excel_path):
-            wb = load_workbook(self.excel_path)
-        else:
-            wb = Workbook()
-            # rimuovi sheet di default
+    def load_all(self) -> dict:
+        """Tutte le tabelle in un solo passaggio (vedi get_many)."""
+        return self.get_many(self.TABLES)
+
+    def save_table(self, table, df):
+        """Salva DataFrame su una tabella SENZA rischiare di svuotare le altre tabelle.
+
+        Strategia: aggiorna solo la tabella richiesta (foglio Excel o tabella SQLite),
+        preservando tutte le altre.
+
+        **Safety per uso multi-utente (≈10 utenti)**:
+        - serializza le scritture con lock (globale + su file)
+        - crea backup automatico prima della scrittura
+        - salva su file temporaneo e sostituisce in modo atomico (os.replace)
+          oppure, con SQLite, in un'unica transazione
+        """
+        if table not in self.TABLES:
+            raise ValueError(f"Tabella {table} non esiste")
+
+        # Normalizza dataframe (il risultato di un import si legge a blocchi in scrittura: niente copia)
+        if df is None:
+            df = pd.DataFrame()
+        elif not isinstance(df, _ImportResult):
             try:
-                if wb.active and wb.active.title == 'Sheet':
-                    wb.remove(wb.active)
+                df = df.copy()
             except Exception:
                 pass
 
-        # Assicura che TUTTE le tabelle esistano come fogli (senza sovrascriverle)
-        for tbl in self.TABLES:
-            if tbl not in wb.sheetnames:
-                wb.create_sheet(tbl)
-
-        # Rimuovi e ricrea il foglio target alla posizione coerente con TABLES
-        try:
-            idx = self.TABLES.index(table)
-        except Exception:
-            idx = 0
+        # Dentro db.transaction(): solo staging in memoria, scrittura al commit
+        tx = self._current_tx()
+        if tx is not None:
+            tx[table] = df
+            return
 
-        if table in wb.sheetnames:
-            ws_old = wb[table]
-            wb.remove(ws_old)
+        self._write_tables({table: df})
 
-        ws = wb.create_sheet(table, index=min(idx, len(wb.sheetnames)))
+    def _write_tables(self, data: dict, row_ops: dict | None = None):
+        """Scrive insieme piu' tabelle: un lock, un backup, una sostituzione atomica.
 
-        # Scrivi header + righe
-        for _r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), start=1):
-            ws.append(row)
+        row_ops: {tabella: (df, operazioni)} per le tabelle cambiate solo in poche righe (vedi
+        _stage_row_ops): se data[tabella] e' ancora quel df le operazioni vanno nel journal e la
+        tabella non viene riscritta. Journal e tabelle vanno insieme: se la scrittura delle tabelle
+        fallisce il journal torna com'era.
+        """
+        data = dict(data)
+        ops = []
+        for table, (frame, entries) in (row_ops or {}).items():
+            if data.get(table) is frame:
+                del data[table]
+                ops.extend(entries)
+        if not data and not ops:
+            return
+        data = _storage_column_names(data)
 
-        # Salvataggio atomico: tmp -> replace
-        tmp_path = self.excel_path.with_suffix(self.excel_path.suffix + ".tmp")
-        try:
-            wb.save(tmp_path)
-            # validazione minima: il file deve riaprirsi
+        # Lock su scrittura: impedisce sovrascritture concorrenti
+        with _persgest_write_lock(self.excel_path, site="_write_tables"):
+            self._journal_settle()
+            journal_before = _journal_read(self.excel_path)
+            for table, df in data.items():
+                if isinstance(df, _ImportResult) and df.stored and self._journal_entries(table, journal_before):
+                    # le righe in journal non sono nel file dati: la tabella si riscrive per intero
+                    df.stored = False
+            changed = bool(ops)
+            published = False
+            if ops:
+                _journal_append(self.excel_path, ops)
             try:
-                _ = load_workbook(tmp_path, read_only=True)
-            except Exception as e:
-                raise RuntimeError(f"File Excel temporaneo non valido: {e}") from e
+                if data:
+                    # Backup best-effort (snapshot istantaneo, elaborazione in background)
+                    self._queue_backup()
 
-            _atomic_replace(tmp_path, self.excel_path)
-            _bump_db_version(self.excel_path)
-        finally:
+                    sig_before = _source_signature(self.storage_path)
+                    # df e' lo stato completo della tabella: le operazioni in journal sono superate
+                    # (marcate prima di pubblicare il file, tolte dopo)
+                    changed = self._journal_fold(data.keys()) or changed
+                    self.storage.write_tables(data, self.TABLES)
+                    published = True
+                    self._journal_discard(data.keys())
+                    # Le cache (get_all e derivate) sono legate alla versione: cambiano solo queste tabelle
+                    _bump_db_version(self.excel_path, data.keys(), self.storage_path, sig_before)
+            except Exception:
+                # tabelle non scritte: il journal torna com'era (se scritte, le voci marcate restano
+                # superate e le toglie la prossima scrittura)
+                if changed and not published:
+                    _journal_rewrite(self.excel_path, journal_before)
+                raise
+
+        if ops and self._journal_needs_compaction():
             try:
-                if tmp_path.exists():
-                    tmp_path.unlink()
+                self.compact_journal()
             except Exception:
+                # il journal resta valido: si riprova alla prossima operazione
                 pass
 
-    # Invalida cache
-    try:
-        self.get_all.clear()
-    except Exception:
-        pass
-    try:
-        st.cache_data.clear()
-    except Exception:
-        pass
-    def import_excel(self, uploaded_file, table_mapping, mode: str = 'replace'):
-        """Import da file Excel esterno
-        
+    def _stage_row_ops(self, table, ops: list[dict]):
+        """Dentro db.transaction(): la tabella appena salvata differisce dalla precedente solo per ops.
+
+        Al commit le operazioni vanno nel journal invece di riscrivere la tabella, a meno che nel
+        frattempo la tabella sia stata salvata di nuovo.
+        """
+        tx = self._current_tx()
+        if tx is not None and table in tx:
+            self._tx_local.row_ops[table] = (tx[table], ops)
+
+    def _current_tx(self):
+        """Tabelle in staging della transazione aperta nel thread corrente (None se nessuna)."""
+        return getattr(self._tx_local, "tables", None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Raggruppa piu' scritture in un unico commit.
+
+        Dentro il blocco save_table/clear_table/add_record/update_record/delete_record
+        lavorano su copie in memoria (e get_all le vede); all'uscita tutte le tabelle toccate
+        vengono scritte con un solo lock, un solo backup e una sola sostituzione atomica.
+        Se il blocco solleva un'eccezione non viene scritto nulla.
+        Le transazioni annidate confluiscono in quella esterna.
+
+        Esempio:
+            with db.transaction():
+                db.save_table('Personale', df_pers)
+                db.add_record('Note', {...})
+        """
+        if self._current_tx() is not None:
+            yield self
+            return
+
+        self._tx_local.tables = {}
+        self._tx_local.row_ops = {}
+        try:
+            yield self
+            staged, row_ops = self._tx_local.tables, self._tx_local.row_ops
+        finally:
+            self._tx_local.tables = None
+            self._tx_local.row_ops = None
+        self._write_tables(staged, row_ops)
+
+    def import_excel(self, uploaded_file, table_mapping, mode: str = 'replace', progress=None,
+                     chunk_rows: int = IMPORT_CHUNK_ROWS, natural_keys: dict | None = None,
+                     parallel: bool | None = None):
+        """Import da file Excel esterno (anche CSV/TSV: un foglio con il nome del file, vedi import_csv)
+
         Args:
-            uploaded_file: File Excel caricato
+            uploaded_file: File Excel (o CSV/TSV) caricato
             table_mapping: Dict {foglio_origine: tabella_destinazione}
+            mode: 'replace', 'append' (solo righe nuove) o 'upsert' (aggiorna per chiave naturale)
+            progress: callback opzionale progress(foglio, righe_lette, righe_totali)
+            chunk_rows: righe per blocco in lettura (xlsx/xlsm, CSV/TSV), preparazione e scrittura
+            natural_keys: Dict {tabella: [colonne chiave]} che sovrascrive IMPORT_NATURAL_KEYS;
+                in upsert le tabelle senza chiave si comportano come in append
+            parallel: fogli letti nel pool di processi (None = automatico: piu' fogli, piu' core,
+                file >= IMPORT_PARALLEL_MIN_BYTES); con il pool progress arriva a foglio completato
         """
+        import tempfile
+        wb = None
+        excel_file = None
+        stage_dir = None
         try:
             mode = (mode or 'replace').strip().lower()
-            if mode not in {'replace', 'append'}:
+            if mode not in {'replace', 'append', 'upsert'}:
                 mode = 'replace'
+            keys_by_table = {**IMPORT_NATURAL_KEYS, **(natural_keys or {})}
             # Streamlit UploadedFile e' un file-like: assicurati che il puntatore sia all'inizio
             try:
                 uploaded_file.seek(0)
             except Exception:
                 pass
             eng = _excel_engine_for_obj(uploaded_file)
-            excel_file = pd.ExcelFile(uploaded_file, engine=eng) if eng else pd.ExcelFile(uploaded_file)
+            # xlsx/xlsm: sola lettura, righe lette a blocchi (vedi _excel_sheet_chunks)
+            wb, excel_file = _open_import_source(uploaded_file, eng)
+            sheet_names = wb.sheetnames if wb is not None else excel_file.sheet_names
+            tasks = [(sheet_name, dest_table) for sheet_name, dest_table in table_mapping.items()
+                     if sheet_name in sheet_names]
+            # righe dell'import su file temporanei, non in memoria (vedi "Import a blocchi")
+            stage_dir = tempfile.mkdtemp(prefix="persgest_import_")
 
-            for sheet_name, dest_table in table_mapping.items():
-                if sheet_name not in excel_file.sheet_names:
-                    continue
+            # fogli letti in parallelo (se conviene), altrimenti uno alla volta durante il commit
+            parsed = None
+            if _import_use_pool(parallel, tasks, uploaded_file):
+                parsed = _import_sheets_parallel(uploaded_file, eng, tasks, stage_dir, chunk_rows, progress)
 
-                # --- ATTIVITA (GT_IMPORT) ---
-                if dest_table == 'Festivi':
-                    # Foglio Festivi: prima colonna può essere numerica tipo 0101 (ggmm). Normalizziamo in gg/mm (anno perpetuo).
-                    df_raw = excel_file.parse(sheet_name=sheet_name, header=0)
-                    df_raw = _normalize_columns_generic(df_raw)
-
-                    # colonne attese: data (ggmm o date), nome/descrizione (opzionale)
-                    cols = {c.lower(): c for c in df_raw.columns}
-                    c_data = cols.get("data") or cols.get("giorno") or cols.get("ggmm") or list(df_raw.columns)[0]
-                    c_nome = cols.get("nome") or cols.get("festivo") or cols.get("descrizione") or (list(df_raw.columns)[1] if len(df_raw.columns) > 1 else None)
-
-                    def _to_ddmm(v):
-                        if v is None or (isinstance(v, float) and pd.isna(v)):
-                            return None
-                        s = str(v).strip()
-                        if not s:
-                            return None
-                        # Se Excel ha interpretato come data vera
-                        try:
-                            dt = pd.to_datetime(v, errors="coerce")
-                            if pd.notna(dt):
-                                return dt.strftime("%d/%m")
-                        except Exception:
-                            pass
-                        s = re.sub(r"[^0-9]", "", s)
-                        if len(s) == 3:  # es 101 -> 0101
-                            s = "0" + s
-                        if len(s) >= 4:
-                            gg = s[:2]
-                            mm = s[2:4]
-                            return f"{gg}/{mm}"
-                        return None
-
-                    out = pd.DataFrame()
-                    out["ddmm"] = df_raw[c_data].apply(_to_ddmm)
-                    out["nome"] = (df_raw[c_nome] if c_nome else "").astype(str).str.strip()
-                    out = out[out["ddmm"].notna()].copy()
-                    # compatibilità: tabella Festivi usa colonna 'data' come dd/mm
-                    out.rename(columns={"ddmm": "data"}, inplace=True)
-
-                    df = out
-
-                elif dest_table == 'Attivita':
-                    # Il file "Attivita" può avere header "strano" o mancante: rileviamo se la prima riga è header.
-                    preview = excel_file.parse(sheet_name, header=None, nrows=2)
-                    if _looks_like_header_row(preview):
-                        df = excel_file.parse(sheet_name, header=0)
-                        df = _normalize_columns_generic(df)
-                    else:
-                        df0 = excel_file.parse(sheet_name, header=None)
-                        df = _normalize_attivita_headerless(df0)
+            def _sheet(sheet_name, dest_table):
+                if parsed is not None:
+                    return parsed.pop(sheet_name)
+                return _import_stage_sheet(wb, excel_file, sheet_name, dest_table, stage_dir, chunk_rows,
+                                           progress)
 
-                else:
-                    df = excel_file.parse(sheet_name, header=0)
-                    df = _normalize_columns_generic(df)
-                # Normalizzazione extra per Attivita:
-                # se attività secondarie sono state inserite come righe extra in colonna TURNO,
-                # le spostiamo in ATT per evitare "più turni primari" e per mostrarle correttamente nel Crosstab.
-                if dest_table == 'Attivita':
-                    try:
-                        tdf = self.get_all('Turni_tipo')
-                        # prova a trovare colonna codice turno
-                        tcols = {c.lower(): c for c in (tdf.columns if isinstance(tdf, pd.DataFrame) else [])}
-                        c_turno = tcols.get('turno') or tcols.get('codice') or tcols.get('sigla') or None
-                        primary_turni = set()
-                        if c_turno and len(tdf) > 0:
-                            primary_turni = set(tdf[c_turno].dropna().astype(str).str.strip().str.upper().tolist())
-                        df = _attivita_move_extra_turno_to_att(df, primary_turni=primary_turni)
-                    except Exception:
-                        # best effort: non bloccare l'import se qualcosa non torna
-                        pass
+            # dentro una transazione esterna la tabella va in memoria: lo staging si cancella all'uscita
+            nested = self._current_tx() is not None
+            # Tutti i fogli in un unico commit: se uno fallisce non viene scritto nulla
+            new_fps = {}
+            report = {}
+            with self.transaction():
+                for sheet_name, dest_table in tasks:
+                    raw = _sheet(sheet_name, dest_table)
+                    keys = keys_by_table.get(dest_table) if mode == 'upsert' else None
+                    # Normalizzazione extra per Attivita (in _import_prepare):
+                    # se attività secondarie sono state inserite come righe extra in colonna TURNO,
+                    # le spostiamo in ATT per evitare "più turni primari" e per mostrarle correttamente nel Crosstab.
+                    primary = self._primary_turni() if dest_table == 'Attivita' else None
+                    rows, fps, key_fps = _import_prepare(dest_table, raw, stage_dir, chunk_rows, primary, keys)
+
+                    # Modalita': replace (default), append o upsert
+                    result, fps, counts = self._import_table(dest_table, rows, fps, key_fps, stage_dir,
+                                                             mode, keys, chunk_rows)
+                    if counts is not None:
+                        report[dest_table] = counts
+                    if result is None:
+                        continue  # nessuna riga nuova o cambiata: niente da scrivere
+                    new_fps[dest_table] = fps
 
-                df = df.drop_duplicates()
-
-                # Modalita': replace (default) o append
-                if mode == 'append':
-                    cur = self.get_all(dest_table)
-                    if len(cur) > 0:
-                        df = pd.concat([cur, df], ignore_index=True)
-                        df = df.drop_duplicates()
-
-                        if dest_table == 'Attivita':
-                            try:
-                                tdf = self.get_all('Turni_tipo')
-                                tcols = {c.lower(): c for c in (tdf.columns if isinstance(tdf, pd.DataFrame) else [])}
-                                c_turno = tcols.get('turno') or tcols.get('codice') or tcols.get('sigla') or None
-                                primary_turni = set()
-                                if c_turno and len(tdf) > 0:
-                                    primary_turni = set(tdf[c_turno].dropna().astype(str).str.strip().str.upper().tolist())
-                                df = _attivita_move_extra_turno_to_att(df, primary_turni=primary_turni)
-                            except Exception:
-                                pass
-
-                self.save_table(dest_table, df)
+                    # upsert su poche righe: al commit solo le righe toccate (journal), non la tabella
+                    ops = None
+                    if mode == 'upsert' and result.head is not None:
+                        ops = result.row_ops(dest_table, JOURNAL_COMPACT_ENTRIES)
+                    self.save_table(dest_table, result.copy() if nested else result)
+                    if ops is not None:
+                        self._stage_row_ops(dest_table, ops)
 
+            # indici impronte gia' pronti per la versione appena scritta (niente ricalcolo al prossimo import)
+            for table, fps in new_fps.items():
+                self._store_fingerprints(table, fps)
+
+            if report:
+                esito = "; ".join(f"{t}: {c['inserite']} inserite, {c['aggiornate']} aggiornate, "
+                                  f"{c['invariate']} invariate" for t, c in report.items())
+                return True, f"Import completato! {esito}"
             return True, "Import completato!"
 
         except Exception as e:
             return False, f"Errore import: {e}"
-    
+        finally:
+            if wb is not None or excel_file is not None:
+                try:
+                    (wb or excel_file).close()
+                except Exception:
+                    pass
+            if stage_dir is not None:
+                shutil.rmtree(stage_dir, ignore_errors=True)
+
+    def import_csv(self, uploaded_file, dest_table, mode: str = 'replace', **kwargs):
+        """Import da file delimitato (CSV/TSV/TXT; separatore e codifica riconosciuti dal contenuto)
+
+        Args:
+            uploaded_file: File caricato (o percorso)
+            dest_table: Tabella destinazione
+            mode, **kwargs: come import_excel
+        """
+        return self.import_excel(uploaded_file, {_delimited_sheet_name(uploaded_file): dest_table},
+                                 mode=mode, **kwargs)
+
+    def _primary_turni(self) -> set:
+        """Codici turno primari (Turni_tipo) per lo spostamento dei turni extra in ATT."""
+        tdf = self.get_all('Turni_tipo')
+        tcols = {c.lower(): c for c in (tdf.columns if isinstance(tdf, pd.DataFrame) else [])}
+        c_turno = tcols.get('turno') or tcols.get('codice') or tcols.get('sigla') or None
+        if c_turno and len(tdf) > 0:
+            return set(tdf[c_turno].dropna().astype(str).str.strip().str.upper().tolist())
+        return set()
+
+    def _get_fingerprints(self, table, cur: pd.DataFrame) -> np.ndarray:
+        """Impronte (ordinate, uniche) delle righe di cur = get_all(table): da cache se la versione e' nota."""
+        tx = self._current_tx()
+        if tx is not None and table in tx:
+            return np.unique(_row_fingerprints(cur))
+        token = self.table_token(table)
+
+        def _load():
+            direct = not self._journal_entries(table)
+            if direct:
+                cached = _sidecar_load(self.excel_path, f"{table}.fp", token[1])
+                if cached is not None and 'fp' in cached.columns:
+                    return cached
+            out = pd.DataFrame({'fp': np.unique(_row_fingerprints(cur))})
+            if direct:
+                _sidecar_store(self.excel_path, f"{table}.fp", token[1], out)
+            return out
+        return _TABLE_STORE.fetch(("fingerprints", str(self.excel_path), table, token), _load)['fp'].to_numpy()
+
+    def _store_fingerprints(self, table, fps: np.ndarray):
+        """Registra le impronte della versione corrente di table (dopo una scrittura completa)."""
+        try:
+            if self._journal_entries(table):
+                return
+            token = self.table_token(table)
+            out = pd.DataFrame({'fp': np.unique(np.asarray(fps, dtype='uint64'))})
+            _sidecar_store(self.excel_path, f"{table}.fp", token[1], out)
+            _TABLE_STORE.put(("fingerprints", str(self.excel_path), table, token), out)
+        except Exception:
+            pass
+
+    def _import_table(self, table, rows: _StagedRows, fps, key_fps, folder, mode: str, keys=None,
+                      chunk_rows: int = IMPORT_CHUNK_ROWS):
+        """Terzo passaggio dell'import: la tabella risultante dalla modalita', a blocchi.
+
+        replace (o tabella vuota): la tabella e' esattamente rows. append/upsert: ogni blocco di
+        rows si confronta con la tabella attuale (_append_chunk/_upsert_chunk) e nello staging vanno
+        solo le righe esistenti cambiate (per posizione) e le righe nuove (in fondo, nell'ordine
+        di rows). Per Attivita i blocchi non spezzano mai un giorno (matricola, giorno).
+
+        Returns:
+            (_ImportResult o None se nulla cambia, impronte della tabella risultante,
+             conteggi {'inserite', 'aggiornate', 'invariate'} in upsert, altrimenti None)
+        """
+        n_in = len(rows)
+        # tabella non ancora toccata nella transazione: cur e' quella del file dati (piu' il journal)
+        stored = table not in (self._current_tx() or {})
+        cur = self.get_all(table) if mode in {'append', 'upsert'} else None
+        if cur is None or len(cur) == 0:
+            # replace (o tabella vuota): la tabella e' esattamente rows
+            counts = {'inserite': n_in, 'aggiornate': 0, 'invariate': 0} if mode == 'upsert' else None
+            return _ImportResult(rows, chunk_rows=chunk_rows), fps, counts
+
+        keys = list(keys) if keys else None
+        if keys:
+            missing = [k for k in keys if k not in rows.columns]
+            if missing:
+                raise ValueError(f"{table}: colonne chiave mancanti nel file ({', '.join(missing)})")
+        cur = _schema_release(cur)
+        fp_before = fp_cur = self._get_fingerprints(table, cur)
+        att_days = None
+        if table == 'Attivita' and {'matricola', 'data'}.issubset(cur.columns) and 'data' in rows.columns:
+            att_days = _attivita_day_keys(cur)
+        if keys:
+            # posizione in cur della (prima) riga con ogni chiave; chiavi ripetute nel file: vale l'ultima
+            key_cur = pd.Index(_row_fingerprints(cur.reindex(columns=keys)))
+            first = ~key_cur.duplicated()
+            key_index, key_pos = key_cur[first], np.flatnonzero(first)
+            last = ~pd.Series(key_fps).duplicated(keep='last').to_numpy()
+            counts = {'inserite': 0, 'aggiornate': 0, 'invariate': 0}
+
+        patches = _stage_rows(folder, ('_pos',))
+        tail = _stage_rows(folder, ('_seq',))
+        by = ('_kt', '_kd') if att_days is not None else ()
+        for chunk in rows.chunks(chunk_rows, by=by):
+            if keys:
+                at = chunk.index.to_numpy()
+                chunk, key_new = chunk[last[at]], key_fps[at][last[at]]
+                changed, added, fp_cur, got = self._upsert_chunk(table, cur, chunk, key_new, fp_before, fp_cur,
+                                                                 att_days, key_index, key_pos)
+                counts = {k: counts[k] + got[k] for k in counts}
+            else:
+                changed, added, fp_cur = self._append_chunk(table, cur, chunk, fp_cur, att_days)
+            if changed is not None and len(changed):
+                # solo le righe davvero cambiate (il riordino puo' lasciarle come erano)
+                diff = _row_fingerprints(changed) != _row_fingerprints(cur.iloc[changed.index.to_numpy()])
+                changed = changed[diff]
+                if len(changed):
+                    patches.append(changed, _pos=changed.index.to_numpy())
+            if len(added):
+                tail.append(added, _seq=added.index.to_numpy())
+
+        if not keys and mode == 'upsert':
+            counts = {'inserite': len(tail), 'aggiornate': 0, 'invariate': max(n_in - len(tail), 0)}
+        elif not keys:
+            counts = None
+        if not len(patches) and not len(tail):
+            return None, fp_cur, counts
+        result = _ImportResult(tail, head=cur, patches=patches, tail_by=('_seq',), chunk_rows=chunk_rows,
+                               stored=stored)
+        return result, fp_cur, counts
+
+    def _append_chunk(self, table, cur: pd.DataFrame, new: pd.DataFrame, fp_cur: np.ndarray,
+                      att_days: np.ndarray | None = None, patched: pd.DataFrame | None = None):
+        """Import in aggiunta di un blocco: righe della tabella cambiate + righe nuove + impronte.
+
+        Le righe gia' presenti (stessa impronta) vengono scartate senza rileggere la storia. Per
+        Attivita lo spostamento dei turni extra si rifa' solo sui giorni (matricola, giorno) toccati
+        dalle righe nuove: le righe esistenti di quei giorni restano nella loro posizione (con
+        turno/att aggiornati), le righe nuove vanno in fondo nell'ordine del file.
+
+        Duplicati: si confrontano solo le righe in arrivo (con la tabella e tra loro). Righe doppie
+        gia' presenti nella tabella restano come sono, anche nei giorni Attivita toccati (prima
+        l'append rifaceva drop_duplicates su tutta la tabella e le toglieva). Il risultato e' quindi
+        sempre cur con alcune righe cambiate sul posto piu' le righe nuove in fondo (vedi _row_ops).
+
+        Args:
+            new: blocco di righe preparate (indice = posizione nelle righe preparate)
+            fp_cur: impronte (uniche, ordinate) della tabella a questo punto dell'import
+            att_days: _attivita_day_keys(cur) per Attivita, None per le altre tabelle
+            patched: righe di cur gia' cambiate in questo blocco (indice = posizione in cur)
+
+        Returns:
+            (righe di cur cambiate o None, indice = posizione in cur; righe nuove, indice = posizione
+             nelle righe preparate; impronte della tabella risultante)
+        """
+        fp_new = _row_fingerprints(new)
+        fresh = ~_fp_seen(fp_new, fp_cur) & ~pd.Series(fp_new).duplicated().to_numpy()
+        new, fp_new = new[fresh], fp_new[fresh]
+        if len(new) == 0:
+            return patched, new, fp_cur
+        if att_days is None:
+            return patched, new, _fp_add(fp_cur, fp_new)
+
+        tpos = np.flatnonzero(np.isin(att_days, _attivita_day_keys(new)))
+        base = cur.iloc[tpos].set_axis(tpos)
+        if patched is not None and len(patched):
+            # righe gia' aggiornate nel blocco (upsert): si parte dai valori nuovi
+            base = pd.concat([base[~base.index.isin(patched.index)],
+                              patched[patched.index.isin(tpos)]]).sort_index()
+        # posizione finale di ogni riga: quella in cur per le esistenti, in fondo per le nuove
+        part = pd.concat([base, new], ignore_index=True)
+        part['_pos'] = np.concatenate([base.index.to_numpy(), len(cur) + new.index.to_numpy()])
+        # raggruppa sulla matricola normalizzata (1001 letta dal file == '1001' in tabella)
+        part['_matr'] = part['matricola']
+        part['matricola'] = _fp_text(part['matricola'])
+        try:
+            part = _attivita_move_extra_turno_to_att(part, primary_turni=self._primary_turni())
+        except Exception:
+            pass
+        part['matricola'] = part.pop('_matr')
+        # doppioni creati dal riordino: si scartano solo righe in arrivo, mai righe esistenti
+        part = part[~(part.drop(columns='_pos').duplicated() & (part['_pos'] >= len(cur)).to_numpy())]
+        pos = part.pop('_pos').to_numpy(dtype='int64')
+        old = pos < len(cur)
+        changed = part[old].set_axis(pos[old])
+        if patched is not None and len(patched):
+            changed = pd.concat([patched[~patched.index.isin(changed.index)], changed]).sort_index()
+        fp_keep = fp_cur[~np.isin(fp_cur, _row_fingerprints(base))]
+        return changed, part[~old].set_axis(pos[~old] - len(cur)), _fp_add(fp_keep, _row_fingerprints(part))
+
+    def _upsert_chunk(self, table, cur: pd.DataFrame, new: pd.DataFrame, key_new: np.ndarray,
+                      fp_before: np.ndarray, fp_cur: np.ndarray, att_days, key_index: pd.Index,
+                      key_pos: np.ndarray):
+        """Import in upsert di un blocco: righe con chiave naturale gia' presente aggiornate, le altre inserite.
+
+        Le righe identiche a una esistente (stessa impronta) sono invariate e non toccano nulla; le
+        righe aggiornate restano nella loro posizione e ricevono i valori delle colonne del file
+        (le altre colonne restano come sono). Le righe nuove passano da _append_chunk (per
+        Attivita: spostamento turni extra sui soli giorni toccati). Le chiavi ripetute nel file
+        sono gia' state risolte da _import_table (vale l'ultima riga).
+
+        Args:
+            key_new: impronte delle chiavi delle righe di new
+            fp_before: impronte della tabella prima dell'import (righe invariate)
+            key_index, key_pos: impronte delle chiavi di cur (prima occorrenza) e loro posizioni
+
+        Returns:
+            (righe di cur cambiate o None, righe nuove, impronte della tabella risultante,
+             conteggi {'inserite', 'aggiornate', 'invariate'} del blocco)
+        """
+        same = _fp_seen(_row_fingerprints(new), fp_before)
+        counts = {'inserite': 0, 'aggiornate': 0, 'invariate': int(same.sum())}
+        new, key_new = new[~same], key_new[~same]
+        if len(new) == 0:
+            return None, new, fp_cur, counts
+
+        hit = key_index.get_indexer(key_new)
+        upd = hit >= 0
+        pos = key_pos[hit[upd]]
+        counts['aggiornate'] = int(upd.sum())
+        patched = None
+        if len(pos):
+            old = cur.iloc[pos]
+            patched = old.set_axis(pos)
+            src = new[upd]
+            for c in src.columns:
+                patched[c] = src[c].to_numpy()
+            fp_cur = _fp_add(fp_cur[~np.isin(fp_cur, _row_fingerprints(old))], _row_fingerprints(patched))
+
+        ins = new[~upd]
+        counts['inserite'] = int(len(ins))
+        changed, added, fp_cur = self._append_chunk(table, cur, ins, fp_cur, att_days, patched)
+        return changed, added, fp_cur, counts
+
     def export_excel(self, tables=None):
         """Export tabelle selezionate in file Excel
-        
+
         Args:
             tables: Lista tabelle da esportare (None = tutte)
-            
+
         Returns:
             Path del file esportato
         """
         if tables is None:
             tables = self.TABLES
-        
+
         export_path = Path(f'data/export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx')
-        
+
+        data = self.get_many(tables)
         with pd.ExcelWriter(export_path, engine='xlsxwriter') as writer:
             for table in tables:
-                df = self.get_all(table)
-                df.to_excel(writer, sheet_name=table, index=False)
-        
+                data[table].to_excel(writer, sheet_name=table, index=False)
+
         return export_path
-    
+
     def get_stats(self):
         """Statistiche database
-        
+
         Returns:
             Dict con conteggi per tabella
         """
-        stats = {}
-        for table in self.TABLES:
-            df = self.get_all(table)
-            stats[table] = len(df)
-        return stats
-    
+        return {table: len(df) for table, df in self.load_all().items()}
+
     def clear_table(self, table):
         """Svuota una tabella
-        
+
         Args:
             table: Nome tabella da svuotare
         """
         self.save_table(table, pd.DataFrame())
-    
+
     def add_record(self, table, record):
         """Aggiungi singolo record
-        
+
         Args:
             table: Nome tabella
             record: Dict con dati record
         """
-        df = self.get_all(table)
-        new_df = pd.concat([df, pd.DataFrame([record])], ignore_index=True)
-        self.save_table(table, new_df)
-    
+        self._log_row_op(table, 'add', record=record)
+
     def update_record(self, table, index, record):
         """Aggiorna record esistente
-        
+
         Args:
             table: Nome tabella
             index: Indice riga da aggiornare
             record: Dict con nuovi dati
         """
-        df = self.get_all(table)
-        for key, value in record.items():
-            df.at[index, key] = value
-        self.save_table(table, df)
-    
+        self._log_row_op(table, 'update', index=index, record=record)
+
     def delete_record(self, table, index):
         """Elimina record
-        
+
         Args:
             table: Nome tabella
             index: Indice riga da eliminare
         """
+        self._log_row_op(table, 'delete', index=index)
+
+    # ----------------------------
+    # Journal operazioni di riga
+    # ----------------------------
+
+    def _journal_entries(self, table, entries=None) -> list[dict]:
+        if entries is None:
+            entries = _journal_read(self.excel_path)
+        out = [e for e in entries if e.get("table") == table]
+        if any("folded_on" in e for e in out):
+            # riscrittura della tabella interrotta: se il file dati e' cambiato da quando le voci
+            # sono state marcate le contiene gia' (vedi _journal_fold)
+            gen = self.storage.generation()
+            out = [e for e in out if e.get("folded_on", gen) == gen]
+        return out
+
+    def _journal_fold(self, tables) -> bool:
+        """Marca le voci delle tabelle con la generazione corrente del file dati, prima di riscriverle
+        per intero (chiamare sotto write lock). True se il journal e' cambiato."""
+        tables = set(tables)
+        entries = _journal_read(self.excel_path)
+        if not any(e.get("table") in tables for e in entries):
+            return False
+        gen = self.storage.generation()
+        _journal_rewrite(self.excel_path, [{**e, "folded_on": gen} if e.get("table") in tables else e
+                                           for e in entries])
+        return True
+
+    def _journal_settle(self):
+        """Chiude una riscrittura interrotta prima di cambiare il file dati (chiamare sotto write lock).
+
+        Voci marcate da _journal_fold: tolte se il file dati e' cambiato (sono nella tabella),
+        altrimenti la scrittura non e' avvenuta e tornano normali.
+        """
+        entries = _journal_read(self.excel_path)
+        if not any("folded_on" in e for e in entries):
+            return
+        gen = self.storage.generation()
+        keep = []
+        for e in entries:
+            if "folded_on" in e:
+                if e["folded_on"] != gen:
+                    continue
+                e = {k: v for k, v in e.items() if k != "folded_on"}
+            keep.append(e)
+        _journal_rewrite(self.excel_path, keep)
+
+    def _journal_discard(self, tables):
+        """Rimuove dal journal le operazioni delle tabelle indicate (chiamare sotto write lock)."""
+        tables = {tables} if isinstance(tables, str) else set(tables)
+        entries = _journal_read(self.excel_path)
+        keep = [e for e in entries if e.get("table") not in tables]
+        if len(keep) != len(entries):
+            _journal_rewrite(self.excel_path, keep)
+
+    def _log_row_op(self, table, op, index=None, record=None):
+        if table not in self.TABLES:
+            raise ValueError(f"Tabella {table} non esiste")
+        entry = {
+            "ts": time.time(),
+            "by": current_session_id(),
+            "table": table,
+            "op": op,
+            "index": int(index) if index is not None else None,
+            "record": {str(k): _journal_encode(v) for k, v in (record or {}).items()},
+        }
+        tx = self._current_tx()
+        if tx is not None:
+            tx[table] = _journal_apply(self.get_all(table), [entry], table, strict=True)
+            return
+
+        with _persgest_write_lock(self.excel_path, site="_log_row_op"):
+            self._journal_validate(table, entry)
+            _journal_append(self.excel_path, [entry])
+
+        if self._journal_needs_compaction():
+            try:
+                self.compact_journal()
+            except Exception:
+                # il journal resta valido: si riprova alla prossima operazione
+                pass
+
+    def _journal_validate(self, table, entry):
+        """Solleva se l'operazione non si applica alla tabella corrente (chiamare sotto write lock)."""
+        json.dumps(entry, ensure_ascii=False)  # valori non serializzabili: errore prima di scrivere
+        if entry["op"] == "add":
+            return
         df = self.get_all(table)
-        df = df.drop(index).reset_index(drop=True)
-        self.save_table(table, df)
\ No newline at end of file
+        index = entry["index"]
+        if index is None or index not in df.index:
+            raise KeyError(f"Riga {index} non presente in {table}")
+        # prova sulla sola riga interessata (tipi/valori), senza copiare la tabella
+        _journal_apply_one(_schema_release(df.loc[[index]]).copy(), entry)
+
+    def _journal_needs_compaction(self) -> bool:
+        entries = _journal_read(self.excel_path)
+        if not entries:
+            return False
+        if len(entries) >= JOURNAL_COMPACT_ENTRIES:
+            return True
+        if _source_signature(_journal_path_for(self.excel_path))[1] >= JOURNAL_COMPACT_BYTES:
+            return True
+        try:
+            return (time.time() - float(entries[0].get("ts", 0))) >= JOURNAL_COMPACT_AGE_S
+        except Exception:
+            return False
+
+    def journal_info(self) -> dict:
+        """Stato journal: numero operazioni, tabelle coinvolte e operazioni non applicabili.
+
+        failed: voci ancora in journal saltate in lettura ({table, op, index, error});
+        rejected: voci spostate dalla compattazione in rejected_path.
+        """
+        entries = _journal_read(self.excel_path)
+        failed = []
+        for e in entries:
+            err = _JOURNAL_APPLY_ERRORS.get((e.get("table"), e.get("ts"), e.get("op"), e.get("index")))
+            if err:
+                failed.append({"table": e.get("table"), "op": e.get("op"), "index": e.get("index"), "error": err})
+        rp = _journal_rejected_path_for(self.excel_path)
+        try:
+            with open(rp, "r", encoding="utf-8") as f:
+                rejected = sum(1 for line in f if line.strip())
+        except OSError:
+            rejected = 0
+        return {
+            "entries": len(entries),
+            "tables": sorted({e.get("table") for e in entries}),
+            "path": _journal_path_for(self.excel_path),
+            "failed": failed,
+            "rejected": rejected,
+            "rejected_path": rp,
+        }
+
+    def compact_journal(self) -> int:
+        """Riporta nel DB tutte le operazioni in journal e lo svuota.
+
+        Le operazioni non applicabili finiscono nel file .journal.rejected.jsonl (journal_info).
+
+        Returns:
+            Numero di operazioni compattate (incluse quelle scartate)
+        """
+        with _persgest_write_lock(self.excel_path, site="compact_journal"):
+            self._journal_settle()
+            entries = _journal_read(self.excel_path)
+            if not entries:
+                return 0
+
+            tables = []
+            for e in entries:
+                t = e.get("table")
+                if t in self.TABLES and t not in tables:
+                    tables.append(t)
+
+            self._queue_backup()
+            sig_before = _source_signature(self.storage_path)
+            failed = []
+            data = {t: _journal_apply(self._load_table(t), self._journal_entries(t, entries), t, failed=failed)
+                    for t in tables}
+            if data:
+                self._journal_fold(tables)
+                self.storage.write_tables(_storage_column_names(data), self.TABLES)
+            # le voci non applicabili non si perdono: restano nel file .rejected (vedi journal_info)
+            _journal_reject(self.excel_path, failed)
+            _journal_rewrite(self.excel_path, [])
+            _bump_db_version(self.excel_path, tables, self.storage_path, sig_before)
+
+        return len(entries)
+
+    # ----------------------------
+    # Watcher modifiche (altre postazioni / altre sessioni)
+    # ----------------------------
+
+    def _watch_snapshot(self):
+        meta = _read_db_meta(self.excel_path)
+        journal = _journal_read(self.excel_path)
+        snap = {}
+        last_by = {}
+        for t in self.TABLES:
+            entries = self._journal_entries(t, journal)
+            jtok = (len(entries), entries[-1].get("ts") if entries else None)
+            snap[t] = (_table_version_key(self.excel_path, self.storage_path, t, meta), jtok)
+            if entries:
+                last_by[t] = entries[-1].get("by", "")
+        return snap, meta, last_by
+
+    def _watch_poll(self):
+        """Confronta lo stato con il giro precedente e registra le tabelle cambiate."""
+        snap, meta, last_by = self._watch_snapshot()
+        prev = self._watch_state
+        self._watch_state = snap
+        if not prev:
+            return []
+        changed = [t for t in self.TABLES if snap.get(t) != prev.get(t)]
+        if not changed:
+            return []
+
+        writers_meta = meta.get("table_last_writer") if isinstance(meta.get("table_last_writer"), dict) else {}
+        writers = {}
+        for t in changed:
+            # cambiato solo il journal -> autore dell'ultima operazione di riga
+            if snap[t][0] == prev.get(t, (None,))[0] and t in last_by:
+                writers[t] = last_by[t]
+            elif snap[t][0][2] is not None:
+                writers[t] = ""  # modifica esterna al file
+            else:
+                writers[t] = writers_meta.get(t, "")
+
+        with self._changes_lock:
+            self._change_seq += 1
+            self._changes.append((self._change_seq, time.time(), tuple(changed), writers))
+            self._changes = self._changes[-200:]
+
+        # Solo registrazione: nessuna lettura delle tabelle da questo thread (niente ScriptRunContext,
+        # st.cache e lock di lettura sono affare delle sessioni). Le tabelle cambiate si ricaricano
+        # alla prossima lettura di una sessione, perche' la loro versione e' cambiata.
+        return changed
+
+    def _watch_loop(self, interval: float):
+        while not self._watch_stop.wait(interval):
+            try:
+                self._watch_poll()
+            except Exception:
+                pass
+
+    def start_watcher(self, interval: float = 2.0):
+        """Avvia (una volta per processo) il thread che controlla db_meta.json, file dati e journal.
+
+        Rileva le scritture di altre postazioni sulla cartella condivisa (o modifiche fatte a mano
+        al file) e registra le tabelle coinvolte, visibili tramite changes_since(). Il thread legge
+        solo db_meta.json, firme dei file e journal: le tabelle le ricaricano le sessioni.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._watch_stop.clear()
+        self._watch_state = self._watch_snapshot()[0]
+        self._watcher = threading.Thread(target=self._watch_loop, args=(interval,), name="persgest-db-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._watch_stop.set()
+
+    def changes_since(self, seq, session_id: str | None = None):
+        """Tabelle cambiate dopo seq (escluse quelle scritte dalla sessione indicata).
+
+        Returns:
+            (ultimo seq, lista tabelle cambiate)
+        """
+        with self._changes_lock:
+            cur = self._change_seq
+            changes = list(self._changes)
+        if seq is None:
+            return cur, []
+        tables = []
+        for c_seq, _ts, c_tables, writers in changes:
+            if c_seq <= seq:
+                continue
+            for t in c_tables:
+                if session_id and writers.get(t) == session_id:
+                    continue
+                if t not in tables:
+                    tables.append(t)
+        return cur, tables
+
+    def table_last_write(self) -> dict:
+        """Ora dell'ultima scrittura per tabella (da db_meta.json)."""
+        meta = _read_db_meta(self.excel_path)
+        tw = meta.get("table_last_write")
+        return dict(tw) if isinstance(tw, dict) else {}
+
+    # ----------------------------
+    # Backup
+    # ----------------------------
+
+    def list_backups(self) -> list[dict]:
+        """Backup disponibili per il file dati corrente (dal piu' recente)."""
+        out = []
+        for mp in _list_backup_manifests(self.storage_path):
+            try:
+                m = json.loads(mp.read_text(encoding="utf-8"))
+            except Exception:
+                continue
+            out.append({
+                "manifest": mp,
+                "created": m.get("created", ""),
+                "format": m.get("format", ""),
+                "size": sum(int(e.get("size", 0)) for e in m.get("parts", [])),
+            })
+        return out
+
+    def restore_backup(self, manifest, dest_path=None) -> Path:
+        """Ricostruisce un backup in un nuovo file (non sovrascrive il DB in uso).
+
+        Args:
+            manifest: Path del manifest (vedi list_backups)
+            dest_path: file di destinazione (default: backups/restore_<timestamp>.<ext>)
+        """
+        manifest = Path(manifest)
+        if dest_path is None:
+            ext = ".sqlite" if self.storage_path.suffix.lower() == ".sqlite" else self.storage_path.suffix
+            dest_path = self.storage_path.parent / "backups" / f"restore_{manifest.stem}{ext}"
+        return _restore_backup(manifest, Path(dest_path))
@@ -66,6 +66,7 @@ Sistema Gestione Personale con UI Aziendale
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
+import numpy as np
 import textwrap
 from datetime import datetime, timedelta, date
 from pathlib import Path
@@ -73,9 +74,12 @@ import sys
 import os
 import json
 import re
+from functools import lru_cache
 
 sys.path.append(str(Path(__file__).parent))
-from database import PersGestDatabase
+from database import (PersGestDatabase, STORAGE_BACKENDS, backup_metrics, lock_metrics, table_store_metrics,
+                      vocabulary, text_column, excel_sheet_names, IMPORT_NATURAL_KEYS,
+                      readonly_frame, shared_view, current_session_id)
 
 # Asset (immagini) per UI (es. Calendario "vista ampia")
 ASSETS_DIR = Path(__file__).parent / "assets"
@@ -217,28 +221,32 @@ def extract_gt_overtime(attivita: pd.DataFrame) -> pd.DataFrame:
     if 'matricola' not in df.columns or 'data' not in df.columns:
         return pd.DataFrame(columns=['matricola','data','turno','minuti','ore','_is_gt_ot'])
 
-    df['matricola'] = df['matricola'].astype(str).str.strip()
+    df['matricola'] = text_column(df['matricola'])
     df['data'] = pd.to_datetime(df['data'], errors='coerce', dayfirst=True)
     df = df[df['data'].notna()].copy()
 
-    # valore/minuti
-    val_col = None
-    for cand in ['valore', 'minuti', 'mins', 'minute']:
-        if cand in df.columns:
-            val_col = cand
-            break
-    if val_col is None:
-        return pd.DataFrame(columns=['matricola','data','turno','minuti','ore','_is_gt_ot'])
-
-    df['_min'] = series_to_numeric(df[val_col]).fillna(0.0).astype(float)
-
-    # Normalizzazione input GT:
-    # - atteso: MINUTI (es. 480 = 8h)
-    # - in alcuni export: ORE (es. 8 = 8h)
-    # Regola conservativa: se il valore è un intero tra 1 e 24 lo trattiamo come ORE.
-    mask_hours = (df['_min'] > 0) & (df['_min'] <= 24) & ((df['_min'] % 1) == 0)
-    if mask_hours.any():
-        df.loc[mask_hours, '_min'] = df.loc[mask_hours, '_min'] * 60
+    if '_mins_gt' in df.columns:
+        # minuti gia' calcolati dal database con questa stessa regola (get_all(..., derived=True))
+        df['_min'] = df['_mins_gt'].astype(float)
+    else:
+        # valore/minuti
+        val_col = None
+        for cand in ['valore', 'minuti', 'mins', 'minute']:
+            if cand in df.columns:
+                val_col = cand
+                break
+        if val_col is None:
+            return pd.DataFrame(columns=['matricola','data','turno','minuti','ore','_is_gt_ot'])
+
+        df['_min'] = series_to_numeric(df[val_col]).fillna(0.0).astype(float)
+
+        # Normalizzazione input GT:
+        # - atteso: MINUTI (es. 480 = 8h)
+        # - in alcuni export: ORE (es. 8 = 8h)
+        # Regola conservativa: se il valore è un intero tra 1 e 24 lo trattiamo come ORE.
+        mask_hours = (df['_min'] > 0) & (df['_min'] <= 24) & ((df['_min'] % 1) == 0)
+        if mask_hours.any():
+            df.loc[mask_hours, '_min'] = df.loc[mask_hours, '_min'] * 60
     df = df[df['_min'] > 0].copy()
     if len(df) == 0:
         return pd.DataFrame(columns=['matricola','data','turno','minuti','ore','_is_gt_ot'])
@@ -246,14 +254,18 @@ def extract_gt_overtime(attivita: pd.DataFrame) -> pd.DataFrame:
     OT_CODES = {'STR', 'RPD', 'RPN'}
 
     recs = []
-    for col in ['turno', 'att']:
-        if col in df.columns:
-            c = df[col].astype(str).str.strip().str.upper()
-            mm = c.isin(OT_CODES)
-            if mm.any():
-                tmp = df.loc[mm, ['matricola','data','_min']].copy()
-                tmp['turno'] = c[mm].values
-                recs.append(tmp)
+    for col, col_up in [('turno', '_turno_up'), ('att', '_att_up')]:
+        if col_up in df.columns:
+            c = df[col_up].astype(str)
+        elif col in df.columns:
+            c = text_column(df[col], upper=True)
+        else:
+            continue
+        mm = c.isin(OT_CODES)
+        if mm.any():
+            tmp = df.loc[mm, ['matricola','data','_min']].copy()
+            tmp['turno'] = c[mm].values
+            recs.append(tmp)
 
     if not recs:
         return pd.DataFrame(columns=['matricola','data','turno','minuti','ore','_is_gt_ot'])
@@ -280,8 +292,15 @@ def parse_date_ddmmyyyy(s: str, default_dt: datetime) -> datetime:
     except Exception:
         return default_dt
 
+def _month_bounds(mese: str, anno) -> tuple[date, date]:
+    """Primo e ultimo giorno del mese (nome italiano, es. 'Marzo') per i filtri data di get_all."""
+    mesi = ['Gennaio', 'Febbraio', 'Marzo', 'Aprile', 'Maggio', 'Giugno',
+            'Luglio', 'Agosto', 'Settembre', 'Ottobre', 'Novembre', 'Dicembre']
+    first = date(int(anno), mesi.index(mese) + 1, 1)
+    last = (pd.Timestamp(first) + pd.offsets.MonthEnd(0)).date()
+    return first, last
+
 # ========== REGISTRO RELAZIONALE (Nome/Matricola/UO/Categoria) ==========
-@st.cache_data(ttl=5)
 def get_person_registry():
     """Costruisce un registro persone in logica relazionale.
 
@@ -290,7 +309,13 @@ def get_person_registry():
       2) Tabella Attivita (sempre presente nel tuo flusso) -> mapping matricola->nome e UO
 
     Ritorna DataFrame con colonne: matricola, nome, uo, cat
+    (in cache finche' Personale/Attivita non cambiano)
     """
+    return _get_person_registry_cached(db.tables_token(['Personale', 'Attivita']))
+
+
+@st.cache_data(max_entries=16)
+def _get_person_registry_cached(token):
     try:
         pers = db.get_all('Personale')
     except Exception:
@@ -323,7 +348,7 @@ def get_person_registry():
                 matr_col = colmap[key]
                 break
         if matr_col is not None:
-            p['matricola'] = p[matr_col].astype(str).str.strip()
+            p['matricola'] = text_column(p[matr_col])
 
             # nome: prova varie combinazioni (anche con varianti maiuscole)
             # 1) Cognome + Nome (se esistono entrambi come colonne distinte)
@@ -339,7 +364,7 @@ def get_person_registry():
                         nome_src = colmap[key]
                         break
                 if nome_src is not None:
-                    p['nome'] = p[nome_src].astype(str).str.strip()
+                    p['nome'] = text_column(p[nome_src])
                 else:
                     p['nome'] = p['matricola']
             p['nome'] = p['nome'].replace({'': None}).fillna(p['matricola'])
@@ -350,7 +375,7 @@ def get_person_registry():
                 if key in colmap:
                     uo_col = colmap[key]
                     break
-            p['uo'] = p[uo_col].astype(str).str.strip() if uo_col else ''
+            p['uo'] = text_column(p[uo_col]) if uo_col else ''
 
             # categoria (CatProfTipo)
             cat_col = None
@@ -358,7 +383,7 @@ def get_person_registry():
                 if key in colmap:
                     cat_col = colmap[key]
                     break
-            p['cat'] = p[cat_col].astype(str).str.strip() if cat_col else ''
+            p['cat'] = text_column(p[cat_col]) if cat_col else ''
 
             reg = p[['matricola', 'nome', 'uo', 'cat']].drop_duplicates('matricola')
             # se nome vuoto, fallback
@@ -370,7 +395,7 @@ def get_person_registry():
         return pd.DataFrame(columns=['matricola', 'nome', 'uo', 'cat'])
 
     a = att.copy()
-    a['matricola'] = a['matricola'].astype(str).str.strip()
+    a['matricola'] = text_column(a['matricola'])
 
     # nome da attivita: usa il piu frequente per matricola (supporta varianti colonna)
     name_col = None
@@ -379,7 +404,7 @@ def get_person_registry():
             name_col = c
             break
     if name_col is not None:
-        a['_nome_src'] = a[name_col].astype(str).str.strip()
+        a['_nome_src'] = text_column(a[name_col])
         name_map = (a[a['_nome_src'].notna() & (a['_nome_src'] != '')]
                     .groupby('matricola')['_nome_src']
                     .agg(lambda s: s.value_counts().index[0]))
@@ -393,7 +418,7 @@ def get_person_registry():
             uo_col = c
             break
     if uo_col is not None:
-        a['_uo_src'] = a[uo_col].astype(str).str.strip()
+        a['_uo_src'] = text_column(a[uo_col])
         uo_map = (a[a['_uo_src'].notna() & (a['_uo_src'] != '')]
                   .groupby('matricola')['_uo_src']
                   .agg(lambda s: s.value_counts().index[0]))
@@ -433,10 +458,8 @@ def _norm_in_forza_global(v):
     return True
 
 
-@st.cache_data(ttl=5)
-
-
-def _compile_wildcard_patterns(s: str) -> list[str]:
+@lru_cache(maxsize=256)  # funzione pura: cache in memoria limitata, niente pickling di st.cache_data
+def _compile_wildcard_patterns(s: str) -> tuple[str, ...]:
     """Converte input utente con jolly '*' in regex (per str.contains).
 
     Regole:
@@ -448,10 +471,10 @@ def _compile_wildcard_patterns(s: str) -> list[str]:
     - Più pattern separati da spazio, virgola, ';' o '|' (OR).
     """
     if s is None:
-        return []
+        return ()
     s = str(s).strip()
     if not s:
-        return []
+        return ()
     s = s.upper()
 
     tokens = [t for t in re.split(r"[,\s;|]+", s) if t]
@@ -474,15 +497,15 @@ def _compile_wildcard_patterns(s: str) -> list[str]:
         if not tok.endswith("*"):
             rpat = rpat + "$"
         pats.append(rpat)
-    return pats
+    return tuple(pats)
 
 
-def get_person_meta() -> pd.DataFrame:
-    """Registro persone + stato (in_forza) come base unica per tutto il progetto.
+def _build_person_meta(reg) -> pd.DataFrame:
+    """Registro persone + stato (in_forza): costruzione della dimensione persone.
 
     Colonne garantite: matricola, nome, uo, cat, in_forza
     """
-    reg = get_person_registry().copy() if isinstance(get_person_registry(), pd.DataFrame) else pd.DataFrame()
+    reg = reg.copy() if isinstance(reg, pd.DataFrame) else pd.DataFrame()
     if reg is None or reg.empty:
         reg = pd.DataFrame(columns=['matricola', 'nome', 'uo', 'cat'])
 
@@ -491,10 +514,10 @@ def get_person_meta() -> pd.DataFrame:
         if c not in reg.columns:
             reg[c] = ''
 
-    reg['matricola'] = reg['matricola'].astype(str).str.strip()
-    reg['nome'] = reg['nome'].fillna('').astype(str).str.strip()
-    reg['uo'] = reg['uo'].fillna('').astype(str).str.strip()
-    reg['cat'] = reg['cat'].fillna('').astype(str).str.strip()
+    reg['matricola'] = text_column(reg['matricola'])
+    reg['nome'] = text_column(reg['nome'], fill='')
+    reg['uo'] = text_column(reg['uo'], fill='')
+    reg['cat'] = text_column(reg['cat'], fill='')
 
     # prova a leggere in_forza da Personale
     try:
@@ -512,14 +535,14 @@ def get_person_meta() -> pd.DataFrame:
             try:
                 tmpn = pers[[cols_l.get('matricola') or cols_l.get('matr') or cols_l.get('matricola ') or list(pers.columns)[0], name_col]].copy()
                 tmpn.columns = ['matricola', 'nome_pers']
-                tmpn['matricola'] = tmpn['matricola'].astype(str).str.strip()
-                tmpn['nome_pers'] = tmpn['nome_pers'].fillna('').astype(str).str.strip()
+                tmpn['matricola'] = text_column(tmpn['matricola'])
+                tmpn['nome_pers'] = text_column(tmpn['nome_pers'], fill='')
                 nmap = (tmpn[tmpn['nome_pers'] != '']
                             .drop_duplicates(subset=['matricola'])
                             .set_index('matricola')['nome_pers']
                             .to_dict())
                 reg.loc[(reg['nome'] == '') | (reg['nome'].str.lower() == 'nan'), 'nome'] = reg['matricola'].map(nmap).fillna(reg['nome'])
-                reg['nome'] = reg['nome'].fillna('').astype(str).str.strip()
+                reg['nome'] = text_column(reg['nome'], fill='')
             except Exception:
                 pass
         
@@ -528,7 +551,7 @@ def get_person_meta() -> pd.DataFrame:
         if matr_col in pers.columns and inf_col in pers.columns:
             tmp = pers[[matr_col, inf_col]].copy()
             tmp.columns = ['matricola', 'in_forza']
-            tmp['matricola'] = tmp['matricola'].astype(str).str.strip()
+            tmp['matricola'] = text_column(tmp['matricola'])
             tmp['in_forza'] = tmp['in_forza'].apply(_norm_in_forza_global)
             # in caso di duplicati matricola, prendi il valore più frequente
             try:
@@ -547,6 +570,41 @@ def get_person_meta() -> pd.DataFrame:
     return reg[['matricola', 'nome', 'uo', 'cat', 'in_forza']]
 
 
+def get_person_dim() -> dict:
+    """Dimensione persone condivisa: meta (con in_forza) + insiemi di matricole per UO e Categoria.
+
+    E' calcolata una sola volta per versione di Personale/Attivita e condivisa tra pagine e sessioni
+    (st.cache_resource, nessuna copia): meta e' condivisa (readonly_frame), get_person_meta ne da' una shared_view.
+    """
+    return _get_person_dim_cached(db.tables_token(['Personale', 'Attivita']))
+
+
+@st.cache_resource(max_entries=4)
+def _get_person_dim_cached(token):
+    meta = _build_person_meta(_get_person_registry_cached(token))
+    meta = readonly_frame(meta.reset_index(drop=True))
+
+    def _sets(col: str) -> dict:
+        try:
+            return {str(k): frozenset(v) for k, v in meta.groupby(meta[col].astype(str), sort=False)['matricola']}
+        except Exception:
+            return {}
+
+    return {
+        'meta': meta,
+        'by_uo': _sets('uo'),
+        'by_cat': _sets('cat'),
+    }
+
+
+def get_person_meta() -> pd.DataFrame:
+    """Registro persone + stato (in_forza) come base unica per tutto il progetto.
+
+    Colonne garantite: matricola, nome, uo, cat, in_forza
+    """
+    return shared_view(get_person_dim()['meta'])
+
+
 def get_relational_selections():
     """Ritorna (uo_sel, cat_sel) dai filtri globali in sidebar."""
     return (
@@ -555,19 +613,65 @@ def get_relational_selections():
     )
 
 
-def get_person_meta_rel_filtered(uo_sel: str | None = None, cat_sel: str | None = None) -> pd.DataFrame:
-    """Meta personale filtrata dai selettori relazionali globali (sidebar)."""
+def relational_keep(uo_sel: str | None = None, cat_sel: str | None = None) -> frozenset | None:
+    """Matricole ammesse dai filtri relazionali (UO, Categoria); None se entrambi sono 'Tutte'.
+
+    L'insieme viene dalla dimensione persone in cache: calcolarlo una volta e riusarlo per piu' tabelle.
+    """
     if uo_sel is None or cat_sel is None:
         uo_sel2, cat_sel2 = get_relational_selections()
         uo_sel = uo_sel if uo_sel is not None else uo_sel2
         cat_sel = cat_sel if cat_sel is not None else cat_sel2
 
-    meta = get_person_meta().copy()
-    if uo_sel and uo_sel != 'Tutte':
-        meta = meta[meta['uo'].astype(str) == str(uo_sel)]
-    if cat_sel and cat_sel != 'Tutte':
-        meta = meta[meta['cat'].astype(str) == str(cat_sel)]
-    return meta
+    use_uo = bool(uo_sel) and uo_sel != 'Tutte'
+    use_cat = bool(cat_sel) and cat_sel != 'Tutte'
+    if not use_uo and not use_cat:
+        return None
+
+    dim = get_person_dim()
+    keep = None
+    if use_uo:
+        keep = dim['by_uo'].get(str(uo_sel), frozenset())
+    if use_cat:
+        cat_keep = dim['by_cat'].get(str(cat_sel), frozenset())
+        keep = cat_keep if keep is None else (keep & cat_keep)
+    return keep
+
+
+def _matricola_str(s: pd.Series) -> pd.Series:
+    """matricola come testo ripulito (astype(str).strip), calcolato sui soli valori distinti."""
+    return text_column(s)
+
+
+def relational_mask(df: pd.DataFrame, uo_sel: str | None = None, cat_sel: str | None = None, keep=None):
+    """Maschera booleana (array numpy, allineata alle righe di df) dei filtri relazionali per matricola.
+
+    Ritorna None quando non c'e' nulla da filtrare (filtri 'Tutte' o df senza 'matricola'):
+    il chiamante usa df cosi' com'e', senza copie. Passando `keep` (da relational_keep)
+    lo stesso filtro si applica a piu' tabelle senza ricalcolarlo.
+    """
+    if df is None or 'matricola' not in df.columns:
+        return None
+    if keep is None:
+        keep = relational_keep(uo_sel, cat_sel)
+        if keep is None:
+            return None
+
+    s = df['matricola']
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = pd.Index(s.cat.categories).astype(str).str.strip()
+        hit = pd.Series(list(cats.isin(keep)) + [False], dtype=bool).to_numpy()
+        return hit[s.cat.codes.to_numpy()]
+    return text_column(s).isin(keep).to_numpy()
+
+
+def get_person_meta_rel_filtered(uo_sel: str | None = None, cat_sel: str | None = None) -> pd.DataFrame:
+    """Meta personale filtrata dai selettori relazionali globali (sidebar)."""
+    meta = get_person_meta()
+    keep = relational_keep(uo_sel, cat_sel)
+    if keep is None:
+        return meta
+    return meta[meta['matricola'].isin(keep)]
 
 
 def apply_relational_filters(df: pd.DataFrame, uo_sel: str, cat_sel: str) -> pd.DataFrame:
@@ -577,26 +681,19 @@ def apply_relational_filters(df: pd.DataFrame, uo_sel: str, cat_sel: str) -> pd.
     - Il filtro in sidebar determina SEMPRE l'insieme persone/record da mostrare.
     - Il filtro si applica per matricola (join relazionale), NON si fida di eventuali colonne uo/cat già presenti nel df.
 
-    Nota: evita collisioni di colonne (uo/cat) mantenendo lo schema originale.
+    Nota: evita collisioni di colonne (uo/cat) mantenendo lo schema originale; la matricola
+    in uscita e' sempre testo ripulito. Per filtrare senza copie usare relational_mask.
     """
     if df is None or len(df) == 0:
         return df
     if 'matricola' not in df.columns:
         return df
 
-    out = df.copy()
-    out['matricola'] = out['matricola'].astype(str).str.strip()
-
-    meta = get_person_meta_rel_filtered(uo_sel=uo_sel, cat_sel=cat_sel)
-    keep = set(meta['matricola'].astype(str)) if len(meta) > 0 else set()
-
-    # Se meta è vuoto e il filtro NON è 'Tutte', restituisci vuoto: coerente col filtro relazionale.
-    if (uo_sel and uo_sel != 'Tutte') or (cat_sel and cat_sel != 'Tutte'):
-        out = out[out['matricola'].isin(keep)].copy()
-    else:
-        # 'Tutte' => nessun filtro (mostra tutto)
-        pass
-
+    # Se il filtro NON è 'Tutte' e nessuna persona corrisponde, il risultato è vuoto: coerente col filtro relazionale.
+    # 'Tutte' => nessun filtro (mostra tutto)
+    mask = relational_mask(df, uo_sel, cat_sel)
+    out = df.copy(deep=False) if mask is None else df[mask]
+    out['matricola'] = _matricola_str(out['matricola'])
     return out
 
 
@@ -630,7 +727,7 @@ def get_shift_hours_map(att_df: pd.DataFrame) -> dict:
                 break
         if turno_col and min_col:
             t = tt[[turno_col, min_col]].copy()
-            t[turno_col] = t[turno_col].astype(str).str.strip().str.upper()
+            t[turno_col] = text_column(t[turno_col], upper=True)
             mins = pd.to_numeric(t[min_col], errors='coerce').fillna(0.0)
             hrs = (mins / 60.0).round(2)
             out.update({k: float(v) for k, v in zip(t[turno_col], hrs) if k and float(v) > 0})
@@ -638,7 +735,7 @@ def get_shift_hours_map(att_df: pd.DataFrame) -> dict:
     # 2) fallback da attivita (mediana per turno)
     if (not out) and (att_df is not None) and len(att_df) > 0 and ('turno' in att_df.columns) and ('ore' in att_df.columns):
         tmp = att_df.copy()
-        tmp['turno'] = tmp['turno'].astype(str).str.strip().str.upper()
+        tmp['turno'] = text_column(tmp['turno'], upper=True)
         tmp['ore'] = pd.to_numeric(tmp['ore'], errors='coerce')
         grp = tmp.dropna(subset=['turno']).groupby('turno')['ore'].median()
         for k, v in grp.items():
@@ -920,6 +1017,7 @@ st.markdown("""
 def get_database():
     cfg = load_config()
     base_dir = (cfg.get("base_dir") or "").strip()
+    backend = (cfg.get("storage_backend") or "").strip() or None
     
     candidates = []
     if base_dir:
@@ -935,14 +1033,21 @@ def get_database():
         Path('persgest_master.xlsx')
     ]
     
+    database = None
     for p in candidates:
         try:
             if p.exists():
-                return PersGestDatabase(str(p))
+                database = PersGestDatabase(str(p), backend=backend)
+                break
         except:
             continue
     
-    return PersGestDatabase('data/persgest_master.xlsx')
+    if database is None:
+        database = PersGestDatabase('data/persgest_master.xlsx', backend=backend)
+    
+    # Un solo watcher per processo: segnala le modifiche fatte da altre postazioni/sessioni
+    database.start_watcher()
+    return database
 
 db = get_database()
 
@@ -970,9 +1075,9 @@ try:
             if 'GiornoFestivo' in df_f.columns:
                 df_f['GiornoFestivo'] = pd.to_numeric(df_f['GiornoFestivo'], errors='coerce').astype('Int64')
             if 'Descrizione' in df_f.columns:
-                df_f['Descrizione'] = df_f['Descrizione'].fillna('').astype(str).str.strip()
+                df_f['Descrizione'] = text_column(df_f['Descrizione'], fill='')
             if 'Localita' in df_f.columns:
-                df_f['Localita'] = df_f['Localita'].fillna('').astype(str).str.strip()
+                df_f['Localita'] = text_column(df_f['Localita'], fill='')
             df_f = df_f.dropna(how='all')
             df_f = df_f[df_f.get('GiornoFestivo').notna()] if 'GiornoFestivo' in df_f.columns else df_f
             db.save_table('Festivi', df_f)
@@ -1067,6 +1172,19 @@ with st.sidebar:
         format_func=lambda p: labels.get(p, p),
     )
 
+    # Avviso "dati aggiornati" (modifiche di altri utenti/postazioni rilevate dal watcher)
+    _seen = st.session_state.get('_db_seen_seq')
+    _cur_seq, _changed = db.changes_since(_seen, session_id=current_session_id() or None)
+    if _seen is None:
+        st.session_state._db_seen_seq = _cur_seq
+    elif _changed:
+        st.info("🔄 Dati aggiornati: " + ", ".join(_changed))
+        if st.button("✔️ OK", key="db_changes_ack"):
+            st.session_state._db_seen_seq = _cur_seq
+            st.rerun()
+    else:
+        st.session_state._db_seen_seq = _cur_seq
+
     st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
 
     st.markdown(
@@ -1163,18 +1281,16 @@ elif st.session_state.page == 'Report Straordinari':
     
     straordinari = db.get_all('Straordinario')
     personale = db.get_all('Personale')
-    # Attivita: serve per estrarre straordinari importati da GT (STR/RPD/RPN con minuti>0)
-    attivita = db.get_all('Attivita')
     
     # Normalizza matricole per merge
     if len(personale) > 0 and 'matricola' in personale.columns:
         personale_clean = personale.copy()
-        personale_clean['matricola'] = personale_clean['matricola'].astype(str).str.strip()
+        personale_clean['matricola'] = text_column(personale_clean['matricola'])
     else:
         personale_clean = personale.copy()
     
     if len(straordinari) > 0 and 'matricola' in straordinari.columns:
-        straordinari['matricola'] = straordinari['matricola'].astype(str).str.strip()
+        straordinari['matricola'] = text_column(straordinari['matricola'])
     
     with col1:
         # Lista persone in logica relazionale (Nome ↔ Matricola), filtrata per UO/Categoria
@@ -1194,8 +1310,8 @@ elif st.session_state.page == 'Report Straordinari':
         if len(reg) > 0 and ('nome' in reg.columns) and ('matricola' in reg.columns):
             persona_mappa = dict(
                 zip(
-                    reg['nome'].fillna('').astype(str).str.strip().tolist(),
-                    reg['matricola'].fillna('').astype(str).str.strip().tolist(),
+                    text_column(reg['nome'], fill='').tolist(),
+                    text_column(reg['matricola'], fill='').tolist(),
                 )
             )
         persona_sel = st.selectbox("👤 Persona", persone_list, key="str_pers")
@@ -1218,6 +1334,14 @@ elif st.session_state.page == 'Report Straordinari':
     # Range datetime usato sia per Straordinari (tabella) che per OT da Attivita (GT)
     d0 = pd.to_datetime(data_inizio)
     d1 = pd.to_datetime(data_fine)
+
+    # Attivita: serve per estrarre straordinari importati da GT (STR/RPD/RPN con minuti>0)
+    # (solo il periodo selezionato e, se scelte, le persone: i filtri li applica il database,
+    # la persona/UO tramite l'indice per matricola senza scandire la tabella)
+    att_mats = relational_keep(uo_sel, cat_sel)
+    if persona_sel != "Tutti" and persona_mappa.get(persona_sel):
+        att_mats = [persona_mappa[persona_sel]]
+    attivita = db.get_all('Attivita', derived=True, date_from=d0, date_to=d1, matricole=att_mats)
     
     with col4:
         st.markdown("<br>", unsafe_allow_html=True)
@@ -1230,7 +1354,7 @@ elif st.session_state.page == 'Report Straordinari':
             # --- Manuale (tabella Straordinario) ---
             manual = straordinari.copy() if straordinari is not None else pd.DataFrame()
             if len(manual) > 0:
-                manual['matricola'] = manual['matricola'].astype(str).str.strip()
+                manual['matricola'] = text_column(manual['matricola'])
                 manual['data'] = pd.to_datetime(manual['data'], errors='coerce', dayfirst=True)
                 manual = manual[manual['data'].notna()].copy()
 
@@ -1268,7 +1392,7 @@ elif st.session_state.page == 'Report Straordinari':
                 if persona_sel != "Tutti":
                     mat = persona_mappa.get(persona_sel, None)
                     if mat and 'matricola' in att.columns:
-                        att = att[att['matricola'].astype(str).str.strip() == str(mat)].copy()
+                        att = att[text_column(att['matricola']) == str(mat)].copy()
 
                 # Date range (prima dell'estrazione)
                 if 'data' in att.columns:
@@ -1290,8 +1414,8 @@ elif st.session_state.page == 'Report Straordinari':
                 # join nome
                 pers = personale.copy() if personale is not None else pd.DataFrame()
                 if len(pers) > 0:
-                    pers['matricola'] = pers['matricola'].astype(str).str.strip()
-                    pers['nome'] = pers['nome'].astype(str).str.strip()
+                    pers['matricola'] = text_column(pers['matricola'])
+                    pers['nome'] = text_column(pers['nome'])
                     combined = combined.merge(pers[['matricola','nome']], on='matricola', how='left')
                 else:
                     combined['nome'] = combined.get('matricola', '').astype(str)
@@ -1371,8 +1495,10 @@ elif st.session_state.page == 'Verifica Match':
         verifica = st.button("🔍 VERIFICA", type="primary", width="stretch")
     
     if verifica:
-        straordinari = db.get_all('Straordinario')
-        attivita = db.get_all('Attivita')
+        # solo il mese da verificare (filtro data nel database)
+        _m_from, _m_to = _month_bounds(mese, anno)
+        straordinari = db.get_all('Straordinario', date_from=_m_from, date_to=_m_to)
+        attivita = db.get_all('Attivita', derived=True, date_from=_m_from, date_to=_m_to)
         personale = db.get_all('Personale')
         
         # Check se tabelle hanno dati
@@ -1477,9 +1603,9 @@ elif st.session_state.page == 'Verifica Match':
             attivita['data'] = pd.to_datetime(attivita['data'], errors='coerce', dayfirst=True)
             # normalizza chiavi per match
             if 'matricola' in straordinari.columns:
-                straordinari['matricola'] = straordinari['matricola'].astype(str).str.strip()
+                straordinari['matricola'] = text_column(straordinari['matricola'])
             if 'matricola' in attivita.columns:
-                attivita['matricola'] = attivita['matricola'].astype(str).str.strip()
+                attivita['matricola'] = text_column(attivita['matricola'])
             # usa solo la data (senza orario) per evitare mismatch Timestamp
             straordinari['_data_key'] = straordinari['data'].dt.date
             attivita['_data_key'] = attivita['data'].dt.date
@@ -1498,26 +1624,55 @@ elif st.session_state.page == 'Verifica Match':
             reg = get_person_registry()
             reg_map = {}
             if len(reg) > 0 and 'matricola' in reg.columns and 'nome' in reg.columns:
-                reg_map = dict(zip(reg['matricola'].astype(str).str.strip(), reg['nome'].astype(str).str.strip()))
+                reg_map = dict(zip(text_column(reg['matricola']), text_column(reg['nome'])))
 
             # Mappa ore attese per TURNO (da Turni_tipo o stima)
             shift_hours = get_shift_hours_map(att_filt)
             TOL = 0.05  # ~3 minuti
 
-            for _, s in str_filt.iterrows():
-                matr = str(s.get('matricola', '')).strip()
-                turno = str(s.get('turno', '')).strip().upper()
+            # GT per chiave (matricola, giorno, turno) su id interi: un solo raggruppamento invece
+            # di una scansione di att_filt per ogni straordinario. Stesso dizionario per GT e STR
+            # (vocabulary), chiavi STR codificate tutte insieme prima del ciclo.
+            voc_matr, voc_code = vocabulary('matricola'), vocabulary('code')
+            att_mid = voc_matr.encode(att_filt['matricola'])
+            att_tid = voc_code.encode(att_filt['_turno_up'])
+            att_day = att_filt['_day'].to_numpy(dtype='datetime64[ns]').view('int64')
+            ore_by_key = (pd.to_numeric(att_filt['ore'], errors='coerce').fillna(0.0)
+                          .groupby([att_mid, att_day, att_tid]).sum())
+            _att_data = pd.to_datetime(att_filt['data'], errors='coerce')
+            _has_data = _att_data.notna().to_numpy()
+            att_day_keys = pd.MultiIndex.from_arrays([att_mid[_has_data],
+                                                      _att_data.to_numpy(dtype='datetime64[ns]').view('int64')[_has_data]])
+
+            n_str = len(str_filt)
+            str_col = lambda c: str_filt[c] if c in str_filt.columns else pd.Series('', index=str_filt.index, dtype=object)
+            str_matr = text_column(str_col('matricola'))
+            # vuoti come in _turno_up (GT): '' e non 'NAN'/'NONE'
+            str_turno = text_column(str_col('turno'), upper=True).replace({'NAN': '', 'NONE': ''})
+            str_mid = voc_matr.keys(str_matr)
+            str_tid = voc_code.keys(str_turno)
+            str_ds = pd.to_datetime(str_col('data'), errors='coerce')
+            str_ok = str_ds.notna().to_numpy()
+            str_day = str_ds.dt.normalize().to_numpy(dtype='datetime64[ns]').view('int64')
+            str_val = str_ds.to_numpy(dtype='datetime64[ns]').view('int64')
+            hit = str_ok & (str_mid >= 0) & (str_tid >= 0)
+            ore_gt_arr = np.full(n_str, np.nan)
+            if hit.any() and len(ore_by_key):
+                ore_gt_arr[hit] = ore_by_key.reindex(
+                    pd.MultiIndex.from_arrays([str_mid[hit], str_day[hit], str_tid[hit]])).to_numpy(dtype=float)
+            day_match = np.zeros(n_str, dtype=bool)
+            day_ok = str_ok & (str_mid >= 0)
+            if day_ok.any():
+                day_match[day_ok] = pd.MultiIndex.from_arrays([str_mid[day_ok], str_val[day_ok]]).isin(att_day_keys)
+
+            for i, (_, s) in enumerate(str_filt.iterrows()):
+                matr = str_matr.iat[i]
+                turno = str_turno.iat[i]
                 data_s = s.get('data')
+                ore_gt_tot = None if np.isnan(ore_gt_arr[i]) else ore_gt_arr[i]
 
-                # confronto data su solo giorno (evita mismatch per eventuali timestamp)
-                ds = pd.to_datetime(data_s, errors='coerce')
-                d_day = ds.date() if pd.notna(ds) else None
-                att_tmp = att_filt.copy()
-                att_tmp['_day'] = pd.to_datetime(att_tmp['data'], errors='coerce', dayfirst=True).dt.date
-                match = att_tmp[(att_tmp['matricola'] == matr) & (att_tmp['_day'] == d_day) & (att_tmp['turno'].astype(str).str.strip().str.upper() == turno)]
-
-                if len(match) > 0:
-                    ore_gt_tot = float(pd.to_numeric(match['ore'], errors='coerce').fillna(0.0).sum())
+                if ore_gt_tot is not None:
+                    ore_gt_tot = float(ore_gt_tot)
                     ore_str = float(s.get('ore', 0.0) or 0.0)
                     ore_attese = shift_hours.get(turno)
 
@@ -1556,8 +1711,7 @@ elif st.session_state.page == 'Verifica Match':
                             'problema': problema
                         })
                 else:
-                    any_match = att_filt[(att_filt['matricola'] == matr) & (att_filt['data'] == data_s)]
-                    prob = "Turno diverso" if len(any_match) > 0 else "Nessuna attività GT"
+                    prob = "Turno diverso" if day_match[i] else "Nessuna attività GT"
                     discrepanze.append({
                         'data': data_s,
                         'nome': reg_map.get(matr, matr),
@@ -1616,7 +1770,7 @@ elif st.session_state.page == 'Verifica Match':
             # Normalizza matricole per merge (rimuovi spazi, converti a str)
             if len(personale) > 0 and 'matricola' in personale.columns:
                 personale_clean = personale.copy()
-                personale_clean['matricola'] = personale_clean['matricola'].astype(str).str.strip()
+                personale_clean['matricola'] = text_column(personale_clean['matricola'])
             # Match (coerenti)
             st.markdown("---")
             st.markdown("### ✅ Match Coerenti")
@@ -1692,7 +1846,9 @@ elif st.session_state.page == 'Editor Dati':
         tab_sel = st.selectbox("📋 Tabella", options, index=default_idx, key="edit_tab")
     
     if tab_sel != '-- Seleziona --':
-        df = db.get_all(tab_sel)
+        # editor a testo libero: codici come object (con le categorie l'editor offrirebbe solo i
+        # codici gia' presenti e un codice nuovo solleverebbe)
+        df = db.get_all(tab_sel, typed=False)
         st.info(f"📊 **{tab_sel}** - {len(df):,} record | ⚠️ 'valore' in MINUTI (60=1h)")
         
         with col2:
@@ -2254,8 +2410,8 @@ elif st.session_state.page == 'Editor Dati':
 
             @st.dialog(f"Modifica record #{selected_idx} - {tab_sel}")
             def _dlg_edit():
-                row = db.get_all(tab_sel).loc[selected_idx]
-                cols = list(db.get_all(tab_sel).columns)
+                row = db.get_all(tab_sel, typed=False).loc[selected_idx]
+                cols = list(db.get_all(tab_sel, typed=False).columns)
 
                 # ---- Cascata: Dipendente / Turno (usa dati consolidati) ----
                 mode = 'edit'
@@ -2336,7 +2492,7 @@ elif st.session_state.page == 'Editor Dati':
                             g2.append(c)
                     return g1, g2, g3
 
-                cols_all = list(db.get_all(tab_sel).columns)
+                cols_all = list(db.get_all(tab_sel, typed=False).columns)
                 g_person, g_work, g_extra = _group_cols(cols_all)
                 has_extra = len(g_extra) > 0
 
@@ -2358,7 +2514,7 @@ elif st.session_state.page == 'Editor Dati':
                     cL, cR = st.columns(2, gap='large')
                     for i, c in enumerate(group_cols):
                         with (cL if i % 2 == 0 else cR):
-                            out[c], _ = _infer_widget(c, db.get_all(tab_sel)[c], row.get(c))
+                            out[c], _ = _infer_widget(c, db.get_all(tab_sel, typed=False)[c], row.get(c))
                     return out
 
                 data = {}
@@ -2378,10 +2534,15 @@ elif st.session_state.page == 'Editor Dati':
                 c1, c2 = st.columns(2)
                 with c1:
                     if st.button("💾 Salva modifiche", type="primary", width="stretch"):
-                        with st.spinner("Salvataggio..."):
-                            db.update_record(tab_sel, selected_idx, data)
-                        st.success("Record aggiornato")
-                        st.rerun()
+                        try:
+                            with st.spinner("Salvataggio..."):
+                                db.update_record(tab_sel, selected_idx, data)
+                        except Exception as e:
+                            # riga non piu' presente (modificata da un'altra sessione) o valori non validi
+                            st.error(f"❌ Modifica non salvata: {e}")
+                        else:
+                            st.success("Record aggiornato")
+                            st.rerun()
                 with c2:
                     st.button("Annulla", width="stretch")
 
@@ -2397,10 +2558,14 @@ elif st.session_state.page == 'Editor Dati':
                 c1, c2 = st.columns(2)
                 with c1:
                     if st.button("🗑️ Elimina", type="primary", width="stretch"):
-                        with st.spinner("Eliminazione..."):
-                            db.delete_record(tab_sel, selected_idx)
-                        st.success("Record eliminato")
-                        st.rerun()
+                        try:
+                            with st.spinner("Eliminazione..."):
+                                db.delete_record(tab_sel, selected_idx)
+                        except Exception as e:
+                            st.error(f"❌ Record non eliminato: {e}")
+                        else:
+                            st.success("Record eliminato")
+                            st.rerun()
                 with c2:
                     st.button("Annulla", width="stretch")
 
@@ -2498,9 +2663,9 @@ elif st.session_state.page == 'Festivi':
             meta = meta.rename(columns=rename_map)
 
     if 'Matricola' in meta.columns:
-        meta['Matricola'] = meta['Matricola'].fillna('').astype(str).str.strip()
+        meta['Matricola'] = text_column(meta['Matricola'], fill='')
     if 'Nome' in meta.columns:
-        meta['Nome'] = meta['Nome'].fillna('').astype(str).str.strip()
+        meta['Nome'] = text_column(meta['Nome'], fill='')
 
     c1, c2, c3 = st.columns([1, 1, 1])
     with c1:
@@ -2520,7 +2685,7 @@ elif st.session_state.page == 'Festivi':
 
     meta_f = meta.copy()
     if only_inforza and 'In_Forza' in meta_f.columns:
-        meta_f['In_Forza'] = meta_f['In_Forza'].astype(str).str.strip().str.lower().isin(['1', 'true', 'yes', 'si', 'sì', 'y'])
+        meta_f['In_Forza'] = text_column(meta_f['In_Forza']).str.lower().isin(['1', 'true', 'yes', 'si', 'sì', 'y'])
         meta_f = meta_f[meta_f['In_Forza']]
     if cat_sel and 'CatProfTipo' in meta_f.columns:
         meta_f = meta_f[meta_f['CatProfTipo'].astype(str).isin(cat_sel)]
@@ -2529,7 +2694,9 @@ elif st.session_state.page == 'Festivi':
         meta_f = meta_f[key.isin(nom_sel)]
 
     if st.button('🔎 Genera', key='fest_gen'):
-        df_att = db.get_all('Attivita')
+        # periodo e persone selezionati: filtro applicato dal database
+        mats = set(meta_f['Matricola'].astype(str)) if 'Matricola' in meta_f.columns else set()
+        df_att = db.get_all('Attivita', derived=True, date_from=d1, date_to=d2, matricole=mats)
         df_fest = db.get_all('Festivi')
 
         if df_att is None or len(df_att) == 0 or len(meta_f) == 0:
@@ -2537,11 +2704,10 @@ elif st.session_state.page == 'Festivi':
         else:
             df = df_att.copy()
             if 'matricola' in df.columns:
-                df['matricola'] = df['matricola'].fillna('').astype(str).str.strip()
-            if 'data' in df.columns:
-                df['data'] = pd.to_datetime(df['data'], errors='coerce').dt.date
+                df['matricola'] = text_column(df['matricola'], fill='')
+            # giorno canonico (colonna derivata _day del database)
+            df['data'] = df['_day'].dt.date
 
-            mats = set(meta_f['Matricola'].astype(str)) if 'Matricola' in meta_f.columns else set()
             df = df[df['matricola'].isin(mats)] if mats else df.iloc[0:0]
             df = df[(df['data'] >= d1) & (df['data'] <= d2)]
 
@@ -2587,18 +2753,10 @@ elif st.session_state.page == 'Festivi':
                     }
 
             if len(assenze_codes) > 0 and len(df) > 0:
-                def _has_assenza(row) -> bool:
-                    vals = []
-                    if 'turno' in row and pd.notna(row['turno']):
-                        vals.append(str(row['turno']))
-                    if 'att' in row and pd.notna(row['att']):
-                        vals.append(str(row['att']))
-                    blob = ' '.join(vals).upper()
-                    # tokenizza per evitare match parziali (es. P38 vs 38)
-                    toks = re.findall(r"[A-Z0-9]+", blob)
-                    return any(t in assenze_codes for t in toks)
-
-                df['_has_assenza'] = df.apply(_has_assenza, axis=1)
+                blob = df['_turno_up'].astype(str) + ' ' + df['_att_up'].astype(str)
+                # tokenizza per evitare match parziali (es. P38 vs 38)
+                toks = blob.str.findall(r"[A-Z0-9]+")
+                df['_has_assenza'] = toks.map(lambda ts: any(t in assenze_codes for t in ts)).astype(bool)
                 any_abs = df.groupby(['matricola', 'data'])['_has_assenza'].transform('any')
                 df = df[~any_abs].drop(columns=['_has_assenza'])
 
@@ -2636,23 +2794,32 @@ elif st.session_state.page == 'Import Export':
     tab1, tab2 = st.tabs(["📥 IMPORT", "📤 EXPORT"])
     
     with tab1:
-        st.markdown("### Importa Excel")
-        st.info("⚠️ File Excel deve avere valori in MINUTI")
+        st.markdown("### Importa Excel / CSV")
+        st.info("⚠️ File Excel o CSV deve avere valori in MINUTI")
+
+        # esito dell'ultimo import (il rerun dopo l'import cancellerebbe il messaggio)
+        imp_esito = st.session_state.pop("imp_esito", None)
+        if imp_esito:
+            st.success(f"✅ {imp_esito}")
 
         imp_mode_lbl = st.radio(
             "Modalità import",
-            ["Sostituisci (svuota tabella prima di import)", "Aggiungi (mantieni record esistenti)"] ,
+            ["Sostituisci (svuota tabella prima di import)", "Aggiungi (mantieni record esistenti)",
+             "Aggiorna (stessa chiave: aggiorna, altrimenti aggiungi)"] ,
             index=0,
             horizontal=True,
             key="imp_mode"
         )
-        imp_mode = 'replace' if imp_mode_lbl.startswith('Sostituisci') else 'append'
+        imp_mode = {'Sostituisci': 'replace', 'Aggiungi': 'append', 'Aggiorna': 'upsert'}[imp_mode_lbl.split(' ')[0]]
+        if imp_mode == 'upsert':
+            st.caption("Chiavi: " + " · ".join(f"{t} ({', '.join(k)})" for t, k in IMPORT_NATURAL_KEYS.items())
+                       + ". Le altre tabelle si comportano come in Aggiungi.")
         
-        file = st.file_uploader("File", type=['xlsx', 'xlsm'], key="imp_file")
+        file = st.file_uploader("File", type=['xlsx', 'xlsm', 'csv', 'tsv', 'txt'], key="imp_file")
         
         if file:
-            excel = pd.ExcelFile(file)
-            fogli = excel.sheet_names
+            # solo i nomi dei fogli (sola lettura): le righe si leggono a blocchi all'import
+            fogli = excel_sheet_names(file)
             
             st.success(f"✅ {file.name}")
             st.info(f"📄 Fogli: {', '.join(fogli)}")
@@ -2677,9 +2844,16 @@ elif st.session_state.page == 'Import Export':
                         mapping[foglio] = dest
             
             if st.button("📥 IMPORTA", type="primary", width="stretch"):
-                success, msg = db.import_excel(file, mapping, mode=imp_mode)
+                bar = st.progress(0.0, text="Lettura file...")
+
+                def _imp_progress(foglio, lette, totali):
+                    frac = min(1.0, lette / totali) if totali else 0.0
+                    bar.progress(frac, text=f"📄 {foglio}: {lette:,} / {totali:,} righe".replace(',', '.'))
+
+                success, msg = db.import_excel(file, mapping, mode=imp_mode, progress=_imp_progress)
+                bar.empty()
                 if success:
-                    st.success(f"✅ {msg}")
+                    st.session_state["imp_esito"] = msg
                     st.balloons()
                     st.rerun()
                 else:
@@ -2740,11 +2914,84 @@ elif st.session_state.page == 'Configurazione':
                 st.session_state.selected_folder = folder
                 st.info(f"✅ {folder}")
     
+    backends = list(STORAGE_BACKENDS)
+    cur_backend = cfg.get("storage_backend") or db.storage.name
+    new_backend = st.selectbox(
+        "Motore dati",
+        backends,
+        index=backends.index(cur_backend) if cur_backend in backends else 0,
+        key="cfg_storage_backend",
+        help="excel = file persgest_master.xlsx (default) · sqlite = persgest_master.sqlite nella stessa cartella (creato dall'xlsx al primo avvio)",
+    )
+    
     if st.button("💾 SALVA", type="primary"):
         cfg["base_dir"] = new_path
+        cfg["storage_backend"] = new_backend
         save_config(cfg)
         st.success("✅ Salvato! Riavvia app.")
     
+    jinfo = db.journal_info()
+    if jinfo["entries"]:
+        st.caption(f"📝 Modifiche in journal non ancora compattate: {jinfo['entries']} ({', '.join(jinfo['tables'])})")
+        if st.button("🗜️ COMPATTA ORA"):
+            n = db.compact_journal()
+            st.success(f"✅ Compattate {n} modifiche nel database.")
+    if jinfo["failed"]:
+        st.warning(f"⚠️ {len(jinfo['failed'])} modifiche in journal non applicabili (escluse dai dati):")
+        st.dataframe(pd.DataFrame(jinfo["failed"]), hide_index=True)
+    if jinfo["rejected"]:
+        st.warning(f"⚠️ {jinfo['rejected']} modifiche non applicabili conservate in {jinfo['rejected_path']}")
+    
+    with st.expander("🗄️ Backup", expanded=False):
+        bm = backup_metrics()
+        st.caption(
+            f"In coda: {bm['queue_depth']} (max {bm['max_queue_depth']}) · completati: {bm['processed']} · "
+            f"errori: {bm['failed']} · durata media {bm['backup_avg_s']:.2f}s (max {bm['backup_max_s']:.2f}s) · "
+            f"snapshot sotto lock {bm['snapshot_avg_s'] * 1000:.1f}ms"
+        )
+        if bm['last_error']:
+            st.warning(f"Ultimo errore backup: {bm['last_error']}")
+        backups = db.list_backups()
+        if not backups:
+            st.caption("Nessun backup disponibile.")
+        else:
+            st.caption(f"{len(backups)} backup (fogli non modificati salvati una sola volta)")
+            sel_bk = st.selectbox(
+                "Versione",
+                list(range(len(backups))),
+                format_func=lambda i: f"{backups[i]['created']} · {backups[i]['size'] / 1024 / 1024:.1f} MB",
+                key="cfg_backup_sel",
+            )
+            if st.button("♻️ RICOSTRUISCI FILE", key="cfg_backup_restore"):
+                try:
+                    out = db.restore_backup(backups[sel_bk]['manifest'])
+                    st.success(f"✅ Ricostruito: {out}")
+                    with open(out, "rb") as f:
+                        st.download_button("⬇️ Scarica", f.read(), file_name=out.name, key="cfg_backup_dl")
+                except Exception as e:
+                    st.error(f"Errore ricostruzione backup: {e}")
+    
+    with st.expander("🔒 Lock database (questo processo)", expanded=False):
+        lm = lock_metrics()
+        if not lm:
+            st.caption("Nessun lock registrato.")
+        else:
+            lm_df = pd.DataFrame(lm)[['site', 'mode', 'count', 'contended', 'timeouts',
+                                      'wait_avg_s', 'wait_max_s', 'hold_avg_s', 'hold_max_s']]
+            st.dataframe(lm_df, hide_index=True, width="stretch")
+
+    with st.expander("🧠 Memoria tabelle (condivisa tra le sessioni)", expanded=False):
+        tm = table_store_metrics()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Occupata", f"{tm['bytes'] / 1024 / 1024:.1f} MB", help=f"Budget {tm['max_bytes'] / 1024 / 1024:.0f} MB")
+        m2.metric("Voci", tm['entries'])
+        m3.metric("Hit / miss", f"{tm['hits']} / {tm['misses']}")
+        m4.metric("Scartate", tm['evictions'])
+        if tm['items']:
+            tm_df = pd.DataFrame(tm['items'])
+            tm_df['MB'] = (tm_df['bytes'] / 1024 / 1024).round(2)
+            st.dataframe(tm_df[['kind', 'table', 'rows', 'MB']], hide_index=True, width="stretch")
+    
     st.markdown("---")
     st.markdown("### ℹ️ Info Sistema")
     
@@ -2752,7 +2999,7 @@ elif st.session_state.page == 'Configurazione':
     
     with col1:
         st.info(f"""
-        **📍 Database:** `{db.excel_path.name}`  
+        **📍 Database:** `{db.storage_path.name}` ({db.storage.name})  
         **📊 Tabelle:** {len(db.TABLES)}  
         **💾 Record:** {sum(db.get_stats().values()):,}
         """)
@@ -2853,12 +3100,14 @@ elif st.session_state.page == 'Calendario Crosstab':
 
             with (st.spinner('⏳ Aggiornamento in corso...') if genera_crosstab else contextlib.nullcontext()):
 
-                    # Carica dati
+                    # Carica dati (solo il mese richiesto: il filtro data lo applica il database)
 
-                    attivita = db.get_all('Attivita')
+                    _m_from, _m_to = _month_bounds(mese, anno)
+
+                    attivita = db.get_all('Attivita', derived=True, date_from=_m_from, date_to=_m_to)
 
                     # Straordinari (per evidenziare il turno primario in Crosstab)
-                    straordinari = db.get_all('Straordinario')
+                    straordinari = db.get_all('Straordinario', date_from=_m_from, date_to=_m_to)
 
                     personale = db.get_all('Personale')
     
@@ -2867,14 +3116,14 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                     if len(attivita) > 0 and 'matricola' in attivita.columns:
 
-                        attivita['matricola'] = attivita['matricola'].astype(str).str.strip()
+                        attivita['matricola'] = text_column(attivita['matricola'])
     
 
                     if len(personale) > 0 and 'matricola' in personale.columns:
 
                         personale_clean = personale.copy()
 
-                        personale_clean['matricola'] = personale_clean['matricola'].astype(str).str.strip()
+                        personale_clean['matricola'] = text_column(personale_clean['matricola'])
 
                     else:
 
@@ -2883,7 +3132,7 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                     if len(attivita) == 0:
 
-                        st.warning("⚠️ Nessuna attività trovata nel database. Importa prima i dati.")
+                        st.warning(f"⚠️ Nessuna attività trovata per {mese} {anno}. Importa prima i dati.")
 
                     else:
 
@@ -2932,8 +3181,8 @@ elif st.session_state.page == 'Calendario Crosstab':
                             try:
                                 if len(straordinari) > 0 and {'matricola', 'data', 'turno'}.issubset(set(straordinari.columns)):
                                     stx = straordinari.copy()
-                                    stx['matricola'] = stx['matricola'].astype(str).str.strip()
-                                    stx['turno'] = stx['turno'].astype(str).str.strip().str.upper()
+                                    stx['matricola'] = text_column(stx['matricola'])
+                                    stx['turno'] = text_column(stx['turno'], upper=True)
                                     stx['data'] = pd.to_datetime(stx['data'], errors='coerce', dayfirst=True)
                                     stx = stx[(stx['data'].dt.year == int(anno)) & (stx['data'].dt.month == int(mese_num))].copy()
                                     stx = apply_relational_filters(stx, uo_sel, cat_sel)
@@ -3000,7 +3249,7 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                     tmp = reg.copy()
 
-                                    tmp['matricola'] = tmp['matricola'].astype(str).str.strip()
+                                    tmp['matricola'] = text_column(tmp['matricola'])
 
                                     tmp = tmp.drop_duplicates(subset=['matricola'])
 
@@ -3031,7 +3280,7 @@ elif st.session_state.page == 'Calendario Crosstab':
                                             att_filt['valore'] = att_filt[oc]
                                             break
 
-                                att_filt['matricola'] = att_filt['matricola'].astype(str).str.strip()
+                                att_filt['matricola'] = text_column(att_filt['matricola'])
 
                                 for col in ['nome', 'uo', 'cat', 'turno', 'att', 'pox']:
 
@@ -3039,7 +3288,7 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                         att_filt[col] = ''
 
-                                    att_filt[col] = att_filt[col].fillna('').astype(str).str.strip()
+                                    att_filt[col] = text_column(att_filt[col], fill='')
 
                                 if 'valore' in att_filt.columns:
 
@@ -3058,9 +3307,11 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                 meta_rows = []
 
+                                _rows_by_matr = att_filt.groupby('matricola', sort=False).indices
+
                                 for matr in matr_list:
 
-                                    subm = att_filt[att_filt['matricola'] == matr]
+                                    subm = att_filt.iloc[_rows_by_matr[matr]]
 
 
                                     nome_m = ''
@@ -3176,7 +3427,7 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                     if code_col and min_col:
 
-                                        tt2[code_col] = tt2[code_col].astype(str).str.strip().str.upper()
+                                        tt2[code_col] = text_column(tt2[code_col], upper=True)
 
                                         tt2[min_col] = pd.to_numeric(tt2[min_col], errors='coerce')
 
@@ -3336,7 +3587,7 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                 for matr in people:
 
-                                    sub = att_filt[att_filt['matricola'] == matr].copy()
+                                    sub = att_filt.iloc[_rows_by_matr.get(matr, [])].copy()
 
 
                                     # meta
@@ -3415,24 +3666,10 @@ elif st.session_state.page == 'Calendario Crosstab':
                                         day_rows = sub[sub['giorno'] == g]
 
                                         # --- Turno primario + eventuali righe "seconda riga" (stessa data/matricola) ---
-                                        _day_turno = day_rows.copy()
-
-                                        # normalizza minuti per usare i valori reali della tabella Attivita (minuti o valore)
-                                        if 'minuti' in _day_turno.columns:
-                                            _day_turno['_mins'] = pd.to_numeric(_day_turno['minuti'], errors='coerce').fillna(0.0)
-                                        elif 'valore' in _day_turno.columns:
-                                            _v = pd.to_numeric(_day_turno['valore'], errors='coerce').fillna(0.0)
-                                            # euristica: se sembra ore (< 24) -> converto in minuti
-                                            _day_turno['_mins'] = (_v * 60.0) if float(_v.max() if len(_v) else 0.0) <= 24.0 else _v
-                                        else:
-                                            _day_turno['_mins'] = 0.0
-
-                                        _day_turno['_t'] = _day_turno['turno'].astype(str).str.strip().replace({'nan': '', 'None': '', 'NONE': ''})
-                                        _day_turno = _day_turno[_day_turno['_t'] != '']
-                                        _day_turno['_t_up'] = _day_turno['_t'].astype(str).str.upper().str.strip()
-
+                                        # codice turno e minuti canonici (colonne derivate _turno_up/_mins del database)
                                         # non mostrare POX nel calendario
-                                        _day_turno = _day_turno[_day_turno['_t_up'] != 'POX']
+                                        _day_turno = day_rows[~day_rows['_turno_up'].isin({'', 'POX'})].copy()
+                                        _day_turno['_t_up'] = _day_turno['_turno_up'].astype(str)
 
                                         primary_code = ''
                                         primary_mins = 0.0
@@ -3475,19 +3712,9 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                         # NB: nel calendario NON mostrare POX
 
-                                        sec_df = day_rows.copy()
-
-                                        # normalizza minuti (alcuni DB possono avere solo 'valore' in ore)
-                                        if 'minuti' not in sec_df.columns:
-                                            if 'valore' in sec_df.columns:
-                                                _v = pd.to_numeric(sec_df['valore'], errors='coerce').fillna(0.0)
-                                                sec_df['minuti'] = (_v * 60.0) if float(_v.max() if len(_v) else 0.0) <= 24.0 else _v
-                                            else:
-                                                sec_df['minuti'] = 0.0
-
-                                        sec_df['att'] = sec_df['att'].astype(str).str.strip().replace({'nan': '', 'None': '', 'NONE': ''})
-
-                                        sec_df = sec_df[sec_df['att'] != '']
+                                        # att e minuti canonici (colonne derivate _att_up/_mins del database)
+                                        sec_df = day_rows[day_rows['_att_up'] != ''].copy()
+                                        sec_df['_att_up'] = sec_df['_att_up'].astype(str)
 
 
                                         # Per il calcolo "impegnato" nel weekend:
@@ -3504,8 +3731,6 @@ elif st.session_state.page == 'Calendario Crosstab':
 
                                         if len(sec_df) > 0:
 
-                                            sec_df['_att_up'] = sec_df['att'].astype(str).str.upper().str.strip()
-
                                             has_fer_rfs = sec_df['_att_up'].isin({'FER', 'RFS'}).any()
 
                                             real_sec = sec_df[~sec_df['_att_up'].isin({'FER', 'RFS'})].copy()
@@ -3571,14 +3796,14 @@ elif st.session_state.page == 'Calendario Crosstab':
                                         # Secondarie da campo ATT (attivita' secondarie "esplicite")
                                         if len(sec_df) > 0:
                                             grp = (
-                                                sec_df.groupby('att', as_index=False)
-                                                      .agg(minuti=('minuti', 'sum'))
+                                                sec_df.groupby('_att_up', as_index=False)
+                                                      .agg(minuti=('_mins', 'sum'))
                                                       .sort_values('minuti', ascending=False)
                                             )
 
                                             # Mostra TUTTE le attivita' secondarie (richiesta)
                                             for _, r in grp.iterrows():
-                                                _att_code = str(r['att']).strip().upper()
+                                                _att_code = str(r['_att_up'])
                                                 if not _att_code or _att_code in {'NAN', 'NONE'}:
                                                     continue
                                                 _mins_sum = float(r['minuti']) if pd.notna(r['minuti']) else 0.0
@@ -3624,16 +3849,7 @@ elif st.session_state.page == 'Calendario Crosstab':
                                         gt_mins = 0.0
                                         try:
                                             if len(sec_df) > 0:
-                                                _tmp = sec_df.copy()
-                                                _tmp['_att_up'] = _tmp['att'].astype(str).str.strip().str.upper()
-                                                if 'minuti' in _tmp.columns:
-                                                    _tmp['_mins'] = pd.to_numeric(_tmp['minuti'], errors='coerce').fillna(0.0)
-                                                elif 'valore' in _tmp.columns:
-                                                    _v = pd.to_numeric(_tmp['valore'], errors='coerce').fillna(0.0)
-                                                    _tmp['_mins'] = (_v * 60.0) if float(_v.max() if len(_v) else 0.0) <= 24.0 else _v
-                                                else:
-                                                    _tmp['_mins'] = 0.0
-                                                gt_mins += float(_tmp.loc[_tmp['_att_up'].isin(gt_codes) & (_tmp['_mins'] > 0), '_mins'].sum())
+                                                gt_mins += float(sec_df.loc[sec_df['_att_up'].isin(gt_codes) & (sec_df['_mins'] > 0), '_mins'].sum())
                                             if sec_turno_present:
                                                 for _c, _m in sec_turno_groups:
                                                     _c = str(_c).strip().upper()
@@ -3963,8 +4179,10 @@ elif st.session_state.page == 'Conteggi Turni Crosstab':
         st.info('Nessun dato Attivita disponibile.')
     else:
         # filtri globali relazionali sempre applicati
-        att = apply_relational_filters(att, uo_sel=uo_sel, cat_sel=cat_sel)
-        att['matricola'] = att['matricola'].astype(str).str.strip()
+        rel_mask = relational_mask(att, uo_sel=uo_sel, cat_sel=cat_sel)
+        if rel_mask is not None:
+            att = att[rel_mask]
+        att['matricola'] = text_column(att['matricola'])
         if selected_mats:
             att = att[att['matricola'].isin(set(selected_mats))]
 
@@ -3982,8 +4200,8 @@ elif st.session_state.page == 'Conteggi Turni Crosstab':
             # normalizza colonne testo (turno + attività) per filtro wildcard
             # turno è la colonna principale; se turno è vuoto ma l'attività è valorizzata,
             # useremo un "codice effettivo" per conteggiare.
-            t['turno'] = t['turno'].fillna('').astype(str).str.strip()
-            t['_turno_norm'] = t['turno'].astype(str).str.strip().str.upper()
+            t['turno'] = text_column(t['turno'], fill='')
+            t['_turno_norm'] = text_column(t['turno'], upper=True)
 
             # trova colonne attività presenti in Attivita
             cols_l = {str(c).strip().lower(): c for c in t.columns}
@@ -3999,7 +4217,7 @@ elif st.session_state.page == 'Conteggi Turni Crosstab':
             match_cols = ['_turno_norm']
             for c in act_cols:
                 norm_c = f"_{str(c).strip().lower()}_norm"
-                t[norm_c] = t[c].fillna('').astype(str).str.strip().str.upper()
+                t[norm_c] = text_column(t[c], upper=True, fill='')
                 match_cols.append(norm_c)
 
             # filtro testo con wildcard (* = jolly). Default: "contiene" (rp => *rp*)
@@ -4038,14 +4256,14 @@ elif st.session_state.page == 'Conteggi Turni Crosstab':
                 t = t[~t['turno'].isin(abs_codes)]
 
             # rimuovi codici vuoti
-            t = t[t['turno'].astype(str).str.strip() != '']
+            t = t[text_column(t['turno']) != '']
 
             # mese label
             t['mese'] = t['data'].dt.to_period('M').astype(str)
 
             # label persona (Nome | Matricola) con fallback robusto
             meta_lbl = meta2[['matricola', 'nome']].copy() if len(meta2) else pd.DataFrame(columns=['matricola','nome'])
-            meta_lbl['matricola'] = meta_lbl['matricola'].astype(str).str.strip()
+            meta_lbl['matricola'] = text_column(meta_lbl['matricola'])
             meta_lbl['nome'] = meta_lbl.get('nome', '').fillna('').astype(str).str.strip() if 'nome' in meta_lbl.columns else ''
             t = t.merge(meta_lbl, on='matricola', how='left')
 
@@ -4069,13 +4287,13 @@ elif st.session_state.page == 'Conteggi Turni Crosstab':
                     src = cand_cols[0]
                     if 'nome' not in t.columns:
                         t['nome'] = ''
-                    miss = t['nome'].fillna('').astype(str).str.strip() == ''
-                    t.loc[miss, 'nome'] = t.loc[miss, src].fillna('').astype(str).str.strip()
+                    miss = text_column(t['nome'], fill='') == ''
+                    t.loc[miss, 'nome'] = text_column(t.loc[miss, src], fill='')
             except Exception:
                 pass
             if 'nome' not in t.columns:
                 t['nome'] = ''
-            t['nome'] = t['nome'].fillna('').astype(str).str.strip()
+            t['nome'] = text_column(t['nome'], fill='')
             t['persona'] = t.apply(lambda r: (f"{str(r.get('nome','')).strip()} | {r.get('matricola','')}" if str(r.get('nome','')).strip() else f"{r.get('matricola','')}"), axis=1)
             # ore (somma minuti/60) - usa colonna 'valore' se presente (minuti)
             if 'valore' in t.columns:
@@ -4168,12 +4386,14 @@ elif st.session_state.page == 'Specializzazioni Personale':
                 spec_pers = spec_pers.rename(columns={mcol: 'matricola'})
         if 'matricola' not in spec_pers.columns:
             spec_pers['matricola'] = ''
-        spec_pers['matricola'] = spec_pers['matricola'].astype(str).str.strip()
+        spec_pers['matricola'] = text_column(spec_pers['matricola'])
 
         # applica filtro relazionale globale (regola di progetto)
-        spec_pers = apply_relational_filters(spec_pers, uo_sel=uo_sel, cat_sel=cat_sel)
+        rel_mask = relational_mask(spec_pers, uo_sel=uo_sel, cat_sel=cat_sel)
+        if rel_mask is not None:
+            spec_pers = spec_pers[rel_mask]
         if only_active and len(meta2):
-            keep = set(meta2['matricola'].astype(str).str.strip())
+            keep = set(text_column(meta2['matricola']))
             spec_pers = spec_pers[spec_pers['matricola'].isin(keep)]
 
         # colonne specializzazione
@@ -4192,12 +4412,12 @@ elif st.session_state.page == 'Specializzazioni Personale':
         if spec_col is None:
             st.warning("Non trovo la colonna specializzazione in SpecUOPers (attesa: 'SpecUO/Comp').")
         else:
-            spec_pers[spec_col] = spec_pers[spec_col].astype(str).str.strip()
+            spec_pers[spec_col] = text_column(spec_pers[spec_col])
             spec_pers = spec_pers[spec_pers[spec_col] != '']
 
             # merge nome
             meta_lbl = meta2[['matricola', 'nome', 'uo', 'cat']].copy() if len(meta2) else pd.DataFrame(columns=['matricola','nome','uo','cat'])
-            meta_lbl['matricola'] = meta_lbl['matricola'].astype(str).str.strip()
+            meta_lbl['matricola'] = text_column(meta_lbl['matricola'])
             df = spec_pers.merge(meta_lbl, on='matricola', how='left')
             df['persona'] = df.apply(lambda r: f"{(r.get('nome') or '').strip()} | {r['matricola']}", axis=1)
 
@@ -4366,7 +4586,9 @@ elif st.session_state.page == 'Controllo WE liberi':
         st.stop()
 
     # --- Dati Attivita (stessa logica del Crosstab per weekend "impegnato") ---
-    att = db.get_all('Attivita')
+    # periodo e persone selezionati: filtro applicato dal database
+    att = db.get_all('Attivita', derived=True, date_from=d_start, date_to=d_end,
+                     matricole=meta_f['matricola'].astype(str).tolist())
     if att is None or len(att) == 0:
         st.info('Nessun dato in tabella Attivita.')
         st.stop()
@@ -4384,7 +4606,7 @@ elif st.session_state.page == 'Controllo WE liberi':
     # normalizza
     att['data'] = pd.to_datetime(att['data'], errors='coerce', dayfirst=True)
     att = att[att['data'].notna()].copy()
-    att['matricola'] = att['matricola'].astype(str).str.strip()
+    att['matricola'] = text_column(att['matricola'])
 
     # filtra periodo
     start_ts = pd.to_datetime(d_start)
@@ -4403,11 +4625,11 @@ elif st.session_state.page == 'Controllo WE liberi':
     if 'att' not in att.columns:
         att['att'] = ''
 
-    att['turno'] = att['turno'].fillna('').astype(str).str.strip().replace({'nan': '', 'None': '', 'NONE': ''})
-    att['att'] = att['att'].fillna('').astype(str).str.strip().replace({'nan': '', 'None': '', 'NONE': ''})
+    att['turno'] = text_column(att['turno'], fill='').replace({'nan': '', 'None': '', 'NONE': ''})
+    att['att'] = text_column(att['att'], fill='').replace({'nan': '', 'None': '', 'NONE': ''})
 
-    # chiave giorno
-    att['day'] = att['data'].dt.normalize()
+    # chiave giorno (colonna derivata canonica)
+    att['day'] = att['_day']
 
     # Costruisci lista weekend (sabato+dom) nel range
     all_days = pd.date_range(start=start_ts, end=end_ts, freq='D')
@@ -4422,6 +4644,9 @@ elif st.session_state.page == 'Controllo WE liberi':
         st.info('Nel periodo selezionato non ci sono weekend completi (sab+dom) da analizzare.')
         st.stop()
 
+    # servono solo i giorni di weekend: il raggruppamento (matricola, giorno) lavora su quelli
+    att = att[att['day'].isin([d for k in weekend_keys for d in k])]
+
     # Precalcola stato "engaged" per (matricola, day) con la stessa logica del Crosstab
     # engaged = (turno reale) OR (att secondaria reale)
     # override: se ci sono solo FER/RFS in secondaria -> non engaged (anche se turno presente)
@@ -4434,21 +4659,9 @@ elif st.session_state.page == 'Controllo WE liberi':
     for (matr, day), gdf in att_sorted.groupby(['matricola', 'day'], sort=False):
         # TURNO: primario = codice con piu' minuti (se disponibili); le altre occorrenze in TURNO
         # (stesso giorno/persona) sono considerate "secondarie" come nel Calendario Crosstab.
-        _g = gdf.copy()
-        if 'minuti' in _g.columns:
-            _g['_mins'] = pd.to_numeric(_g['minuti'], errors='coerce').fillna(0.0)
-        elif 'valore' in _g.columns:
-            _v = pd.to_numeric(_g['valore'], errors='coerce').fillna(0.0)
-            _g['_mins'] = (_v * 60.0) if float(_v.max() if len(_v) else 0.0) <= 24.0 else _v
-        else:
-            _g['_mins'] = 0.0
-        
-        _g['_t'] = _g['turno'].astype(str).str.strip().replace({'nan': '', 'None': '', 'NONE': ''})
-        _g = _g[_g['_t'] != '']
-        _g['_t_up'] = _g['_t'].astype(str).str.upper().str.strip()
-        
-        # ignora POX anche qui
-        _g = _g[_g['_t_up'] != 'POX']
+        # codice turno e minuti canonici (colonne derivate _turno_up/_mins); ignora POX anche qui
+        _g = gdf[~gdf['_turno_up'].isin({'', 'POX'})].copy()
+        _g['_t_up'] = _g['_turno_up'].astype(str)
         
         primary = ''
         sec_turno_up = pd.Series([], dtype=str)
@@ -4467,9 +4680,8 @@ elif st.session_state.page == 'Controllo WE liberi':
         
         sec_turno_real_present = sec_turno_up[~sec_turno_up.isin({'', 'FER', 'RFS'})].shape[0] > 0
 
-        sec_df = gdf.copy()
-        sec_df['_att_up'] = sec_df['att'].astype(str).str.upper().str.strip()
-        sec_df = sec_df[sec_df['_att_up'] != '']
+        sec_df = gdf[gdf['_att_up'] != ''].copy()
+        sec_df['_att_up'] = sec_df['_att_up'].astype(str)
 
         has_fer_rfs = False
         if len(sec_df) > 0:
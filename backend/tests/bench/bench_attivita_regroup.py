@@ -0,0 +1,178 @@
+"""
+Benchmark: spostamento dei turni extra in ATT su Attivita (import GT)
+
+Confronta _attivita_move_extra_turno_to_att (vettoriale) con la versione di riferimento
+attivita_move_extra_turno_to_att_loop (l'implementazione originale, un gruppo alla volta) su dati
+sintetici tipo export GT e verifica che l'output sia identico (valori, tipi, ordine righe e colonne).
+L'equivalenza sui casi limite e' in tests/test_attivita_regroup.py.
+
+Uso (dalla cartella backend):
+    python tests/bench/bench_attivita_regroup.py [righe] [ripetizioni]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app"))
+from database import _attivita_move_extra_turno_to_att  # noqa: E402
+
+PRIMARY_TURNI = {'M78', 'P38', 'N11', 'M61'}
+
+
+def attivita_move_extra_turno_to_att_loop(df: pd.DataFrame, primary_turni: set[str] | None = None) -> pd.DataFrame:
+    """Versione di riferimento (un gruppo alla volta) di database._attivita_move_extra_turno_to_att.
+
+    Normalizza la tabella Attivita quando le *attività secondarie* sono state inserite come righe extra nel campo TURNO.
+
+    Scenario tipico (export/import):
+      - stessa matricola + stesso giorno -> più righe
+      - una riga con turno primario (es. M78/P38/N11...) + minuti ~480
+      - altre righe con codici attività (es. ESAU/ISTR/UCS...) e minuti diversi, ma messe in colonna TURNO
+
+    Obiettivo:
+      - per ogni (matricola, giorno) tenere 1 sola riga con TURNO valorizzato (primario)
+      - convertire le altre righe in secondarie usando la colonna ATT (TURNO vuoto)
+      - preservare minuti/valore per il calcolo ore delle secondarie
+    """
+    if df is None or len(df) == 0:
+        return df
+
+    out = df.copy()
+
+    # colonne minime
+    for c in ["matricola", "turno", "att"]:
+        if c not in out.columns:
+            out[c] = ""
+    if "data" not in out.columns:
+        return out
+
+    # data -> giorno (senza orario)
+    out["data"] = pd.to_datetime(out["data"], errors="coerce", dayfirst=True)
+    out["_day"] = out["data"].dt.normalize()
+
+    # minuti coerenti
+    if "minuti" in out.columns:
+        out["minuti"] = pd.to_numeric(out["minuti"], errors="coerce").fillna(0.0).astype(float)
+    else:
+        # fallback: se esiste valore in ore
+        if "valore" in out.columns:
+            out["valore"] = pd.to_numeric(out["valore"], errors="coerce").fillna(0.0).astype(float)
+            out["minuti"] = (out["valore"] * 60.0).round(0)
+        else:
+            out["minuti"] = 0.0
+
+    out["turno"] = out["turno"].fillna("").astype(str).str.strip()
+    out["att"] = out["att"].fillna("").astype(str).str.strip()
+
+    primary_turni = {str(x).strip().upper() for x in (primary_turni or set()) if str(x).strip()}
+
+    def pick_primary(g: pd.DataFrame) -> int:
+        # preferisci codici che appartengono a Turni_tipo, altrimenti max minuti
+        t = g["turno"].fillna("").astype(str).str.strip().str.upper()
+        is_primary_code = t.isin(primary_turni) if primary_turni else pd.Series([False]*len(g), index=g.index)
+        if is_primary_code.any():
+            gg = g[is_primary_code]
+            # tra i primari scegli quello con più minuti
+            return int(gg["minuti"].idxmax())
+        # fallback: il record con più minuti
+        return int(g["minuti"].idxmax())
+
+    new_rows = []
+    for (mat, day), g in out.groupby(["matricola", "_day"], dropna=False):
+        if len(g) == 1:
+            new_rows.append(g)
+            continue
+
+        idx_primary = pick_primary(g)
+        primary_row = g.loc[[idx_primary]].copy()
+
+        # le altre righe diventano secondarie
+        others = g.drop(index=idx_primary).copy()
+        # se att è vuoto, usa turno come codice attività
+        others["att"] = others["att"].where(others["att"].astype(str).str.strip().ne(""), others["turno"])
+        # turno vuoto sulle secondarie per evitare "più turni primari"
+        others["turno"] = ""
+
+        # se la riga primaria aveva anche un'attività in colonna att, la lasciamo; se invece l'attività era in turno (caso raro)
+        primary_row["att"] = primary_row["att"].astype(str).str.strip()
+
+        new_rows.append(primary_row)
+        new_rows.append(others)
+
+    out2 = pd.concat(new_rows, ignore_index=True)
+
+    # pulizia helper
+    out2 = out2.drop(columns=["_day"], errors="ignore")
+
+    # ricalcola valore (ore) da minuti, se presente
+    out2["minuti"] = pd.to_numeric(out2.get("minuti", 0), errors="coerce").fillna(0.0).astype(float)
+    out2["valore"] = (out2["minuti"] / 60.0).round(2)
+
+    # dedup finale
+    out2 = out2.drop_duplicates()
+
+    return out2
+
+
+def synthetic_gt(rows: int, seed: int = 7) -> pd.DataFrame:
+    """Righe tipo export GT: un turno al giorno per persona, spesso con righe extra (attivita') nel TURNO."""
+    rng = np.random.default_rng(seed)
+    persone = max(1, rows // 300)
+    mats = rng.integers(10000, 10000 + persone, rows).astype(str)
+    days = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')
+    turni = np.array(['M78', 'P38', 'N11', 'M61', 'ESAU', 'ISTR', 'UCS', 'FER', 'RFS', ''])
+    turno = turni[rng.integers(0, len(turni), rows)]
+    att = np.where(rng.random(rows) < 0.15, 'FORM', '')
+    minuti = rng.choice([480.0, 450.0, 60.0, 120.0, 30.0, 0.0], rows)
+    df = pd.DataFrame({
+        'nome': np.char.add('Persona ', mats),
+        'matricola': mats,
+        'uo': 'UO1',
+        'turno': turno,
+        'att': att,
+        'pox': '',
+        'data': days.strftime('%d/%m/%Y'),
+        'minuti': minuti,
+    })
+    df['valore'] = (df['minuti'] / 60.0).round(2)
+    return df
+
+
+def _same(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    return (list(a.columns) == list(b.columns)
+            and a.dtypes.equals(b.dtypes)
+            and a.index.equals(b.index)
+            and a.to_csv().encode() == b.to_csv().encode())
+
+
+def main(rows: int = 20_000, repeat: int = 1):
+    df = synthetic_gt(rows)
+    print(f"righe: {len(df):,}  gruppi (matricola, giorno): {df.groupby(['matricola', 'data']).ngroups:,}")
+
+    results = {}
+    for name, fn in (('loop', attivita_move_extra_turno_to_att_loop), ('vettoriale', _attivita_move_extra_turno_to_att)):
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            out = fn(df, primary_turni=PRIMARY_TURNI)
+            dt = time.perf_counter() - t0
+            best = dt if best is None else min(best, dt)
+        results[name] = (out, best)
+        print(f"{name:>10}: {best:8.2f} s")
+
+    identico = _same(results['loop'][0], results['vettoriale'][0])
+    # anche senza Turni_tipo (primario = riga con piu' minuti)
+    identico &= _same(attivita_move_extra_turno_to_att_loop(df.head(2_000)),
+                      _attivita_move_extra_turno_to_att(df.head(2_000)))
+    print(f"speedup: {results['loop'][1] / max(results['vettoriale'][1], 1e-9):.1f}x  output identico: {identico}")
+    return identico
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    ok = main(*args)
+    sys.exit(0 if ok else 1)
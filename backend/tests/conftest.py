@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+# i moduli dell'app si importano come in persgest.py (cartella app nel path)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+import pandas as pd
+import pytest
+
+
+ATTIVITA_ROWS = [
+    ['Rossi 1', '1001', 'UO_A', 'M78', '', '', '2024-01-01', 480.0, 8.0],
+    ['Rossi 1', '1001', 'UO_A', 'STR', '', '', '2024-01-02', 60.0, 1.0],
+    ['Bianchi 2', '1002', 'UO_B', 'P38', 'FORM', '', '2024-01-01', 480.0, 8.0],
+    ['Bianchi 2', '1002', 'UO_B', 'FER', '', '', '2024-02-03', 0.0, 0.0],
+    ['Verdi 3', '1003', 'UO_A', 'N11', '', '', '2024-02-10', 480.0, 8.0],
+]
+
+
+def attivita_frame(rows=None) -> pd.DataFrame:
+    df = pd.DataFrame(rows or ATTIVITA_ROWS,
+                      columns=['nome', 'matricola', 'uo', 'turno', 'att', 'pox', 'data', 'minuti', 'valore'])
+    df['data'] = pd.to_datetime(df['data'])
+    return df
+
+
+@pytest.fixture(params=['excel', 'sqlite'])
+def db(request, tmp_path, monkeypatch):
+    """Database vuoto (tutte le tabelle) in una cartella temporanea, per ogni motore dati."""
+    monkeypatch.setenv('LOCALAPPDATA', str(tmp_path))
+    import database
+    return database.PersGestDatabase(tmp_path / 'data' / 'persgest_master.xlsx', backend=request.param)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import _attivita_move_extra_turno_to_att
+from bench.bench_attivita_regroup import attivita_move_extra_turno_to_att_loop, synthetic_gt
+
+PRIMARY = {'M78', 'P38', 'N11', 'M61'}
+COLS = ['nome', 'matricola', 'uo', 'turno', 'att', 'pox', 'data', 'minuti', 'valore']
+
+
+def _frame(rows):
+    return pd.DataFrame(rows, columns=COLS)
+
+
+def _assert_same(df, primary_turni):
+    exp = attivita_move_extra_turno_to_att_loop(df, primary_turni=primary_turni)
+    got = _attivita_move_extra_turno_to_att(df, primary_turni=primary_turni)
+    assert list(got.columns) == list(exp.columns)
+    assert got.dtypes.equals(exp.dtypes)
+    pd.testing.assert_frame_equal(got, exp)
+    return got
+
+
+EDGE_CASES = {
+    'turno_nan': [
+        ['A', '1', 'U', np.nan, '', '', '01/03/2024', 480, 8],
+        ['A', '1', 'U', 'ESAU', '', '', '01/03/2024', 60, 1],
+        ['A', '1', 'U', None, 'FORM', '', '02/03/2024', 30, 0.5],
+    ],
+    'pox': [
+        ['A', '1', 'U', 'M78', '', '', '01/03/2024', 480, 8],
+        ['A', '1', 'U', 'POX', '', 'POX', '01/03/2024', 480, 8],
+        ['B', '2', 'U', 'POX', '', 'POX', '01/03/2024', 600, 10],
+        ['B', '2', 'U', 'ISTR', '', '', '01/03/2024', 120, 2],
+    ],
+    'fer_rfs': [
+        ['A', '1', 'U', 'FER', '', '', '01/03/2024', 0, 0],
+        ['A', '1', 'U', 'RFS', '', '', '01/03/2024', 0, 0],
+        ['B', '2', 'U', 'P38', '', '', '01/03/2024', 480, 8],
+        ['B', '2', 'U', 'FER', 'FER', '', '01/03/2024', 480, 8],
+    ],
+    'gruppi_di_una_riga': [
+        ['A', '1', 'U', 'N11', '', '', '01/03/2024', 480, 8],
+        ['A', '1', 'U', 'UCS', '', '', '02/03/2024', 90, 1.5],
+        ['B', '2', 'U', '', '', '', '01/03/2024', 0, 0],
+    ],
+    'pari_minuti_e_data_vuota': [
+        ['A', '1', 'U', 'ESAU', '', '', '01/03/2024', 120, 2],
+        ['A', '1', 'U', 'ISTR', '', '', '01/03/2024', 120, 2],
+        ['A', '1', 'U', 'M78', '', '', None, 480, 8],
+        ['A', '1', 'U', 'UCS', '', '', 'non una data', 60, 1],
+    ],
+}
+
+
+@pytest.mark.parametrize('primary_turni', [PRIMARY, None], ids=['turni_tipo', 'senza_turni_tipo'])
+@pytest.mark.parametrize('case', sorted(EDGE_CASES))
+def test_regroup_come_versione_originale(case, primary_turni):
+    _assert_same(_frame(EDGE_CASES[case]), primary_turni)
+
+
+def test_regroup_primario_e_secondarie():
+    got = _assert_same(_frame(EDGE_CASES['pox']), PRIMARY)
+    # stesso giorno: M78 resta primario, POX diventa attivita' secondaria
+    assert got['turno'].tolist() == ['M78', '', 'POX', '']
+    assert got['att'].tolist() == ['', 'POX', '', 'ISTR']
+
+
+def test_regroup_dati_sintetici():
+    _assert_same(synthetic_gt(3_000), PRIMARY)
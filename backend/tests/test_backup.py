@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+import pandas as pd
+
+import database
+from conftest import attivita_frame
+
+
+def _read_restored(path, table):
+    if path.suffix == '.sqlite':
+        return database.SQLiteStorage(path.with_suffix('.xlsx')).read_table(table)
+    return pd.read_excel(path, sheet_name=table)
+
+
+def test_restore_backup_ricostruisce_la_versione_precedente(db):
+    db.save_table('Attivita', attivita_frame())
+    db.save_table('Attivita', attivita_frame().assign(turno='RPD'))
+    assert database._BACKUP_WORKER.wait(30)
+
+    backups = db.list_backups()
+    assert len(backups) >= 2
+    # il backup piu' recente e' lo stato prima dell'ultimo salvataggio
+    restored = db.restore_backup(backups[0]['manifest'])
+    assert restored.exists() and restored != db.storage_path
+    assert _read_restored(restored, 'Attivita')['turno'].tolist() == attivita_frame()['turno'].tolist()
+    # il DB in uso non cambia
+    assert db.get_all('Attivita')['turno'].tolist() == ['RPD'] * 5
+
+    # parti invariate (fogli/tabelle non toccati) salvate una volta sola
+    parts = [{e['sha256'] for e in json.loads(b['manifest'].read_text(encoding='utf-8'))['parts']}
+             for b in backups[:2]]
+    assert parts[0] & parts[1] and parts[0] != parts[1]
+
+
+def _workbook(path, tag):
+    pd.DataFrame({'turno': [tag]}).to_excel(path, sheet_name='Attivita', index=False)
+
+
+def _objects(path):
+    return {p.name: p for p in (path.parent / 'backups' / 'objects').glob('*/*')}
+
+
+def test_pulizia_non_tocca_oggetti_recenti_non_referenziati(tmp_path):
+    path = tmp_path / 'persgest_master.xlsx'
+    _workbook(path, 'M78')
+    first = database._backup_excel(path, keep_last=1)
+    # la parte con il testo (sharedStrings o foglio): le altre, come docProps/core.xml con l'ora
+    # di salvataggio, possono cambiare o no da un backup all'altro
+    parts = {e['name']: e['sha256'] for e in json.loads(first.read_text())['parts']}
+    sheet = parts.get('xl/sharedStrings.xml') or parts['xl/worksheets/sheet1.xml']
+
+    # altri backup: il manifest del primo viene scartato, la parte col testo non e' piu' referenziata
+    for tag in ('P38', 'N11', 'RPD'):
+        _workbook(path, tag)
+        database._backup_excel(path, keep_last=1)
+    assert not first.exists()
+    later = {e['sha256'] for b in database._list_backup_manifests(path)
+             for e in json.loads(b.read_text())['parts']}
+    assert sheet not in later
+    # ancora dentro il periodo di grazia: un backup in corso altrove potrebbe usarlo
+    assert sheet in _objects(path)
+
+    old = time.time() - database.BACKUP_OBJECT_GRACE_S - 60
+    os.utime(_objects(path)[sheet], (old, old))
+    _workbook(path, 'FER')
+    database._backup_excel(path, keep_last=1)
+    assert sheet not in _objects(path)
+    # gli oggetti dei backup rimasti ci sono tutti
+    for b in database._list_backup_manifests(path):
+        restored = database._restore_backup(b, tmp_path / 'restore' / f'{b.stem}.xlsx')
+        assert len(pd.read_excel(restored)) == 1
+
+
+def test_oggetto_riusato_ritoccato(tmp_path):
+    objects = tmp_path / 'objects'
+    h = database._backup_store_object(objects, b'foglio')
+    p = objects / h[:2] / h
+    old = time.time() - database.BACKUP_OBJECT_GRACE_S - 60
+    os.utime(p, (old, old))
+    assert database._backup_store_object(objects, b'foglio') == h
+    assert p.stat().st_mtime > old + 60
+
+
+def test_retention_copie_integrali(tmp_path):
+    path = tmp_path / 'persgest_master.xlsx'
+    backups = tmp_path / 'backups'
+    backups.mkdir()
+    names = [f'persgest_master_2024010{i}_120000.xlsx' for i in range(1, 6)]
+    for n in names:
+        (backups / n).write_bytes(b'copia')
+    (backups / 'restore_x.xlsx').write_bytes(b'ripristino')
+    database._prune_backups(path, keep_last=2)
+    assert sorted(p.name for p in backups.iterdir()) == sorted(names[-2:] + ['restore_x.xlsx'])
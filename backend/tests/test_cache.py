@@ -0,0 +1,50 @@
+import sqlite3
+
+import pandas as pd
+
+import database
+from conftest import attivita_frame
+
+
+def _fresh_read(db, table):
+    """Rilettura senza tabelle in memoria: passa dalla cache su disco (sidecar) se valida."""
+    database._TABLE_STORE.clear()
+    return db.get_all(table)
+
+
+def test_sidecar_non_riusato_dopo_reset_di_db_meta(db):
+    db.save_table('Attivita', attivita_frame())
+    assert _fresh_read(db, 'Attivita')['turno'].tolist() == ['M78', 'STR', 'P38', 'FER', 'N11']
+    assert list((db.excel_path.parent / 'persgest_cache').glob('Attivita.v*.pkl'))
+
+    # db_meta.json perso: i contatori ripartono e tornano alla stessa versione della cache
+    (db.excel_path.parent / 'db_meta.json').unlink()
+    db.save_table('Attivita', attivita_frame().assign(turno='FER'))
+    db.save_table('Attivita', attivita_frame().assign(turno='RPD'))
+    assert _fresh_read(db, 'Attivita')['turno'].tolist() == ['RPD'] * 5
+
+
+def test_sidecar_invalidato_da_modifica_esterna(db):
+    db.save_table('Attivita', attivita_frame())
+    db.save_table('Note', pd.DataFrame({'testo': ['a']}))
+    _fresh_read(db, 'Attivita')
+    _fresh_read(db, 'Note')
+
+    # modifica fatta fuori dall'app (Excel aperto a mano / altro programma sul file SQLite)
+    if db.storage.name == 'sqlite':
+        with sqlite3.connect(db.storage_path) as conn:
+            conn.execute('UPDATE "Attivita" SET "turno" = \'N11\'')
+    else:
+        from openpyxl import load_workbook
+        wb = load_workbook(db.storage_path)
+        ws = wb['Attivita']
+        col = [c.value for c in ws[1]].index('turno') + 1
+        for r in range(2, ws.max_row + 1):
+            ws.cell(row=r, column=col, value='N11')
+        wb.save(db.storage_path)
+
+    assert _fresh_read(db, 'Attivita')['turno'].tolist() == ['N11'] * 5
+    assert _fresh_read(db, 'Note')['testo'].tolist() == ['a']
+    # la scrittura successiva dell'app registra la nuova firma: la cache resta valida
+    db.save_table('Note', pd.DataFrame({'testo': ['b']}))
+    assert _fresh_read(db, 'Attivita')['turno'].tolist() == ['N11'] * 5
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from database import _derive_columns
+
+
+# --- regole originali delle pagine (prima delle colonne derivate) ---
+
+def _crosstab_mins_old(day_rows: pd.DataFrame) -> pd.Series:
+    """Calendario Crosstab / WE liberi: minuti di un giorno di una persona."""
+    if 'minuti' in day_rows.columns:
+        return pd.to_numeric(day_rows['minuti'], errors='coerce').fillna(0.0)
+    if 'valore' in day_rows.columns:
+        v = pd.to_numeric(day_rows['valore'], errors='coerce').fillna(0.0)
+        return (v * 60.0) if float(v.max() if len(v) else 0.0) <= 24.0 else v
+    return pd.Series(0.0, index=day_rows.index)
+
+
+def _gt_mins_old(df: pd.DataFrame) -> pd.Series:
+    """extract_gt_overtime: prima colonna valore/minuti, intero 1..24 = ore (riga per riga)."""
+    val_col = next(c for c in ['valore', 'minuti', 'mins', 'minute'] if c in df.columns)
+    m = pd.to_numeric(df[val_col].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
+    mask_hours = (m > 0) & (m <= 24) & ((m % 1) == 0)
+    m = m.copy()
+    m.loc[mask_hours] = m.loc[mask_hours] * 60
+    return m
+
+
+def _fixture(with_minuti: bool) -> pd.DataFrame:
+    # persona 1: giorni in ore (8, 7.5); persona 2: giorni in minuti (480, 90);
+    # giorno misto (2 e 120 lo stesso giorno) e giorno con sole righe vuote
+    rows = [
+        ('1', '01/03/2024', 'M', '', 8, 480),
+        ('1', '01/03/2024', '', 'STR', 2, 120),
+        ('1', '02/03/2024', 'P', '', 7.5, 450),
+        ('2', '01/03/2024', 'M', '', 480, 480),
+        ('2', '01/03/2024', '', 'RPD', 90, 90),
+        ('2', '02/03/2024', 'N', '', 2, 120),
+        ('2', '02/03/2024', '', 'STR', 120, 120),
+        ('3', '03/03/2024', 'STR', '', None, None),
+        ('3', '04/03/2024', 'RPN', '', '3', 180),
+    ]
+    df = pd.DataFrame(rows, columns=['matricola', 'data', 'turno', 'att', 'valore', 'minuti'])
+    return df if with_minuti else df.drop(columns=['minuti'])
+
+
+def _old_per_day(df: pd.DataFrame) -> pd.Series:
+    day = pd.to_datetime(df['data'], dayfirst=True)
+    parts = [_crosstab_mins_old(g) for _, g in df.groupby([df['matricola'], day], sort=False)]
+    return pd.concat(parts).reindex(df.index)
+
+
+def test_minuti_derivati_come_prima_con_colonna_minuti():
+    df = _fixture(with_minuti=True)
+    der = _derive_columns('Attivita', df)
+    np.testing.assert_allclose(der['_mins'].astype(float), _old_per_day(df))
+    np.testing.assert_allclose(der['_mins_gt'].astype(float), _gt_mins_old(df))
+
+
+def test_minuti_derivati_come_prima_solo_valore():
+    df = _fixture(with_minuti=False)
+    der = _derive_columns('Attivita', df)
+    np.testing.assert_allclose(der['_mins'].astype(float), _old_per_day(df))
+    np.testing.assert_allclose(der['_mins_gt'].astype(float), _gt_mins_old(df))
+    # giorno con 2 e 120: il massimo supera 24, quindi entrambi in minuti (non 120 ore)
+    assert der['_mins'].tolist()[5:7] == [2.0, 120.0]
+    # totali GT: 2 -> 120 minuti, 120 resta 120, 7.5 (non intero) resta com'era
+    assert der['_mins_gt'].tolist()[:3] == [480.0, 120.0, 7.5]
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+SERIES = {
+    'object': pd.Series([' 1001', '1001 ', None, np.nan, 'm78', 1001, 1001.0, True, ''], index=list('abcdefghi')),
+    'float': pd.Series([1.0, np.nan, 2.5, 1.0, -0.0, 0.0]),
+    'int': pd.Series([3, 1, 3], name='matricola'),
+    'bool': pd.Series([True, False, True]),
+    'datetime': pd.Series(pd.to_datetime(['2024-01-01 00:00', None, '2024-01-01 10:00'])),
+    'category': pd.Series([' a', 'B ', None, ' a'], dtype='category'),
+}
+
+
+@pytest.mark.parametrize('kind', sorted(SERIES))
+@pytest.mark.parametrize('upper', [False, True])
+def test_text_column_come_astype_str_strip(kind, upper):
+    s = SERIES[kind]
+    expected = s.astype(str).str.strip()
+    if upper:
+        expected = expected.str.upper()
+    out = database.text_column(s, upper=upper)
+    assert out.dtype == object and out.index.equals(s.index) and out.name == s.name
+    assert out.tolist() == expected.tolist()
+
+
+def test_text_column_fill():
+    s = pd.Series([' x ', None, np.nan, 'y'])
+    assert database.text_column(s, fill='').tolist() == ['x', '', '', 'y']
+    assert database.text_column(s, upper=True, fill=' n ').tolist() == ['X', 'N', 'N', 'Y']
+    cat = s.astype('category')
+    assert database.text_column(cat, fill='').tolist() == ['x', '', '', 'y']
+
+
+def test_vocabulary_ruota_oltre_il_limite(db, monkeypatch):
+    monkeypatch.setattr(database, 'VOCABULARY_MAX_VALUES', 3)
+    monkeypatch.setattr(database, '_VOCABULARIES', {d: database._Vocabulary(d) for d in database._VOCABULARIES})
+    old = database.vocabulary('matricola')
+    ids = old.encode(pd.Series(['1001', '1002', '1003', '1001']))
+    assert ids.tolist() == [0, 1, 2, 0]
+
+    db.save_table('Attivita', attivita_frame())
+    new = database.vocabulary('matricola')
+    assert new is not old and new.generation == old.generation + 1
+    # il vecchio dizionario resta coerente per chi lo tiene ancora
+    assert old.values(ids).tolist() == ['1001', '1002', '1003', '1001']
+    assert old.keys(['1003', '9999']).tolist() == [2, -1]
+
+    enc = db.get_encoded('Attivita')
+    assert database.decode_ids('matricola', enc['matricola_id']).tolist() == ['1001', '1001', '1002', '1002', '1003']
+    assert database._current_vocabulary('matricola') is new
+    # alla rotazione successiva gli id gia' calcolati non si decodificano col dizionario nuovo
+    new.encode(pd.Series(['1004']))
+    assert database.vocabulary('matricola').generation == new.generation + 1
+    with pytest.raises(ValueError):
+        database.decode_ids('matricola', enc['matricola_id'])
+    enc2 = db.get_encoded('Attivita')
+    assert database.decode_ids('matricola', enc2['matricola_id']).tolist() == ['1001', '1001', '1002', '1002', '1003']
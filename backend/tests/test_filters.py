@@ -0,0 +1,108 @@
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+ROWS = [
+    ['Rossi 1', '1001', 'UO_A', 'M78', '', '', '2024-01-01 00:00', 480.0, 8.0],
+    ['Rossi 1', '1001', 'UO_A', 'P38', '', '', '2024-01-31 10:00', 480.0, 8.0],
+    ['Bianchi 2', '1002', 'UO_B', 'N11', '', '', '2024-01-15 00:00', 480.0, 8.0],
+    ['Bianchi 2', '1002', 'UO_B', 'FER', '', '', '2024-02-01 00:00', 0.0, 0.0],
+    ['Verdi 3', '1003', 'UO_A', 'M61', '', '', '2023-12-31 23:00', 480.0, 8.0],
+]
+
+
+def _expected(full, columns=None, date_from=None, date_to=None, matricole=None):
+    m = pd.Series(True, index=full.index)
+    if date_from is not None:
+        m &= full['data'] >= pd.Timestamp(date_from)
+    if date_to is not None:
+        m &= full['data'] < pd.Timestamp(date_to) + pd.Timedelta(days=1)
+    if matricole is not None:
+        m &= full['matricola'].astype(str).str.strip().isin({str(x) for x in matricole})
+    out = full[m]
+    return out if columns is None else out[list(columns)]
+
+
+FILTERS = [
+    dict(date_from='2024-01-01', date_to='2024-01-31'),
+    dict(matricole=[1001]),
+    dict(matricole=['1002', '9999'], date_from='2024-01-10'),
+    dict(columns=['matricola', 'turno'], date_to='2023-12-31'),
+]
+
+
+@pytest.mark.parametrize('filtro', FILTERS)
+def test_get_all_filtrato_come_filtro_in_memoria(db, monkeypatch, filtro):
+    db.save_table('Attivita', attivita_frame(ROWS))
+    full = db.get_all('Attivita')
+    exp = _expected(full, **filtro)
+
+    sql = []
+    orig = db.storage.read_filtered
+    monkeypatch.setattr(db.storage, 'read_filtered', lambda *a, **k: sql.append(a) or orig(*a, **k))
+    database._TABLE_STORE.clear()
+    got = db.get_all('Attivita', **filtro)
+    # lettura SQL: categorie dei soli valori letti (stessi valori del filtro in memoria)
+    pd.testing.assert_frame_equal(got, exp, check_dtype=False, check_categorical=False)
+    if db.storage.name == 'sqlite' and 'matricole' not in filtro:
+        assert sql  # filtro eseguito in SQL
+
+    # tabella completa gia' in memoria (indice per persona / filtro in memoria)
+    db.get_all('Attivita')
+    pd.testing.assert_frame_equal(db.get_all('Attivita', **filtro), exp, check_dtype=False, check_categorical=False)
+
+
+def test_get_all_filtrato_con_journal(db):
+    db.save_table('Attivita', attivita_frame(ROWS))
+    db.update_record('Attivita', 2, {'turno': 'RPD', 'data': pd.Timestamp('2024-03-01')})
+    db.delete_record('Attivita', 0)
+    full = db.get_all('Attivita')
+    database._TABLE_STORE.clear()
+    got = db.get_all('Attivita', date_from='2024-01-01', date_to='2024-01-31')
+    # indici della tabella completa (validi per update_record/delete_record)
+    pd.testing.assert_frame_equal(got, _expected(full, date_from='2024-01-01', date_to='2024-01-31'),
+                                  check_dtype=False)
+    assert got['turno'].tolist() == ['P38']
+
+
+PART_ROWS = ROWS + [
+    ['Rossi 1', '1001', 'UO_A', 'M78', '', '', '2024-02-28 00:00', 480.0, 8.0],
+    ['Verdi 3', '1003', 'UO_A', 'N11', '', '', '2024-03-01 00:00', 480.0, 8.0],
+    ['Verdi 3', '1003', 'UO_A', 'FER', '', '', '2024-03-31 00:00', 0.0, 0.0],
+    ['Bianchi 2', '1002', 'UO_B', 'ESAU', '', '', None, 60.0, 1.0],
+    ['Rossi 1', '1001', 'UO_A', 'STR', '', '', None, 30.0, 0.5],
+]
+
+RANGES = [
+    dict(date_from='2024-01-15', date_to='2024-03-01'),   # a cavallo di tre mesi, estremi inclusi
+    dict(date_from='2024-02-01', date_to='2024-02-01'),   # un solo giorno (mese con due righe)
+    dict(date_from='2024-02-10'),                         # senza fine
+    dict(date_to='2024-01-31'),                           # senza inizio (anche dicembre 2023)
+    dict(date_from='2025-01-01', date_to='2025-12-31'),   # nessun mese
+]
+
+
+@pytest.mark.parametrize('periodo', RANGES)
+def test_get_all_dalle_partizioni_mensili_come_filtro(db, monkeypatch, periodo):
+    db.save_table('Attivita', attivita_frame(PART_ROWS))
+    full = db.get_all('Attivita')
+    token = db.table_token('Attivita')
+    # partizioni della versione (Excel le scrive alla prima lettura filtrata, SQLite filtra in SQL)
+    database._partition_store(db.excel_path, 'Attivita', token[1], full)
+    man = database._partition_manifest(database._partition_dir(db.excel_path, 'Attivita', token[1]))
+    assert {p['name'] for p in man['parts']} == {'2023-12', '2024-01', '2024-02', '2024-03', 'nodate'}
+
+    loaded = []
+    orig = database._partition_load
+    monkeypatch.setattr(database, '_partition_load', lambda *a, **k: loaded.append(orig(*a, **k)) or loaded[-1])
+    database._TABLE_STORE.clear()
+    got = db.get_all('Attivita', **periodo)
+    # letta dai soli file dei mesi, senza tabella completa in memoria
+    assert loaded and loaded[0] is not None
+    assert database._TABLE_STORE.peek(("all", str(db.excel_path), 'Attivita', token)) is None
+    # stesse righe (senza quelle prive di data), stessi indici della tabella completa
+    pd.testing.assert_frame_equal(got, _expected(full, **periodo), check_dtype=False, check_categorical=False)
+    assert got['data'].notna().all()
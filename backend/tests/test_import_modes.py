@@ -0,0 +1,366 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+def _xlsx(tmp_path, df, sheet='GT'):
+    src = tmp_path / f'{sheet}.xlsx'
+    df.to_excel(src, sheet_name=sheet, index=False)
+    return str(src)
+
+
+def test_append_regroup_lascia_le_righe_al_loro_posto(db, tmp_path):
+    db.save_table('Attivita', attivita_frame())
+    before = db.get_all('Attivita')
+    extra = attivita_frame([['Rossi 1', '1001', 'UO_A', 'ESAU', '', '', '2024-01-01', 60.0, 1.0],
+                            ['Verdi 3', '1003', 'UO_A', 'M78', '', '', '2024-02-11', 480.0, 8.0]])
+    ok, msg = db.import_excel(_xlsx(tmp_path, extra), {'GT': 'Attivita'}, mode='append')
+    assert ok, msg
+
+    df = db.get_all('Attivita').fillna({'turno': '', 'att': ''})
+    assert len(df) == 7
+    # righe esistenti nella stessa posizione, anche quella del giorno toccato (1001, 01/01)
+    assert [str(m) for m in df['matricola'][:5]] == [str(m) for m in before['matricola']]
+    assert df['turno'][:5].tolist() == before['turno'].tolist()
+    # righe nuove in fondo, nell'ordine del file; ESAU diventa secondaria del giorno di 1001
+    assert df.loc[5, 'turno'] == '' and df.loc[5, 'att'] == 'ESAU'
+    assert str(df.loc[6, 'matricola']) == '1003' and df.loc[6, 'turno'] == 'M78'
+
+
+def test_append_non_toglie_i_doppioni_gia_in_tabella(db, tmp_path):
+    stra = pd.DataFrame({'matricola': ['1001', '1001', '1002'], 'turno': 'STR', 'valore': [2.5, 2.5, 1.0],
+                         'data': pd.to_datetime(['2024-01-05', '2024-01-05', '2024-01-06'])})
+    db.save_table('Straordinario', stra)
+    arrivo = pd.DataFrame({'matricola': ['1002', '1003', '1003'], 'turno': 'STR', 'valore': [1.0, 3.0, 3.0],
+                           'data': pd.to_datetime(['2024-01-06', '2024-01-07', '2024-01-07'])})
+    ok, msg = db.import_excel(_xlsx(tmp_path, arrivo, 'STR'), {'STR': 'Straordinario'}, mode='append')
+    assert ok, msg
+    df = db.get_all('Straordinario')
+    # il doppione 1001 resta, 1002 gia' presente e il doppione in arrivo 1003 vengono scartati
+    assert [str(m) for m in df['matricola']] == ['1001', '1001', '1002', '1003']
+
+
+def test_append_senza_righe_nuove_non_scrive(db, tmp_path):
+    db.save_table('Attivita', attivita_frame())
+    token = db.table_token('Attivita')
+    ok, msg = db.import_excel(_xlsx(tmp_path, attivita_frame()), {'GT': 'Attivita'}, mode='append')
+    assert ok, msg
+    assert db.table_token('Attivita') == token
+
+
+def _stra(matricole, giorni, valori):
+    return pd.DataFrame({'matricola': matricole, 'turno': 'STR', 'valore': valori,
+                         'data': pd.to_datetime(giorni)})
+
+
+def test_upsert_scrive_solo_le_righe_toccate(db, tmp_path):
+    db.save_table('Straordinario', _stra(['1001', '1002', '1003'], ['2024-01-05', '2024-01-06', '2024-01-07'],
+                                         [2.5, 1.0, 3.0]))
+    sig = database._source_signature(db.storage_path)
+    arrivo = _stra(['1002', '1003', '1004'], ['2024-01-06', '2024-01-07', '2024-01-08'], [1.5, 3.0, 4.0])
+    ok, msg = db.import_excel(_xlsx(tmp_path, arrivo, 'STR'), {'STR': 'Straordinario'}, mode='upsert')
+    assert ok, msg
+    assert 'Straordinario: 1 inserite, 1 aggiornate, 1 invariate' in msg
+
+    # file dati intatto: update della riga 1 e add in fondo nel journal
+    assert database._source_signature(db.storage_path) == sig
+    assert db.journal_info()['entries'] == 2
+    df = db.get_all('Straordinario')
+    assert [str(m) for m in df['matricola']] == ['1001', '1002', '1003', '1004']
+    assert df['valore'].tolist() == [2.5, 1.5, 3.0, 4.0]
+    db.compact_journal()
+    assert db.get_all('Straordinario')['valore'].tolist() == [2.5, 1.5, 3.0, 4.0]
+
+
+def test_upsert_oltre_la_soglia_riscrive_la_tabella(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'JOURNAL_COMPACT_ENTRIES', 2)
+    db.save_table('Straordinario', _stra(['1001'], ['2024-01-05'], [2.5]))
+    arrivo = _stra(['1001', '1002', '1003'], ['2024-01-05', '2024-01-06', '2024-01-07'], [1.0, 1.0, 1.0])
+    ok, msg = db.import_excel(_xlsx(tmp_path, arrivo, 'STR'), {'STR': 'Straordinario'}, mode='upsert')
+    assert ok, msg
+    assert db.journal_info()['entries'] == 0
+    assert db.get_all('Straordinario')['valore'].tolist() == [1.0, 1.0, 1.0]
+
+
+def test_upsert_chiavi_ripetute(db, tmp_path):
+    # chiave doppia in tabella: si aggiorna la prima riga; chiave doppia nel file: vale l'ultima
+    db.save_table('Straordinario', _stra(['1001', '1001'], ['2024-01-05', '2024-01-05'], [2.5, 2.5]))
+    arrivo = _stra(['1001', '1001'], ['2024-01-05', '2024-01-05'], [1.0, 4.0])
+    ok, msg = db.import_excel(_xlsx(tmp_path, arrivo, 'STR'), {'STR': 'Straordinario'}, mode='upsert')
+    assert ok, msg
+    assert 'Straordinario: 0 inserite, 1 aggiornate, 0 invariate' in msg
+    assert db.get_all('Straordinario')['valore'].tolist() == [4.0, 2.5]
+
+
+def test_upsert_colonna_chiave_mancante_non_scrive_nulla(db, tmp_path):
+    db.save_table('Straordinario', _stra(['1001'], ['2024-01-05'], [2.5]))
+    db.save_table('Attivita', attivita_frame())
+    tokens = {t: db.table_token(t) for t in ('Straordinario', 'Attivita')}
+
+    src = tmp_path / 'pacchetto.xlsx'
+    with pd.ExcelWriter(src) as xw:
+        attivita_frame().assign(turno='RPD').to_excel(xw, sheet_name='GT', index=False)
+        _stra(['1001'], ['2024-01-05'], [1.0]).drop(columns='data').to_excel(xw, sheet_name='STR', index=False)
+    ok, msg = db.import_excel(str(src), {'GT': 'Attivita', 'STR': 'Straordinario'}, mode='upsert')
+    assert not ok and 'colonne chiave mancanti' in msg and 'data' in msg
+    # import tutto o niente: nemmeno il foglio GT (valido) viene scritto
+    assert {t: db.table_token(t) for t in tokens} == tokens
+    assert db.journal_info()['entries'] == 0
+
+
+def test_upsert_attivita_riordino_nel_journal(db, tmp_path):
+    # ESAU del 03/02 era l'unica riga del giorno (turno); arriva il turno P38: ESAU diventa secondaria
+    db.save_table('Attivita', attivita_frame([['Bianchi 2', '1002', 'UO_B', 'ESAU', '', '', '2024-02-03', 60.0, 1.0],
+                                              ['Verdi 3', '1003', 'UO_A', 'N11', '', '', '2024-02-10', 480.0, 8.0]]))
+    sig = database._source_signature(db.storage_path)
+    arrivo = attivita_frame([['Bianchi 2', '1002', 'UO_B', 'P38', '', '', '2024-02-03', 480.0, 8.0]])
+    ok, msg = db.import_excel(_xlsx(tmp_path, arrivo), {'GT': 'Attivita'}, mode='upsert')
+    assert ok, msg
+    assert database._source_signature(db.storage_path) == sig
+    assert db.journal_info()['entries'] == 2
+    df = db.get_all('Attivita').fillna({'turno': '', 'att': ''})
+    assert df[['turno', 'att']].values.tolist() == [['', 'ESAU'], ['N11', ''], ['P38', '']]
+
+
+def test_upsert_journal_annullato_se_la_scrittura_fallisce(db, tmp_path, monkeypatch):
+    db.save_table('Straordinario', _stra(['1001'], ['2024-01-05'], [2.5]))
+    src = tmp_path / 'pacchetto.xlsx'
+    with pd.ExcelWriter(src) as xw:
+        attivita_frame().to_excel(xw, sheet_name='GT', index=False)    # Attivita vuota: tabella intera
+        _stra(['1001'], ['2024-01-05'], [1.0]).to_excel(xw, sheet_name='STR', index=False)    # journal
+
+    def _guasto(*a, **k):
+        raise OSError('disco pieno')
+    monkeypatch.setattr(db.storage, 'write_tables', _guasto)
+    ok, msg = db.import_excel(str(src), {'GT': 'Attivita', 'STR': 'Straordinario'}, mode='upsert')
+    assert not ok and 'disco pieno' in msg
+    assert db.journal_info()['entries'] == 0
+    assert db.get_all('Straordinario')['valore'].tolist() == [2.5]
+
+
+def _gt_file(path, rows):
+    from openpyxl import Workbook
+    wb = Workbook()     # non write_only: come i file di Excel ha <dimension> (openpyxl non scorre il foglio all'apertura)
+    ws = wb.active
+    ws.title = 'GT'
+    ws.append(['nome', 'matricola', 'uo', 'turno', 'att', 'pox', 'data', 'minuti', 'valore'])
+    for i in range(rows):
+        ws.append([f'Persona {i % 300}', str(1000 + i % 300), f'UO_{i % 7}', ('M78', 'P38', 'ESAU')[i % 3], '',
+                   '', pd.Timestamp('2024-01-01') + pd.Timedelta(days=i // 300), 480.0, 8.0])
+    wb.save(path)
+    return str(path)
+
+
+def test_import_a_blocchi_come_foglio_intero(db, tmp_path):
+    src = _gt_file(tmp_path / 'gt.xlsx', 2000)
+    letti = []
+    ok, msg = db.import_excel(src, {'GT': 'Attivita'}, chunk_rows=300, parallel=False,
+                              progress=lambda foglio, fatte, totali: letti.append((foglio, fatte, totali)))
+    assert ok, msg
+    a_blocchi = db.get_all('Attivita')
+    # un avanzamento per blocco letto, fino all'ultima riga del foglio
+    assert len(letti) == 7 and letti[-1] == ('GT', 2001, 2001)
+    assert [f for _, f, _ in letti] == sorted(f for _, f, _ in letti)
+
+    ok, msg = db.import_excel(src, {'GT': 'Attivita'}, chunk_rows=100_000, parallel=False)
+    assert ok, msg
+    pd.testing.assert_frame_equal(a_blocchi, db.get_all('Attivita'))
+    assert len(a_blocchi) == 2000 and pd.api.types.is_datetime64_any_dtype(a_blocchi['data'])
+
+
+
+def _import_peak(db, src, chunk_rows):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        ok, msg = db.import_excel(src, {'GT': 'Attivita'}, chunk_rows=chunk_rows, parallel=False)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert ok, msg
+    return peak
+
+
+def test_import_a_blocchi_memoria_limitata_dal_blocco(db, tmp_path, monkeypatch):
+    # backup in background: legge il file dati in un altro thread (memoria non dell'import)
+    monkeypatch.setattr(db, '_queue_backup', lambda: None)
+    small, large = _gt_file(tmp_path / 'small.xlsx', 500), _gt_file(tmp_path / 'large.xlsx', 4000)
+    ok, msg = db.import_excel(small, {'GT': 'Attivita'}, chunk_rows=250, parallel=False)  # moduli e cache
+    assert ok, msg
+    peak_small = _import_peak(db, small, 250)
+    peak_large = _import_peak(db, large, 250)
+    assert len(db.get_all('Attivita')) == 4000
+    peak_sheet = _import_peak(db, large, 100_000)   # foglio intero in un blocco
+    # 8x le righe, stesso blocco: il picco cresce solo delle impronte (8 byte per riga, piu' le
+    # loro copie) e resta lontano da quello del foglio letto in un solo blocco
+    assert peak_large - peak_small < (peak_sheet - peak_small) / 5
+
+
+def test_append_a_blocchi_come_foglio_intero(db, tmp_path, monkeypatch):
+    scritte = []
+    orig = database.SQLiteStorage._write_rows
+
+    def spia(self, *a, **k):
+        scritte.append(orig(self, *a, **k))
+        return scritte[-1]
+    monkeypatch.setattr(database.SQLiteStorage, '_write_rows', spia)
+
+    db.save_table('Attivita', attivita_frame())
+    src = _gt_file(tmp_path / 'gt.xlsx', 900)
+    ok, msg = db.import_excel(src, {'GT': 'Attivita'}, mode='append', chunk_rows=200, parallel=False)
+    assert ok, msg
+    a_blocchi = db.get_all('Attivita')
+
+    db.save_table('Attivita', attivita_frame())
+    ok, msg = db.import_excel(src, {'GT': 'Attivita'}, mode='append', chunk_rows=100_000, parallel=False)
+    assert ok, msg
+    pd.testing.assert_frame_equal(a_blocchi, db.get_all('Attivita'))
+    # righe esistenti al loro posto, nuove in fondo
+    assert a_blocchi['matricola'].head(5).astype(str).tolist() == attivita_frame()['matricola'].tolist()
+    if isinstance(db.storage, database.SQLiteStorage):
+        # nel file dati solo le righe cambiate e quelle nuove, senza riscrivere la tabella
+        assert scritte == [True, True]
+
+
+# --- File delimitati (CSV/TSV) ---
+
+def _delimited(tmp_path, text, name='GT.csv', encoding='utf-8'):
+    src = tmp_path / name
+    src.write_bytes(text.encode(encoding))
+    return str(src)
+
+
+STR_CSV = {
+    ';': 'matricola;data;turno;valore\n1001;05/01/2024;STR;2,5\n1002;06/01/2024;STR;1\n',
+    ',': 'matricola,data,turno,valore\n1001,05/01/2024,STR,2.5\n1002,06/01/2024,STR,1\n',
+    '\t': 'matricola\tdata\tturno\tvalore\n1001\t05/01/2024\tSTR\t2.5\n1002\t06/01/2024\tSTR\t1\n',
+}
+
+
+@pytest.mark.parametrize('sep', list(STR_CSV), ids=['punto_e_virgola', 'virgola', 'tab'])
+def test_csv_separatore_riconosciuto(db, tmp_path, sep):
+    # anche il tab in un .csv: il separatore viene dal contenuto, non dall'estensione
+    ok, msg = db.import_csv(_delimited(tmp_path, STR_CSV[sep], 'STR.csv'), 'Straordinario')
+    assert ok, msg
+    df = db.get_all('Straordinario')
+    assert [str(m) for m in df['matricola']] == ['1001', '1002']
+    # virgola decimale con il ';', date gg/mm
+    assert df['valore'].tolist() == [2.5, 1.0]
+    assert df['data'].tolist() == [pd.Timestamp('2024-01-05'), pd.Timestamp('2024-01-06')]
+
+
+def test_tsv_dall_estensione(db, tmp_path):
+    ok, msg = db.import_csv(_delimited(tmp_path, STR_CSV['\t'], 'STR.tsv'), 'Straordinario')
+    assert ok, msg
+    assert db.get_all('Straordinario')['valore'].tolist() == [2.5, 1.0]
+
+
+@pytest.mark.parametrize('encoding', ['cp1252', 'utf-8-sig'])
+def test_csv_codifica_riconosciuta(db, tmp_path, encoding):
+    text = ('nome;matricola;uo;turno;att;pox;data;minuti;valore\n'
+            'Niccolò Città;1001;UO_A;M78;;;01/02/2024;480;8\n')
+    ok, msg = db.import_csv(_delimited(tmp_path, text, encoding=encoding), 'Attivita')
+    assert ok, msg
+    df = db.get_all('Attivita')
+    # BOM tolto dal nome della prima colonna, accentate lette come nel file
+    assert 'nome' in df.columns
+    assert df['nome'].tolist() == ['Niccolò Città']
+    assert df['data'].tolist() == [pd.Timestamp('2024-02-01')]
+
+
+def test_csv_file_caricato_come_percorso(db, tmp_path):
+    import io
+    text = STR_CSV[';']
+    ok, msg = db.import_csv(_delimited(tmp_path, text, 'STR.csv'), 'Straordinario')
+    assert ok, msg
+    da_percorso = db.get_all('Straordinario')
+
+    # file caricato (come UploadedFile di Streamlit): nome per estensione e foglio, puntatore gia' letto
+    up = io.BytesIO(text.encode('cp1252'))
+    up.name = 'STR.csv'
+    up.read()
+    ok, msg = db.import_csv(up, 'Straordinario')
+    assert ok, msg
+    pd.testing.assert_frame_equal(db.get_all('Straordinario'), da_percorso)
+
+    # import_excel con un CSV: un foglio con il nome del file
+    up.seek(0)
+    ok, msg = db.import_excel(up, {'STR': 'Straordinario'}, mode='append')
+    assert ok, msg
+    assert len(db.get_all('Straordinario')) == 2
+
+
+def test_csv_append_e_upsert(db, tmp_path):
+    db.save_table('Straordinario', _stra(['1001', '1002'], ['2024-01-05', '2024-01-06'], [2.5, 1.0]))
+    arrivo = ('matricola;data;turno;valore\n'
+              '1002;06/01/2024;STR;1\n1003;07/01/2024;STR;3\n1003;07/01/2024;STR;3\n1004;08/01/2024;STR;4\n')
+    # blocchi di 2 righe: doppioni e righe gia' presenti riconosciuti anche tra blocchi diversi
+    ok, msg = db.import_csv(_delimited(tmp_path, arrivo, 'STR.csv'), 'Straordinario', mode='append', chunk_rows=2)
+    assert ok, msg
+    df = db.get_all('Straordinario')
+    assert [str(m) for m in df['matricola']] == ['1001', '1002', '1003', '1004']
+
+    agg = 'matricola;data;turno;valore\n1001;05/01/2024;STR;0,5\n1005;09/01/2024;STR;2\n'
+    ok, msg = db.import_csv(_delimited(tmp_path, agg, 'STR.csv'), 'Straordinario', mode='upsert')
+    assert ok, msg
+    assert 'Straordinario: 1 inserite, 1 aggiornate, 0 invariate' in msg
+    df = db.get_all('Straordinario')
+    assert [str(m) for m in df['matricola']] == ['1001', '1002', '1003', '1004', '1005']
+    assert df['valore'].tolist() == [0.5, 1.0, 3.0, 4.0, 2.0]
+
+
+def test_csv_attivita_senza_intestazioni(db, tmp_path):
+    # export GT senza riga di intestazione (matricola alfanumerica): colonne riconosciute sul primo
+    # blocco e riusate per gli altri, minuti -> ore
+    text = ('Rossi Mario;A1001;UO_A;M78;;01/02/2024;480;P1\n'
+            'Bianchi Anna;A1002;UO_B;P38;FORM;02/02/2024;450;\n'
+            'Verdi Luca;A1003;UO_A;N11;;03/02/2024;600;\n')
+    ok, msg = db.import_csv(_delimited(tmp_path, text), 'Attivita', chunk_rows=2)
+    assert ok, msg
+    df = db.get_all('Attivita').fillna({'att': '', 'pox': ''})
+    assert df['matricola'].tolist() == ['A1001', 'A1002', 'A1003']
+    assert df['nome'].tolist() == ['Rossi Mario', 'Bianchi Anna', 'Verdi Luca']
+    assert df['turno'].tolist() == ['M78', 'P38', 'N11']
+    assert df['data'].tolist() == [pd.Timestamp('2024-02-01'), pd.Timestamp('2024-02-02'),
+                                   pd.Timestamp('2024-02-03')]
+    assert df['minuti'].tolist() == [480.0, 450.0, 600.0]
+    assert df['valore'].tolist() == [8.0, 7.5, 10.0]
+
+
+def test_xlsx_attivita_senza_intestazioni_date_di_testo(db, tmp_path):
+    # foglio Excel senza intestazioni, date come testo in formati liberi e colonna data non al suo posto:
+    # la data e' riconosciuta anche fuori dai formati fissi dei CSV
+    righe = pd.DataFrame([['2024/03/01', 'Rossi Mario', 'A1001', 'UO_A', 'M78', '', 480, 'P1'],
+                          ['2 mar 2024', 'Bianchi Anna', 'A1002', 'UO_B', 'P38', 'FORM', 450, ''],
+                          ['03/03/2024', 'Verdi Luca', 'A1003', 'UO_A', 'N11', '', 600, '']])
+    src = tmp_path / 'GT.xlsx'
+    righe.to_excel(src, sheet_name='GT', index=False, header=False)
+    ok, msg = db.import_excel(str(src), {'GT': 'Attivita'})
+    assert ok, msg
+    df = db.get_all('Attivita')
+    assert df['matricola'].tolist() == ['A1001', 'A1002', 'A1003']
+    assert df['data'].tolist() == [pd.Timestamp('2024-03-01'), pd.Timestamp('2024-03-02'),
+                                   pd.Timestamp('2024-03-03')]
+    assert df['valore'].tolist() == [8.0, 7.5, 10.0]
+
+
+def test_csv_grande_letto_a_blocchi_senza_avvisi(db, tmp_path):
+    import warnings
+    # oltre il campione iniziale (codifica e separatore): righe lette a blocchi dal file
+    righe = [f'Persona {i};{1000 + i % 300};UO_A;M78;;{1 + i % 28:02d}/02/2024;480;' for i in range(3000)]
+    src = _delimited(tmp_path, '\n'.join(righe) + '\n')
+    assert Path(src).stat().st_size > database.DELIMITED_SAMPLE_BYTES
+    letti = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', UserWarning)     # niente "Could not infer format" sulle colonne di testo
+        ok, msg = db.import_csv(src, 'Attivita', chunk_rows=500,
+                                progress=lambda foglio, fatte, totali: letti.append((fatte, totali)))
+    assert ok, msg
+    assert len(letti) == 6 and letti[-1] == (3000, 3000)
+    assert all(fatte < totali for fatte, totali in letti[:-1])
+    df = db.get_all('Attivita')
+    assert len(df) == 3000 and df['data'].max() == pd.Timestamp('2024-02-28')
@@ -0,0 +1,30 @@
+import multiprocessing
+
+import pandas as pd
+
+import database
+from conftest import attivita_frame
+
+
+def test_pool_chiuso_dopo_import(db, tmp_path, monkeypatch):
+    letti = []
+    orig = database._import_sheets_parallel
+
+    def spia(*a, **k):
+        out = orig(*a, **k)
+        letti.append(sorted(out or ()))
+        return out
+    monkeypatch.setattr(database, '_import_sheets_parallel', spia)
+
+    src = tmp_path / 'pacchetto.xlsx'
+    stra = pd.DataFrame({'matricola': ['1001'], 'data': [pd.Timestamp('2024-01-05')], 'turno': ['STR'], 'valore': [2.5]})
+    with pd.ExcelWriter(src) as xw:
+        attivita_frame().to_excel(xw, sheet_name='GT', index=False)
+        stra.to_excel(xw, sheet_name='STR', index=False)
+
+    ok, msg = db.import_excel(str(src), {'GT': 'Attivita', 'STR': 'Straordinario'}, parallel=True)
+    assert ok, msg
+    assert letti == [['GT', 'STR']]     # fogli letti davvero nei processi
+    assert len(db.get_all('Attivita')) == 5 and len(db.get_all('Straordinario')) == 1
+    # pool limitato all'import: nessun processo figlio resta attivo
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,148 @@
+import json
+
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+def test_operazione_non_applicabile_non_entra_nel_journal(db):
+    db.save_table('Attivita', attivita_frame())
+    with pytest.raises(KeyError):
+        db.delete_record('Attivita', 99)
+    with pytest.raises(KeyError):
+        db.update_record('Attivita', 99, {'turno': 'M61'})
+    assert db.journal_info()['entries'] == 0
+
+
+def test_replay_journal(db):
+    db.save_table('Attivita', attivita_frame())
+    db.update_record('Attivita', 1, {'turno': 'RPD', 'minuti': 90.0})
+    db.delete_record('Attivita', 0)
+    db.add_record('Attivita', {'matricola': '1004', 'turno': 'M61', 'data': pd.Timestamp('2024-03-01'), 'minuti': 480.0})
+    assert db.journal_info()['entries'] == 3
+
+    def _check(df):
+        assert len(df) == 5
+        assert df.loc[0, 'turno'] == 'RPD' and df.loc[0, 'minuti'] == 90.0
+        assert str(df.loc[4, 'matricola']) == '1004' and df.loc[4, 'data'] == pd.Timestamp('2024-03-01')
+
+    _check(db.get_all('Attivita'))
+    # un'altra istanza (altra sessione/processo) rilegge base + journal
+    database._TABLE_STORE.clear()
+    other = database.PersGestDatabase(db.excel_path, backend=db.storage.name)
+    _check(other.get_all('Attivita'))
+    assert db.compact_journal() == 3
+    assert db.journal_info()['entries'] == 0
+    _check(db.get_all('Attivita'))
+
+
+
+def test_journal_applica_solo_le_voci_nuove(db, monkeypatch):
+    db.save_table('Attivita', attivita_frame())
+    db.get_all('Attivita')
+    applicate = []
+    orig = database._journal_apply
+
+    def spia(df, entries, *a, **k):
+        applicate.append(len(entries))
+        return orig(df, entries, *a, **k)
+    monkeypatch.setattr(database, '_journal_apply', spia)
+
+    for i in range(3):
+        db.add_record('Attivita', {'matricola': f'10{i + 5}', 'turno': 'M78', 'data': pd.Timestamp('2024-03-01'),
+                                   'minuti': 480.0})
+        db.get_all('Attivita')
+    db.update_record('Attivita', 6, {'turno': 'NUOVO'})
+    db.delete_record('Attivita', 0)
+    got = db.get_all('Attivita')
+    # ogni lettura parte dalla versione precedente in memoria: una voce alla volta
+    assert [n for n in applicate if n] == [1, 1, 1, 1, 1]
+
+    # stesso risultato della rilettura completa (tabella base + tutte le voci)
+    database._TABLE_STORE.clear()
+    other = database.PersGestDatabase(db.excel_path, backend=db.storage.name)
+    pd.testing.assert_frame_equal(got, other.get_all('Attivita'))
+    assert got['turno'].tolist()[-3:] == ['M78', 'NUOVO', 'M78']
+
+
+def test_voce_non_applicabile_segnalata_e_conservata(db):
+    db.save_table('Attivita', attivita_frame())
+    db.update_record('Attivita', 2, {'turno': 'M61'})
+    # voce non valida scritta da fuori (es. altra versione dell'app)
+    with open(database._journal_path_for(db.excel_path), 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'ts': 1.0, 'table': 'Attivita', 'op': 'delete', 'index': 42, 'record': {}}) + '\n')
+
+    df = db.get_all('Attivita')
+    assert len(df) == 5 and df.loc[2, 'turno'] == 'M61'
+    info = db.journal_info()
+    assert [(f['op'], f['index']) for f in info['failed']] == [('delete', 42)]
+
+    assert db.compact_journal() == 2
+    info = db.journal_info()
+    assert info['entries'] == 0 and info['rejected'] == 1
+    rejected = [json.loads(line) for line in open(info['rejected_path'], encoding='utf-8')]
+    assert rejected[0]['index'] == 42 and 'KeyError' in rejected[0]['error']
+    assert db.get_all('Attivita').loc[2, 'turno'] == 'M61'
+
+
+class _Crash(Exception):
+    pass
+
+
+def _crash(*args, **kwargs):
+    raise _Crash()
+
+
+def _reopen(db):
+    database._TABLE_STORE.clear()
+    return database.PersGestDatabase(db.excel_path, backend=db.storage.name)
+
+
+@pytest.mark.parametrize('step', ['save_table', 'compact_journal'])
+def test_interruzione_dopo_scrittura_tabelle_non_riapplica_il_journal(db, monkeypatch, step):
+    db.save_table('Attivita', attivita_frame())
+    db.delete_record('Attivita', 0)
+    db.update_record('Attivita', 1, {'turno': 'M61'})
+    db.add_record('Attivita', {'matricola': '1004', 'turno': 'N11', 'data': pd.Timestamp('2024-03-01')})
+    expected = db.get_all('Attivita')
+    assert len(expected) == 5 and expected.loc[1, 'turno'] == 'M61'
+
+    # processo interrotto tra la scrittura del file dati e la pulizia del journal
+    if step == 'save_table':
+        monkeypatch.setattr(db, '_journal_discard', _crash)
+        with pytest.raises(_Crash):
+            db.save_table('Attivita', expected)
+    else:
+        monkeypatch.setattr(database, '_journal_reject', _crash)
+        with pytest.raises(_Crash):
+            db.compact_journal()
+    monkeypatch.undo()
+    assert db.journal_info()['entries'] == 3
+
+    other = _reopen(db)
+    df = other.get_all('Attivita')
+    assert len(df) == 5
+    assert list(df['turno']) == list(expected['turno'])
+    # la scrittura successiva toglie le voci gia' nel file dati
+    other.update_record('Attivita', 4, {'turno': 'M78'})
+    assert other.compact_journal() == 1
+    df = _reopen(db).get_all('Attivita')
+    assert list(df['turno']) == list(expected['turno'][:4]) + ['M78']
+
+
+def test_interruzione_prima_della_scrittura_conserva_il_journal(db, monkeypatch):
+    db.save_table('Attivita', attivita_frame())
+    db.delete_record('Attivita', 0)
+    db.add_record('Attivita', {'matricola': '1004', 'turno': 'N11', 'data': pd.Timestamp('2024-03-01')})
+    expected = list(db.get_all('Attivita')['turno'])
+
+    monkeypatch.setattr(db.storage, 'write_tables', _crash)
+    with pytest.raises(_Crash):
+        db.compact_journal()
+    monkeypatch.undo()
+
+    assert list(_reopen(db).get_all('Attivita')['turno']) == expected
+    assert db.compact_journal() == 2
+    assert list(_reopen(db).get_all('Attivita')['turno']) == expected
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+import pytest
+
+import database
+from database import _PathLock, _file_lock_try, _file_unlock
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="flock: lock per descrittore (Linux/macOS)")
+
+
+def _external(path):
+    """Descrittore separato sullo stesso file: per flock vale come un altro processo."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return open(path, "a+b")
+
+
+def test_timeout_scatta_mentre_un_altro_thread_aspetta_il_file(tmp_path):
+    lk = _PathLock(tmp_path / "db.xlsx.lock")
+    ext = _external(lk.lock_file)
+    assert _file_lock_try(ext, True)
+    writer_err = []
+
+    def writer():
+        try:
+            lk.acquire(True, 1.0)
+        except TimeoutError as e:
+            writer_err.append(e)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    time.sleep(0.1)
+    t0 = time.time()
+    with pytest.raises(TimeoutError):
+        lk.acquire(False, 0.2)
+    # prima l'attesa sul file teneva la condition: il lettore restava bloccato fino a 1s
+    assert time.time() - t0 < 0.6
+    t.join()
+    assert writer_err
+    _file_unlock(ext)
+    time.sleep(0.1)     # l'attesa abbandonata dello scrittore prende e rilascia subito il file
+    assert lk.acquire(False, 1.0) == (False, False)
+    lk.release(False)
+
+
+def test_scrittore_esterno_in_attesa_blocca_nuovi_lettori(tmp_path):
+    lk = _PathLock(tmp_path / "db.xlsx.lock")
+    lk.acquire(False, 1.0)                      # lettore attivo: lock condiviso sul file
+    pending = _external(lk.pending_file)
+    main = _external(lk.lock_file)
+    assert _file_lock_try(pending, True)        # scrittore esterno annuncia l'attesa
+    assert not _file_lock_try(main, True)
+
+    got = []
+    t = threading.Thread(target=lambda: got.append(lk.acquire(False, 2.0)) or lk.release(False))
+    t.start()
+    time.sleep(0.2)
+    assert not got                              # il nuovo lettore non si aggiunge al lock condiviso
+    lk.release(False)                           # i lettori escono: il file si libera
+    assert _file_lock_try(main, True)           # lo scrittore esterno entra
+    _file_unlock(pending)
+    _file_unlock(main)
+    t.join(2.0)
+    assert got and got[0][0]                    # il lettore e' entrato dopo, con contesa
+
+
+def test_metriche_per_site(tmp_path):
+    db = tmp_path / "db.xlsx"
+    with database._persgest_read_lock(db, site="test_site"):
+        pass
+    rows = [m for m in database.lock_metrics() if m["site"] == "test_site"]
+    assert rows and rows[0]["mode"] == "sh" and rows[0]["count"] == 1
+
+
+def test_attesa_del_file_bloccante_senza_polling(tmp_path, monkeypatch):
+    lk = _PathLock(tmp_path / "db.xlsx.lock")
+    ext = _external(lk.lock_file)
+    assert _file_lock_try(ext, True)
+    tries = []
+    monkeypatch.setattr(database, "_file_lock_try", lambda fh, ex: tries.append(fh) or _file_lock_try(fh, ex))
+
+    got = []
+    t = threading.Thread(target=lambda: got.append((lk.acquire(True, 5.0), time.time())))
+    t.start()
+    time.sleep(0.5)
+    assert not got
+    released = time.time()
+    _file_unlock(ext)
+    t.join(2.0)
+    assert got and got[0][0] == (True, False)
+    assert got[0][1] - released < 0.1          # risveglio dal sistema operativo, non al giro di polling
+    assert len(tries) == 2                     # un tentativo su -pending e uno sul file, poi attesa
+    lk.release(True)
+    assert _file_lock_try(ext, True)           # rilasciato anche l'handle dell'attesa
+    _file_unlock(ext)
+
+
+def test_attesa_scaduta_non_trattiene_il_file(tmp_path):
+    lk = _PathLock(tmp_path / "db.xlsx.lock")
+    ext = _external(lk.lock_file)
+    assert _file_lock_try(ext, False)          # lettore esterno
+    with pytest.raises(TimeoutError):
+        lk.acquire(True, 0.2)
+    _file_unlock(ext)
+    time.sleep(0.1)
+    # il thread dell'attesa scaduta ha preso il lock e lo ha subito rilasciato
+    assert _file_lock_try(ext, True)
+    _file_unlock(ext)
+    assert lk.acquire(True, 1.0) == (False, False)
+    lk.release(True)
@@ -0,0 +1,55 @@
+import warnings
+
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+from database import text_column
+
+CODE_COLUMNS = ['matricola', 'uo', 'turno', 'att', 'pox']
+
+
+def test_get_all_tipizzato_di_default(db):
+    db.save_table('Attivita', attivita_frame())
+    df = db.get_all('Attivita')
+    assert all(isinstance(df[c].dtype, pd.CategoricalDtype) for c in CODE_COLUMNS)
+    assert df['minuti'].dtype == 'float64' and df['valore'].dtype == 'float64'
+    der = db.get_all('Attivita', derived=True, date_from='2024-01-01', date_to='2024-01-31')
+    assert isinstance(der['turno'].dtype, pd.CategoricalDtype) and der['_mins'].dtype == 'float64'
+    assert isinstance(db.get_many(['Attivita'])['Attivita']['turno'].dtype, pd.CategoricalDtype)
+
+    plain = db.get_all('Attivita', typed=False)
+    assert not any(isinstance(t, pd.CategoricalDtype) for t in plain.dtypes)
+    assert not any(isinstance(t, pd.CategoricalDtype) for t in db.get_many(['Attivita'], typed=False)['Attivita'].dtypes)
+    pd.testing.assert_frame_equal(df.astype({c: object for c in CODE_COLUMNS}), plain)
+
+
+def test_minuti_sommati_senza_perdita(db):
+    # 2^24 + 1 non e' rappresentabile in float32; 7.35 diventerebbe 7.3499999
+    minuti = [16777217.0, 7.35, 480.0, 0.1, 90.0]
+    db.save_table('Attivita', attivita_frame().assign(minuti=minuti))
+    database._TABLE_STORE.clear()
+    df = db.get_all('Attivita', derived=True)
+    assert df['minuti'].tolist() == minuti
+    assert df['minuti'].sum() == sum(minuti)
+    assert df['_mins'].sum() == sum(minuti)
+
+
+def test_pagine_testo_e_assegnazioni(db):
+    db.save_table('Attivita', attivita_frame())
+    # una categoria non piu' usata dopo la modifica non deve comparire come gruppo vuoto
+    db.save_table('Attivita', attivita_frame()[lambda d: d['turno'] != 'N11'])
+    df = db.get_all('Attivita', derived=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        # come nelle pagine: codici passati da text_column prima di raggruppare
+        counts = df.groupby([text_column(df['uo']), text_column(df['_turno_up'])]).size()
+    assert (counts > 0).all() and 'N11' not in set(counts.index.get_level_values(1))
+
+    with pytest.raises((TypeError, ValueError)):
+        df.loc[df['turno'] == 'FER', 'turno'] = 'NUOVO'    # codice nuovo su una categoria
+    plain = db.get_all('Attivita', typed=False)           # Editor Dati
+    plain.loc[plain['turno'] == 'FER', 'turno'] = 'NUOVO'
+    assert (plain['turno'] == 'NUOVO').sum() == 1
+    assert (db.get_all('Attivita')['turno'] == 'FER').sum() == 1
@@ -0,0 +1,197 @@
+import pandas as pd
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+def _frame(tag):
+    return pd.DataFrame({'matricola': ['1001', '1002'], 'turno': [tag, tag]})
+
+
+def test_sqlite_write_tables_tutto_o_niente(tmp_path, monkeypatch):
+    storage = database.SQLiteStorage(tmp_path / 'persgest_master.xlsx')
+    storage.create({'A': _frame('M78'), 'B': _frame('P38')}, ['A', 'B'])
+
+    orig = database.SQLiteStorage._write
+
+    def _write(self, conn, table, df):
+        orig(self, conn, table, df)
+        if table == 'B':
+            raise RuntimeError('disco pieno')
+    monkeypatch.setattr(database.SQLiteStorage, '_write', _write)
+
+    with pytest.raises(RuntimeError):
+        storage.write_tables({'A': _frame('N11'), 'B': _frame('N11')}, ['A', 'B'])
+    # DROP/CREATE di A annullati insieme al resto
+    assert storage.read_table('A')['turno'].tolist() == ['M78', 'M78']
+    assert storage.read_table('B')['turno'].tolist() == ['P38', 'P38']
+
+
+def test_sqlite_colonne_che_differiscono_per_maiuscole(tmp_path):
+    storage = database.SQLiteStorage(tmp_path / 'persgest_master.xlsx')
+    df = pd.DataFrame([['UO_A', 'uo_a', 1]], columns=['UO', 'uo', 'n'])
+    storage.write_tables({'T': df}, ['T'])
+    back = storage.read_table('T')
+    assert back.columns.tolist() == ['UO', 'uo_1', 'n']
+    assert back.iloc[0].tolist() == ['UO_A', 'uo_a', 1]
+
+
+def test_round_trip_e_migrazione_da_excel(db, tmp_path):
+    pers = pd.DataFrame({'CAT': ['CTA', 'OPS'], 'matricola': ['1001', '1002'], 'nome': ['Rossi', 'Bianchi'],
+                         'UO': ['UO_A', 'UO_B'], 'In_Forza': ['SI', 'NO']})
+    db.save_table('Personale', pers)
+    db.save_table('Attivita', attivita_frame())
+
+    def _check(other):
+        back = other.get_all('Attivita')
+        exp = attivita_frame()
+        assert back.columns.tolist() == exp.columns.tolist()
+        assert [str(m) for m in back['matricola']] == exp['matricola'].tolist()
+        assert back['turno'].tolist() == exp['turno'].tolist()
+        assert back['data'].tolist() == exp['data'].tolist()
+        assert back['minuti'].astype(float).tolist() == exp['minuti'].tolist()
+        p = other.get_all('Personale')
+        assert p['nome'].tolist() == ['Rossi', 'Bianchi'] and p['In_Forza'].tolist() == ['SI', 'NO']
+
+    _check(db)
+    # rilettura da un'altra istanza (senza cache in memoria)
+    database._TABLE_STORE.clear()
+    _check(database.PersGestDatabase(db.excel_path, backend=db.storage.name))
+    if db.storage.name == 'excel':
+        # primo avvio con SQLite accanto all'xlsx: stesso contenuto
+        migrated = database.PersGestDatabase(db.excel_path, backend='sqlite')
+        assert migrated.storage_path.suffix == '.sqlite'
+        _check(migrated)
+
+
+def test_colonne_rinominate_uguali_per_ogni_motore(db, caplog):
+    df = pd.DataFrame([['UO_A', 'uo_a', 1]], columns=['UO', ' uo ', 'n'])
+    with caplog.at_level('WARNING', logger='database'):
+        db.save_table('Note', df)
+    assert "colonne rinominate" in caplog.text and "'uo_1'" in caplog.text
+    database._TABLE_STORE.clear()
+    back = db.get_all('Note')
+    assert back.columns.tolist() == ['UO', 'uo_1', 'n']
+    assert back.iloc[0].tolist() == ['UO_A', 'uo_a', 1]
+
+
+# --- Sostituzione fogli a livello zip (ExcelStorage.write_tables) ---
+
+def _xlsx(tmp_path, name='persgest_master.xlsx'):
+    storage = database.ExcelStorage(tmp_path / name)
+    storage.create({'A': _frame('M78'), 'B': _frame('P38')}, ['A', 'B'])
+    return storage
+
+
+def _valori():
+    return pd.DataFrame({
+        'testo': ['<a & b>', '"x" \'y\'', ' spazi ', 'àèì €', None, '007'],
+        'ctrl': ['a\x01b', 'c\x0bd', 'ok', 'e\x1ff', 'tab\tx', 'riga\nnuova'],
+        'data': pd.to_datetime(['2024-01-01 08:30:00', None, '1999-12-31 00:00:00', '2024-02-29 23:59:59',
+                                '2024-03-01 00:00:00', '1900-03-01 00:00:00']),
+        'intero': [1, 2, 3, 4, 5, 6],
+        'decimale': [1.5, float('nan'), -0.1, 1e-7, 123456789.25, 0.0],
+        'flag': [True, False, True, False, True, False],
+        'misto': [1, 'a', None, 2.5, True, pd.Timestamp('2024-01-05')],
+    })
+
+
+def _spy_zip(monkeypatch):
+    calls = []
+    orig = database._xlsx_replace_sheets
+
+    def spia(src, dst, data):
+        try:
+            out = orig(src, dst, data)
+        except database._ZipFastPathUnsupported as e:
+            calls.append(('fallback', str(e)))
+            raise
+        calls.append(('zip', sorted(data)))
+        return out
+    monkeypatch.setattr(database, '_xlsx_replace_sheets', spia)
+    return calls
+
+
+def test_xlsx_zip_valori_come_openpyxl(tmp_path, monkeypatch):
+    from openpyxl import load_workbook
+    calls = _spy_zip(monkeypatch)
+    fast = _xlsx(tmp_path)
+    fast.write_tables({'A': _valori()}, ['A', 'B'])
+    assert calls == [('zip', ['A'])]
+
+    # stesso contenuto salvato con openpyxl (i caratteri di controllo openpyxl li rifiuta: tolti prima)
+    slow = _xlsx(tmp_path, 'openpyxl.xlsx')
+    monkeypatch.setattr(database.ExcelStorage, '_write_tables_zip', lambda self, data: False)
+    ref = _valori()
+    ref['ctrl'] = ref['ctrl'].str.replace(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', regex=True)
+    slow.write_tables({'A': ref}, ['A', 'B'])
+
+    pd.testing.assert_frame_equal(fast.read_table('A'), slow.read_table('A'))
+    assert fast.read_table('A')['ctrl'].tolist() == ['ab', 'cd', 'ok', 'ef', 'tab\tx', 'riga\nnuova']
+
+    wf, ws = load_workbook(fast.path)['A'], load_workbook(slow.path)['A']
+    assert [[c.value for c in r] for r in wf.iter_rows()] == [[c.value for c in r] for r in ws.iter_rows()]
+    date_col = [c.value for c in wf[1]].index('data')
+    for row in wf.iter_rows(min_row=2):
+        cell = row[date_col]
+        assert cell.value is None or (cell.is_date and cell.number_format == 'yyyy-mm-dd h:mm:ss')
+    assert wf.cell(row=2, column=[c.value for c in wf[1]].index('flag') + 1).value is True
+    assert wf.cell(row=3, column=[c.value for c in wf[1]].index('decimale') + 1).value is None
+
+
+def test_xlsx_zip_fogli_non_toccati_identici(tmp_path):
+    import zipfile
+    storage = _xlsx(tmp_path)
+    storage.write_tables({'A': _valori()}, ['A', 'B'])      # aggiunge lo stile data
+    with zipfile.ZipFile(storage.path) as zf:
+        before = {zi.filename: (zi.CRC, zi.compress_size, zf.read(zi)) for zi in zf.infolist()}
+
+    storage.write_tables({'A': _frame('N11')}, ['A', 'B'])
+    with zipfile.ZipFile(storage.path) as zf:
+        after = {zi.filename: (zi.CRC, zi.compress_size, zf.read(zi)) for zi in zf.infolist()}
+        assert zf.testzip() is None
+    assert set(after) == set(before)
+    changed = {n for n in after if after[n] != before[n]}
+    assert changed == {'xl/worksheets/sheet1.xml'}
+    assert storage.read_table('B')['turno'].tolist() == ['P38', 'P38']
+    assert storage.read_table('A')['turno'].tolist() == ['N11', 'N11']
+
+
+def _add_members(path, members):
+    import shutil
+    import zipfile
+    tmp = path.with_name('tmp_' + path.name)
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for zi in src.infolist():
+            dst.writestr(zi, src.read(zi))
+        for name, data in members.items():
+            dst.writestr(name, data)
+    shutil.move(tmp, path)
+
+
+@pytest.mark.parametrize('caso, motivo', [('calcChain', 'calcChain'), ('relazioni', 'foglio A con relazioni'),
+                                           ('zip64', 'zip64'), ('foglio nuovo', 'foglio C assente')])
+def test_xlsx_zip_ripiega_su_openpyxl(tmp_path, monkeypatch, caso, motivo):
+    from openpyxl import load_workbook
+    storage = _xlsx(tmp_path)
+    if caso == 'calcChain':
+        _add_members(storage.path, {'xl/calcChain.xml': '<calcChain xmlns="http://schemas.openxmlformats.org/'
+                                                        'spreadsheetml/2006/main"/>'})
+    elif caso == 'relazioni':
+        _add_members(storage.path, {'xl/worksheets/_rels/sheet1.xml.rels':
+                                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+                                    'relationships"/>'})
+    elif caso == 'zip64':
+        _add_members(storage.path, {f'customXml/item{i}.bin': b'' for i in range(0xFFFF)})
+    calls = _spy_zip(monkeypatch)
+
+    table = 'C' if caso == 'foglio nuovo' else 'A'
+    order = ['A', 'B', 'C'] if table == 'C' else ['A', 'B']
+    storage.write_tables({table: _valori()}, order)
+    assert calls == [('fallback', motivo)]
+    assert load_workbook(storage.path, read_only=True).sheetnames == order
+    back = storage.read_table(table)
+    assert back['testo'].tolist()[:4] == ['<a & b>', '"x" \'y\'', ' spazi ', 'àèì €']
+    assert back['data'].tolist()[0] == pd.Timestamp('2024-01-01 08:30')
+    assert storage.read_table('B')['turno'].tolist() == ['P38', 'P38']
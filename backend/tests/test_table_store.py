@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+import database
+from conftest import attivita_frame
+from database import _TableStore
+
+
+def _store_with(df):
+    store = _TableStore(1 << 30)
+    store.put(("all", "db.xlsx", "Attivita", ("tok", 1)), df)
+    return lambda: store.peek(("all", "db.xlsx", "Attivita", ("tok", 1)))
+
+
+def _frame():
+    return pd.DataFrame({'turno': pd.Series(['M78', 'FER', None], dtype=object),
+                         'minuti': [480.0, 0.0, 60.0],
+                         'uo': pd.Categorical(['A', 'B', 'A'])})
+
+
+def _buffer(s):
+    return s.array.codes if isinstance(s.dtype, pd.CategoricalDtype) else s.to_numpy()
+
+
+def test_letture_senza_copie(db):
+    get = _store_with(_frame())
+    a, b = get(), get()
+    for col in a.columns:
+        assert np.shares_memory(_buffer(a[col]), _buffer(b[col])), col
+
+    # get_all: le colonne della tabella non vengono copiate a ogni lettura (anche con le derivate)
+    db.save_table('Attivita', attivita_frame())
+    x, y = db.get_all('Attivita', derived=True), db.get_all('Attivita', derived=True)
+    for col in ['matricola', 'turno', 'data', 'minuti', 'valore']:
+        assert np.shares_memory(_buffer(x[col]), _buffer(y[col])), col
+
+
+def test_letture_non_modificano_la_voce_condivisa():
+    get = _store_with(_frame())
+    df = get()
+    assert (df['turno'] == 'FER').sum() == 1          # confronto su testo anche in sola lettura
+    # testo su pandas < 2.2: scrivibile e condiviso (vedi test_testo_in_sola_lettura_o_segnalato)
+    cols = [('minuti', 1.0), ('uo', 'B')] + ([('turno', 'X')] if database._READONLY_OBJECT_OK else [])
+    for col, val in cols:
+        try:
+            df.loc[0, col] = val                      # pandas 3: copy-on-write
+        except ValueError as e:                       # pandas 2.x: array condiviso in sola lettura
+            assert 'read-only' in str(e)
+    df['minuti'] = df['minuti'] * 2                   # riassegnazione: sempre ammessa
+
+    mine = get().copy()                               # chi modifica sul posto copia prima
+    mine.loc[mine['turno'] == 'FER', 'turno'] = 'X'
+    mine.loc[0, 'minuti'] = 1.0
+
+    fresh = get()
+    assert fresh['turno'].tolist() == ['M78', 'FER', None]
+    assert fresh['minuti'].tolist() == [480.0, 0.0, 60.0]
+    assert fresh['uo'].tolist() == ['A', 'B', 'A']
+
+
+def test_testo_in_sola_lettura_o_segnalato(caplog):
+    database._READONLY_WARNED.clear()
+    shared = _frame()
+    with caplog.at_level('WARNING', logger='database'):
+        get = _store_with(shared)
+    df = get()
+    assert (df['turno'] == 'M78').sum() == 1
+    if database._READONLY_OBJECT_OK:
+        assert not df['turno'].to_numpy().flags.writeable
+    else:
+        # pandas < 2.2: il testo resta scrivibile (senza copie per sessione) e il log lo dice
+        assert np.shares_memory(df['turno'].to_numpy(), shared['turno'].to_numpy())
+        assert "['turno'] scrivibili" in caplog.text
+
+
+def test_scrittura_sul_posto_non_arriva_alla_tabella_condivisa(db):
+    db.save_table('Attivita', attivita_frame())
+    df = db.get_all('Attivita')
+    for col, val in [('minuti', 1.0), ('valore', 2.0), ('turno', 'FER')]:
+        try:
+            df.loc[0, col] = val                      # pandas 3: copy-on-write
+        except ValueError as e:                       # pandas 2.x: array condiviso in sola lettura
+            assert 'read-only' in str(e)
+    fresh = db.get_all('Attivita')
+    assert fresh.loc[0, 'minuti'] == 480.0 and fresh.loc[0, 'valore'] == 8.0
+    assert fresh.loc[0, 'turno'] == 'M78'
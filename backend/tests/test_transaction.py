@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+from conftest import attivita_frame
+
+
+def test_transaction_annullata_se_il_blocco_solleva(db):
+    db.save_table('Attivita', attivita_frame())
+    token = db.table_token('Attivita')
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.save_table('Attivita', attivita_frame().iloc[:2])
+            db.add_record('Note', {'testo': 'x'})
+            assert len(db.get_all('Attivita')) == 2    # dentro il blocco si vedono le copie in staging
+            raise RuntimeError('annulla')
+    assert db.table_token('Attivita') == token
+    assert len(db.get_all('Attivita')) == 5
+    assert len(db.get_all('Note')) == 0
+    assert db.journal_info()['entries'] == 0
+
+
+def test_transaction_commit_unico(db, monkeypatch):
+    scritture = []
+    orig = db.storage.write_tables
+
+    def spia(data, order):
+        scritture.append(sorted(data))
+        return orig(data, order)
+    monkeypatch.setattr(db.storage, 'write_tables', spia)
+
+    with db.transaction():
+        db.save_table('Attivita', attivita_frame())
+        with db.transaction():    # annidata: confluisce in quella esterna
+            db.save_table('tbl_UO', pd.DataFrame({'UO': ['UO_A', 'UO_B']}))
+        db.update_record('Attivita', 0, {'turno': 'RPD'})
+    assert scritture == [['Attivita', 'tbl_UO']]
+    # le operazioni di riga dentro il blocco finiscono nella tabella, non nel journal
+    assert db.journal_info()['entries'] == 0
+    assert db.get_all('Attivita').loc[0, 'turno'] == 'RPD'
+    assert db.get_all('tbl_UO')['UO'].tolist() == ['UO_A', 'UO_B']
@@ -0,0 +1,22 @@
+import pytest
+
+import database
+from conftest import attivita_frame
+
+
+def test_watcher_registra_senza_leggere_le_tabelle(db, monkeypatch):
+    db._watch_state = db._watch_snapshot()[0]
+    monkeypatch.setattr(database, 'current_session_id', lambda: 'sessione-a')
+    db.save_table('Attivita', attivita_frame())
+    db.add_record('Note', {'testo': 'x'})
+
+    def _no_read(*a, **k):
+        pytest.fail('il thread del watcher non deve leggere tabelle')
+    monkeypatch.setattr(db, 'get_many', _no_read)
+    monkeypatch.setattr(db, 'get_all', _no_read)
+    assert sorted(db._watch_poll()) == ['Attivita', 'Note']
+
+    seq, changed = db.changes_since(0)
+    assert sorted(changed) == ['Attivita', 'Note']
+    # la sessione che ha scritto non riceve l'avviso per le proprie modifiche
+    assert db.changes_since(0, session_id='sessione-a') == (seq, [])